@@ -10,11 +10,21 @@ ALTER TABLE lowlevel_json
   FOREIGN KEY (version)
   REFERENCES version (id);
 
+ALTER TABLE lowlevel_features
+  ADD CONSTRAINT lowlevel_features_fk_lowlevel
+  FOREIGN KEY (id)
+  REFERENCES lowlevel (id);
+
 ALTER TABLE highlevel
   ADD CONSTRAINT highlevel_fk_lowlevel
   FOREIGN KEY (id)
   REFERENCES lowlevel (id);
 
+ALTER TABLE highlevel_pending
+  ADD CONSTRAINT highlevel_pending_fk_lowlevel
+  FOREIGN KEY (id)
+  REFERENCES lowlevel (id);
+
 ALTER TABLE highlevel_meta
   ADD CONSTRAINT highlevel_meta_fk_highlevel
   FOREIGN KEY (id)
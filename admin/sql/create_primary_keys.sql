@@ -2,9 +2,12 @@ BEGIN;
 
 ALTER TABLE lowlevel ADD CONSTRAINT lowlevel_pkey PRIMARY KEY (id);
 ALTER TABLE lowlevel_json ADD CONSTRAINT lowlevel_json_pkey PRIMARY KEY (id);
+ALTER TABLE lowlevel_features ADD CONSTRAINT lowlevel_features_pkey PRIMARY KEY (id);
+ALTER TABLE submission_counter ADD CONSTRAINT submission_counter_pkey PRIMARY KEY (gid);
 ALTER TABLE highlevel ADD CONSTRAINT highlevel_pkey PRIMARY KEY (id);
 ALTER TABLE highlevel_meta ADD CONSTRAINT highlevel_meta_pkey PRIMARY KEY (id);
 ALTER TABLE highlevel_model ADD CONSTRAINT highlevel_model_pkey PRIMARY KEY (id);
+ALTER TABLE highlevel_pending ADD CONSTRAINT highlevel_pending_pkey PRIMARY KEY (id);
 ALTER TABLE model ADD CONSTRAINT model_pkey PRIMARY KEY (id);
 ALTER TABLE version ADD CONSTRAINT version_pkey PRIMARY KEY (id);
 ALTER TABLE statistics ADD CONSTRAINT statistics_pkey PRIMARY KEY (collected);
@@ -23,6 +26,7 @@ ALTER TABLE feedback ADD CONSTRAINT feedback_pkey PRIMARY KEY (user_id, highleve
 ALTER TABLE similarity.similarity ADD CONSTRAINT  similarity_pkey PRIMARY KEY (id);
 ALTER TABLE similarity.similarity_metrics ADD CONSTRAINT similarity_metrics_pkey PRIMARY KEY (metric);
 ALTER TABLE similarity.similarity_stats ADD CONSTRAINT similarity_stats_pkey PRIMARY KEY (metric);
+ALTER TABLE similarity.similarity_shards ADD CONSTRAINT similarity_shards_pkey PRIMARY KEY (start_id);
 ALTER TABLE similarity.eval_params ADD CONSTRAINT eval_params_pkey PRIMARY KEY (id);
 ALTER TABLE similarity.eval_results ADD CONSTRAINT eval_results_pkey PRIMARY KEY (id);
 
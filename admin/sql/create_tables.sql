@@ -10,6 +10,12 @@ CREATE TABLE lowlevel (
   submission_offset INTEGER   NOT NULL
 );
 
+-- The submission_offset to use for the next lowlevel submission of each gid
+CREATE TABLE submission_counter (
+  gid         UUID    NOT NULL,
+  next_offset INTEGER NOT NULL
+);
+
 CREATE TABLE lowlevel_json (
   id          INTEGER, -- FK to lowlevel.id
   data        JSONB    NOT NULL,
@@ -17,6 +23,33 @@ CREATE TABLE lowlevel_json (
   version     INTEGER  NOT NULL-- FK to version.id
 );
 
+-- Individual low-level features copied from lowlevel_json.data, so that they can be read
+-- without reading whole documents. Columns are named by the path of the feature in the document
+CREATE TABLE lowlevel_features (
+  id                                        INTEGER, -- FK to lowlevel.id
+  lowlevel_average_loudness                 JSONB,
+  lowlevel_dynamic_complexity               JSONB,
+  metadata_audio_properties_replay_gain     JSONB,
+  metadata_tags                             JSONB,
+  rhythm_beats_count                        JSONB,
+  rhythm_beats_loudness_mean                JSONB,
+  rhythm_bpm                                JSONB,
+  rhythm_bpm_histogram_first_peak_bpm_mean  JSONB,
+  rhythm_bpm_histogram_second_peak_bpm_mean JSONB,
+  rhythm_danceability                       JSONB,
+  rhythm_onset_rate                         JSONB,
+  tonal_chords_key                          JSONB,
+  tonal_chords_scale                        JSONB,
+  tonal_chords_changes_rate                 JSONB,
+  tonal_key_key                             JSONB,
+  tonal_key_scale                           JSONB,
+  tonal_key_strength                        JSONB,
+  tonal_tuning_frequency                    JSONB,
+  tonal_tuning_equal_tempered_deviation     JSONB,
+  metadata_version                          JSONB,
+  metadata_audio_properties                 JSONB
+);
+
 CREATE TABLE highlevel (
   id         INTEGER, -- FK to lowlevel.id
   mbid       UUID    NOT NULL,
@@ -30,6 +63,12 @@ CREATE TABLE highlevel_meta (
   data_sha256 CHAR(64) NOT NULL
 );
 
+-- lowlevel submissions which still need to be processed by the highlevel extractor
+CREATE TABLE highlevel_pending (
+  id            INTEGER, -- FK to lowlevel.id
+  claimed_until TIMESTAMP WITH TIME ZONE
+);
+
 CREATE TABLE highlevel_model (
   id          SERIAL,
   highlevel   INTEGER, -- FK to highlevel.id
@@ -187,6 +226,14 @@ CREATE TABLE similarity.similarity_stats (
   stddevs DOUBLE PRECISION[]
 );
 
+-- Progress of a parallel `add-metrics` run. Each row is a range of lowlevel.ids (start_id, end_id]
+-- which is processed by one worker, and last_id is the last id which has been added to similarity.similarity
+CREATE TABLE similarity.similarity_shards (
+  start_id INTEGER, -- PK
+  end_id   INTEGER NOT NULL,
+  last_id  INTEGER NOT NULL
+);
+
 CREATE TABLE similarity.eval_params (
   id            SERIAL, -- PK
   metric        TEXT, -- FK to similarity_metrics
@@ -2,7 +2,9 @@ BEGIN;
 
 ALTER TABLE lowlevel_json DROP CONSTRAINT IF EXISTS lowlevel_json_fk_lowlevel;
 ALTER TABLE lowlevel_json DROP CONSTRAINT IF EXISTS lowlevel_json_fk_version;
+ALTER TABLE lowlevel_features DROP CONSTRAINT IF EXISTS lowlevel_features_fk_lowlevel;
 ALTER TABLE highlevel     DROP CONSTRAINT IF EXISTS highlevel_fk_lowlevel;
+ALTER TABLE highlevel_pending DROP CONSTRAINT IF EXISTS highlevel_pending_fk_lowlevel;
 ALTER TABLE highlevel_meta DROP CONSTRAINT IF EXISTS highlevel_meta_fk_highlevel;
 ALTER TABLE highlevel_model DROP CONSTRAINT IF EXISTS highlevel_model_fk_highlevel;
 ALTER TABLE highlevel_model DROP CONSTRAINT IF EXISTS highlevel_model_fk_version;
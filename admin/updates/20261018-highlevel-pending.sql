@@ -0,0 +1,23 @@
+BEGIN;
+
+-- lowlevel submissions which still need to be processed by the highlevel extractor
+CREATE TABLE highlevel_pending (
+  id            INTEGER, -- FK to lowlevel.id
+  claimed_until TIMESTAMP WITH TIME ZONE
+);
+
+INSERT INTO highlevel_pending (id)
+     SELECT ll.id
+       FROM lowlevel AS ll
+  LEFT JOIN highlevel AS hl
+         ON ll.id = hl.id
+      WHERE hl.id IS NULL;
+
+ALTER TABLE highlevel_pending ADD CONSTRAINT highlevel_pending_pkey PRIMARY KEY (id);
+
+ALTER TABLE highlevel_pending
+  ADD CONSTRAINT highlevel_pending_fk_lowlevel
+  FOREIGN KEY (id)
+  REFERENCES lowlevel (id);
+
+COMMIT;
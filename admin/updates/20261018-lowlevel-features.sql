@@ -0,0 +1,39 @@
+BEGIN;
+
+-- Individual low-level features copied from lowlevel_json.data, so that they can be read
+-- without reading whole documents. Columns are named by the path of the feature in the document
+CREATE TABLE lowlevel_features (
+  id                                        INTEGER, -- FK to lowlevel.id
+  lowlevel_average_loudness                 JSONB,
+  lowlevel_dynamic_complexity               JSONB,
+  metadata_audio_properties_replay_gain     JSONB,
+  metadata_tags                             JSONB,
+  rhythm_beats_count                        JSONB,
+  rhythm_beats_loudness_mean                JSONB,
+  rhythm_bpm                                JSONB,
+  rhythm_bpm_histogram_first_peak_bpm_mean  JSONB,
+  rhythm_bpm_histogram_second_peak_bpm_mean JSONB,
+  rhythm_danceability                       JSONB,
+  rhythm_onset_rate                         JSONB,
+  tonal_chords_key                          JSONB,
+  tonal_chords_scale                        JSONB,
+  tonal_chords_changes_rate                 JSONB,
+  tonal_key_key                             JSONB,
+  tonal_key_scale                           JSONB,
+  tonal_key_strength                        JSONB,
+  tonal_tuning_frequency                    JSONB,
+  tonal_tuning_equal_tempered_deviation     JSONB,
+  metadata_version                          JSONB,
+  metadata_audio_properties                 JSONB
+);
+
+ALTER TABLE lowlevel_features ADD CONSTRAINT lowlevel_features_pkey PRIMARY KEY (id);
+
+ALTER TABLE lowlevel_features
+  ADD CONSTRAINT lowlevel_features_fk_lowlevel
+  FOREIGN KEY (id)
+  REFERENCES lowlevel (id);
+
+COMMIT;
+
+-- Existing submissions are copied to the table in batches with `./manage.py populate_lowlevel_features`
@@ -0,0 +1,13 @@
+BEGIN;
+
+-- Progress of a parallel `add-metrics` run. Each row is a range of lowlevel.ids (start_id, end_id]
+-- which is processed by one worker, and last_id is the last id which has been added to similarity.similarity
+CREATE TABLE similarity.similarity_shards (
+  start_id INTEGER, -- PK
+  end_id   INTEGER NOT NULL,
+  last_id  INTEGER NOT NULL
+);
+
+ALTER TABLE similarity.similarity_shards ADD CONSTRAINT similarity_shards_pkey PRIMARY KEY (start_id);
+
+COMMIT;
@@ -0,0 +1,17 @@
+BEGIN;
+
+-- The submission_offset to use for the next lowlevel submission of each gid
+CREATE TABLE submission_counter (
+  gid         UUID    NOT NULL,
+  next_offset INTEGER NOT NULL
+);
+
+INSERT INTO submission_counter (gid, next_offset)
+     SELECT gid
+          , MAX(submission_offset) + 1
+       FROM lowlevel
+   GROUP BY gid;
+
+ALTER TABLE submission_counter ADD CONSTRAINT submission_counter_pkey PRIMARY KEY (gid);
+
+COMMIT;
@@ -0,0 +1,69 @@
+"""Compare the throughput of single and bulk low-level submission.
+
+This benchmark writes documents to the database configured in config.py.
+Don't run it against a production database.
+
+    python -m benchmarks.submission run --documents 2000 --batch-size 100
+"""
+from __future__ import print_function
+
+import copy
+import json
+import os
+import time
+import uuid
+
+import click
+from flask.cli import FlaskGroup
+
+import db.data
+import webserver
+from db import gid_types
+from utils.list_utils import chunks
+
+TEST_DOCUMENT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "db", "test_data",
+                             "0dad432b-16cc-4bf0-8961-fd31d124b01b.json")
+
+cli = FlaskGroup(add_default_commands=False, create_app=webserver.create_app)
+
+
+def generate_documents(count):
+    """Make ``count`` distinct low-level documents, each for a new MBID, from the test document"""
+    with open(TEST_DOCUMENT) as fp:
+        template = json.load(fp)
+    documents = []
+    for i in range(count):
+        mbid = str(uuid.uuid4())
+        document = copy.deepcopy(template)
+        document["metadata"]["tags"]["musicbrainz_recordingid"] = [mbid]
+        document["lowlevel"]["average_loudness"] = i
+        documents.append((mbid, document))
+    return documents
+
+
+@cli.command(name="run")
+@click.option("--documents", "-n", type=int, default=1000, help="Number of documents to submit with each method.")
+@click.option("--batch-size", "-b", type=int, default=100, help="Number of documents per bulk submission.")
+def run(documents, batch_size):
+    """Submit documents one at a time and then in batches, and report documents per second."""
+    single = generate_documents(documents)
+    start = time.time()
+    for mbid, document in single:
+        db.data.submit_low_level_data(mbid, document, gid_types.GID_TYPE_MBID)
+    single_duration = time.time() - start
+
+    bulk = generate_documents(documents)
+    start = time.time()
+    for batch in chunks(bulk, batch_size):
+        db.data.submit_many_low_level_data(batch, gid_types.GID_TYPE_MBID)
+    bulk_duration = time.time() - start
+
+    click.echo("single: {} documents in {:.2f}s ({:.1f} documents/s)".format(
+        documents, single_duration, documents / single_duration))
+    click.echo("bulk:   {} documents in {:.2f}s ({:.1f} documents/s, batch size {})".format(
+        documents, bulk_duration, documents / bulk_duration, batch_size))
+    click.echo("speedup: {:.1f}x".format(single_duration / bulk_duration))
+
+
+if __name__ == '__main__':
+    cli()
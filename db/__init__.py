@@ -1,17 +1,164 @@
+import os
+import threading
+import time
+
 import sqlalchemy
 from flask import current_app
-from sqlalchemy import create_engine
-from sqlalchemy.pool import NullPool
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import NullPool, QueuePool
 
 # This value must be incremented after schema changes on replicated tables!
 SCHEMA_VERSION = 4
 
+# Default connection pool settings, used if they aren't set in config.py
+DEFAULT_POOL_SIZE = 5
+DEFAULT_POOL_MAX_OVERFLOW = 10
+DEFAULT_POOL_RECYCLE = 1800
+DEFAULT_POOL_TIMEOUT = 30
 
 engine = None
 
-def init_db_engine(connect_str):
+
+class _PoolStats(object):
+    """Counters of connection pool activity in this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.connects = 0
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+
+    def record_checkout_wait(self, duration, timed_out=False):
+        with self._lock:
+            self.checkout_wait_total += duration
+            self.checkout_wait_max = max(self.checkout_wait_max, duration)
+            if timed_out:
+                self.checkout_timeouts += 1
+
+    def increment(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+_pool_stats = _PoolStats()
+
+
+class _MeasuredQueuePool(QueuePool):
+    """A QueuePool which records how long it takes to get a connection from the pool"""
+
+    def _do_get(self):
+        start = time.time()
+        timed_out = False
+        try:
+            return super(_MeasuredQueuePool, self)._do_get()
+        except sqlalchemy.exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            _pool_stats.record_checkout_wait(time.time() - start, timed_out)
+
+
+def get_pool_options(config):
+    """Read connection pool settings from a flask config object.
+
+    Returns:
+        a dictionary of keyword arguments for :func:`init_db_engine`
+    """
+    return {
+        "pool_size": config.get("SQLALCHEMY_POOL_SIZE", DEFAULT_POOL_SIZE),
+        "max_overflow": config.get("SQLALCHEMY_POOL_MAX_OVERFLOW", DEFAULT_POOL_MAX_OVERFLOW),
+        "pool_recycle": config.get("SQLALCHEMY_POOL_RECYCLE", DEFAULT_POOL_RECYCLE),
+        "pool_timeout": config.get("SQLALCHEMY_POOL_TIMEOUT", DEFAULT_POOL_TIMEOUT),
+        "pool_pre_ping": config.get("SQLALCHEMY_POOL_PRE_PING", True),
+        "pgbouncer": config.get("SQLALCHEMY_PGBOUNCER", False),
+    }
+
+
+def init_db_engine(connect_str, pool_size=DEFAULT_POOL_SIZE, max_overflow=DEFAULT_POOL_MAX_OVERFLOW,
+                   pool_recycle=DEFAULT_POOL_RECYCLE, pool_timeout=DEFAULT_POOL_TIMEOUT, pool_pre_ping=True,
+                   pgbouncer=False):
+    """Create the database engine used by this process.
+
+    Connections are kept in a pool of ``pool_size`` connections which may grow by
+    ``max_overflow`` connections under load. Connections older than ``pool_recycle`` seconds
+    are replaced, and if ``pool_pre_ping`` is set each connection is checked before it is used.
+
+    If ``pgbouncer`` is set, or ``pool_size`` is 0, no connections are kept open and pooling is
+    left to pgbouncer (or whatever is at ``connect_str``).
+    """
     global engine
-    engine = create_engine(connect_str, poolclass=NullPool, executemany_mode='values', executemany_values_page_size=10000)
+    if engine is not None:
+        engine.dispose()
+
+    options = {"executemany_mode": 'values', "executemany_values_page_size": 10000}
+    if pgbouncer or not pool_size:
+        options["poolclass"] = NullPool
+    else:
+        options.update({"poolclass": _MeasuredQueuePool,
+                        "pool_size": pool_size,
+                        "max_overflow": max_overflow,
+                        "pool_recycle": pool_recycle,
+                        "pool_timeout": pool_timeout,
+                        "pool_pre_ping": pool_pre_ping})
+    engine = create_engine(connect_str, **options)
+
+    event.listen(engine, "connect", _on_connect)
+    event.listen(engine, "checkout", _on_checkout)
+
+
+def _on_connect(dbapi_connection, connection_record):
+    connection_record.info["pid"] = os.getpid()
+    _pool_stats.increment("connects")
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    # A connection opened before a fork must not be used by the child process, as both
+    # processes would then talk to the database over the same socket.
+    pid = os.getpid()
+    if connection_record.info["pid"] != pid:
+        connection_record.dbapi_connection = connection_proxy.dbapi_connection = None
+        raise sqlalchemy.exc.DisconnectionError(
+            "Connection record belongs to pid %s, attempting to check out in pid %s" %
+            (connection_record.info["pid"], pid))
+    _pool_stats.increment("checkouts")
+
+
+def _dispose_engine_after_fork():
+    # uwsgi loads the app in the master process and then forks its workers. Forget about
+    # (but don't close) any connections inherited from the parent so that each worker opens its own.
+    if engine is not None:
+        engine.dispose(close=False)
+    _pool_stats.reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_dispose_engine_after_fork)
+
+
+def get_pool_stats():
+    """Get connection pool activity for this process.
+
+    Returns:
+        a dictionary with the number of new connections made (connects), connections checked
+        out of the pool (checkouts), checkouts that timed out, and the total and maximum time
+        spent waiting for a connection in seconds. If the engine uses a pool, the pool size,
+        number of connections currently checked out and overflow are also included.
+    """
+    stats = {"connects": _pool_stats.connects,
+             "checkouts": _pool_stats.checkouts,
+             "checkout_timeouts": _pool_stats.checkout_timeouts,
+             "checkout_wait_total": _pool_stats.checkout_wait_total,
+             "checkout_wait_max": _pool_stats.checkout_wait_max}
+    if engine is not None and isinstance(engine.pool, QueuePool):
+        stats.update({"pool_size": engine.pool.size(),
+                      "checked_out": engine.pool.checkedout(),
+                      "overflow": engine.pool.overflow()})
+    return stats
 
 
 def run_sql_script(sql_file_path):
@@ -7,10 +7,14 @@ from collections import defaultdict
 from hashlib import sha256
 
 import sqlalchemy.exc
-from sqlalchemy import text
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
 
 import db
+import db.document_cache
 import db.exceptions
+from utils.lru_cache import LRUCache
 
 from six import ensure_binary
 
@@ -42,6 +46,118 @@ VERSION_TYPE_HIGHLEVEL = 'highlevel'
 
 MODEL_STATUSES = [STATUS_HIDDEN, STATUS_EVALUATION, STATUS_SHOW]
 
+# Result of writing a single item with write_many_low_level
+SUBMISSION_SAVED = 'saved'
+SUBMISSION_DUPLICATE = 'duplicate'
+SUBMISSION_REJECTED = 'rejected'
+
+# Number of seconds that a document claimed by the highlevel extractor is reserved for
+HIGHLEVEL_CLAIM_LEASE = 60 * 60
+
+# Separates the id and the document in each line written by copy_low_level_json
+LOW_LEVEL_COPY_DELIMITER = b"\x02"
+
+# Paths of the low-level features which are copied to the lowlevel_features table when a
+# document is written, so that individual features can be read without reading whole documents.
+# Each feature is stored as JSONB in a column named by lowlevel_feature_column
+LOWLEVEL_FEATURES = [
+    "lowlevel.average_loudness",
+    "lowlevel.dynamic_complexity",
+    "metadata.audio_properties.replay_gain",
+    "metadata.tags",
+    "rhythm.beats_count",
+    "rhythm.beats_loudness.mean",
+    "rhythm.bpm",
+    "rhythm.bpm_histogram_first_peak_bpm.mean",
+    "rhythm.bpm_histogram_second_peak_bpm.mean",
+    "rhythm.danceability",
+    "rhythm.onset_rate",
+    "tonal.chords_key",
+    "tonal.chords_scale",
+    "tonal.chords_changes_rate",
+    "tonal.key_key",
+    "tonal.key_scale",
+    "tonal.key_strength",
+    "tonal.tuning_frequency",
+    "tonal.tuning_equal_tempered_deviation",
+    "metadata.version",
+    "metadata.audio_properties",
+]
+
+# Number of lowlevel ids to copy to lowlevel_features in each transaction of populate_lowlevel_features
+LOWLEVEL_FEATURES_BATCH_SIZE = 10000
+
+
+# Rows in the `version` table never change once they are written, and there are only a few
+# distinct versions, so each process remembers (type, data_sha256) -> version.id
+VERSION_CACHE_SIZE = 256
+_version_cache = LRUCache(VERSION_CACHE_SIZE)
+
+# Each process also remembers (model, model_version) -> model.id for all rows in the `model` table
+MODEL_CACHE_SIZE = 1024
+_model_cache = LRUCache(MODEL_CACHE_SIZE)
+
+# and model.id -> model.class_mapping, used to map class names when loading high-level data.
+# Class mappings are only set by admin scripts, so processes must be restarted to see changes.
+_class_mapping_cache = LRUCache(MODEL_CACHE_SIZE)
+
+# Default value for cache lookups, to tell items that aren't cached from cached None values
+_NOT_CACHED = object()
+
+# Cache items for rows inserted in a transaction are kept on the connection until the transaction commits.
+# This is a dictionary {cache: {key: value}}
+_PENDING_CACHE_ITEMS_KEY = "pending_cache_items"
+
+
+@event.listens_for(Engine, "commit")
+def _add_pending_cache_items(connection):
+    pending = connection.info.pop(_PENDING_CACHE_ITEMS_KEY, None)
+    if pending:
+        for cache, items in pending.items():
+            for key, value in items.items():
+                cache.put(key, value)
+
+
+@event.listens_for(Engine, "rollback")
+def _discard_pending_cache_items(connection):
+    connection.info.pop(_PENDING_CACHE_ITEMS_KEY, None)
+
+
+@event.listens_for(Pool, "checkin")
+def _discard_pending_cache_items_on_checkin(dbapi_connection, connection_record):
+    # A connection returned to the pool without committing has its transaction rolled back
+    connection_record.info.pop(_PENDING_CACHE_ITEMS_KEY, None)
+
+
+def _cache_after_commit(connection, cache, key, value):
+    """Add an item to ``cache`` once the current transaction of ``connection`` commits.
+    If there is no transaction then the statement was autocommitted, and the item is added immediately."""
+    if connection.in_transaction():
+        pending = connection.info.setdefault(_PENDING_CACHE_ITEMS_KEY, {})
+        pending.setdefault(cache, {})[key] = value
+    else:
+        cache.put(key, value)
+
+
+def _get_pending_cache_item(connection, cache, key):
+    """Get an item added with :func:`_cache_after_commit` in the current transaction of ``connection``"""
+    return connection.info.get(_PENDING_CACHE_ITEMS_KEY, {}).get(cache, {}).get(key)
+
+
+def get_cache_stats():
+    """Get hit and miss counts of the version id, model id and class mapping caches in this process"""
+    return {"version": _version_cache.stats(),
+            "model": _model_cache.stats(),
+            "class_mapping": _class_mapping_cache.stats()}
+
+
+def clear_caches():
+    """Forget all cached version and model ids and class mappings. This must be called if rows
+    are removed from the `version` or `model` tables"""
+    _version_cache.clear()
+    _model_cache.clear()
+    _class_mapping_cache.clear()
+
 
 # TODO: Util methods should not be in the database package
 
@@ -94,19 +210,27 @@ def get_failed_highlevel_submissions():
 def remove_failed_highlevel_submissions():
     """Remove all highlevel rows with no matching highlevel_meta rows.
     These rows represent rows that failed highlevel processing. Removing the rows
-    will cause them to be processed again."""
+    and adding them to highlevel_pending will cause them to be processed again."""
 
-    with db.engine.connect() as connection:
+    with db.engine.begin() as connection:
         query = text("""
-                    DELETE
-                      FROM highlevel
-                     WHERE highlevel.id
-                        IN (SELECT highlevel.id
-                              FROM highlevel
-                         LEFT JOIN highlevel_meta
-                             USING (id)
-                             WHERE highlevel_meta.id is null
-                           )
+                    WITH removed AS (
+                        DELETE
+                          FROM highlevel
+                         WHERE highlevel.id
+                            IN (SELECT highlevel.id
+                                  FROM highlevel
+                             LEFT JOIN highlevel_meta
+                                 USING (id)
+                                 WHERE highlevel_meta.id is null
+                               )
+                     RETURNING id
+                    )
+                    INSERT INTO highlevel_pending (id)
+                         SELECT id
+                           FROM removed
+                    ON CONFLICT (id)
+                     DO NOTHING
                     """)
         connection.execute(query)
 
@@ -148,6 +272,68 @@ def submit_low_level_data(mbid, data, gid_type, max_duplicate_submissions=None):
           don't add it to the database and return without an error.
     """
     mbid = str(mbid)
+    data = _prepare_low_level_data(mbid, data)
+
+    # The data looks good, lets see about saving it
+    write_low_level(mbid, data, gid_type, max_duplicate_submissions)
+
+
+def submit_many_low_level_data(submissions, gid_type, max_duplicate_submissions=None):
+    """Submit many low-level documents at once.
+
+    Each document is checked in the same way as in :func:`submit_low_level_data`. Documents
+    which fail these checks are rejected, and all remaining documents are written to the
+    database in a single transaction with :func:`write_many_low_level`, which can also reject them.
+
+    Args:
+        submissions: a list of (mbid, data) tuples
+        gid_type: the ID type [musicbrainzid(mbid) or messybrainzid(msid)]
+        max_duplicate_submissions: if set, the maximum number of duplicate submissions for a single
+          mbid to accept in the database.
+
+    Returns:
+        a list of (status, message) tuples, one for each item of ``submissions``, in the same order.
+        status is one of SUBMISSION_SAVED, SUBMISSION_DUPLICATE or SUBMISSION_REJECTED. message is
+        a description of why the item was rejected, or None
+    """
+    results = [None] * len(submissions)
+    to_write = []
+    positions = []
+    for position, (mbid, data) in enumerate(submissions):
+        mbid = str(mbid)
+        try:
+            if not isinstance(data, dict):
+                raise db.exceptions.BadDataException("Submitted data must be a JSON object.")
+            data = _prepare_low_level_data(mbid, data)
+        except KeyError as e:
+            results[position] = (SUBMISSION_REJECTED, "Key '%s' was not found in submitted data." % e.args[0])
+            continue
+        except db.exceptions.BadDataException as e:
+            results[position] = (SUBMISSION_REJECTED, "%s" % e)
+            continue
+        to_write.append((mbid, data))
+        positions.append(position)
+
+    for position, result in zip(positions, write_many_low_level(to_write, gid_type, max_duplicate_submissions)):
+        results[position] = result
+
+    return results
+
+
+def _prepare_low_level_data(mbid, data):
+    """Clean up a submitted low-level document and check that it is valid.
+
+    Args:
+        mbid: MusicBrainz ID of the recording that corresponds to the data.
+        data: Low-level data about the recording.
+
+    Returns:
+        the cleaned data
+
+    Raises:
+        BadDataException: if required keys are missing or the recording id in the data
+          doesn't match ``mbid``
+    """
     data = clean_metadata(data)
 
     try:
@@ -180,14 +366,27 @@ def submit_low_level_data(mbid, data, gid_type, max_duplicate_submissions=None):
             "part of this resource URL."
         )
 
-    # The data looks good, lets see about saving it
-    write_low_level(mbid, data, gid_type, max_duplicate_submissions)
+    return data
 
 
 def insert_version(connection, data, version_type):
-    # TODO: Memoise sha -> id
+    """Get the id of a version row with the given data, adding it if it doesn't exist.
+
+    Ids are cached in this process. A version that is added is only cached once the
+    transaction on ``connection`` commits, so a rollback never leaves an id in the cache
+    for a row that doesn't exist.
+    """
     norm_data = json.dumps(data, sort_keys=True, separators=(',', ':'))
     sha = sha256(ensure_binary(norm_data)).hexdigest()
+    key = (version_type, sha)
+    version_id = _version_cache.get(key)
+    if version_id is not None:
+        return version_id
+
+    version_id = _get_pending_cache_item(connection, _version_cache, key)
+    if version_id is not None:
+        return version_id
+
     query = text("""
             SELECT id
               FROM version
@@ -196,6 +395,7 @@ def insert_version(connection, data, version_type):
     result = connection.execute(query, {"data_sha256": sha, "version_type": version_type})
     row = result.fetchone()
     if row:
+        _version_cache.put(key, row[0])
         return row[0]
 
     result = connection.execute(
@@ -205,6 +405,7 @@ def insert_version(connection, data, version_type):
         {"data": norm_data, "sha": sha, "version_type": version_type}
     )
     row = result.fetchone()
+    _cache_after_commit(connection, _version_cache, key, row[0])
     return row[0]
 
 
@@ -257,51 +458,409 @@ def write_low_level(mbid, data, is_mbid, max_duplicate_submissions=None):
             return
 
         try:
-            submission_offset = get_next_submission_offset(connection, mbid)
-            if max_duplicate_submissions is not None and submission_offset >= max_duplicate_submissions:
+            submission_offset = reserve_submission_offset(connection, mbid, max_duplicate_submissions)
+            if submission_offset is None:
                 return
 
             ll_id = _insert_lowlevel(connection, mbid, build_sha1, is_lossless_submit, is_mbid, submission_offset)
             version_id = insert_version(connection, version, VERSION_TYPE_LOWLEVEL)
             _insert_lowlevel_json(connection, ll_id, data_json, data_sha256, version_id)
+            add_lowlevel_features(connection, [(ll_id, data)])
+            add_highlevel_pending(connection, [ll_id])
             logging.info("Saved %s" % mbid)
         except sqlalchemy.exc.DataError as e:
             raise db.exceptions.BadDataException(
                 "data is badly formed")
 
 
+def write_many_low_level(submissions, gid_type, max_duplicate_submissions=None):
+    """Write many low-level documents to the database in a single transaction.
+
+    This is the batched version of :func:`write_low_level`. Instead of running a set of
+    queries for each document, existing documents are found with one query, submission
+    offsets for all MBIDs are allocated with one query, and the ``lowlevel``, ``lowlevel_json``
+    and ``lowlevel_features`` rows are written with one multi-row INSERT each.
+
+    If the database can't store one of the documents, the multi-row INSERTs are rolled back
+    and each document is written separately, so that only the documents which can't be
+    stored are rejected.
+
+    Args:
+        submissions: a list of (mbid, data) tuples. The data should already have been
+          checked with :func:`sanity_check_data`
+        gid_type: the ID type of all submissions [musicbrainzid(mbid) or messybrainzid(msid)]
+        max_duplicate_submissions: if set, the maximum number of duplicate submissions for a single
+          mbid to accept in the database. Items over this limit are rejected.
+
+    Returns:
+        a list of (status, message) tuples, one for each item of ``submissions``, in the same order.
+        status is SUBMISSION_SAVED if the item was written, SUBMISSION_DUPLICATE if the exact same
+        document already exists (in the database or earlier in ``submissions``), or
+        SUBMISSION_REJECTED if the MBID already has ``max_duplicate_submissions`` submissions
+        or the document is badly formed. message is a description of why the item was rejected, or None
+    """
+    statuses = [None] * len(submissions)
+    items = []
+    seen_shas = set()
+    for position, (mbid, data) in enumerate(submissions):
+        data_json = json.dumps(data, sort_keys=True, separators=(',', ':'))
+        data_sha256 = sha256(ensure_binary(data_json)).hexdigest()
+        if data_sha256 in seen_shas:
+            statuses[position] = (SUBMISSION_DUPLICATE, None)
+            continue
+        seen_shas.add(data_sha256)
+        items.append({"position": position,
+                      "mbid": str(mbid).lower(),
+                      "data": data,
+                      "data_json": data_json,
+                      "data_sha256": data_sha256})
+
+    if not items:
+        return statuses
+
+    with db.engine.begin() as connection:
+        query = text("""
+            SELECT data_sha256
+              FROM lowlevel_json
+             WHERE data_sha256 IN :data_sha256s
+        """)
+        result = connection.execute(query, {"data_sha256s": tuple(seen_shas)})
+        existing_shas = {row["data_sha256"] for row in result}
+
+        new_items = [item for item in items if item["data_sha256"] not in existing_shas]
+        for item in items:
+            if item["data_sha256"] in existing_shas:
+                statuses[item["position"]] = (SUBMISSION_DUPLICATE, None)
+        if not new_items:
+            return statuses
+
+        counts = defaultdict(int)
+        for item in new_items:
+            counts[item["mbid"]] += 1
+        offsets = reserve_submission_offsets(connection, counts, max_duplicate_submissions)
+
+        rows = []
+        for item in new_items:
+            if not offsets[item["mbid"]]:
+                statuses[item["position"]] = (SUBMISSION_REJECTED,
+                                              "The maximum number of submissions for this MBID has been reached.")
+                continue
+            submission_offset = offsets[item["mbid"]].pop(0)
+
+            version = item["data"]['metadata']['version']
+
+            rows.append({"position": item["position"],
+                         "gid": item["mbid"],
+                         "build_sha1": version['essentia_build_sha'],
+                         "lossless": item["data"]['metadata']['audio_properties']['lossless'],
+                         "gid_type": gid_type,
+                         "submission_offset": submission_offset,
+                         "data": item["data_json"],
+                         "document": item["data"],
+                         "data_sha256": item["data_sha256"],
+                         "version": insert_version(connection, version, VERSION_TYPE_LOWLEVEL)})
+
+        if not rows:
+            return statuses
+
+        try:
+            with connection.begin_nested():
+                _insert_low_level_rows(connection, rows)
+            saved = rows
+        except sqlalchemy.exc.DataError:
+            # Find the documents which can't be stored by writing each one in its own savepoint.
+            # Offsets are given to the documents which are saved in order, so that rejected
+            # documents don't leave gaps, and the offsets left over are given back.
+            unused_offsets = defaultdict(list)
+            for row in rows:
+                unused_offsets[row["gid"]].append(row["submission_offset"])
+            saved = []
+            for row in rows:
+                row["submission_offset"] = unused_offsets[row["gid"]].pop(0)
+                try:
+                    with connection.begin_nested():
+                        _insert_low_level_rows(connection, [row])
+                    saved.append(row)
+                except sqlalchemy.exc.DataError:
+                    unused_offsets[row["gid"]].insert(0, row["submission_offset"])
+                    statuses[row["position"]] = (SUBMISSION_REJECTED, "data is badly formed")
+            for gid, offsets in unused_offsets.items():
+                if offsets:
+                    release_submission_offsets(connection, gid, offsets[0])
+
+    for row in saved:
+        statuses[row["position"]] = (SUBMISSION_SAVED, None)
+    logging.info("Saved %s low-level documents" % len(saved))
+    return statuses
+
+
+def _insert_low_level_rows(connection, rows):
+    """Write the ``lowlevel``, ``lowlevel_json`` and ``lowlevel_features`` rows of some
+    low-level documents, and mark them as waiting for high-level data.
+
+    Args:
+        connection: an open database connection
+        rows: a list of dictionaries of the values of each document, prepared by
+          :func:`write_many_low_level`. The ``id`` of each new ``lowlevel`` row is added to them.
+
+    Raises:
+        sqlalchemy.exc.DataError: if one of the documents can't be stored
+    """
+    values, params = _multi_row_values(rows, ["gid", "build_sha1", "lossless", "gid_type", "submission_offset"])
+    query = text("""
+        INSERT INTO lowlevel (gid, build_sha1, lossless, gid_type, submission_offset)
+             VALUES %s
+          RETURNING id, gid::text, submission_offset
+    """ % values)
+    result = connection.execute(query, params)
+    # (gid, submission_offset) is unique within a batch, use it to match up the returned ids
+    ids = {(row["gid"], row["submission_offset"]): row["id"] for row in result}
+    for row in rows:
+        row["id"] = ids[(row["gid"], row["submission_offset"])]
+
+    values, params = _multi_row_values(rows, ["id", "data", "data_sha256", "version"])
+    query = text("""
+        INSERT INTO lowlevel_json (id, data, data_sha256, version)
+             VALUES %s
+    """ % values)
+    connection.execute(query, params)
+
+    add_lowlevel_features(connection, [(row["id"], row["document"]) for row in rows])
+    add_highlevel_pending(connection, [row["id"] for row in rows])
+
+
+def _multi_row_values(rows, columns):
+    """Build the VALUES list of a multi-row INSERT statement.
+
+    Args:
+        rows: a list of dictionaries, each containing a value for every item in ``columns``
+        columns: the names of the columns to insert, in the order they appear in the INSERT statement
+
+    Returns:
+        a tuple (values, params) where ``values`` is a string of the form
+        ``(:col1_0, :col2_0), (:col1_1, :col2_1)`` to be used after VALUES in a query,
+        and ``params`` is a dictionary of the query parameters used in ``values``
+    """
+    values = []
+    params = {}
+    for i, row in enumerate(rows):
+        placeholders = []
+        for column in columns:
+            key = "%s_%d" % (column, i)
+            params[key] = row[column]
+            placeholders.append(":" + key)
+        values.append("(%s)" % ", ".join(placeholders))
+    return ", ".join(values), params
+
+
+def lowlevel_feature_column(feature):
+    """The name of the column of the lowlevel_features table which holds a feature
+    from :py:const:`LOWLEVEL_FEATURES`, e.g. rhythm.bpm -> rhythm_bpm"""
+    return feature.replace(".", "_")
+
+
+def _get_lowlevel_feature(data, feature):
+    """Get a feature from a low-level document by its path, or None if it's not in the document"""
+    for key in feature.split("."):
+        if not isinstance(data, dict) or key not in data:
+            return None
+        data = data[key]
+    return data
+
+
+def add_lowlevel_features(connection, documents):
+    """Copy the features in :py:const:`LOWLEVEL_FEATURES` from low-level documents
+    to the lowlevel_features table.
+
+    Args:
+        connection: a connection to the database, in the transaction which writes the documents
+        documents: a list of (lowlevel.id, low-level document) tuples
+    """
+    columns = [lowlevel_feature_column(feature) for feature in LOWLEVEL_FEATURES]
+    rows = []
+    for ll_id, data in documents:
+        row = {"id": ll_id}
+        for feature, column in zip(LOWLEVEL_FEATURES, columns):
+            value = _get_lowlevel_feature(data, feature)
+            row[column] = json.dumps(value) if value is not None else None
+        rows.append(row)
+    if not rows:
+        return
+
+    values, params = _multi_row_values(rows, ["id"] + columns)
+    query = text("""
+        INSERT INTO lowlevel_features (id, %s)
+             VALUES %s
+    """ % (", ".join(columns), values))
+    connection.execute(query, params)
+
+
+def populate_lowlevel_features(batch_size=LOWLEVEL_FEATURES_BATCH_SIZE):
+    """Copy features of all low-level submissions which aren't in the lowlevel_features
+    table yet. This is only needed after importing a data dump or adding the table,
+    submissions made through the API are copied when they are written.
+
+    The features are copied in ranges of ``batch_size`` lowlevel ids, with a transaction for each range.
+
+    Returns:
+        the number of submissions that were copied
+    """
+    columns = [lowlevel_feature_column(feature) for feature in LOWLEVEL_FEATURES]
+    paths = ["llj.data" + "".join("->'%s'" % key for key in feature.split("."))
+             for feature in LOWLEVEL_FEATURES]
+    query = text("""
+        INSERT INTO lowlevel_features (id, %s)
+             SELECT llj.id, %s
+               FROM lowlevel_json AS llj
+          LEFT JOIN lowlevel_features AS llf
+                 ON llj.id = llf.id
+              WHERE llj.id >= :start
+                AND llj.id < :end
+                AND llf.id IS NULL
+    """ % (", ".join(columns), ", ".join(paths)))
+
+    with db.engine.connect() as connection:
+        result = connection.execute(text("SELECT min(id), max(id) FROM lowlevel_json"))
+        min_id, max_id = result.fetchone()
+    if min_id is None:
+        return 0
+
+    num_added = 0
+    for start in range(min_id, max_id + 1, batch_size):
+        with db.engine.begin() as connection:
+            result = connection.execute(query, {"start": start, "end": start + batch_size})
+            num_added += result.rowcount
+    return num_added
+
+
+def reserve_submission_offsets(connection, counts, max_duplicate_submissions=None):
+    """Reserve submission offsets for new submissions of many MBIDs with a single query.
+
+    Offsets are taken from the submission_counter table, which holds the next offset of each MBID.
+    Counter rows stay locked until the transaction of ``connection`` ends, so concurrent
+    submissions for the same MBID get different offsets, and offsets are given back if the
+    transaction is rolled back.
+
+    Args:
+        connection: a connection to the database, in a transaction
+        counts: a dictionary {mbid: number of offsets to reserve}
+        max_duplicate_submissions: if set, don't reserve offsets greater than or equal to this value
+
+    Returns:
+        a dictionary {mbid: list of offsets}. If the limit set by ``max_duplicate_submissions`` is reached,
+        fewer offsets than requested are returned for an MBID
+    """
+    counts = {str(mbid).lower(): count for mbid, count in counts.items()}
+    if not counts:
+        return {}
+    # Lock counter rows in the same order in every transaction so that concurrent batches can't deadlock
+    rows = [{"gid": gid, "count": counts[gid]} for gid in sorted(counts)]
+    values, params = _multi_row_values(rows, ["gid", "count"])
+    query = text("""
+        INSERT INTO submission_counter AS sc (gid, next_offset)
+             VALUES %s
+        ON CONFLICT (gid)
+      DO UPDATE SET next_offset = sc.next_offset + EXCLUDED.next_offset
+          RETURNING gid::text, next_offset
+    """ % values)
+    result = connection.execute(query, params)
+
+    offsets = {}
+    for row in result.fetchall():
+        first = row["next_offset"] - counts[row["gid"]]
+        end = row["next_offset"]
+        if max_duplicate_submissions is not None and end > max_duplicate_submissions:
+            # Give back the offsets that can't be used
+            end = max(first, max_duplicate_submissions)
+            release_submission_offsets(connection, row["gid"], end)
+        offsets[row["gid"]] = list(range(first, end))
+    return offsets
+
+
+def release_submission_offsets(connection, mbid, next_offset):
+    """Give back the offsets from ``next_offset`` onwards which were reserved for mbid by
+    :func:`reserve_submission_offsets` in the transaction of ``connection``, but not used.
+
+    Args:
+        connection: a connection to the database, in the transaction which reserved the offsets
+        mbid: the MBID whose offsets are given back
+        next_offset: the first offset to give back, which is the next offset of mbid afterwards
+    """
+    query = text("""
+        UPDATE submission_counter
+           SET next_offset = :next_offset
+         WHERE gid = :gid
+    """)
+    connection.execute(query, {"gid": str(mbid).lower(), "next_offset": next_offset})
+
+
+def reserve_submission_offset(connection, mbid, max_duplicate_submissions=None):
+    """Reserve the submission offset for a new submission of mbid.
+    See :func:`reserve_submission_offsets`.
+
+    Returns:
+        the offset, or None if mbid already has ``max_duplicate_submissions`` submissions
+    """
+    [offsets] = reserve_submission_offsets(connection, {mbid: 1}, max_duplicate_submissions).values()
+    return offsets[0] if offsets else None
+
+
 def get_next_submission_offset(connection, mbid):
-    """Get highest existing submission offset for mbid, then increment.
+    """Get the offset that the next submission for mbid will have.
     If the mbid doesn't exist in the database, return an offset of 0"""
     query = text("""
-        SELECT MAX(submission_offset) as max_offset
-          FROM lowlevel
+        SELECT next_offset
+          FROM submission_counter
          WHERE gid = :mbid
     """)
-    result = connection.execute(query, {"mbid": mbid})
+    result = connection.execute(query, {"mbid": str(mbid)})
 
     row = result.fetchone()
-    if row["max_offset"] is not None:
-        return row["max_offset"] + 1
+    if row is not None:
+        return row["next_offset"]
     else:
         # No previous submission
         return 0
 
 
+def update_submission_counters():
+    """Set the counters of the submission_counter table from the submission offsets in the lowlevel table.
+    Submissions made through the API update the counters as they are written, this is only needed
+    after importing a data dump.
+    """
+    with db.engine.begin() as connection:
+        query = text("""
+            INSERT INTO submission_counter AS sc (gid, next_offset)
+                 SELECT gid
+                      , MAX(submission_offset) + 1
+                   FROM lowlevel
+               GROUP BY gid
+            ON CONFLICT (gid)
+          DO UPDATE SET next_offset = GREATEST(sc.next_offset, EXCLUDED.next_offset)
+        """)
+        connection.execute(query)
+
+
 def add_model(model_name, model_version, model_status=STATUS_HIDDEN):
     if model_status not in MODEL_STATUSES:
         raise Exception("model_status must be one of %s" % ",".join(MODEL_STATUSES))
     with db.engine.begin() as connection:
-        query = text(
-            """INSERT INTO model (model, model_version, status)
-                    VALUES (:model_name, :model_version, :model_status)
-                 RETURNING id"""
-        )
-        result = connection.execute(query,
-                                    {"model_name": model_name,
-                                     "model_version": model_version,
-                                     "model_status": model_status})
-        return result.fetchone()[0]
+        return _insert_model(connection, model_name, model_version, model_status)
+
+
+def _insert_model(connection, model_name, model_version, model_status):
+    query = text(
+        """INSERT INTO model (model, model_version, status)
+                VALUES (:model_name, :model_version, :model_status)
+             RETURNING id"""
+    )
+    result = connection.execute(query,
+                                {"model_name": model_name,
+                                 "model_version": model_version,
+                                 "model_status": model_status})
+    model_id = result.fetchone()[0]
+    _cache_after_commit(connection, _model_cache, (model_name, model_version), model_id)
+    return model_id
 
 
 def set_model_status(model_name, model_version, model_status):
@@ -318,6 +877,8 @@ def set_model_status(model_name, model_version, model_status):
                            {"model_name": model_name,
                             "model_version": model_version,
                             "model_status": model_status})
+    # Cached high-level documents only include models with a status of 'show'
+    db.document_cache.invalidate_high_level()
 
 
 def get_active_models():
@@ -348,13 +909,45 @@ def _get_model_id(model_name, version):
             return None
 
 
+def _load_model_cache(connection):
+    """Add the ids of all models in the `model` table to the model id cache.
+    Models that were added in the current transaction of ``connection`` aren't committed yet, and are skipped."""
+    result = connection.execute(text("""SELECT id, model, model_version FROM model"""))
+    for row in result:
+        key = (row["model"], row["model_version"])
+        if _get_pending_cache_item(connection, _model_cache, key) is None:
+            _model_cache.put(key, row["id"])
+
+
+def get_or_add_model_id(connection, model_name, model_version):
+    """Get the id of a model, adding it with a status of hidden if it doesn't exist.
+
+    Ids are looked up in a cache of the `model` table. If a model isn't in the cache the table is
+    loaded again in case another process has added it. A new model is added using ``connection``,
+    so that it is part of the caller's transaction.
+    """
+    key = (model_name, model_version)
+    model_id = _model_cache.get(key)
+    if model_id is not None:
+        return model_id
+
+    model_id = _get_pending_cache_item(connection, _model_cache, key)
+    if model_id is not None:
+        return model_id
+
+    _load_model_cache(connection)
+    model_id = _model_cache.get(key)
+    if model_id is not None:
+        return model_id
+
+    return _insert_model(connection, model_name, model_version, STATUS_HIDDEN)
+
+
 def write_high_level_item(connection, model_name, model_version, ll_id, version_id, data):
     item_norm_data = json.dumps(data, sort_keys=True, separators=(',', ':'))
     item_sha = sha256(ensure_binary(item_norm_data)).hexdigest()
 
-    model_id = _get_model_id(model_name, model_version)
-    if model_id is None:
-        model_id = add_model(model_name, model_version)
+    model_id = get_or_add_model_id(connection, model_name, model_version)
 
     item_q = text(
         """INSERT INTO highlevel_model (highlevel, data, data_sha256, model, version)
@@ -407,6 +1000,7 @@ def write_high_level(mbid, ll_id, data, build_sha1):
         json_high = data.get("highlevel", {})
 
         write_high_level_meta(connection, ll_id, mbid, build_sha1, json_meta)
+        remove_highlevel_pending(connection, [ll_id])
 
         if json_meta and json_high:
             hl_version = json_meta["version"]["highlevel"]
@@ -417,6 +1011,91 @@ def write_high_level(mbid, ll_id, data, build_sha1):
                 write_high_level_item(connection, model_name, model_version, ll_id, version_id, data)
 
 
+def write_many_high_level(batch, build_sha1):
+    """Write highlevel data for many submissions in a single transaction.
+
+    This is the batched version of :func:`write_high_level`. Rows for the whole batch are
+    written to each of the highlevel, highlevel_meta and highlevel_model tables with
+    one multi-row INSERT per table.
+
+    As with write_high_level, an item with empty data still gets a highlevel table
+    entry so that it is no longer processed by the highlevel runner, and highlevel_meta
+    is only written if the highlevel row doesn't already exist.
+
+    Arguments:
+        batch: a list of (ll_id, mbid, data) tuples, as returned by
+          :func:`hl_extractor.hl_calc.process_lowlevel_data`
+        build_sha1: the sha1 of the highlevel extractor used
+    """
+    if not batch:
+        return
+
+    with db.engine.begin() as connection:
+        rows = [{"id": ll_id, "mbid": mbid, "build_sha1": build_sha1} for ll_id, mbid, _ in batch]
+        values, params = _multi_row_values(rows, ["id", "mbid", "build_sha1"])
+        query = text("""
+            INSERT INTO highlevel (id, mbid, build_sha1)
+                 VALUES %s
+            ON CONFLICT (id)
+             DO NOTHING
+              RETURNING id
+        """ % values)
+        result = connection.execute(query, params)
+        # If a highlevel row already exists we don't add highlevel_meta (new model for existing highlevel)
+        new_ids = {row["id"] for row in result}
+        remove_highlevel_pending(connection, [ll_id for ll_id, _, _ in batch])
+
+        meta_rows = []
+        model_rows = []
+        for ll_id, mbid, data in batch:
+            json_meta = data.get("metadata", {})
+            json_high = data.get("highlevel", {})
+
+            if json_meta and ll_id in new_ids:
+                meta_norm_data = json.dumps(json_meta, sort_keys=True, separators=(',', ':'))
+                meta_rows.append({"id": ll_id,
+                                  "data": meta_norm_data,
+                                  "data_sha256": sha256(ensure_binary(meta_norm_data)).hexdigest()})
+
+            if json_meta and json_high:
+                hl_version = json_meta["version"]["highlevel"]
+                version_id = insert_version(connection, hl_version, VERSION_TYPE_HIGHLEVEL)
+                model_version = hl_version["models_essentia_git_sha"]
+
+                for model_name, model_data in json_high.items():
+                    item_norm_data = json.dumps(model_data, sort_keys=True, separators=(',', ':'))
+                    model_rows.append({"highlevel": ll_id,
+                                       "data": item_norm_data,
+                                       "data_sha256": sha256(ensure_binary(item_norm_data)).hexdigest(),
+                                       "model": get_or_add_model_id(connection, model_name, model_version),
+                                       "version": version_id})
+
+        if meta_rows:
+            values, params = _multi_row_values(meta_rows, ["id", "data", "data_sha256"])
+            query = text("""
+                INSERT INTO highlevel_meta (id, data, data_sha256)
+                     VALUES %s
+            """ % values)
+            connection.execute(query, params)
+
+        if model_rows:
+            values, params = _multi_row_values(model_rows, ["highlevel", "data", "data_sha256", "model", "version"])
+            query = text("""
+                INSERT INTO highlevel_model (highlevel, data, data_sha256, model, version)
+                     VALUES %s
+            """ % values)
+            connection.execute(query, params)
+
+
+def _recordings_as_arrays(recordings):
+    """Make query parameters for a list of (mbid, offset) tuples, to be used with
+    ``unnest(CAST(:gids AS uuid[]), CAST(:offsets AS integer[]))``.
+    A pair of arrays keeps the query text the same size for any number of recordings,
+    unlike an IN list with a parameter per item."""
+    return {"gids": [str(mbid) for mbid, _ in recordings],
+            "offsets": [int(offset) for _, offset in recordings]}
+
+
 def load_low_level(mbid, offset=0):
     """Load lowlevel data with the given mbid as a dictionary.
     If no offset is given, return the first. If an offset is
@@ -455,28 +1134,113 @@ def load_many_low_level(recordings):
          "mbid-n": {"offset-1": lowlevel_data}
         }
 
+        Documents are read from the document cache if possible, and added to it if not.
+    """
+    return _load_many_through_cache(recordings,
+                                    db.document_cache.get_many_low_level,
+                                    db.document_cache.set_many_low_level,
+                                    _load_many_low_level_from_db)
+
+
+def _load_many_through_cache(recordings, get_cached, set_cached, load):
+    """Get documents for recordings from the document cache, load the ones that
+    aren't cached with ``load`` and add them to the cache.
+
+    Arguments:
+        recordings: A list of tuples (mbid, offset)
+        get_cached: a function taking a list of (mbid, offset) tuples and returning a
+            dictionary {(mbid, offset): document} of the cached documents
+        set_cached: a function taking a dictionary {(mbid, offset): document} to cache
+        load: a function taking a list of (mbid, offset) tuples and returning a
+            dictionary {mbid: {offset: document}}
+
+    Returns:
+        A dictionary {mbid: {offset: document}} in the format of ``load``
     """
+    keys = {}
+    for mbid, offset in recordings:
+        keys.setdefault((str(mbid).lower(), int(offset)), (mbid, offset))
+    cached = get_cached(list(keys))
+
+    missing = [recording for key, recording in keys.items() if key not in cached]
+    loaded = load(missing) if missing else {}
+    set_cached({(mbid, int(offset)): document
+                for mbid, documents in loaded.items()
+                for offset, document in documents.items()})
+
+    recordings_info = defaultdict(dict, loaded)
+    for (mbid, offset), document in cached.items():
+        recordings_info[mbid][str(offset)] = document
+    return dict(recordings_info)
+
+
+def _load_many_low_level_from_db(recordings, as_json=False):
+    # With as_json, the documents are read as text to avoid psycopg2 decoding them, and
+    # are then serialized in the API format, which differs from the text format of jsonb
+    data_column = "llj.data::text AS data" if as_json else "llj.data"
     with db.engine.connect() as connection:
         query = text("""
             SELECT ll.gid::text,
                    ll.submission_offset::text,
-                   llj.data
-              FROM lowlevel ll
+                   %s
+              FROM unnest(CAST(:gids AS uuid[]), CAST(:offsets AS integer[])) AS r (gid, submission_offset)
+              JOIN lowlevel ll
+                ON ll.gid = r.gid
+               AND ll.submission_offset = r.submission_offset
               JOIN lowlevel_json llj
                 ON ll.id = llj.id
-             WHERE (ll.gid, ll.submission_offset) 
-                IN :recordings
-        """)
+        """ % data_column)
 
-        result = connection.execute(query, {'recordings': tuple(recordings)})
+        result = connection.execute(query, _recordings_as_arrays(recordings))
 
         recordings_info = defaultdict(dict)
         for row in result:
-            recordings_info[row['gid']][row['submission_offset']] = row['data']
+            data = row['data']
+            if as_json:
+                data = db.document_cache.dumps(json.loads(data))
+            recordings_info[row['gid']][row['submission_offset']] = data
 
         return dict(recordings_info)
 
 
+def load_low_level_json(mbid, offset=0):
+    """Load lowlevel data with the given mbid as JSON in the format of :func:`db.document_cache.dumps`.
+
+    Arguments:
+        mbid (str): MBID to load
+        offset (int): submission offset for this MBID, starting from 0
+
+    Raises:
+        NoDataFoundException: if this mbid doesn't exist or the offset is too high"""
+
+    mbid = str(mbid).lower()
+    result = load_many_low_level_json([(mbid, offset)])
+    if not result:
+        raise db.exceptions.NoDataFoundException
+
+    return result[mbid][str(offset)]
+
+
+def load_many_low_level_json(recordings):
+    """Collect low-level data for multiple recordings as JSON in the format of :func:`db.document_cache.dumps`.
+
+    This returns the same documents as :func:`load_many_low_level`, but documents read from
+    the document cache aren't decoded, so they can be returned by the API without building
+    any Python objects.
+
+    Args:
+        recordings: A list of tuples (mbid, offset).
+
+    Returns:
+        A dictionary {mbid: {offset: JSON document}}. If an (mbid, offset) doesn't exist
+        in the database, it is ommitted from the returned data.
+    """
+    return _load_many_through_cache(recordings,
+                                    db.document_cache.get_many_low_level_json,
+                                    db.document_cache.set_many_low_level_json,
+                                    lambda missing: _load_many_low_level_from_db(missing, as_json=True))
+
+
 def map_highlevel_class_names(highlevel, mapping):
     """Convert class names from the classifier output to human readable names.
 
@@ -534,71 +1298,96 @@ def load_many_high_level(recordings, map_classes=False):
          "mbid-n": {"offset-1": {"metadata-1": metadata, "highlevel-1": highlevel}}
         }
 
+        Documents are read from the document cache if possible, and added to it if not.
     """
-    with db.engine.connect() as connection:
-        # Metadata
-        meta_query = text("""
-            SELECT hl.id
-                 , hlm.data
-                 , ll.gid::text
-                 , ll.submission_offset::text
-              FROM highlevel hl
-              JOIN highlevel_meta hlm
-                ON hl.id = hlm.id
-              JOIN lowlevel ll
-                ON ll.id = hl.id
-             WHERE (ll.gid, ll.submission_offset)
-                IN :recordings
+    return _load_many_through_cache(recordings,
+                                    lambda keys: db.document_cache.get_many_high_level(keys, map_classes),
+                                    lambda documents: db.document_cache.set_many_high_level(documents, map_classes),
+                                    lambda missing: _load_many_high_level_from_db(missing, map_classes))
+
+
+def _get_class_mappings(connection, model_ids):
+    """Get the class mappings of models, from the class mapping cache if possible.
+
+    Returns:
+        a dictionary {model id: class mapping}. The mapping is None for models that don't have one
+    """
+    mappings = {}
+    missing = []
+    for model_id in model_ids:
+        mapping = _class_mapping_cache.get(model_id, _NOT_CACHED)
+        if mapping is _NOT_CACHED:
+            missing.append(model_id)
+        else:
+            mappings[model_id] = mapping
+
+    if missing:
+        query = text("""
+            SELECT id
+                 , class_mapping
+              FROM model
+             WHERE id = ANY(:model_ids)
         """)
+        for row in connection.execute(query, {"model_ids": missing}):
+            _class_mapping_cache.put(row["id"], row["class_mapping"])
+            mappings[row["id"]] = row["class_mapping"]
+    return mappings
 
-        meta_result = connection.execute(meta_query, {'recordings': tuple(recordings)})
-        # Return empty dictionary if no metadata is found
-        if not meta_result.rowcount:
-            return {}
 
-        hlids = []
-        recordings_info = defaultdict(dict)
-        for row in meta_result.fetchall():
-            hlids.append(row['id'])
-            gid = row['gid']
-            submission_offset = row['submission_offset']
-            recordings_info[gid][submission_offset] = {'metadata': row['data'],
-                                                       'highlevel': {}}
-
-        # Model data
-        model_query = text("""
-            SELECT m.model
-                 , hlmo.data
-                 , version.data as version
-                 , ll.gid::text
+def _load_many_high_level_from_db(recordings, map_classes):
+    with db.engine.connect() as connection:
+        # Metadata, and the models with a status of 'show' aggregated into one row per document.
+        # Each distinct version is only included once for each document, keyed by version id.
+        query = text("""
+            SELECT ll.gid::text
                  , ll.submission_offset::text
-                 , m.class_mapping
-              FROM highlevel_model hlmo
-              JOIN model m
-                ON m.id = hlmo.model
-              JOIN version
-                ON version.id = hlmo.version
+                 , hlm.data AS metadata
+                 , models.data AS models
+                 , models.model_ids
+                 , models.version_ids
+                 , models.versions
+              FROM unnest(CAST(:gids AS uuid[]), CAST(:offsets AS integer[])) AS r (gid, submission_offset)
               JOIN lowlevel ll
-                ON ll.id = hlmo.highlevel
-             WHERE hlmo.highlevel IN :hlids
-               AND m.status = 'show'
+                ON ll.gid = r.gid
+               AND ll.submission_offset = r.submission_offset
+              JOIN highlevel_meta hlm
+                ON hlm.id = ll.id
+         LEFT JOIN LATERAL (
+                    SELECT jsonb_object_agg(m.model, hlmo.data) AS data
+                         , jsonb_object_agg(m.model, m.id) AS model_ids
+                         , jsonb_object_agg(m.model, hlmo.version) AS version_ids
+                         , jsonb_object_agg(hlmo.version, version.data) AS versions
+                      FROM highlevel_model hlmo
+                      JOIN model m
+                        ON m.id = hlmo.model
+                      JOIN version
+                        ON version.id = hlmo.version
+                     WHERE hlmo.highlevel = ll.id
+                       AND m.status = 'show'
+                   ) models
+                ON true
         """)
+        rows = connection.execute(query, _recordings_as_arrays(recordings)).fetchall()
 
-        model_result = connection.execute(model_query, {'hlids': tuple(hlids)})
-        for row in model_result.fetchall():
-            model = row['model']
-            data = row['data']
-            mapping = row['class_mapping']
-            if map_classes and mapping:
-                data = map_highlevel_class_names(data, mapping)
+        mappings = {}
+        if map_classes:
+            model_ids = {model_id for row in rows for model_id in (row['model_ids'] or {}).values()}
+            mappings = _get_class_mappings(connection, model_ids)
 
-            data['version'] = row['version']
-
-            gid = row['gid']
-            submission_offset = row['submission_offset']
-            recordings_info[gid][submission_offset]['highlevel'][model] = data
+    recordings_info = defaultdict(dict)
+    for row in rows:
+        models = row['models'] or {}
+        for model, data in models.items():
+            mapping = mappings.get(row['model_ids'][model])
+            if mapping:
+                data = map_highlevel_class_names(data, mapping)
+            # Models with the same version share the version document
+            data['version'] = row['versions'][str(row['version_ids'][model])]
+            models[model] = data
+        recordings_info[row['gid']][row['submission_offset']] = {'metadata': row['metadata'],
+                                                                 'highlevel': models}
 
-        return dict(recordings_info)
+    return dict(recordings_info)
 
 
 def load_many_individual_features(recordings, features):
@@ -610,8 +1399,8 @@ def load_many_individual_features(recordings, features):
         individual features, a list of tuples of the form:
             [(<feature_path>, <alias>, <default_type>), ...]
 
-            <feature_path> is a string holding the path to a feature:
-            "llj.data->feature_name"
+            <feature_path> is a string holding the column of a feature:
+            "llf.lowlevel_feature_name"
 
             <alias> is a string alias for a feature:
             "lowlevel.feature_name"
@@ -646,8 +1435,8 @@ def build_feature_string(features):
         individual features, a list of tuples of the form:
             [(<feature_path>, <alias>, <default_type>), ...]
 
-            <feature_path> is a string holding the path to a feature:
-            "llj.data->feature_name"
+            <feature_path> is a string holding the column of a feature:
+            "llf.lowlevel_feature_name"
 
             <alias> is a string alias for a feature:
             "lowlevel.feature_name"
@@ -656,7 +1445,7 @@ def build_feature_string(features):
             if it is non-existent: None, {}, or [].
 
     Returns: a string of the form:
-    "data->'lowlevel'->'mfccs' AS mfccs, data->'lowlevel'->'gfccs' AS gfccs"
+    'llf.rhythm_bpm AS "rhythm.bpm", llf.tonal_key_key AS "tonal.key_key"'
     """
     feature_string = ', '.join(['%s AS "%s"' % (x[0], x[1]) for x in features])
     return feature_string
@@ -664,15 +1453,15 @@ def build_feature_string(features):
 
 def bulk_get_recording_features(recordings, feature_string):
     """Get individual features for many recordings from the
-    lowlevel_json table.
+    lowlevel_features table.
 
     Args:
         recordings: a list of tuples of the form (MBID, offset)
 
-        feature_string: a string of the features that should
+        feature_string: a string of the columns of lowlevel_features that should
         be collected, with their aliases.
-            e.g. "data->'lowlevel'->'mfccs' AS mfccs,
-                  data->'lowlevel'->'gfccs' AS gfccs"
+            e.g. 'llf.rhythm_bpm AS "rhythm.bpm",
+                  llf.tonal_key_key AS "tonal.key_key"'
 
     Returns: result handle from sqlalchemy query, containing
     rows of (ll.id, ll.submission_offset, feature_1, ..., feature_n)
@@ -682,19 +1471,20 @@ def bulk_get_recording_features(recordings, feature_string):
             SELECT ll.gid::text
                  , ll.submission_offset::text
                  , %(features)s
-              FROM lowlevel ll
-              JOIN lowlevel_json llj
-                ON ll.id = llj.id
-             WHERE (ll.gid, ll.submission_offset)
-                IN :recordings
+              FROM unnest(CAST(:gids AS uuid[]), CAST(:offsets AS integer[])) AS r (gid, submission_offset)
+              JOIN lowlevel ll
+                ON ll.gid = r.gid
+               AND ll.submission_offset = r.submission_offset
+              JOIN lowlevel_features llf
+                ON ll.id = llf.id
         """ % {'features': feature_string})
-        result = connection.execute(query, {'recordings': tuple(recordings)})
+        result = connection.execute(query, _recordings_as_arrays(recordings))
         return result.fetchall()
 
 
 def parse_features_row(row, features):
     """
-    Parse a row of the joined lowlevel and lowlevel_json tables
+    Parse a row of the joined lowlevel and lowlevel_features tables
     containing individual features of the lowlevel_json.data for
     a single recording.
 
@@ -712,8 +1502,8 @@ def parse_features_row(row, features):
         features: a list of tuples of the form:
         (<feature_path>, <alias>, <default_type>)
 
-            <feature_path> is a string holding the path to a feature:
-            "llj.data->feature_name"
+            <feature_path> is a string holding the column of a feature:
+            "llf.lowlevel_feature_name"
 
             <alias> is a string alias for a feature:
             "lowlevel.feature_name"
@@ -761,13 +1551,13 @@ def get_mbids_by_ids(ids):
                  , gid
                  , submission_offset
               FROM lowlevel
-             WHERE id in :ids
+             WHERE id = ANY(:ids)
         """)
         id_to_recording = {}
-        result = connection.execute(query, {'ids': tuple(ids)})
+        result = connection.execute(query, {'ids': list(ids)})
         for row in result.fetchall():
             id_to_recording[row['id']] = (str(row['gid']), row['submission_offset'])
-            recordings = []
+        recordings = []
         for id in ids:
             recordings.append(id_to_recording.get(id, (None, None)))
         return recordings
@@ -862,13 +1652,15 @@ def get_ids_by_mbids(mbids):
         as an ID"""
     with db.engine.connect() as connection:
         query = text("""
-            SELECT id
-                 , gid::text
-                 , submission_offset
-              FROM lowlevel
-             WHERE (gid, submission_offset) in :mbid_offsets 
+            SELECT ll.id
+                 , ll.gid::text
+                 , ll.submission_offset
+              FROM unnest(CAST(:gids AS uuid[]), CAST(:offsets AS integer[])) AS r (gid, submission_offset)
+              JOIN lowlevel ll
+                ON ll.gid = r.gid
+               AND ll.submission_offset = r.submission_offset
         """)
-        result = connection.execute(query, {"mbid_offsets": tuple(mbids)})
+        result = connection.execute(query, _recordings_as_arrays(mbids))
         mbid_to_id = {}
         for row in result.fetchall():
             mbid_to_id[(row['gid'], row['submission_offset'])] = row['id']
@@ -891,29 +1683,24 @@ def count_all_lowlevel():
 
 
 def count_lowlevel(mbid):
-    """Count number of stored low-level submissions for a specified MBID."""
+    """Count number of stored low-level submissions for a specified MBID.
+    Submission offsets start at 0 for each MBID, so this is the next submission offset."""
     with db.engine.connect() as connection:
-        result = connection.execute(
-            """SELECT COUNT(*)
-                 FROM lowlevel
-                WHERE gid = %s""",
-            (str(mbid),)
-        )
-        return result.fetchone()[0]
+        return get_next_submission_offset(connection, mbid)
 
 
 def count_many_lowlevel(mbids):
     """Count number of stored low-level submissions for a specified set
-    of MBID."""
+    of MBID. MBIDs with no submissions are not included in the result."""
     with db.engine.connect() as connection:
         query = text(
             """SELECT gid
-                    , COUNT(*)
-                 FROM lowlevel
-                WHERE gid IN :mbids
-             GROUP BY gid""")
+                    , next_offset
+                 FROM submission_counter
+                WHERE gid = ANY(CAST(:mbids AS uuid[]))
+                  AND next_offset > 0""")
         return {str(mbid): {"count": int(count)} for mbid, count
-                in connection.execute(query, {"mbids": tuple(mbids)})}
+                in connection.execute(query, {"mbids": [str(mbid) for mbid in mbids]})}
 
 
 def get_unprocessed_highlevel_documents_for_model(highlevel_model, within=None):
@@ -947,40 +1734,136 @@ def get_unprocessed_highlevel_documents_for_model(highlevel_model, within=None):
         return docs
 
 
-def get_unprocessed_highlevel_documents(limit=100, id_from=0):
-    """Fetch up to 100 low-level documents which have no associated high level data.
+def add_highlevel_pending(connection, ll_ids):
+    """Queue low-level submissions to be processed by the highlevel extractor.
 
     Arguments:
-        limit: Retrieve up to this many low-level documents
-        id_from: Select only low-level documents whose id is greater than this value
+        connection: a connection to the database
+        ll_ids: a list of lowlevel ids
+    """
+    if not ll_ids:
+        return
+    values, params = _multi_row_values([{"id": ll_id} for ll_id in ll_ids], ["id"])
+    query = text("""
+        INSERT INTO highlevel_pending (id)
+             VALUES %s
+        ON CONFLICT (id)
+         DO NOTHING
+    """ % values)
+    connection.execute(query, params)
+
+
+def remove_highlevel_pending(connection, ll_ids):
+    """Mark low-level submissions as processed by the highlevel extractor.
+
+    Arguments:
+        connection: a connection to the database
+        ll_ids: a list of lowlevel ids
+    """
+    if not ll_ids:
+        return
+    query = text("""
+        DELETE FROM highlevel_pending
+              WHERE id IN :ids
+    """)
+    connection.execute(query, {"ids": tuple(ll_ids)})
+
+
+def populate_highlevel_pending():
+    """Queue all low-level submissions which have no high-level data for processing
+    by the highlevel extractor. This is only needed after importing a data dump,
+    submissions made through the API are queued when they are written.
 
     Returns:
-        a list of tuples (rowid, mbid, lowlevel-json as text)
+        the number of submissions that were added to the queue
+    """
+    with db.engine.begin() as connection:
+        query = text("""
+            INSERT INTO highlevel_pending (id)
+                 SELECT ll.id
+                   FROM lowlevel AS ll
+              LEFT JOIN highlevel AS hl
+                     ON ll.id = hl.id
+                  WHERE hl.id IS NULL
+            ON CONFLICT (id)
+             DO NOTHING
+        """)
+        result = connection.execute(query)
+        return result.rowcount
 
+
+def claim_unprocessed_highlevel_documents(limit=100, lease=HIGHLEVEL_CLAIM_LEASE):
+    """Claim up to ``limit`` low-level documents which have no associated high level data.
+
+    Documents are claimed from the highlevel_pending table using ``FOR UPDATE SKIP LOCKED``,
+    so many highlevel extractors can claim documents at the same time without getting the
+    same document. A claimed document is not returned again for ``lease`` seconds. If the
+    high level data for a document hasn't been written by then (for example if the extractor
+    was stopped), it can be claimed again.
+
+    Arguments:
+        limit: Claim up to this many low-level documents
+        lease: Number of seconds that the documents are claimed for
+
+    Returns:
+        a list of tuples (rowid, mbid), ordered by rowid. Use :func:`copy_low_level_json`
+        to get the documents themselves.
     """
-    with db.engine.connect() as connection:
-        query = text(
-            """SELECT ll.id
-                    , ll.gid::text
-                    , llj.data::text
-                 FROM lowlevel AS ll
-                 JOIN lowlevel_json AS llj
-                   ON llj.id = ll.id
-                WHERE ll.id IN (
-                        SELECT ll.id
-                          FROM lowlevel AS ll
-                     LEFT JOIN highlevel AS hl
-                            ON ll.id = hl.id
-                         WHERE hl.mbid IS NULL
-                           AND ll.id > :id_from
-                      ORDER BY ll.id
+    with db.engine.begin() as connection:
+        query = text("""
+            WITH claimed AS (
+                UPDATE highlevel_pending
+                   SET claimed_until = now() + :lease * interval '1 second'
+                 WHERE id IN (
+                        SELECT id
+                          FROM highlevel_pending
+                         WHERE claimed_until IS NULL
+                            OR claimed_until < now()
+                      ORDER BY id
                          LIMIT :limit
-                )""")
-        result = connection.execute(query, {"id_from": id_from, "limit": limit})
+                           FOR UPDATE SKIP LOCKED
+                 )
+             RETURNING id
+            )
+            SELECT ll.id
+                 , ll.gid::text
+              FROM claimed
+              JOIN lowlevel AS ll
+                ON ll.id = claimed.id
+          ORDER BY ll.id
+        """)
+        result = connection.execute(query, {"limit": limit, "lease": lease})
         docs = result.fetchall()
         return docs
 
 
+def copy_low_level_json(ll_ids, fp):
+    """Write the low-level documents with the given ids to a file-like object.
+
+    The documents are written with COPY, so they go from the database to ``fp`` without
+    being decoded into Python strings. Each row is written as
+    ``<id>LOW_LEVEL_COPY_DELIMITER<json>\\n``, where the id and json are bytes.
+
+    Arguments:
+        ll_ids: a list of lowlevel ids
+        fp: an object with a ``write`` method that accepts bytes
+    """
+    if not ll_ids:
+        return
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        # jsonb::text never contains a newline, and the quote and delimiter characters can't
+        # appear in JSON, so in CSV format no value is quoted or escaped
+        query = cursor.mogrify("""
+            COPY (SELECT id, data::text FROM lowlevel_json WHERE id IN %s ORDER BY id)
+              TO STDOUT WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')
+        """, (tuple(ll_ids),))
+        cursor.copy_expert(query, fp)
+    finally:
+        connection.close()
+
+
 def get_summary_data(mbid, offset=0):
     """Fetches the low-level and high-level features from for the specified MBID.
 
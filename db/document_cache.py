@@ -0,0 +1,264 @@
+"""Read-through cache of low-level and high-level documents in Redis.
+
+Documents are stored as compressed JSON in the format returned by the API (see :func:`dumps`),
+keyed by (mbid, submission offset), so that they can be returned to clients without decoding them. Low-level documents never
+change once written. High-level documents include the output of every model with a status of
+'show', so all cached high-level documents are invalidated when the status of a model changes.
+This is done by including a generation token in high-level keys, which is replaced
+by :func:`invalidate_high_level`.
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+import zlib
+
+from brainzutils import cache
+
+LOWLEVEL_NAMESPACE = "lowlevel-document"
+HIGHLEVEL_NAMESPACE = "highlevel-document"
+HIGHLEVEL_GENERATION_KEY = "highlevel-document-generation"
+
+LOWLEVEL_CACHE_TIMEOUT = 7 * 24 * 60 * 60  # 1 week
+HIGHLEVEL_CACHE_TIMEOUT = 24 * 60 * 60  # 1 day
+# Must be longer than HIGHLEVEL_CACHE_TIMEOUT, so that documents cached before the
+# generation key expires can't be read afterwards
+HIGHLEVEL_GENERATION_CACHE_TIMEOUT = 30 * 24 * 60 * 60  # 30 days
+
+# Number of seconds that a process uses the high-level generation token before reading it again.
+# A model status change can take this long to be seen by other processes.
+HIGHLEVEL_GENERATION_TIMEOUT = 10
+
+# Documents larger than this after compression aren't cached, so that a few very
+# large documents don't push many popular ones out of the cache
+MAX_CACHED_DOCUMENT_SIZE = 256 * 1024
+COMPRESSION_LEVEL = 3
+
+# Log hit ratios after this many lookups
+STATS_LOG_INTERVAL = 10000
+
+logger = logging.getLogger(__name__)
+
+
+class _CacheStats(object):
+    """Counters of cache activity in this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counts = {"lowlevel": {"hits": 0, "misses": 0, "not_admitted": 0},
+                       "highlevel": {"hits": 0, "misses": 0, "not_admitted": 0}}
+        self.lookups = 0
+
+    def record(self, kind, name, count):
+        with self._lock:
+            self.counts[kind][name] += count
+            if name in ("hits", "misses"):
+                self.lookups += count
+                if self.lookups >= STATS_LOG_INTERVAL:
+                    self.lookups = 0
+                    logger.info("document cache: %s", self._as_dict())
+
+    def _as_dict(self):
+        stats = {}
+        for kind, counts in self.counts.items():
+            lookups = counts["hits"] + counts["misses"]
+            stats[kind] = dict(counts, hit_ratio=round(counts["hits"] / lookups, 3) if lookups else None)
+        return stats
+
+    def as_dict(self):
+        with self._lock:
+            return self._as_dict()
+
+
+_stats = _CacheStats()
+_highlevel_generation = {"value": None, "read_at": 0}
+
+
+def get_stats():
+    """Get hits, misses, hit ratio and the number of documents too large to cache,
+    for low-level and high-level documents looked up by this process."""
+    return _stats.as_dict()
+
+
+def dumps(document):
+    """Serialize a document to JSON in the same way as ``flask.jsonify``, so that
+    the result can be returned from the API in place of the jsonified document."""
+    return json.dumps(document, sort_keys=True, separators=(",", ":"))
+
+
+def _encode(text):
+    return zlib.compress(text.encode("utf-8"), COMPRESSION_LEVEL)
+
+
+def _decode(value):
+    return zlib.decompress(value).decode("utf-8")
+
+
+def _get_many(kind, keys, namespace):
+    """Get documents from the cache.
+
+    Arguments:
+        kind: lowlevel or highlevel, for the statistics
+        keys: a dictionary {cache key: (mbid, offset)}
+        namespace: the cache namespace of the keys
+
+    Returns:
+        a dictionary {(mbid, offset): JSON document} of the documents that were found
+    """
+    if not keys:
+        return {}
+    try:
+        values = cache.get_many(list(keys), namespace=namespace)
+    except Exception as e:
+        # The database still has everything, so carry on without the cache
+        logger.warning("Cannot get documents from the cache: %s", e)
+        values = {}
+
+    found = {}
+    for key, value in values.items():
+        if value is not None:
+            found[keys[key]] = _decode(value)
+    _stats.record(kind, "hits", len(found))
+    _stats.record(kind, "misses", len(keys) - len(found))
+    return found
+
+
+def _set_many(kind, keys, documents, namespace, timeout):
+    """Add documents to the cache.
+
+    Arguments:
+        kind: lowlevel or highlevel, for the statistics
+        keys: a dictionary {(mbid, offset): cache key}
+        documents: a dictionary {(mbid, offset): JSON document}
+        namespace: the cache namespace of the keys
+        timeout: number of seconds to keep the documents for
+    """
+    values = {}
+    for recording, document in documents.items():
+        value = _encode(document)
+        if len(value) > MAX_CACHED_DOCUMENT_SIZE:
+            _stats.record(kind, "not_admitted", 1)
+            continue
+        values[keys[recording]] = value
+    if not values:
+        return
+    try:
+        cache.set_many(values, expirein=timeout, namespace=namespace)
+    except Exception as e:
+        logger.warning("Cannot add documents to the cache: %s", e)
+
+
+def _lowlevel_key(mbid, offset):
+    return "{}:{}".format(mbid, offset)
+
+
+def get_many_low_level_json(recordings):
+    """Get low-level documents from the cache as JSON.
+
+    Arguments:
+        recordings: a list of (mbid, offset) tuples. MBIDs must be lower case
+
+    Returns:
+        a dictionary {(mbid, offset): JSON document} of the documents that were in the cache
+    """
+    keys = {_lowlevel_key(mbid, offset): (mbid, int(offset)) for mbid, offset in recordings}
+    return _get_many("lowlevel", keys, LOWLEVEL_NAMESPACE)
+
+
+def get_many_low_level(recordings):
+    """Get low-level documents from the cache.
+
+    Arguments:
+        recordings: a list of (mbid, offset) tuples. MBIDs must be lower case
+
+    Returns:
+        a dictionary {(mbid, offset): document} of the documents that were in the cache
+    """
+    return {recording: json.loads(document) for recording, document in get_many_low_level_json(recordings).items()}
+
+
+def set_many_low_level_json(documents):
+    """Add low-level documents to the cache.
+
+    Arguments:
+        documents: a dictionary {(mbid, offset): JSON document}. Documents must be
+            serialized with :func:`dumps`
+    """
+    keys = {(mbid, offset): _lowlevel_key(mbid, offset) for mbid, offset in documents}
+    _set_many("lowlevel", keys, documents, LOWLEVEL_NAMESPACE, LOWLEVEL_CACHE_TIMEOUT)
+
+
+def set_many_low_level(documents):
+    """Add low-level documents to the cache.
+
+    Arguments:
+        documents: a dictionary {(mbid, offset): document}
+    """
+    set_many_low_level_json({recording: dumps(document) for recording, document in documents.items()})
+
+
+def _get_highlevel_generation():
+    now = time.time()
+    if _highlevel_generation["value"] is None or now - _highlevel_generation["read_at"] > HIGHLEVEL_GENERATION_TIMEOUT:
+        try:
+            generation = cache.get(HIGHLEVEL_GENERATION_KEY, namespace=HIGHLEVEL_NAMESPACE)
+        except Exception as e:
+            logger.warning("Cannot get the high-level generation from the cache: %s", e)
+            generation = None
+        _highlevel_generation["value"] = generation or "0"
+        _highlevel_generation["read_at"] = now
+    return _highlevel_generation["value"]
+
+
+def _highlevel_key(mbid, offset, map_classes, generation):
+    return "{}:{}:{}:{}".format(mbid, offset, int(bool(map_classes)), generation)
+
+
+def get_many_high_level(recordings, map_classes):
+    """Get high-level documents from the cache.
+
+    Arguments:
+        recordings: a list of (mbid, offset) tuples. MBIDs must be lower case
+        map_classes: if the documents should have human readable class names
+
+    Returns:
+        a dictionary {(mbid, offset): document} of the documents that were in the cache
+    """
+    generation = _get_highlevel_generation()
+    keys = {_highlevel_key(mbid, offset, map_classes, generation): (mbid, int(offset))
+            for mbid, offset in recordings}
+    documents = _get_many("highlevel", keys, HIGHLEVEL_NAMESPACE)
+    return {recording: json.loads(document) for recording, document in documents.items()}
+
+
+def set_many_high_level(documents, map_classes):
+    """Add high-level documents to the cache.
+
+    Arguments:
+        documents: a dictionary {(mbid, offset): document}
+        map_classes: if the documents have human readable class names
+    """
+    generation = _get_highlevel_generation()
+    keys = {(mbid, offset): _highlevel_key(mbid, offset, map_classes, generation) for mbid, offset in documents}
+    documents = {recording: dumps(document) for recording, document in documents.items()}
+    _set_many("highlevel", keys, documents, HIGHLEVEL_NAMESPACE, HIGHLEVEL_CACHE_TIMEOUT)
+
+
+def invalidate_high_level():
+    """Stop using all cached high-level documents. Old documents are left to expire."""
+    # A random token, so that invalidations at the same time (or on hosts whose clocks differ)
+    # can't reuse the token of documents which were cached before one of them
+    generation = uuid.uuid4().hex
+    cache.set(HIGHLEVEL_GENERATION_KEY, generation, expirein=HIGHLEVEL_GENERATION_CACHE_TIMEOUT,
+              namespace=HIGHLEVEL_NAMESPACE)
+    _highlevel_generation["value"] = None
+
+
+def reset():
+    """Forget the high-level generation and statistics of this process"""
+    _highlevel_generation["value"] = None
+    _stats.reset()
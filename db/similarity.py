@@ -8,10 +8,15 @@ import similarity.metrics
 import similarity.utils
 from utils.list_utils import chunks
 import json
+import multiprocessing
 
 from sqlalchemy import text
 from collections import defaultdict
 
+# Number of id ranges made for each worker by add_metrics_parallel. Using more ranges
+# than workers keeps all workers busy when some ranges take longer than others.
+SHARDS_PER_WORKER = 4
+
 def get_all_metrics():
     """Get name, category, and description for each of the metrics
     in the similarity.similarity_metrics table.
@@ -84,20 +89,24 @@ def add_index(index, num_ids, ids, batch_size):
 
         batch_size (int): the size of each batch of recording
         vectors being added in each increment.
+
+    Raises:
+        DatabaseException: if a run of add_metrics_parallel is unfinished
     """
     num_added = 0
 
-    # Fill empty rows in the database with placeholders
-    # of the form [0, ..., 0]
-    index = similarity.index_utils.add_empty_rows(index, ids)
-
     with db.engine.connect() as connection:
+        check_no_similarity_shards(connection)
         batch_query = text("""
-            SELECT id
-                 , {}
-              FROM similarity.similarity
-             WHERE id IN :ids
-          ORDER BY id
+            SELECT s.id
+                 , ll.gid::text
+                 , ll.submission_offset
+                 , s.{}
+              FROM similarity.similarity s
+              JOIN lowlevel ll
+                ON ll.id = s.id
+             WHERE s.id IN :ids
+          ORDER BY s.id
         """.format(index.metric_name))
 
         current_app.logger.info("Items added: {}/{} ({:.3f}%)".format(num_added, num_ids, float(num_added) / num_ids * 100))
@@ -105,7 +114,8 @@ def add_index(index, num_ids, ids, batch_size):
             # Get ids and vectors for specific metric in batches
             batch_result = connection.execute(batch_query, {"ids": tuple(sub_ids)})
             for row in batch_result:
-                index.add_recording_with_vector(row["id"], row[index.metric_name])
+                index.add_recording_with_vector(row["id"], row[index.metric_name],
+                                                recording=(row["gid"], row["submission_offset"]))
 
             num_added += len(sub_ids)
             current_app.logger.info("Items added: {}/{} ({:.3f}%)".format(num_added, num_ids, float(num_added) / num_ids * 100))
@@ -116,6 +126,86 @@ def add_index(index, num_ids, ids, batch_size):
         index.save()
 
 
+# Indices being built by add_indices, which are inherited by the processes it forks to build them
+_indices_to_build = []
+
+
+def add_indices(indices, batch_size, workers=1):
+    """Adds all items to many indices, then builds and saves each index.
+    *Note*: indices must already be initialized.
+
+    The similarity table is read once, in order of id, using a server-side
+    cursor, and each row is added to all of the indices. The indices are then
+    built and saved by `workers` processes at the same time.
+
+    The rows are read in the same snapshot as the check that no run of
+    :func:`add_metrics_parallel` is unfinished (see :func:`check_no_similarity_shards`),
+    so rows added after the snapshot all have a higher id than the rows which are read.
+
+    Args:
+        indices: a list of initialized Annoy indices.
+
+        batch_size (int): the number of rows fetched from the database
+        at a time.
+
+        workers (int): the number of indices built at the same time.
+
+    Raises:
+        DatabaseException: if a run of add_metrics_parallel is unfinished
+    """
+    num_ids = get_similarity_count()
+    num_added = 0
+    metric_names = sorted(set(name for index in indices for name in index.columns))
+
+    with db.engine.execution_options(isolation_level="REPEATABLE READ").begin() as connection:
+        check_no_similarity_shards(connection)
+        query = text("""
+            SELECT s.id
+                 , ll.gid::text
+                 , ll.submission_offset
+                 , %(columns)s
+              FROM similarity.similarity s
+              JOIN lowlevel ll
+                ON ll.id = s.id
+          ORDER BY s.id
+        """ % {"columns": ", ".join(["s.{}".format(name) for name in metric_names])})
+        result = connection.execution_options(stream_results=True, max_row_buffer=batch_size).execute(query)
+
+        current_app.logger.info("Items added: {}/{} ({:.3f}%)".format(num_added, num_ids, float(num_added) / num_ids * 100))
+        for rows in result.partitions(batch_size):
+            for row in rows:
+                recording = (row["gid"], row["submission_offset"])
+                for index in indices:
+                    index.add_recording_with_vector(row["id"], index.get_row_vector(row), recording=recording)
+
+            num_added += len(rows)
+            current_app.logger.info("Items added: {}/{} ({:.3f}%)".format(num_added, num_ids, float(num_added) / num_ids * 100))
+
+    current_app.logger.info("Finished adding items. Building indices...")
+    n_jobs = current_app.config['SIMILARITY_BUILD_NUM_JOBS']
+    location = current_app.config['SIMILARITY_INDEX_DIR']
+    arguments = [(i, n_jobs, location) for i in range(len(indices))]
+    _indices_to_build[:] = indices
+    try:
+        if workers > 1:
+            with multiprocessing.Pool(workers) as pool:
+                for metric_name in pool.imap_unordered(_build_index, arguments):
+                    current_app.logger.info("Saved index {}".format(metric_name))
+        else:
+            for metric_name in map(_build_index, arguments):
+                current_app.logger.info("Saved index {}".format(metric_name))
+    finally:
+        del _indices_to_build[:]
+
+
+def _build_index(arguments):
+    i, n_jobs, location = arguments
+    index = _indices_to_build[i]
+    index.build(n_jobs=n_jobs)
+    index.save(location=location)
+    return index.metric_name
+
+
 def get_metric_info(metric):
     """Gets the description and category for a given
     metric.
@@ -165,23 +255,188 @@ def add_metrics(batch_size=None):
                 result = get_batch_data(connection, max_id, batch_size)
                 if not result:
                     break
-                added_rows = 0
-                all_rows = []
-                for row in result:
-                    data = bulk_transform_data_to_similarity(row, metrics=metrics)
-                    all_rows.append(data)
-                    added_rows += 1
-                    max_id = max(max_id, row["id"])
+                ids, vectors = transform_batch_to_similarity(result.fetchall(), metrics)
+                copy_similarity(connection, ids, vectors)
+                added_rows = len(ids)
+                max_id = max(max_id, max(ids))
+
+            sim_count += added_rows
+            current_app.logger.info("Processed {} / {} ({:.3f}%)".format(sim_count,
+                                                                         lowlevel_count,
+                                                                         float(sim_count) / lowlevel_count * 100))
+
 
-                insert_similarity_bulk(connection, all_rows)
+def add_metrics_parallel(batch_size, workers):
+    """Computes metrics for all recordings which aren't in the similarity
+    table using `workers` processes, each with its own database connection.
 
+    The lowlevel.ids after the highest id in the similarity table are split
+    into ranges (see :func:`plan_similarity_shards`), and each range is
+    processed in batches by :func:`add_metrics_shard`. The progress of each
+    range is saved in the similarity.similarity_shards table, so if a run is
+    interrupted the next run continues from where each range had got to.
+    The ranges are removed once all of them have been processed.
+    """
+    lowlevel_count = count_all_lowlevel()
+
+    metrics = similarity.utils.init_metrics()
+    # Collect and assign stats to metrics that require normalization
+    for metric in metrics:
+        db.similarity_stats.assign_stats(metric)
+
+    shards = plan_similarity_shards(workers * SHARDS_PER_WORKER)
+    sim_count = count_similarity()
+    current_app.logger.info("Processing {} id ranges with {} workers".format(len(shards), workers))
+    current_app.logger.info("Processed {} / {} ({:.3f}%)".format(sim_count,
+                                                                 lowlevel_count,
+                                                                 float(sim_count) / lowlevel_count * 100))
+
+    # Worker processes are forked, and db.engine doesn't reuse connections opened by the parent process
+    arguments = [(metrics, start_id, end_id, last_id, batch_size) for start_id, end_id, last_id in shards]
+    with multiprocessing.Pool(workers) as pool:
+        for added_rows in pool.imap_unordered(_add_metrics_shard, arguments):
             sim_count += added_rows
             current_app.logger.info("Processed {} / {} ({:.3f}%)".format(sim_count,
                                                                          lowlevel_count,
                                                                          float(sim_count) / lowlevel_count * 100))
 
+    delete_similarity_shards()
+
+
+def _add_metrics_shard(arguments):
+    return add_metrics_shard(*arguments)
+
+
+def add_metrics_shard(metrics, start_id, end_id, last_id, batch_size):
+    """Computes metrics for the recordings with ids in (last_id, end_id],
+    saving the last id added to the similarity table in the
+    similarity.similarity_shards row of the range starting at `start_id`
+    in the same transaction as each batch.
+
+    Returns:
+        the number of rows added to the similarity table
+    """
+    added_rows = 0
+    with db.engine.connect() as connection:
+        while last_id < end_id:
+            with connection.begin():
+                result = get_batch_data(connection, last_id, batch_size, end_id=end_id)
+                if result:
+                    ids, vectors = transform_batch_to_similarity(result.fetchall(), metrics)
+                    copy_similarity(connection, ids, vectors)
+                    added_rows += len(ids)
+                    last_id = max(ids)
+                else:
+                    last_id = end_id
+                update_similarity_shard(connection, start_id, last_id)
+    return added_rows
+
+
+def plan_similarity_shards(num_shards):
+    """Get the ranges of lowlevel.ids to be processed by :func:`add_metrics_parallel`.
+
+    If there are no ranges in the similarity.similarity_shards table, the ids
+    after the highest id in the similarity table are split into `num_shards`
+    ranges of the same size. Otherwise the existing ranges are used, so that
+    an interrupted run can be continued, with a new range added for any
+    recordings submitted since they were made.
 
-def get_batch_data(connection, max_id, batch_size):
+    Returns:
+        a list of (start_id, end_id, last_id) tuples for each range which
+        still has recordings to be processed
+    """
+    with db.engine.begin() as connection:
+        result = connection.execute(text("""
+            SELECT coalesce(max(id), 0)
+              FROM lowlevel
+        """))
+        max_lowlevel_id = result.fetchone()[0]
+        result = connection.execute(text("""
+            SELECT max(end_id)
+              FROM similarity.similarity_shards
+        """))
+        max_shard_id = result.fetchone()[0]
+
+        if max_shard_id is None:
+            result = connection.execute(text("""
+                SELECT coalesce(max(id), 0)
+                  FROM similarity.similarity
+            """))
+            min_id = result.fetchone()[0]
+            num_shards = max(1, min(num_shards, max_lowlevel_id - min_id))
+            bounds = [min_id + (max_lowlevel_id - min_id) * i // num_shards for i in range(num_shards + 1)]
+            shards = list(zip(bounds[:-1], bounds[1:]))
+        elif max_lowlevel_id > max_shard_id:
+            shards = [(max_shard_id, max_lowlevel_id)]
+        else:
+            shards = []
+
+        if shards:
+            connection.execute(text("""
+                INSERT INTO similarity.similarity_shards (start_id, end_id, last_id)
+                     VALUES (:start_id, :end_id, :start_id)
+            """), [{"start_id": start_id, "end_id": end_id} for start_id, end_id in shards])
+
+        result = connection.execute(text("""
+            SELECT start_id, end_id, last_id
+              FROM similarity.similarity_shards
+             WHERE last_id < end_id
+          ORDER BY start_id
+        """))
+        return [tuple(row) for row in result.fetchall()]
+
+
+def update_similarity_shard(connection, start_id, last_id):
+    """Saves the last id processed in the range starting at `start_id`"""
+    query = text("""
+        UPDATE similarity.similarity_shards
+           SET last_id = :last_id
+         WHERE start_id = :start_id
+    """)
+    connection.execute(query, {"start_id": start_id, "last_id": last_id})
+
+
+def similarity_shards_exist():
+    """Check if there are ranges left by an interrupted run of :func:`add_metrics_parallel`"""
+    with db.engine.connect() as connection:
+        return _similarity_shards_exist(connection)
+
+
+def _similarity_shards_exist(connection):
+    result = connection.execute(text("""
+        SELECT 1
+          FROM similarity.similarity_shards
+         LIMIT 1
+    """))
+    return result.rowcount > 0
+
+
+def check_no_similarity_shards(connection):
+    """Check that no run of :func:`add_metrics_parallel` is unfinished, before an index is built.
+
+    An index holds the rows of the similarity table up to the highest id it was built with, and rows
+    added later are found by their higher id (see :meth:`similarity.index_model.AnnoyModel.save_delta`).
+    The ranges of a parallel run are filled out of order, so while any of them are unfinished there may
+    be rows still to be added below the highest id, which would never be added to the index.
+
+    Raises:
+        DatabaseException: if there are unfinished ranges in the similarity.similarity_shards table
+    """
+    if _similarity_shards_exist(connection):
+        raise db.exceptions.DatabaseException("Metrics are still being added by a run of add-metrics with "
+                                              "several workers. Finish it by running add-metrics before "
+                                              "building indices.")
+
+
+def delete_similarity_shards():
+    """Removes all ranges from the similarity.similarity_shards table"""
+    with db.engine.begin() as connection:
+        connection.execute(text("""
+            DELETE FROM similarity.similarity_shards
+        """))
+
+
+def get_batch_data(connection, max_id, batch_size, end_id=None):
     """Performs a query to collect highlevel models and lowlevel
     data for a batch of `batch_size` recordings.
 
@@ -190,6 +445,8 @@ def get_batch_data(connection, max_id, batch_size):
         max_id: get only items with an id greater than this
         batch_size: the number of recordings (rows) that should
         be collected in the query.
+        end_id: if set, get only items with an id less than or
+        equal to this.
 
     Returns:
         If no rows are returned by the query, i.e. there are no
@@ -216,11 +473,11 @@ def get_batch_data(connection, max_id, batch_size):
             ON model.id = hlm.model
          WHERE llj.id IN (
                SELECT id
-               FROM lowlevel WHERE id > :max_id ORDER BY id LIMIT :batch_size)
+               FROM lowlevel WHERE id > :max_id AND (:end_id IS NULL OR id <= :end_id) ORDER BY id LIMIT :batch_size)
       GROUP BY (llj.id)
       """)
 
-    result = connection.execute(batch_query, {"max_id": max_id, "batch_size": batch_size})
+    result = connection.execute(batch_query, {"max_id": max_id, "end_id": end_id, "batch_size": batch_size})
     if not result.rowcount:
         return None
     return result
@@ -276,6 +533,132 @@ def insert_similarity_bulk(connection, data):
     connection.execute(query, data)
 
 
+class _LineReader(object):
+    """A file-like object that reads the lines from an iterator, so
+    that rows can be formatted as they are sent by cursor.copy_expert"""
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.buffer = ""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.lines)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def _format_array(vector):
+    # repr of a float round-trips exactly through DOUBLE PRECISION
+    return "{" + ",".join([repr(value) for value in vector]) + "}"
+
+
+def copy_similarity(connection, ids, vectors, table="similarity.similarity"):
+    """Adds rows to the similarity table using COPY, which is much faster than
+    inserting rows with :func:`insert_similarity_bulk` for large batches.
+
+        Args:
+            connection: a connection to the database. The rows are added in the
+            transaction of this connection.
+            ids (list): the lowlevel.id of each row
+            vectors (dict): {metric name: numpy array with a vector for each row},
+            as returned by :func:`transform_batch_to_similarity`
+            table: the table to add rows to, which must have the same columns as
+            similarity.similarity
+    """
+    if not ids:
+        return
+
+    metric_names = list(vectors.keys())
+    columns = [[_format_array(vector) for vector in vectors[name].tolist()] for name in metric_names]
+    lines = ("{}\t{}\n".format(id, "\t".join(values)) for id, values in zip(ids, zip(*columns)))
+
+    cursor = connection.connection.cursor()
+    query = "COPY {} (id, {}) FROM STDIN".format(table, ", ".join(metric_names))
+    cursor.copy_expert(query, _LineReader(lines))
+
+
+def rebuild_similarity(batch_size):
+    """Computes metrics for all recordings and replaces the similarity table with them.
+
+    Rows are copied into an unlogged table without any constraints, which is much
+    faster than adding them to the similarity table. Once all rows have been added,
+    the new table is made logged, the primary and foreign keys are added, and it
+    replaces similarity.similarity. The similarity table can be read until the new
+    table replaces it.
+    """
+    lowlevel_count = count_all_lowlevel()
+
+    metrics = similarity.utils.init_metrics()
+    # Collect and assign stats to metrics that require normalization
+    for metric in metrics:
+        db.similarity_stats.assign_stats(metric)
+
+    with db.engine.begin() as connection:
+        connection.execute(text("""
+            DROP TABLE IF EXISTS similarity.similarity_staging
+        """))
+        connection.execute(text("""
+            CREATE UNLOGGED TABLE similarity.similarity_staging (LIKE similarity.similarity INCLUDING DEFAULTS)
+        """))
+
+    sim_count = 0
+    max_id = 0
+    with db.engine.connect() as connection:
+        while True:
+            with connection.begin():
+                result = get_batch_data(connection, max_id, batch_size)
+                if not result:
+                    break
+                ids, vectors = transform_batch_to_similarity(result.fetchall(), metrics)
+                copy_similarity(connection, ids, vectors, table="similarity.similarity_staging")
+                max_id = max(max_id, max(ids))
+
+            sim_count += len(ids)
+            current_app.logger.info("Processed {} / {} ({:.3f}%)".format(sim_count,
+                                                                         lowlevel_count,
+                                                                         float(sim_count) / lowlevel_count * 100))
+
+    current_app.logger.info("Adding keys to the new similarity table...")
+    with db.engine.begin() as connection:
+        connection.execute(text("""
+            ALTER TABLE similarity.similarity_staging SET LOGGED
+        """))
+        connection.execute(text("""
+            ALTER TABLE similarity.similarity_staging ADD CONSTRAINT similarity_staging_pkey PRIMARY KEY (id)
+        """))
+        connection.execute(text("""
+            ALTER TABLE similarity.similarity_staging
+              ADD CONSTRAINT similarity_staging_fk_lowlevel
+              FOREIGN KEY (id)
+              REFERENCES lowlevel (id)
+        """))
+
+    current_app.logger.info("Replacing the similarity table...")
+    with db.engine.begin() as connection:
+        connection.execute(text("""
+            DROP TABLE similarity.similarity
+        """))
+        connection.execute(text("""
+            ALTER TABLE similarity.similarity_staging RENAME TO similarity
+        """))
+        connection.execute(text("""
+            ALTER TABLE similarity.similarity RENAME CONSTRAINT similarity_staging_pkey TO similarity_pkey
+        """))
+        connection.execute(text("""
+            ALTER TABLE similarity.similarity RENAME CONSTRAINT similarity_staging_fk_lowlevel TO similarity_fk_lowlevel
+        """))
+        # Ranges of an interrupted parallel run refer to the old table
+        connection.execute(text("""
+            DELETE FROM similarity.similarity_shards
+        """))
+
+
 def count_similarity():
     # Get total number of submissions in similarity table
     with db.engine.connect() as connection:
@@ -287,6 +670,70 @@ def count_similarity():
         return result.fetchone()[0]
 
 
+def count_similarity_after(max_id):
+    # Get the number of rows in the similarity table with an id greater than max_id
+    with db.engine.connect() as connection:
+        query = text("""
+            SELECT COUNT(*)
+              FROM similarity.similarity
+             WHERE id > :max_id
+        """)
+        result = connection.execute(query, {"max_id": max_id})
+        return result.fetchone()[0]
+
+
+def get_similarity_after(metric_names, max_id, limit):
+    """Get the vectors of some metrics for rows of the similarity table with
+    an id greater than `max_id`, in order of id.
+
+    Args:
+        metric_names (list): the names of the metrics.
+        max_id (int): get only rows with an id greater than this.
+        limit (int): the maximum number of rows to get.
+
+    Returns:
+        a list of rows with the keys id, gid, submission_offset and each of `metric_names`.
+    """
+    for metric_name in metric_names:
+        if metric_name not in similarity.metrics.BASE_METRICS:
+            raise db.exceptions.NoDataFoundException("No existing metric named \"{}\"".format(metric_name))
+    with db.engine.connect() as connection:
+        query = text("""
+            SELECT s.id
+                 , ll.gid::text
+                 , ll.submission_offset
+                 , %(columns)s
+              FROM similarity.similarity s
+              JOIN lowlevel ll
+                ON ll.id = s.id
+             WHERE s.id > :max_id
+          ORDER BY s.id
+             LIMIT :limit
+        """ % {"columns": ", ".join(["s.{}".format(name) for name in metric_names])})
+        result = connection.execute(query, {"max_id": max_id, "limit": limit})
+        return result.fetchall()
+
+
+def get_metric_vectors(metric_name, limit, batch_size):
+    """Get the vectors of a metric for the first `limit` rows of the
+    similarity table, in order of id. Rows are read using a server-side
+    cursor, and yielded in lists of up to `batch_size` vectors.
+    """
+    if metric_name not in similarity.metrics.BASE_METRICS:
+        raise db.exceptions.NoDataFoundException("No existing metric named \"{}\"".format(metric_name))
+    with db.engine.connect() as connection:
+        query = text("""
+            SELECT s.%(metric)s
+              FROM similarity.similarity s
+          ORDER BY s.id
+             LIMIT :limit
+        """ % {"metric": metric_name})
+        result = connection.execution_options(stream_results=True, max_row_buffer=batch_size) \
+            .execute(query, {"limit": limit})
+        for rows in result.partitions(batch_size):
+            yield [row[metric_name] for row in rows]
+
+
 def get_max_similarity_id():
     # Get the highest id currently in the similarity table
     with db.engine.connect() as connection:
@@ -377,6 +824,46 @@ def bulk_transform_data_to_similarity(row, metrics):
     return results
 
 
+def transform_batch_to_similarity(rows, metrics):
+    """Transforms lowlevel and highlevel data for a batch of recordings
+    according to each metric. This gives the same vectors as calling
+    :func:`bulk_transform_data_to_similarity` for each row, but each metric
+    transforms the whole batch at once.
+
+    Args:
+        rows: a list of rows generated from get_batch_data, including id, ll_data, and hl_data
+
+        metrics (list): a list of initialized metric classes, for which similarity
+        vectors should be computed.
+
+    Returns:
+        a tuple (ids, vectors) where ids is a list of the lowlevel.id of each row,
+        and vectors is a dictionary {metric name: numpy array with a vector for each row}
+    """
+    ids = [row["id"] for row in rows]
+    vectors = {}
+    for metric in metrics:
+        if isinstance(metric, similarity.metrics.LowLevelMetric):
+            values = [metric.get_feature_data(row["ll_data"]) for row in rows]
+        else:
+            # High level metrics use models for transformation.
+            values = [row["hl_data"] for row in rows]
+        vectors[metric.name] = metric.transform_batch(values)
+    return ids, vectors
+
+
+def similarity_rows(ids, vectors):
+    """Converts the result of :func:`transform_batch_to_similarity` to a list
+    of rows to be inserted with :func:`insert_similarity_bulk`."""
+    vector_lists = {name: matrix.tolist() for name, matrix in vectors.items()}
+    rows = []
+    for i, id in enumerate(ids):
+        row = {name: vector_list[i] for name, vector_list in vector_lists.items()}
+        row["id"] = id
+        rows.append(row)
+    return rows
+
+
 def submit_similarity_by_mbid(mbid, offset):
     """Computes similarity metrics for a single recording specified
     by (mbid, offset) combination, then inserts the metrics as a new
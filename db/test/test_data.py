@@ -7,6 +7,7 @@ import six
 import sqlalchemy
 
 import db.data
+import db.document_cache
 import db.exceptions
 from webserver.testing import AcousticbrainzTestCase, DB_TEST_DATA_PATH, gid_types
 import similarity.metrics
@@ -102,6 +103,36 @@ class DataDBTestCase(AcousticbrainzTestCase):
             db.data.write_low_level(self.test_mbid_two, three, gid_types.GID_TYPE_MBID)
             self.assertEqual(1, db.data.get_next_submission_offset(connection, self.test_mbid_two))
 
+    def test_reserve_submission_offsets(self):
+        with db.engine.begin() as connection:
+            offsets = db.data.reserve_submission_offsets(connection, {self.test_mbid: 2, self.test_mbid_two: 1})
+            self.assertEqual(offsets, {self.test_mbid: [0, 1], self.test_mbid_two: [0]})
+            self.assertEqual(db.data.reserve_submission_offset(connection, self.test_mbid.upper()), 2)
+
+            # Only offsets under the limit are reserved
+            offsets = db.data.reserve_submission_offsets(connection, {self.test_mbid: 3, self.test_mbid_two: 3}, 4)
+            self.assertEqual(offsets, {self.test_mbid: [3], self.test_mbid_two: [1, 2, 3]})
+            self.assertIsNone(db.data.reserve_submission_offset(connection, self.test_mbid, 4))
+            self.assertEqual(db.data.get_next_submission_offset(connection, self.test_mbid), 4)
+
+        # Offsets reserved in a transaction which is rolled back are reused
+        with db.engine.connect() as connection:
+            with connection.begin() as transaction:
+                self.assertEqual(db.data.reserve_submission_offset(connection, self.test_mbid), 4)
+                transaction.rollback()
+            self.assertEqual(db.data.reserve_submission_offset(connection, self.test_mbid), 4)
+
+    def test_update_submission_counters(self):
+        db.data.write_low_level(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        with db.engine.begin() as connection:
+            connection.execute(sqlalchemy.text("DELETE FROM submission_counter"))
+        self.assertEqual(0, db.data.count_lowlevel(self.test_mbid))
+
+        db.data.update_submission_counters()
+        self.assertEqual(1, db.data.count_lowlevel(self.test_mbid))
+        self.assertEqual({self.test_mbid: {"count": 1}},
+                         db.data.count_many_lowlevel([self.test_mbid, self.test_mbid_two]))
+
     def test_write_lowlevel_max_duplicate_submissions(self):
         # The same MBID submitted more times than the max duplicate submissions
         with db.engine.connect() as connection:
@@ -121,6 +152,116 @@ class DataDBTestCase(AcousticbrainzTestCase):
             count = db.data.count_lowlevel(self.test_mbid)
             self.assertEqual(2, count)
 
+    def test_write_many_low_level(self):
+        one = {"data": "one",
+               "metadata": {"audio_properties": {"lossless": True}, "version": {"essentia_build_sha": "x"}}}
+        two = {"data": "two",
+               "metadata": {"audio_properties": {"lossless": False}, "version": {"essentia_build_sha": "y"}}}
+        three = {"data": "three",
+                 "metadata": {"audio_properties": {"lossless": True}, "version": {"essentia_build_sha": "x"}}}
+        db.data.write_low_level(self.test_mbid, one, gid_types.GID_TYPE_MBID)
+
+        # one is already in the database, the second copy of two in the batch is a duplicate
+        results = db.data.write_many_low_level([(self.test_mbid, one),
+                                                (self.test_mbid, two),
+                                                (self.test_mbid_two, three),
+                                                (self.test_mbid_two, two)], gid_types.GID_TYPE_MBID)
+        self.assertEqual(results, [(db.data.SUBMISSION_DUPLICATE, None), (db.data.SUBMISSION_SAVED, None),
+                                   (db.data.SUBMISSION_SAVED, None), (db.data.SUBMISSION_DUPLICATE, None)])
+
+        # Offsets continue from the existing submissions
+        self.assertEqual(one, db.data.load_low_level(self.test_mbid, 0))
+        self.assertEqual(two, db.data.load_low_level(self.test_mbid, 1))
+        self.assertEqual(three, db.data.load_low_level(self.test_mbid_two, 0))
+        self.assertEqual(2, db.data.count_lowlevel(self.test_mbid))
+        self.assertEqual(1, db.data.count_lowlevel(self.test_mbid_two))
+
+    def test_write_many_low_level_max_duplicate_submissions(self):
+        one = {"data": "one",
+               "metadata": {"audio_properties": {"lossless": True}, "version": {"essentia_build_sha": "x"}}}
+        two = {"data": "two",
+               "metadata": {"audio_properties": {"lossless": True}, "version": {"essentia_build_sha": "x"}}}
+        three = {"data": "three",
+                 "metadata": {"audio_properties": {"lossless": True}, "version": {"essentia_build_sha": "x"}}}
+
+        results = db.data.write_many_low_level([(self.test_mbid, one),
+                                                (self.test_mbid, two),
+                                                (self.test_mbid, three)], gid_types.GID_TYPE_MBID, 2)
+        self.assertEqual([status for status, _ in results], [db.data.SUBMISSION_SAVED, db.data.SUBMISSION_SAVED,
+                                                             db.data.SUBMISSION_REJECTED])
+        self.assertIn("maximum number of submissions", results[2][1])
+        self.assertEqual(2, db.data.count_lowlevel(self.test_mbid))
+
+    def test_write_many_low_level_invalid_data(self):
+        """Documents which the database can't store are rejected without affecting the rest of the batch"""
+        one = {"data": "one",
+               "metadata": {"audio_properties": {"lossless": True}, "version": {"essentia_build_sha": "x"}}}
+        bad = {"data": "\uc544\uc774\uc720 (IU)\udc93",
+               "metadata": {"audio_properties": {"lossless": True}, "version": {"essentia_build_sha": "x"}}}
+        three = {"data": "three",
+                 "metadata": {"audio_properties": {"lossless": True}, "version": {"essentia_build_sha": "x"}}}
+        four = {"data": "four",
+                "metadata": {"audio_properties": {"lossless": True}, "version": {"essentia_build_sha": "x"}}}
+
+        results = db.data.write_many_low_level([(self.test_mbid, one),
+                                                (self.test_mbid, bad),
+                                                (self.test_mbid_two, three),
+                                                (self.test_mbid, four)], gid_types.GID_TYPE_MBID)
+        self.assertEqual(results, [(db.data.SUBMISSION_SAVED, None),
+                                   (db.data.SUBMISSION_REJECTED, "data is badly formed"),
+                                   (db.data.SUBMISSION_SAVED, None),
+                                   (db.data.SUBMISSION_SAVED, None)])
+        # The rejected document doesn't leave a gap in the submission offsets
+        self.assertEqual(one, db.data.load_low_level(self.test_mbid, 0))
+        self.assertEqual(four, db.data.load_low_level(self.test_mbid, 1))
+        self.assertEqual(three, db.data.load_low_level(self.test_mbid_two, 0))
+        self.assertEqual(2, db.data.count_lowlevel(self.test_mbid))
+        self.assertEqual(1, db.data.count_lowlevel(self.test_mbid_two))
+
+    def test_submit_many_low_level_data(self):
+        bad_mbid = copy.deepcopy(self.test_lowlevel_data)
+        bad_mbid["metadata"]["tags"]["musicbrainz_recordingid"] = [self.test_mbid_two]
+
+        results = db.data.submit_many_low_level_data([(self.test_mbid, self.test_lowlevel_data),
+                                                      (self.test_mbid, bad_mbid),
+                                                      (self.test_mbid_two, {"metadata": {}}),
+                                                      (self.test_mbid_two, self.test_lowlevel_data_two)],
+                                                     gid_types.GID_TYPE_MBID)
+        statuses = [status for status, _ in results]
+        self.assertEqual(statuses, [db.data.SUBMISSION_SAVED, db.data.SUBMISSION_REJECTED,
+                                    db.data.SUBMISSION_REJECTED, db.data.SUBMISSION_SAVED])
+        self.assertIsNone(results[0][1])
+        self.assertIn("does not match the MBID", results[1][1])
+        self.assertEqual(1, db.data.count_lowlevel(self.test_mbid))
+        self.assertEqual(1, db.data.count_lowlevel(self.test_mbid_two))
+
+    def test_insert_version_cache(self):
+        version = {"essentia": "2.1", "essentia_build_sha": "x"}
+
+        # A version added in a transaction that is rolled back is not cached
+        with db.engine.connect() as connection:
+            transaction = connection.begin()
+            db.data.insert_version(connection, version, db.data.VERSION_TYPE_LOWLEVEL)
+            transaction.rollback()
+        self.assertEqual(db.data.get_cache_stats()["version"]["size"], 0)
+
+        with db.engine.begin() as connection:
+            version_id = db.data.insert_version(connection, version, db.data.VERSION_TYPE_LOWLEVEL)
+            # Inserted in this transaction, but not committed yet
+            self.assertEqual(db.data.get_cache_stats()["version"]["size"], 0)
+            self.assertEqual(version_id, db.data.insert_version(connection, version, db.data.VERSION_TYPE_LOWLEVEL))
+        self.assertEqual(db.data.get_cache_stats()["version"]["size"], 1)
+
+        # The cached id is used without a query, and the version type is part of the key
+        with db.engine.begin() as connection:
+            with mock.patch.object(connection, "execute", wraps=connection.execute) as execute:
+                self.assertEqual(version_id,
+                                 db.data.insert_version(connection, version, db.data.VERSION_TYPE_LOWLEVEL))
+                execute.assert_not_called()
+            hl_version_id = db.data.insert_version(connection, version, db.data.VERSION_TYPE_HIGHLEVEL)
+        self.assertNotEqual(version_id, hl_version_id)
+        self.assertEqual(db.data.get_cache_stats()["version"]["hits"], 1)
+
     def test_write_load_low_level(self):
         """Writing and loading a dict returns the same data"""
         one = {"data": "one",
@@ -234,6 +375,49 @@ class DataDBTestCase(AcousticbrainzTestCase):
 
         self.assertEqual(ll_expected, db.data.load_many_low_level(list(recordings)))
 
+    def test_load_many_low_level_cached(self):
+        db.data.write_low_level(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        recordings = [(self.test_mbid, 0), (self.test_mbid_two, 0)]
+        expected = {self.test_mbid: {'0': self.test_lowlevel_data}}
+
+        self.assertEqual(expected, db.data.load_many_low_level(recordings))
+        self.assertEqual({"hits": 0, "misses": 2, "not_admitted": 0, "hit_ratio": 0.0},
+                         db.document_cache.get_stats()["lowlevel"])
+
+        # The document is now read from the cache, and an upper case mbid gets the same document
+        with mock.patch("db.data._load_many_low_level_from_db") as load:
+            load.return_value = {}
+            self.assertEqual(expected, db.data.load_many_low_level([(self.test_mbid.upper(), 0),
+                                                                    (self.test_mbid_two, 0)]))
+            load.assert_called_once_with([(self.test_mbid_two, 0)])
+        self.assertEqual({"hits": 1, "misses": 3, "not_admitted": 0, "hit_ratio": 0.25},
+                         db.document_cache.get_stats()["lowlevel"])
+
+    def test_load_many_low_level_json(self):
+        db.data.write_low_level(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        recordings = [(self.test_mbid, 0), (self.test_mbid_two, 0)]
+        expected = {self.test_mbid: {'0': db.document_cache.dumps(self.test_lowlevel_data)}}
+
+        # Read from the database, and then from the cache
+        self.assertEqual(expected, db.data.load_many_low_level_json(recordings))
+        self.assertEqual(expected, db.data.load_many_low_level_json(recordings))
+        self.assertEqual(1, db.document_cache.get_stats()["lowlevel"]["hits"])
+
+        self.assertEqual(expected[self.test_mbid]['0'], db.data.load_low_level_json(self.test_mbid.upper()))
+        with self.assertRaises(db.exceptions.NoDataFoundException):
+            db.data.load_low_level_json(self.test_mbid, 1)
+
+    @mock.patch("db.document_cache.MAX_CACHED_DOCUMENT_SIZE", 10)
+    def test_load_many_low_level_not_admitted(self):
+        db.data.write_low_level(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        recordings = [(self.test_mbid, 0)]
+        expected = {self.test_mbid: {'0': self.test_lowlevel_data}}
+
+        self.assertEqual(expected, db.data.load_many_low_level(recordings))
+        self.assertEqual(expected, db.data.load_many_low_level(recordings))
+        self.assertEqual({"hits": 0, "misses": 2, "not_admitted": 2, "hit_ratio": 0.0},
+                         db.document_cache.get_stats()["lowlevel"])
+
     def test_write_load_high_level(self):
         """Writing and loading a dict returns the same data"""
         ll = {"data": "one",
@@ -278,6 +462,54 @@ class DataDBTestCase(AcousticbrainzTestCase):
             result = connection.execute("select id from highlevel where mbid = %s", (self.test_mbid,))
             self.assertEqual(result.rowcount, 1)
 
+    def test_write_many_high_level(self):
+        ll = {"data": "one",
+              "metadata": {"audio_properties": {"lossless": True}, "version": {"essentia_build_sha": "x"}}}
+        ll_two = {"data": "two",
+                  "metadata": {"audio_properties": {"lossless": True}, "version": {"essentia_build_sha": "x"}}}
+        ll_three = {"data": "three",
+                    "metadata": {"audio_properties": {"lossless": True}, "version": {"essentia_build_sha": "x"}}}
+        ver = {"hlversion": "123", "models_essentia_git_sha": "v1"}
+        hl = {"highlevel": {"model1": {"x": "y"}, "model2": {"a": "b"}},
+              "metadata": {"meta": "here",
+                           "version": {"highlevel": ver}
+                           }
+              }
+        hl_two = {"highlevel": {"model1": {"x": "z"}},
+                  "metadata": {"meta": "there",
+                               "version": {"highlevel": ver}
+                               }
+                  }
+
+        db.data.add_model("model1", "v1", "show")
+        db.data.write_low_level(self.test_mbid, ll, gid_types.GID_TYPE_MBID)
+        db.data.write_low_level(self.test_mbid, ll_two, gid_types.GID_TYPE_MBID)
+        db.data.write_low_level(self.test_mbid_two, ll_three, gid_types.GID_TYPE_MBID)
+        ll_id1, ll_id2 = sorted(self._get_ll_id_from_mbid(self.test_mbid))
+        ll_id3 = self._get_ll_id_from_mbid(self.test_mbid_two)[0]
+
+        db.data.write_many_high_level([(ll_id1, self.test_mbid, hl),
+                                       (ll_id2, self.test_mbid, hl_two),
+                                       (ll_id3, self.test_mbid_two, {})], "test")
+
+        # model2 didn't exist, and was added as hidden
+        db.data.set_model_status("model2", "v1", "show")
+        hl_expected = copy.deepcopy(hl)
+        for mname in ["model1", "model2"]:
+            hl_expected["highlevel"][mname]["version"] = ver
+        hl_two_expected = copy.deepcopy(hl_two)
+        hl_two_expected["highlevel"]["model1"]["version"] = ver
+
+        self.assertEqual(hl_expected, db.data.load_high_level(self.test_mbid, 0))
+        self.assertEqual(hl_two_expected, db.data.load_high_level(self.test_mbid, 1))
+        with self.assertRaises(db.exceptions.NoDataFoundException):
+            db.data.load_high_level(self.test_mbid_two)
+
+        # The empty document still has a highlevel row so that it isn't processed again
+        with db.engine.connect() as connection:
+            result = connection.execute("select id from highlevel where mbid = %s", (self.test_mbid_two,))
+            self.assertEqual(result.rowcount, 1)
+
     def test_load_high_level_offset(self):
         # If there are two lowlevel items, but only one highlevel, we should raise NoDataFound
         second_data = copy.deepcopy(self.test_lowlevel_data)
@@ -526,6 +758,39 @@ class DataDBTestCase(AcousticbrainzTestCase):
 
         self.assertDictEqual(expected, db.data.load_many_high_level(list(recordings)))
 
+    def test_load_many_high_level_cache_invalidated(self):
+        """A change of model status is seen by high-level documents that are already cached"""
+        db.data.write_low_level(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        ll_id = self._get_ll_id_from_mbid(self.test_mbid)[0]
+        db.data.add_model("model1", "v1", "show")
+        db.data.add_model("model2", "v1", "hidden")
+
+        ver = {"hlversion": "123", "models_essentia_git_sha": "v1"}
+        hl = {"highlevel": {"model1": {"x": "y"}, "model2": {"a": "b"}},
+              "metadata": {"meta": "here", "version": {"highlevel": ver}}}
+        db.data.write_high_level(self.test_mbid, ll_id, hl, "sha")
+        recordings = [(self.test_mbid, 0)]
+
+        result = db.data.load_many_high_level(recordings)
+        self.assertEqual(["model1"], list(result[self.test_mbid]["0"]["highlevel"].keys()))
+        result = db.data.load_many_high_level(recordings)
+        self.assertEqual(["model1"], list(result[self.test_mbid]["0"]["highlevel"].keys()))
+        self.assertEqual(1, db.document_cache.get_stats()["highlevel"]["hits"])
+
+        db.data.set_model_status("model2", "v1", "show")
+        result = db.data.load_many_high_level(recordings)
+        self.assertEqual(["model1", "model2"], sorted(result[self.test_mbid]["0"]["highlevel"].keys()))
+        self.assertEqual(1, db.document_cache.get_stats()["highlevel"]["hits"])
+
+    @mock.patch("db.document_cache.time.time", return_value=1000.0)
+    def test_invalidate_high_level_same_time(self, _):
+        """Invalidating the cached high-level documents twice at the same time gives a new token each time"""
+        generations = []
+        for _ in range(2):
+            db.document_cache.invalidate_high_level()
+            generations.append(db.document_cache._get_highlevel_generation())
+        self.assertNotEqual(generations[0], generations[1])
+
     def test_load_many_high_level_offset(self):
         # If no hl data is found, empty dictionary is returned
         recordings = [(self.test_mbid, 0),
@@ -738,6 +1003,9 @@ class DataDBTestCase(AcousticbrainzTestCase):
             connection.execute(
                 sqlalchemy.text("""UPDATE model set class_mapping = '{"one": "Class One", "two": "Class Two"}'::jsonb""")
             )
+        # Class mappings and documents are cached, so changing a mapping requires clearing the caches
+        db.data.clear_caches()
+        db.document_cache.invalidate_high_level()
 
         # Now with the mapping, the values in the expected values have been changed
         hl1_expected = copy.deepcopy(hl1)
@@ -750,6 +1018,39 @@ class DataDBTestCase(AcousticbrainzTestCase):
         }
         self.assertEqual(expected, db.data.load_many_high_level(list(recordings), map_classes=True))
 
+    def test_load_many_high_level_shared_version(self):
+        """Models with the same version share one version document, and class mappings
+        are only read from the database once"""
+        db.data.write_low_level(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        db.data.write_low_level(self.test_mbid_two, self.test_lowlevel_data_two, gid_types.GID_TYPE_MBID)
+        ll_id1 = self._get_ll_id_from_mbid(self.test_mbid)[0]
+        ll_id2 = self._get_ll_id_from_mbid(self.test_mbid_two)[0]
+        db.data.add_model("model1", "v1", "show")
+        db.data.add_model("model2", "v1", "show")
+        with db.engine.connect() as connection:
+            connection.execute(
+                sqlalchemy.text("""UPDATE model set class_mapping = '{"one": "Class One", "two": "Class Two"}'::jsonb""")
+            )
+
+        ver = {"hlversion": "123", "models_essentia_git_sha": "v1"}
+        model_data = {"all": {"one": 0.4, "two": 0.6}, "probability": 0.6, "value": "two"}
+        hl = {"highlevel": {"model1": model_data, "model2": model_data},
+              "metadata": {"meta": "here", "version": {"highlevel": ver}}}
+        db.data.write_many_high_level([(ll_id1, self.test_mbid, hl), (ll_id2, self.test_mbid_two, hl)], "sha")
+
+        result = db.data.load_many_high_level([(self.test_mbid, 0), (self.test_mbid_two, 0)], map_classes=True)
+        expected_model = {"all": {"Class One": 0.4, "Class Two": 0.6}, "probability": 0.6, "value": "Class Two",
+                          "version": ver}
+        for mbid in [self.test_mbid, self.test_mbid_two]:
+            highlevel = result[mbid]["0"]["highlevel"]
+            self.assertEqual({"model1": expected_model, "model2": expected_model}, highlevel)
+            self.assertIs(highlevel["model1"]["version"], highlevel["model2"]["version"])
+        self.assertEqual(0, db.data.get_cache_stats()["class_mapping"]["hits"])
+
+        db.document_cache.invalidate_high_level()
+        db.data.load_many_high_level([(self.test_mbid, 0)], map_classes=True)
+        self.assertEqual(2, db.data.get_cache_stats()["class_mapping"]["hits"])
+
     def test_load_many_individual_features(self):
         """Lowlevel data returned matches (mbid, offset) pairs. Only returns features that
         are specified, with lowlevel structure maintained.
@@ -767,13 +1068,13 @@ class DataDBTestCase(AcousticbrainzTestCase):
                       (self.test_mbid, 2),
                       (self.test_mbid_two, 0)]
 
-        features = [("llj.data->'lowlevel'->'average_loudness'", "lowlevel.average_loudness", None),
-                    ("llj.data->'lowlevel'->'dynamic_complexity'", "lowlevel.dynamic_complexity", None),
-                    ("llj.data->'metadata'->'audio_properties'->'replay_gain'", "metadata.audio_properties.replay_gain", None),
-                    ("llj.data->'metadata'->'tags'", "metadata.tags", {}),
-                    ("llj.data->'rhythm'->'beats_loudness'->'mean'", "rhythm.beats_loudness.mean", None),
-                    ("llj.data->'rhythm'->'bpm_histogram_second_peak_bpm'->'mean'", "rhythm.bpm_histogram_second_peak_bpm.mean", None),
-                    ("llj.data->'tonal'->'key_key'", "tonal.key_key", None)]
+        features = [("llf.lowlevel_average_loudness", "lowlevel.average_loudness", None),
+                    ("llf.lowlevel_dynamic_complexity", "lowlevel.dynamic_complexity", None),
+                    ("llf.metadata_audio_properties_replay_gain", "metadata.audio_properties.replay_gain", None),
+                    ("llf.metadata_tags", "metadata.tags", {}),
+                    ("llf.rhythm_beats_loudness_mean", "rhythm.beats_loudness.mean", None),
+                    ("llf.rhythm_bpm_histogram_second_peak_bpm_mean", "rhythm.bpm_histogram_second_peak_bpm.mean", None),
+                    ("llf.tonal_key_key", "tonal.key_key", None)]
 
         expected = json.loads(open(os.path.join(DB_TEST_DATA_PATH, "lowlevel_select_features_response.json")).read())
         self.assertEqual(expected, db.data.load_many_individual_features(list(recordings), features))
@@ -786,13 +1087,13 @@ class DataDBTestCase(AcousticbrainzTestCase):
         recordings = [(self.test_mbid, 0),
                       (self.test_mbid_two, 0)]
 
-        features = [("llj.data->'lowlevel'->'average_loudness'", "lowlevel.average_loudness", None),
-                    ("llj.data->'lowlevel'->'dynamic_complexity'", "lowlevel.dynamic_complexity", None),
-                    ("llj.data->'metadata'->'audio_properties'->'replay_gain'", "metadata.audio_properties.replay_gain", None),
-                    ("llj.data->'metadata'->'tags'", "metadata.tags", {}),
-                    ("llj.data->'rhythm'->'beats_loudness'->'mean'", "rhythm.beats_loudness.mean", None),
-                    ("llj.data->'rhythm'->'bpm_histogram_second_peak_bpm'->'mean'", "rhythm.beats_loudness.mean", None),
-                    ("llj.data->'tonal'->'key_key'", "tonal.key_key", None)]
+        features = [("llf.lowlevel_average_loudness", "lowlevel.average_loudness", None),
+                    ("llf.lowlevel_dynamic_complexity", "lowlevel.dynamic_complexity", None),
+                    ("llf.metadata_audio_properties_replay_gain", "metadata.audio_properties.replay_gain", None),
+                    ("llf.metadata_tags", "metadata.tags", {}),
+                    ("llf.rhythm_beats_loudness_mean", "rhythm.beats_loudness.mean", None),
+                    ("llf.rhythm_bpm_histogram_second_peak_bpm_mean", "rhythm.beats_loudness.mean", None),
+                    ("llf.tonal_key_key", "tonal.key_key", None)]
 
         expected = {}
         self.assertEqual(expected, db.data.load_many_individual_features(list(recordings), features))
@@ -805,9 +1106,9 @@ class DataDBTestCase(AcousticbrainzTestCase):
 
         recordings = [(self.test_mbid, 0)]
 
-        features = [("llj.data->'lowlevel'->'average_loudness'", "lowlevel.average_loudness", None),
-                    ("llj.data->'metadata'->'audio_properties'->'replay_gain'", "metadata.audio_properties.replay_gain", None),
-                    ("llj.data->'metadata'->'tags'", "metadata.tags", {})]
+        features = [("llf.lowlevel_average_loudness", "lowlevel.average_loudness", None),
+                    ("llf.metadata_audio_properties_replay_gain", "metadata.audio_properties.replay_gain", None),
+                    ("llf.metadata_tags", "metadata.tags", {})]
 
         expected = {"0dad432b-16cc-4bf0-8961-fd31d124b01b": {"0": {"lowlevel": {"average_loudness": None},
                                                                    "metadata": {"audio_properties": {
@@ -824,15 +1125,16 @@ class DataDBTestCase(AcousticbrainzTestCase):
         features = []
         self.assertEqual("", db.data.build_feature_string(features))
 
-        features = [("llj.data->'lowlevel'->'average_loudness'", "lowlevel.average_loudness", None),
-                    ("llj.data->'lowlevel'->'dynamic_complexity'", "lowlevel.dynamic_complexity", None)]
-        expected_string = """llj.data->'lowlevel'->'average_loudness' AS \"lowlevel.average_loudness\", llj.data->'lowlevel'->'dynamic_complexity' AS \"lowlevel.dynamic_complexity\""""
+        features = [("llf.lowlevel_average_loudness", "lowlevel.average_loudness", None),
+                    ("llf.lowlevel_dynamic_complexity", "lowlevel.dynamic_complexity", None)]
+        expected_string = ('llf.lowlevel_average_loudness AS "lowlevel.average_loudness", '
+                           'llf.lowlevel_dynamic_complexity AS "lowlevel.dynamic_complexity"')
         self.assertEqual(expected_string, db.data.build_feature_string(features))
 
     def test_bulk_get_feature_recordings(self):
         # If all (MBID, offsets) are not present, empty array is returned
-        feature_string = """llj.data->'lowlevel'->'average_loudness' AS \"lowlevel.average_loudness\",
-                            llj.data->'metadata'->'tags' AS \"metadata.tags\""""
+        feature_string = """llf.lowlevel_average_loudness AS \"lowlevel.average_loudness\",
+                            llf.metadata_tags AS \"metadata.tags\""""
         recordings = [(self.test_mbid, 0)]
         self.assertEqual([], db.data.bulk_get_recording_features(recordings, feature_string))
 
@@ -879,9 +1181,9 @@ class DataDBTestCase(AcousticbrainzTestCase):
                "submission_offset": 0,
                "lowlevel.average_loudness": 0.048737552017,
                "rhythm.bpm": None}
-        features = [("llj.data->'lowlevel'->'average_loudness'", "lowlevel.average_loudness", None),
-                    ("llj.data->'metadata'->'tags'", "metadata.tags", {}),
-                    ("llj.data->'rhythm'->'bpm'", "rhythm.bpm", None)]
+        features = [("llf.lowlevel_average_loudness", "lowlevel.average_loudness", None),
+                    ("llf.metadata_tags", "metadata.tags", {}),
+                    ("llf.rhythm_bpm", "rhythm.bpm", None)]
 
         # Row data is reconstructed to mirror lowlevel document structure
         expected_dict = {"lowlevel": {"average_loudness": 0.048737552017},
@@ -889,6 +1191,41 @@ class DataDBTestCase(AcousticbrainzTestCase):
                          "rhythm": {"bpm": None}}
         self.assertEqual(expected_dict, db.data.parse_features_row(row, features))
 
+    def _get_lowlevel_features(self):
+        with db.engine.connect() as connection:
+            result = connection.execute(sqlalchemy.text("""
+                SELECT id, rhythm_bpm, metadata_tags, lowlevel_average_loudness
+                  FROM lowlevel_features
+              ORDER BY id
+            """))
+            return [tuple(row) for row in result]
+
+    def test_write_lowlevel_features(self):
+        """Features are copied to the lowlevel_features table when documents are written"""
+        altered_data = copy.deepcopy(self.test_lowlevel_data)
+        del altered_data["lowlevel"]["average_loudness"]
+        db.data.write_low_level(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        db.data.write_many_low_level([(self.test_mbid, altered_data)], gid_types.GID_TYPE_MBID)
+        ll_id1, ll_id2 = sorted(self._get_ll_id_from_mbid(self.test_mbid))
+
+        bpm = self.test_lowlevel_data["rhythm"]["bpm"]
+        tags = self.test_lowlevel_data["metadata"]["tags"]
+        average_loudness = self.test_lowlevel_data["lowlevel"]["average_loudness"]
+        self.assertEqual(self._get_lowlevel_features(), [(ll_id1, bpm, tags, average_loudness),
+                                                         (ll_id2, bpm, tags, None)])
+
+    def test_populate_lowlevel_features(self):
+        db.data.write_low_level(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        db.data.write_low_level(self.test_mbid_two, self.test_lowlevel_data_two, gid_types.GID_TYPE_MBID)
+        expected = self._get_lowlevel_features()
+        self.assertEqual(db.data.populate_lowlevel_features(), 0)
+
+        # As if the submissions were imported from a dump
+        with db.engine.begin() as connection:
+            connection.execute(sqlalchemy.text("DELETE FROM lowlevel_features"))
+        self.assertEqual(db.data.populate_lowlevel_features(batch_size=1), 2)
+        self.assertEqual(self._get_lowlevel_features(), expected)
+
     def test_count_lowlevel(self):
         db.data.submit_low_level_data(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
         self.assertEqual(1, db.data.count_lowlevel(self.test_mbid))
@@ -909,6 +1246,32 @@ class DataDBTestCase(AcousticbrainzTestCase):
         get_id = db.data._get_model_id("modelname", "v1")
         self.assertEqual(modelid, get_id)
 
+    def test_get_or_add_model_id(self):
+        existing_id = db.data.add_model("existing", "v1", "show")
+
+        with db.engine.begin() as connection:
+            self.assertEqual(existing_id, db.data.get_or_add_model_id(connection, "existing", "v1"))
+            # A missing model is added as part of this transaction
+            new_id = db.data.get_or_add_model_id(connection, "new", "v1")
+            self.assertEqual(new_id, db.data.get_or_add_model_id(connection, "new", "v1"))
+            self.assertEqual(db.data.get_cache_stats()["model"]["size"], 1)
+        self.assertEqual(new_id, db.data._get_model_id("new", "v1"))
+        self.assertEqual(db.data.get_cache_stats()["model"]["size"], 2)
+
+        # A model added in a transaction that is rolled back isn't remembered
+        with db.engine.connect() as connection:
+            transaction = connection.begin()
+            db.data.get_or_add_model_id(connection, "rolledback", "v1")
+            transaction.rollback()
+        self.assertIsNone(db.data._get_model_id("rolledback", "v1"))
+        self.assertEqual(db.data.get_cache_stats()["model"]["size"], 2)
+
+        # A model added by another process is found by reloading the table
+        other_id = db.data.add_model("other", "v1")
+        db.data._model_cache.delete(("other", "v1"))
+        with db.engine.begin() as connection:
+            self.assertEqual(other_id, db.data.get_or_add_model_id(connection, "other", "v1"))
+
     def test_get_failed_highlevel_submissions(self):
         hl = {"highlevel": {"model1": {"x": "y"}, "model2": {"a": "b"}},
               "metadata": {}
@@ -923,6 +1286,48 @@ class DataDBTestCase(AcousticbrainzTestCase):
         self.assertEqual(len(rows), 1)
         self.assertEqual(rows[0]["gid"], self.test_mbid)
 
+        # Removing the failed row queues the submission to be processed again
+        self.assertEqual(db.data.claim_unprocessed_highlevel_documents(), [])
+        db.data.remove_failed_highlevel_submissions()
+        docs = db.data.claim_unprocessed_highlevel_documents()
+        self.assertEqual([doc[0] for doc in docs], [ll_id])
+
+    def test_claim_unprocessed_highlevel_documents(self):
+        second_data = copy.deepcopy(self.test_lowlevel_data)
+        second_data["metadata"]["tags"]["album"] = ["Another album"]
+        db.data.write_low_level(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        db.data.write_many_low_level([(self.test_mbid, second_data),
+                                      (self.test_mbid_two, self.test_lowlevel_data_two)], gid_types.GID_TYPE_MBID)
+        ll_id1, ll_id2 = sorted(self._get_ll_id_from_mbid(self.test_mbid))
+        ll_id3 = self._get_ll_id_from_mbid(self.test_mbid_two)[0]
+
+        docs = db.data.claim_unprocessed_highlevel_documents(limit=2)
+        self.assertEqual([(doc[0], doc[1]) for doc in docs], [(ll_id1, self.test_mbid), (ll_id2, self.test_mbid)])
+
+        fp = six.BytesIO()
+        db.data.copy_low_level_json([ll_id2, ll_id1], fp)
+        lines = fp.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        ll_id, data = lines[0].split(db.data.LOW_LEVEL_COPY_DELIMITER)
+        self.assertEqual(int(ll_id), ll_id1)
+        self.assertEqual(json.loads(data.decode("utf-8")), self.test_lowlevel_data)
+
+        # Claimed documents aren't returned again
+        docs = db.data.claim_unprocessed_highlevel_documents(limit=2)
+        self.assertEqual([doc[0] for doc in docs], [ll_id3])
+        self.assertEqual(db.data.claim_unprocessed_highlevel_documents(), [])
+
+        # Until their lease expires, unless high-level data has been written
+        db.data.write_many_high_level([(ll_id3, self.test_mbid_two, {})], "test")
+        db.data.write_high_level(self.test_mbid, ll_id1, {}, "test")
+        self.assertEqual(db.data.claim_unprocessed_highlevel_documents(), [])
+
+        db.data.populate_highlevel_pending()
+        with db.engine.begin() as connection:
+            connection.execute(sqlalchemy.text("UPDATE highlevel_pending SET claimed_until = NULL"))
+        docs = db.data.claim_unprocessed_highlevel_documents()
+        self.assertEqual([doc[0] for doc in docs], [ll_id2])
+
     def test_get_active_models(self):
         models = db.data.get_active_models()
         self.assertEqual(len(models), 0)
@@ -0,0 +1,48 @@
+from unittest import mock
+
+from sqlalchemy import text
+from sqlalchemy.pool import NullPool, QueuePool
+
+import db
+from webserver.testing import AcousticbrainzTestCase
+
+
+class PoolTestCase(AcousticbrainzTestCase):
+
+    def test_get_pool_options(self):
+        options = db.get_pool_options({"SQLALCHEMY_POOL_SIZE": 2, "SQLALCHEMY_PGBOUNCER": True})
+        self.assertEqual(options["pool_size"], 2)
+        self.assertEqual(options["max_overflow"], db.DEFAULT_POOL_MAX_OVERFLOW)
+        self.assertTrue(options["pool_pre_ping"])
+        self.assertTrue(options["pgbouncer"])
+
+    def test_init_db_engine_pgbouncer(self):
+        uri = self.app.config["SQLALCHEMY_DATABASE_URI"]
+        try:
+            db.init_db_engine(uri, pgbouncer=True)
+            self.assertIsInstance(db.engine.pool, NullPool)
+            db.init_db_engine(uri, pool_size=2)
+            self.assertIsInstance(db.engine.pool, QueuePool)
+            self.assertEqual(db.engine.pool.size(), 2)
+        finally:
+            db.init_db_engine(uri, **db.get_pool_options(self.app.config))
+
+    def test_pool_stats(self):
+        before = db.get_pool_stats()
+        with db.engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+            self.assertEqual(db.get_pool_stats()["checked_out"], before["checked_out"] + 1)
+        after = db.get_pool_stats()
+        self.assertEqual(after["checkouts"], before["checkouts"] + 1)
+        self.assertEqual(after["checked_out"], before["checked_out"])
+
+    def test_connection_not_shared_after_fork(self):
+        with db.engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+        connects = db.get_pool_stats()["connects"]
+
+        # A connection made by another process is replaced instead of being reused
+        with mock.patch("os.getpid", return_value=-1):
+            with db.engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+        self.assertEqual(db.get_pool_stats()["connects"], connects + 1)
@@ -1,8 +1,12 @@
 import copy
 import json
 import os.path
+import shutil
+import tempfile
 from unittest import mock
 
+from flask import current_app
+
 import db
 import db.data
 import db.similarity
@@ -11,6 +15,7 @@ import db.exceptions
 from webserver.testing import AcousticbrainzTestCase, DB_TEST_DATA_PATH, gid_types
 import db.test_data.similarity_metrics_data
 import similarity.utils
+from similarity.index_model import AnnoyModel
 
 from sqlalchemy import text
 
@@ -65,6 +70,190 @@ class SimilarityDBTestCase(AcousticbrainzTestCase):
 
             self.assertEqual(db.test_data.similarity_metrics_data.expected_similarity_rows, recs)
 
+    def _get_similarity_rows(self):
+        with db.engine.connect() as connection:
+            result = connection.execute(text("""
+                SELECT *
+                  FROM similarity.similarity
+              ORDER BY id
+            """))
+            return [dict(row) for row in result]
+
+    def test_add_metrics_parallel(self):
+        db.data.submit_low_level_data(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        id_1 = db.data.get_ids_by_mbids([(self.test_mbid, 0)])[0]
+        db.data.write_high_level(self.test_mbid, id_1, self.test_highlevel_data, "test")
+        db.data.submit_low_level_data(self.test_mbid_two, self.test_lowlevel_data_two, gid_types.GID_TYPE_MBID)
+        self.show_highlevel_models()
+        db.similarity_stats.compute_stats(2)
+
+        # The same rows are added as by add_metrics
+        db.similarity.add_metrics_parallel(1, 2)
+        self.assertEqual(db.test_data.similarity_metrics_data.expected_similarity_rows, self._get_similarity_rows())
+        self.assertFalse(db.similarity.similarity_shards_exist())
+
+    def test_copy_similarity(self):
+        db.data.submit_low_level_data(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        id_1 = db.data.get_ids_by_mbids([(self.test_mbid, 0)])[0]
+        db.data.write_high_level(self.test_mbid, id_1, self.test_highlevel_data, "test")
+        db.data.submit_low_level_data(self.test_mbid_two, self.test_lowlevel_data_two, gid_types.GID_TYPE_MBID)
+        self.show_highlevel_models()
+        db.similarity_stats.compute_stats(2)
+        metrics = similarity.utils.init_metrics()
+        for metric in metrics:
+            db.similarity_stats.assign_stats(metric)
+
+        with db.engine.connect() as connection:
+            with connection.begin():
+                rows = db.similarity.get_batch_data(connection, 0, 2).fetchall()
+                ids, vectors = db.similarity.transform_batch_to_similarity(rows, metrics)
+                db.similarity.copy_similarity(connection, ids, vectors)
+                # Nothing is copied for an empty batch
+                db.similarity.copy_similarity(connection, [], {})
+
+        # Values are the same as inserted values
+        self.assertEqual(db.test_data.similarity_metrics_data.expected_similarity_rows, self._get_similarity_rows())
+
+    def test_rebuild_similarity(self):
+        db.data.submit_low_level_data(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        id_1 = db.data.get_ids_by_mbids([(self.test_mbid, 0)])[0]
+        db.data.write_high_level(self.test_mbid, id_1, self.test_highlevel_data, "test")
+        db.data.submit_low_level_data(self.test_mbid_two, self.test_lowlevel_data_two, gid_types.GID_TYPE_MBID)
+        self.show_highlevel_models()
+        db.similarity_stats.compute_stats(2)
+
+        # Only some of the rows are in the old table
+        db.similarity.submit_similarity_by_id(id_1)
+        db.similarity.plan_similarity_shards(2)
+        db.similarity.rebuild_similarity(1)
+        self.assertEqual(db.test_data.similarity_metrics_data.expected_similarity_rows, self._get_similarity_rows())
+        self.assertFalse(db.similarity.similarity_shards_exist())
+
+        with db.engine.connect() as connection:
+            result = connection.execute(text("""
+                SELECT conname
+                  FROM pg_constraint
+                 WHERE conrelid = 'similarity.similarity'::regclass
+              ORDER BY conname
+            """))
+            self.assertEqual(["similarity_fk_lowlevel", "similarity_pkey"], [row[0] for row in result])
+            result = connection.execute(text("""
+                SELECT relpersistence
+                  FROM pg_class
+                 WHERE oid = 'similarity.similarity'::regclass
+            """))
+            self.assertEqual("p", result.fetchone()[0])
+
+    def test_plan_similarity_shards(self):
+        db.data.submit_low_level_data(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        id_1 = db.data.get_ids_by_mbids([(self.test_mbid, 0)])[0]
+        db.data.write_high_level(self.test_mbid, id_1, self.test_highlevel_data, "test")
+        db.data.submit_low_level_data(self.test_mbid_two, self.test_lowlevel_data_two, gid_types.GID_TYPE_MBID)
+        id_2 = db.data.get_ids_by_mbids([(self.test_mbid_two, 0)])[0]
+        self.show_highlevel_models()
+        db.similarity_stats.compute_stats(2)
+        metrics = similarity.utils.init_metrics()
+        for metric in metrics:
+            db.similarity_stats.assign_stats(metric)
+
+        # The ranges cover all ids
+        self.assertFalse(db.similarity.similarity_shards_exist())
+        shards = db.similarity.plan_similarity_shards(2)
+        self.assertEqual(2, len(shards))
+        self.assertEqual((0, 0), (shards[0][0], shards[0][2]))
+        self.assertEqual(shards[0][1], shards[1][0])
+        self.assertEqual(id_2, shards[1][1])
+        self.assertTrue(db.similarity.similarity_shards_exist())
+
+        # Processing a range saves its progress, and the remaining ranges are used by the next run
+        added = db.similarity.add_metrics_shard(metrics, *shards[0], batch_size=1)
+        self.assertEqual(len([i for i in (id_1, id_2) if i <= shards[0][1]]), added)
+        self.assertEqual(shards[1:], db.similarity.plan_similarity_shards(2))
+        self.assertEqual(shards[1:], db.similarity.plan_similarity_shards(2))
+        db.similarity.add_metrics_shard(metrics, *shards[1], batch_size=1)
+        self.assertEqual([], db.similarity.plan_similarity_shards(2))
+        self.assertEqual(db.test_data.similarity_metrics_data.expected_similarity_rows, self._get_similarity_rows())
+
+        # A range is added for new submissions
+        second_data = copy.deepcopy(self.test_lowlevel_data)
+        second_data["metadata"]["tags"]["album"] = ["Another album"]
+        db.data.submit_low_level_data(self.test_mbid, second_data, gid_types.GID_TYPE_MBID)
+        id_3 = db.data.get_ids_by_mbids([(self.test_mbid, 1)])[0]
+        self.assertEqual([(id_2, id_3, id_2)], db.similarity.plan_similarity_shards(2))
+
+        # New ranges start after the highest id in the similarity table
+        db.similarity.delete_similarity_shards()
+        self.assertFalse(db.similarity.similarity_shards_exist())
+        self.assertEqual([(id_2, id_3, id_2)], db.similarity.plan_similarity_shards(10))
+
+    def test_add_indices(self):
+        db.data.submit_low_level_data(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        id_1 = db.data.get_ids_by_mbids([(self.test_mbid, 0)])[0]
+        db.data.write_high_level(self.test_mbid, id_1, self.test_highlevel_data, "test")
+        db.data.submit_low_level_data(self.test_mbid_two, self.test_lowlevel_data_two, gid_types.GID_TYPE_MBID)
+        id_2 = db.data.get_ids_by_mbids([(self.test_mbid_two, 0)])[0]
+        self.show_highlevel_models()
+        db.similarity_stats.compute_stats(2)
+        db.similarity.add_metrics(2)
+
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        with mock.patch.dict(current_app.config, {"SIMILARITY_INDEX_DIR": location}):
+            # Indices aren't built while a parallel run of add-metrics is unfinished, because
+            # it may still add rows below the highest id in the similarity table
+            with db.engine.begin() as connection:
+                connection.execute(text("""
+                    INSERT INTO similarity.similarity_shards (start_id, end_id, last_id)
+                         VALUES (0, :end_id, 0)
+                """), {"end_id": id_2})
+            with self.assertRaises(db.exceptions.DatabaseException):
+                db.similarity.add_indices([AnnoyModel("mfccs")], 1)
+            with self.assertRaises(db.exceptions.DatabaseException):
+                db.similarity.add_index(AnnoyModel("mfccs"), 2, [id_1, id_2], 1)
+            self.assertEqual([], os.listdir(location))
+            db.similarity.delete_similarity_shards()
+
+            indices = [AnnoyModel("mfccs"), AnnoyModel("key")]
+            db.similarity.add_indices(indices, 1, workers=2)
+
+            for metric_name in ["mfccs", "key"]:
+                index = AnnoyModel(metric_name, load_existing=True)
+                # Items are numbered from 0, however sparse the ids are
+                self.assertEqual(2, index.index.get_n_items())
+                self.assertEqual([id_1, id_2], index.mapping.get_item_ids([0, 1]))
+                similar = index.get_nns_by_mbid(self.test_mbid, 0, 2)
+                self.assertEqual({(self.test_mbid, 0), (self.test_mbid_two, 0)},
+                                 {(item["recording_mbid"], item["offset"]) for item in similar})
+                row = db.similarity.get_similarity_row_id(id_2)
+                self.assertEqual(len(row[metric_name]), len(index.index.get_item_vector(1)))
+
+    def test_transform_batch_to_similarity(self):
+        """Vectors computed for a whole batch are the same as vectors computed for each row"""
+        db.data.submit_low_level_data(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        id_1 = db.data.get_ids_by_mbids([(self.test_mbid, 0)])[0]
+        db.data.write_high_level(self.test_mbid, id_1, self.test_highlevel_data, "test")
+        db.data.submit_low_level_data(self.test_mbid_two, self.test_lowlevel_data_two, gid_types.GID_TYPE_MBID)
+        id_2 = db.data.get_ids_by_mbids([(self.test_mbid_two, 0)])[0]
+        self.show_highlevel_models()
+        db.similarity_stats.compute_stats(2)
+
+        metrics = similarity.utils.init_metrics()
+        for metric in metrics:
+            db.similarity_stats.assign_stats(metric)
+        with db.engine.connect() as connection:
+            rows = [dict(row) for row in db.similarity.get_batch_data(connection, 0, 2)]
+        # A row without any usable data
+        rows.append({"id": id_2 + 1,
+                     "ll_data": {"mfcc": None, "gfcc": None, "bpm": None, "onset_rate": 0,
+                                 "key": {"key_key": None, "key_scale": None}},
+                     "hl_data": None})
+
+        ids, vectors = db.similarity.transform_batch_to_similarity(rows, metrics)
+        self.assertEqual([id_1, id_2, id_2 + 1], ids)
+        self.assertEqual((3, 13), vectors["mfccs"].shape)
+        expected = [db.similarity.bulk_transform_data_to_similarity(row, metrics) for row in rows]
+        self.assertEqual(expected, db.similarity.similarity_rows(ids, vectors))
+
     def _convert_ll_to_bulk_format(self, lowlevel_data):
         return {"gfcc": lowlevel_data["lowlevel"]["gfcc"]["mean"],
                 "onset_rate": lowlevel_data["rhythm"]["onset_rate"],
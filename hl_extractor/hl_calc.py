@@ -1,23 +1,27 @@
 #!/usr/bin/env python
 import hashlib
-import json
 import logging
 import os
+import queue
 import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import traceback
 
-import concurrent.futures
+import ujson
 import yaml
 from flask import current_app
 
 import db
 import db.data
+from hl_extractor import staging
 
 DEFAULT_NUM_THREADS = 2
+DEFAULT_FETCH_THREADS = 1
+DEFAULT_SAVE_THREADS = 1
 
 SLEEP_DURATION = 30  # number of seconds to wait between runs
 BASE_DIR = os.path.dirname(__file__)
@@ -31,6 +35,15 @@ DOCUMENTS_PER_QUERY = 100
 
 MAX_ITEMS_PER_PROCESS = 20
 
+# Number of chunks of documents to fetch ahead of each extractor thread
+PREFETCH_CHUNKS_PER_THREAD = 2
+
+STATS_INTERVAL = 60  # number of seconds between logging pipeline statistics
+CONTROL_INTERVAL = 5  # number of seconds between checks of the control file for new settings
+
+# Settings of a running pipeline which can be changed in its control file
+CONTROL_SETTINGS = ("threads", "batch_size", "fetch_threads", "save_threads")
+
 
 class HighLevelExtractorError(Exception):
     """Indicates an error running the highlevel extractor"""
@@ -47,12 +60,17 @@ def chunks(l, n):
         yield l[i:i+n]
 
 
-def process_lowlevel_data(data, logger_name=None):
+def process_lowlevel_data(data, logger_name=None, binary=HIGH_LEVEL_EXTRACTOR_BINARY, staging_dir=None):
     """Process a set of lowlevel submissions with the highlevel binary.
 
     Arguments:
         data: list of up to ``MAX_ITEMS_PER_PROCESS`` (rowid, mbid, ll_data) tuples containing
-         the lowlevel id of a submission, its MBID, and the actual data of the submission
+         the lowlevel id of a submission, its MBID, and the actual data of the submission.
+         If ll_data is None, the data is copied from the database straight into the extractor's input file
+        logger_name: if set, log the start and end of processing to this logger
+        binary: path to the highlevel extractor binary
+        staging_dir: the directory to write the extractor's input and output files to,
+         see :func:`hl_extractor.staging.get_staging_dir`
 
     Returns:
         a list of (rowid, mbid, hl_data) tuples containing the highlevel results for the associated
@@ -79,46 +97,66 @@ def process_lowlevel_data(data, logger_name=None):
         logger.info("Starting {}".format(llids))
 
     try:
-        working_dir = tempfile.mkdtemp(prefix="hlcalc")
-    except IOError as e:
+        working_dir = staging.make_working_dir("hlcalc", staging_dir)
+    except (IOError, OSError) as e:
         raise HighLevelExtractorError("Unable to create temporary directory", e)
 
-    call_args = [HIGH_LEVEL_EXTRACTOR_BINARY]
     results = []
-
-    for rowid, mbid, ll_data in data:
-        in_path = os.path.join(working_dir, '{}-input.json'.format(rowid))
-        out_path = os.path.join(working_dir, '{}-output.json'.format(rowid))
-        try:
-            # Write this data to disk for the extractor to read. If there's an error writing a lowlevel
-            # item to disk, we won't add it to the arguments. When reading the result files after execution
-            # of the extractor a missing output file will raise an IOError, causing an empty result to be
-            # added
-            with open(in_path, 'w') as fp:
-                fp.write(ll_data.encode("utf-8"))
-            call_args.extend([in_path, out_path])
-        except IOError:
-            pass
-
-    if not call_args:
-        raise HighLevelExtractorError("Unable to write any lowlevel files to temporary directory")
-
-    fnull = open(os.devnull, 'w')
     try:
-        call_args.append(PROFILE_CONF)
-        subprocess.check_call(call_args, stdout=fnull, stderr=fnull)
-
+        written = set()
+        to_copy = {}
         for rowid, mbid, ll_data in data:
+            in_path = os.path.join(working_dir, '{}-input.json'.format(rowid))
+            if ll_data is None:
+                to_copy[rowid] = in_path
+                continue
+            try:
+                # Write this data to disk for the extractor to read. If there's an error writing a lowlevel
+                # item to disk, we won't add it to the arguments. When reading the result files after execution
+                # of the extractor a missing output file will raise an IOError, causing an empty result to be
+                # added
+                with open(in_path, 'w', encoding='utf-8') as fp:
+                    fp.write(ll_data)
+                written.add(rowid)
+            except IOError:
+                pass
+
+        if to_copy:
+            writer = staging.LowlevelFileWriter(to_copy)
+            try:
+                db.data.copy_low_level_json(list(to_copy.keys()), writer)
+            except IOError as e:
+                raise HighLevelExtractorError("Unable to write lowlevel files to temporary directory", e)
+            finally:
+                writer.close()
+            written |= writer.written
+
+        call_args = [binary]
+        for rowid, _, _ in data:
+            if rowid in written:
+                call_args.extend([os.path.join(working_dir, '{}-input.json'.format(rowid)),
+                                  os.path.join(working_dir, '{}-output.json'.format(rowid))])
+
+        if len(call_args) == 1:
+            raise HighLevelExtractorError("Unable to write any lowlevel files to temporary directory")
+
+        fnull = open(os.devnull, 'w')
+        try:
+            call_args.append(PROFILE_CONF)
+            subprocess.check_call(call_args, stdout=fnull, stderr=fnull)
+        except (subprocess.CalledProcessError, OSError):
+            raise HighLevelExtractorError("Cannot call the highlevel extractor")
+        finally:
+            fnull.close()
+
+        for rowid, mbid, _ in data:
             out_file = '{}-output.json'.format(rowid)
             try:
                 with open(os.path.join(working_dir, out_file), "r") as fp:
-                    hl_data = json.load(fp)
+                    hl_data = ujson.load(fp)
             except (IOError, ValueError):
                 hl_data = {}
             results.append((rowid, mbid, hl_data))
-
-    except (subprocess.CalledProcessError, OSError):
-        raise HighLevelExtractorError("Cannot call the highlevel extractor")
     finally:
         # At this point we can remove the working directory,
         # regardless of if we failed or if we succeeded
@@ -170,62 +208,351 @@ def get_build_sha1(binary):
 
 
 def save_hl_documents(hl_data_list, build_sha1):
-    """Save a list of highlevel documents to the database.
+    """Save a list of highlevel documents to the database in a single transaction.
 
     Arguments:
-        hl_data_list: a tuple of (ll-rowid, mbid, hl_data_json)
+        hl_data_list: a list of (ll-rowid, mbid, hl_data_json) tuples
         build_sha1: the sha1 of the hl extractor used"""
 
-    for rowid, mbid, hl_data in hl_data_list:
-        db.data.write_high_level(mbid, rowid, hl_data, build_sha1)
+    db.data.write_many_high_level(hl_data_list, build_sha1)
 
 
-def main(num_threads=DEFAULT_NUM_THREADS):
-    current_app.logger.info("High-level extractor daemon starting with {} threads".format(num_threads))
-    if num_threads * MAX_ITEMS_PER_PROCESS > DOCUMENTS_PER_QUERY:
-        current_app.logger.warn("Number of threads ({}) * items per thread ({}) = {} is greater than number of "
-                                "documents selected from database ({}), this means that available resources "
-                                "will not be fully utillised".format(
-            num_threads, MAX_ITEMS_PER_PROCESS, (num_threads * MAX_ITEMS_PER_PROCESS), DOCUMENTS_PER_QUERY
-        ))
+class StageStats(object):
+    """Throughput of one stage of the extractor pipeline"""
 
-    try:
-        build_sha1 = get_build_sha1(HIGH_LEVEL_EXTRACTOR_BINARY)
-        create_profile(PROFILE_CONF_TEMPLATE, PROFILE_CONF, build_sha1)
-    except HighLevelConfigurationError as e:
-        current_app.logger.error(u'{}'.format(e))
-        sys.exit(-1)
+    def __init__(self, name, num_threads):
+        self.name = name
+        self.num_threads = num_threads
+        self.items = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self.started = time.time()
+        self._lock = threading.Lock()
 
-    num_processed = 0
-    max_ll_id = 0
+    def set_num_threads(self, num_threads):
+        with self._lock:
+            self.num_threads = num_threads
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
-        while True:
-            docs = db.data.get_unprocessed_highlevel_documents(DOCUMENTS_PER_QUERY, max_ll_id)
-            current_app.logger.info("Got {} documents".format(len(docs)))
+    def record(self, num_items, duration, error=False):
+        with self._lock:
+            self.items += num_items
+            self.busy_time += duration
+            if error:
+                self.errors += 1
 
-            futures = []
-            for subdocs in chunks(docs, MAX_ITEMS_PER_PROCESS):
-                futures.append(executor.submit(process_lowlevel_data, subdocs, current_app.logger.name))
+    def as_dict(self):
+        elapsed = max(time.time() - self.started, 1e-6)
+        with self._lock:
+            return {"threads": self.num_threads,
+                    "items": self.items,
+                    "errors": self.errors,
+                    "items_per_second": round(self.items / elapsed, 2),
+                    # fraction of the time that the threads of this stage were doing work
+                    "utilisation": round(self.busy_time / (elapsed * self.num_threads), 2)}
 
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    hl_data_list = future.result()
-                except HighLevelExtractorError as e:
-                    current_app.logger.error(u"Error when calling extractor: {}".format(e))
-                except Exception as e:
-                    traceback.print_exc()
-                    current_app.logger.error(u"Unknown error when calling extractor: {}".format(e))
-                else:
-                    num_processed += len(hl_data_list)
-                    this_max_ll_id = max([rowid for rowid, _, _ in hl_data_list])
-                    max_ll_id = max(max_ll_id, this_max_ll_id)
-                    save_hl_documents(hl_data_list, build_sha1)
+
+class Pipeline(object):
+    """Compute highlevel data in three stages, each run by its own pool of threads:
+
+      fetch: claim unprocessed documents from the database, in chunks of ``batch_size``
+      extract: copy a chunk of documents from the database to files and run the highlevel extractor on them
+      save: write the results of one or more chunks to the database
+
+    Stages are connected by bounded queues, so fetching stops once a few chunks are waiting
+    for each extractor thread, and extraction stops if saving can't keep up.
+
+    The number of threads of each stage and the batch size can be changed while the
+    pipeline is running with :meth:`reconfigure`.
+    """
+
+    def __init__(self, build_sha1, logger, extract_threads=DEFAULT_NUM_THREADS, batch_size=MAX_ITEMS_PER_PROCESS,
+                 fetch_threads=DEFAULT_FETCH_THREADS, save_threads=DEFAULT_SAVE_THREADS,
+                 binary=HIGH_LEVEL_EXTRACTOR_BINARY, staging_dir=None):
+        _check_batch_size(batch_size)
+        self.build_sha1 = build_sha1
+        self.logger = logger
+        self.batch_size = batch_size
+        self.binary = binary
+        self.staging_dir = staging_dir
+        self.num_threads = {"fetch": fetch_threads, "extract": extract_threads, "save": save_threads}
+        self.extract_queue = queue.Queue(maxsize=extract_threads * PREFETCH_CHUNKS_PER_THREAD)
+        self.save_queue = queue.Queue(maxsize=extract_threads * PREFETCH_CHUNKS_PER_THREAD)
+        self.stats = {name: StageStats(name, num_threads) for name, num_threads in self.num_threads.items()}
+        # The running threads of each stage, by their number in the stage
+        self.threads = {name: {} for name in self.num_threads}
+        self._lock = threading.Lock()
+        self._started = False
+        self._stopping = threading.Event()
+
+    def start(self):
+        """Start the threads of all stages. They run until :meth:`stop` is called."""
+        with self._lock:
+            self._started = True
+            for name in self.num_threads:
+                self._start_threads(name)
+
+    def _start_threads(self, name):
+        # Start threads of a stage until it has as many as it should. A thread whose number is
+        # at least the number of threads of its stage exits once it has finished its current item,
+        # and is only replaced once it has exited.
+        targets = {"fetch": self._fetch, "extract": self._extract, "save": self._save}
+        threads = self.threads[name]
+        for i in range(self.num_threads[name]):
+            if i in threads and threads[i].is_alive():
+                continue
+            thread = threading.Thread(target=targets[name], args=(i,), name="hl_calc_{}_{}".format(name, i))
+            thread.daemon = True
+            thread.start()
+            threads[i] = thread
+
+    def reconfigure(self, extract_threads=None, batch_size=None, fetch_threads=None, save_threads=None):
+        """Change the number of threads of some stages or the number of documents given to each
+        extractor process, without stopping the pipeline. Arguments which are None aren't changed.
+
+        Removed threads exit once they have finished the item they are working on, so that
+        no documents are dropped. New batch sizes apply to documents fetched afterwards.
+
+        Raises:
+            ValueError: if a number of threads is less than 1, or the batch size is out of range
+        """
+        num_threads = {"fetch": fetch_threads, "extract": extract_threads, "save": save_threads}
+        num_threads = {name: count for name, count in num_threads.items() if count is not None}
+        for name, count in num_threads.items():
+            if count < 1:
+                raise ValueError("The number of {} threads must be at least 1".format(name))
+        if batch_size is not None:
+            _check_batch_size(batch_size)
+            self.batch_size = batch_size
+
+        with self._lock:
+            self.num_threads.update(num_threads)
+            for name, count in num_threads.items():
+                self.stats[name].set_num_threads(count)
+            if "extract" in num_threads:
+                for work_queue in (self.extract_queue, self.save_queue):
+                    with work_queue.mutex:
+                        work_queue.maxsize = num_threads["extract"] * PREFETCH_CHUNKS_PER_THREAD
+                        work_queue.not_full.notify_all()
+            if self._started and not self._stopping.is_set():
+                for name in num_threads:
+                    self._start_threads(name)
+
+    def get_settings(self):
+        """Get the current settings of the pipeline, with the names of :data:`CONTROL_SETTINGS`"""
+        with self._lock:
+            return {"threads": self.num_threads["extract"],
+                    "batch_size": self.batch_size,
+                    "fetch_threads": self.num_threads["fetch"],
+                    "save_threads": self.num_threads["save"]}
+
+    def stop(self):
+        """Stop all stages and wait for their threads to finish.
+        Documents that haven't been saved yet are claimed again once their lease expires."""
+        self._stopping.set()
+        with self._lock:
+            threads = [thread for stage_threads in self.threads.values() for thread in stage_threads.values()]
+        for thread in threads:
+            thread.join()
+
+    def _is_running(self, name, number):
+        """Check if thread ``number`` of stage ``name`` should keep taking new work"""
+        return not self._stopping.is_set() and number < self.num_threads[name]
+
+    def get_stats(self):
+        """Get the throughput of each stage and the number of chunks waiting in each queue"""
+        stats = {name: stage.as_dict() for name, stage in self.stats.items()}
+        stats["extract"]["queue_depth"] = self.extract_queue.qsize()
+        stats["save"]["queue_depth"] = self.save_queue.qsize()
+        return stats
+
+    def _get(self, work_queue, name, number):
+        """Get the next item from ``work_queue``, or None if the pipeline is stopping
+        or thread ``number`` of stage ``name`` has been removed"""
+        while self._is_running(name, number):
+            try:
+                return work_queue.get(timeout=1)
+            except queue.Empty:
+                pass
+        return None
+
+    def _put(self, work_queue, item):
+        """Put an item on ``work_queue`` once there is space, unless the pipeline is stopping"""
+        while not self._stopping.is_set():
+            try:
+                work_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def _fetch(self, number):
+        while self._is_running("fetch", number):
+            start = time.time()
+            try:
+                docs = db.data.claim_unprocessed_highlevel_documents(DOCUMENTS_PER_QUERY)
+            except Exception as e:
+                self.stats["fetch"].record(0, time.time() - start, error=True)
+                self.logger.error(u"Error when fetching documents: {}".format(e))
+                self._stopping.wait(SLEEP_DURATION)
+                continue
+            self.stats["fetch"].record(len(docs), time.time() - start)
+
+            # Documents are copied from the database by the extract stage
+            docs = [(rowid, mbid, None) for rowid, mbid in docs]
+            for subdocs in chunks(docs, self.batch_size):
+                self._put(self.extract_queue, subdocs)
 
             # If we got less than the number of documents we asked for then we should wait
             # for a while for some more to appear
             if len(docs) < DOCUMENTS_PER_QUERY:
-                if num_processed > 0:
-                    current_app.logger.info("processed {} documents, none remain. Sleeping.".format(num_processed))
-                num_processed = 0
-                time.sleep(SLEEP_DURATION)
+                self._stopping.wait(SLEEP_DURATION)
+
+    def _extract(self, number):
+        while True:
+            subdocs = self._get(self.extract_queue, "extract", number)
+            if subdocs is None:
+                return
+            start = time.time()
+            try:
+                hl_data_list = process_lowlevel_data(subdocs, self.logger.name, self.binary, self.staging_dir)
+            except HighLevelExtractorError as e:
+                self.stats["extract"].record(0, time.time() - start, error=True)
+                self.logger.error(u"Error when calling extractor: {}".format(e))
+            except Exception as e:
+                self.stats["extract"].record(0, time.time() - start, error=True)
+                traceback.print_exc()
+                self.logger.error(u"Unknown error when calling extractor: {}".format(e))
+            else:
+                self.stats["extract"].record(len(hl_data_list), time.time() - start)
+                self._put(self.save_queue, hl_data_list)
+
+    def _save(self, number):
+        while True:
+            # Write everything that has been extracted so far in a single transaction
+            hl_data_list = self._get(self.save_queue, "save", number)
+            if hl_data_list is None:
+                return
+            hl_data_list = list(hl_data_list)
+            while len(hl_data_list) < DOCUMENTS_PER_QUERY:
+                try:
+                    hl_data_list.extend(self.save_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            start = time.time()
+            try:
+                save_hl_documents(hl_data_list, self.build_sha1)
+            except Exception as e:
+                # These documents will be claimed and processed again once their lease expires
+                self.stats["save"].record(0, time.time() - start, error=True)
+                self.logger.error(u"Error when saving documents: {}".format(e))
+            else:
+                self.stats["save"].record(len(hl_data_list), time.time() - start)
+
+
+def _check_batch_size(batch_size):
+    if not 1 <= batch_size <= MAX_ITEMS_PER_PROCESS:
+        raise ValueError("'batch_size' must be between 1 and {}".format(MAX_ITEMS_PER_PROCESS))
+
+
+def read_control_file(path):
+    """Read the settings of a running pipeline from a YAML control file, e.g.
+
+        threads: 4
+        batch_size: 10
+
+    Arguments:
+        path: the path of the control file
+
+    Returns:
+        a dictionary of the settings in the file, with names from :data:`CONTROL_SETTINGS`.
+        Settings which aren't in the file aren't changed.
+
+    Raises:
+        HighLevelConfigurationError: if the file can't be read or has an invalid setting
+    """
+    try:
+        with open(path) as fp:
+            settings = yaml.safe_load(fp) or {}
+    except (IOError, yaml.YAMLError) as e:
+        raise HighLevelConfigurationError("Cannot read the control file {}: {}".format(path, e))
+    if not isinstance(settings, dict):
+        raise HighLevelConfigurationError("The control file {} must contain a mapping of settings".format(path))
+    for name, value in settings.items():
+        if name not in CONTROL_SETTINGS:
+            raise HighLevelConfigurationError("Unknown setting in the control file {}: {}".format(path, name))
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise HighLevelConfigurationError("Setting {} in the control file {} must be an integer".format(name, path))
+    return settings
+
+
+def apply_control_file(pipeline, path, logger):
+    """Change the settings of ``pipeline`` to those in the control file at ``path``,
+    logging any error instead of raising it so that the pipeline keeps running with its
+    current settings"""
+    try:
+        settings = read_control_file(path)
+        pipeline.reconfigure(extract_threads=settings.get("threads"), batch_size=settings.get("batch_size"),
+                             fetch_threads=settings.get("fetch_threads"), save_threads=settings.get("save_threads"))
+    except (HighLevelConfigurationError, ValueError) as e:
+        logger.error(u"Not changing pipeline settings: {}".format(e))
+    else:
+        logger.info("Pipeline settings: {}".format(pipeline.get_settings()))
+
+
+def _get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def main(num_threads=DEFAULT_NUM_THREADS, batch_size=MAX_ITEMS_PER_PROCESS, fetch_threads=DEFAULT_FETCH_THREADS,
+         save_threads=DEFAULT_SAVE_THREADS, binary=HIGH_LEVEL_EXTRACTOR_BINARY, control_file=None):
+    """Run the highlevel extractor pipeline until the process is stopped.
+
+    If ``control_file`` is given, it is checked every CONTROL_INTERVAL seconds, and when it
+    changes the pipeline is reconfigured with the settings in it (see :func:`read_control_file`).
+    """
+    current_app.logger.info("High-level extractor daemon starting with {} threads".format(num_threads))
+
+    try:
+        build_sha1 = get_build_sha1(binary)
+        create_profile(PROFILE_CONF_TEMPLATE, PROFILE_CONF, build_sha1)
+    except HighLevelConfigurationError as e:
+        current_app.logger.error(u'{}'.format(e))
+        sys.exit(-1)
+
+    staging_dir = staging.get_staging_dir(current_app.config.get("HIGHLEVEL_STAGING_DIR"))
+    current_app.logger.info("Extractor files are written to {}".format(staging_dir or tempfile.gettempdir()))
+
+    pipeline = Pipeline(build_sha1, current_app.logger, extract_threads=num_threads, batch_size=batch_size,
+                        fetch_threads=fetch_threads, save_threads=save_threads, binary=binary,
+                        staging_dir=staging_dir)
+    pipeline.start()
+
+    control_mtime = None
+    if control_file:
+        current_app.logger.info("Pipeline settings are read from {} when it changes".format(control_file))
+        # Settings in an existing control file replace those given on the command line
+        control_mtime = _get_mtime(control_file)
+        if control_mtime is not None:
+            apply_control_file(pipeline, control_file, current_app.logger)
+
+    num_saved = 0
+    last_stats = time.time()
+    while True:
+        time.sleep(CONTROL_INTERVAL)
+        if control_file:
+            mtime = _get_mtime(control_file)
+            if mtime is not None and mtime != control_mtime:
+                apply_control_file(pipeline, control_file, current_app.logger)
+            control_mtime = mtime
+        if time.time() - last_stats < STATS_INTERVAL:
+            continue
+        last_stats = time.time()
+        stats = pipeline.get_stats()
+        if stats["save"]["items"] != num_saved:
+            num_saved = stats["save"]["items"]
+            current_app.logger.info("pipeline: {}".format(stats))
+            current_app.logger.info("id caches: {}".format(db.data.get_cache_stats()))
+            current_app.logger.info("connection pool: {}".format(db.get_pool_stats()))
@@ -20,6 +20,7 @@ import db
 import db.data
 import db.dataset
 import db.dataset_eval
+from hl_extractor import staging
 
 DEFAULT_NUM_THREADS = 1
 
@@ -37,18 +38,19 @@ class HighLevel(Thread):
     high-level calculator.
     """
 
-    def __init__(self, mbid, ll_data, ll_id):
+    def __init__(self, mbid, ll_data, ll_id, staging_dir=None):
         Thread.__init__(self)
         self.mbid = mbid
         self.ll_data = ll_data
         self.hl_data = None
         self.ll_id = ll_id
+        self.staging_dir = staging_dir
 
     def _calculate(self):
         """Invoke Essentia high-level extractor and return its JSON output."""
 
         try:
-            f = tempfile.NamedTemporaryFile(delete=False)
+            f = tempfile.NamedTemporaryFile(delete=False, dir=self.staging_dir)
             name = f.name
             f.write(self.ll_data.encode("utf-8"))
             f.close()
@@ -57,7 +59,7 @@ class HighLevel(Thread):
             return "{}"
 
         # Securely generate a temporary filename
-        tmp_file = tempfile.mkstemp()
+        tmp_file = tempfile.mkstemp(dir=self.staging_dir)
         out_file = tmp_file[1]
         os.close(tmp_file[0])
 
@@ -166,6 +168,7 @@ def main(num_threads, profile, dataset_job_id):
 
     model_id = get_model_from_eval(dataset_job_id)
     includes = load_includes_from_eval(dataset_job_id)
+    staging_dir = staging.get_staging_dir(current_app.config.get("HIGHLEVEL_STAGING_DIR"))
 
     num_processed = 0
 
@@ -188,7 +191,7 @@ def main(num_threads, profile, dataset_job_id):
         if len(docs):
             # Start one document
             mbid, doc, id = docs.pop()
-            th = HighLevel(mbid, doc, id)
+            th = HighLevel(mbid, doc, id, staging_dir)
             th.start()
             current_app.logger.info("start %s" % id)
             sys.stdout.flush()
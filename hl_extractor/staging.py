@@ -0,0 +1,94 @@
+"""Scratch space for the files passed to and from the highlevel extractor.
+
+Every document is written to disk once for the extractor to read, and its results are read
+back once, after which the files are deleted. Keeping them on a memory-backed filesystem
+such as /dev/shm avoids disk I/O for data that never needs to be persisted.
+"""
+import os
+import tempfile
+
+import db.data
+
+# Directories to try if no staging directory is configured, in order of preference
+DEFAULT_STAGING_DIRS = ["/dev/shm"]
+
+
+def _is_usable(path):
+    return os.path.isdir(path) and os.access(path, os.W_OK | os.X_OK)
+
+
+def get_staging_dir(configured_dir=None):
+    """Choose the directory to create extractor working directories in.
+
+    Arguments:
+        configured_dir: a directory to use if it exists and is writable
+
+    Returns:
+        ``configured_dir`` or the first usable directory of ``DEFAULT_STAGING_DIRS``.
+        If none of them can be used, None, which makes :func:`make_working_dir` use
+        the system temporary directory.
+    """
+    candidates = [configured_dir] if configured_dir else []
+    for path in candidates + DEFAULT_STAGING_DIRS:
+        if _is_usable(path):
+            return path
+    return None
+
+
+def make_working_dir(prefix, staging_dir=None):
+    """Create a new temporary directory in ``staging_dir``, falling back to the system
+    temporary directory if that fails (e.g. if ``staging_dir`` is full).
+
+    Returns:
+        the path of the new directory
+    """
+    if staging_dir:
+        try:
+            return tempfile.mkdtemp(prefix=prefix, dir=staging_dir)
+        except OSError:
+            pass
+    return tempfile.mkdtemp(prefix=prefix)
+
+
+class LowlevelFileWriter(object):
+    """A file-like object to pass to :func:`db.data.copy_low_level_json`, which writes each
+    document to its own file as the data arrives from the database.
+
+    Arguments:
+        paths: a dictionary {lowlevel id: path to write the document to}
+    """
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.written = set()
+        self._fp = None
+        self._id_buffer = b""
+
+    def write(self, data):
+        position = 0
+        while position < len(data):
+            if self._fp is None:
+                # Find the id at the start of the row
+                delimiter = data.find(db.data.LOW_LEVEL_COPY_DELIMITER, position)
+                if delimiter == -1:
+                    self._id_buffer += data[position:]
+                    return
+                ll_id = int(self._id_buffer + data[position:delimiter])
+                self._id_buffer = b""
+                self._fp = open(self.paths[ll_id], "wb")
+                self.written.add(ll_id)
+                position = delimiter + 1
+
+            end = data.find(b"\n", position)
+            if end == -1:
+                self._fp.write(memoryview(data)[position:])
+                return
+            self._fp.write(memoryview(data)[position:end])
+            self._fp.close()
+            self._fp = None
+            position = end + 1
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
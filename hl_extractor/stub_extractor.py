@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""A stand-in for the essentia highlevel extractor, for benchmarking hl_calc without essentia.
+
+It takes the same arguments as the real extractor:
+
+    stub_extractor.py input1.json output1.json [input2.json output2.json ...] profile.conf
+
+and writes an output file with the structure of a real highlevel document for each input.
+Set HL_STUB_DELAY to the number of seconds to spend on each document to simulate the time
+taken by the real extractor. For example:
+
+    HL_STUB_DELAY=0.5 ./worker_manage.py hl_extractor -t 4 --binary hl_extractor/stub_extractor.py
+"""
+import json
+import os
+import sys
+import time
+
+import yaml
+
+STUB_MODELS = ["danceability", "gender", "genre_dortmund", "mood_happy", "voice_instrumental"]
+
+
+def extract(in_path, out_path, merge_values):
+    with open(in_path) as fp:
+        lowlevel = json.load(fp)
+
+    metadata = dict(merge_values.get("metadata", {}))
+    metadata["audio_properties"] = lowlevel.get("metadata", {}).get("audio_properties", {})
+    metadata["tags"] = lowlevel.get("metadata", {}).get("tags", {})
+
+    highlevel = {}
+    for model in STUB_MODELS:
+        highlevel[model] = {"value": "stub", "probability": 1.0, "all": {"stub": 1.0, "not_stub": 0.0}}
+
+    with open(out_path, "w") as fp:
+        json.dump({"metadata": metadata, "highlevel": highlevel}, fp)
+
+
+def main(args):
+    if len(args) < 3 or len(args) % 2 != 1:
+        sys.stderr.write("usage: {} input output [input output ...] profile\n".format(sys.argv[0]))
+        return 1
+
+    with open(args[-1]) as fp:
+        profile = yaml.safe_load(fp)
+    merge_values = profile.get("mergeValues", {})
+    delay = float(os.environ.get("HL_STUB_DELAY", 0))
+
+    for in_path, out_path in zip(args[:-1:2], args[1:-1:2]):
+        time.sleep(delay)
+        try:
+            extract(in_path, out_path, merge_values)
+        except (IOError, ValueError) as e:
+            # The real extractor carries on with the next file if one can't be processed
+            sys.stderr.write("cannot process {}: {}\n".format(in_path, e))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
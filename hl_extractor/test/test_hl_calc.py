@@ -2,6 +2,7 @@ import os
 import shutil
 import subprocess
 import tempfile
+import time
 import unittest
 
 from unittest import mock
@@ -86,8 +87,8 @@ class HlCalcTest(unittest.TestCase):
 
         hl_calc.process_lowlevel_data([(1, 'mbid', '{data}'), (2, 'mbid', '{data2}')], None)
 
-        mock_open.assert_has_calls([mock.call('/tmp/hl/1-input.json', 'w'),
-                                    mock.call('/tmp/hl/2-input.json', 'w'),
+        mock_open.assert_has_calls([mock.call('/tmp/hl/1-input.json', 'w', encoding='utf-8'),
+                                    mock.call('/tmp/hl/2-input.json', 'w', encoding='utf-8'),
                                     mock.call('/tmp/hl/1-output.json', 'r'),
                                     mock.call('/tmp/hl/2-output.json', 'r')], any_order=True)
 
@@ -97,6 +98,29 @@ class HlCalcTest(unittest.TestCase):
             stdout=mock.ANY)
         mock_rmtree.assert_called_with("/tmp/hl", ignore_errors=True)
 
+    @mock.patch("db.data.copy_low_level_json")
+    @mock.patch("subprocess.check_call")
+    def test_process_lowlevel_data_copy_from_database(self, mock_check_call, mock_copy):
+        # lowlevel data which isn't given is copied from the database into the staging directory
+        staging_dir = tempfile.mkdtemp()
+        mock_copy.side_effect = lambda ll_ids, fp: fp.write(b'2\x02{"data":2}\n')
+
+        def extract(call_args, **kwargs):
+            self.assertTrue(call_args[1].startswith(staging_dir))
+            with open(call_args[1]) as fp:
+                self.assertEqual(fp.read(), '{"data":2}')
+            with open(call_args[2], "w") as fp:
+                fp.write('{"highlevel": {}}')
+        mock_check_call.side_effect = extract
+
+        results = hl_calc.process_lowlevel_data([(2, 'mbid2', None)], None, staging_dir=staging_dir)
+
+        mock_copy.assert_called_with([2], mock.ANY)
+        self.assertEqual(results, [(2, 'mbid2', {"highlevel": {}})])
+        # The working directory was removed
+        self.assertEqual(os.listdir(staging_dir), [])
+        shutil.rmtree(staging_dir)
+
     def test_create_profile(self):
         # TODO: Use `with tempfile.TemporaryDirectory` in Python 3
         dirname = tempfile.mkdtemp()
@@ -143,3 +167,104 @@ mergeValues:
         with self.assertRaises(hl_calc.HighLevelConfigurationError):
             data_file = os.path.join(data_dir, "unknown_file")
             hl_calc.get_build_sha1(data_file)
+
+
+class PipelineTest(unittest.TestCase):
+
+    @mock.patch("hl_extractor.hl_calc.SLEEP_DURATION", 0.01)
+    @mock.patch("db.data.write_many_high_level")
+    @mock.patch("hl_extractor.hl_calc.process_lowlevel_data")
+    @mock.patch("db.data.claim_unprocessed_highlevel_documents")
+    def test_pipeline(self, mock_claim, mock_process, mock_write):
+        docs = [(i, 'mbid%d' % i) for i in range(5)]
+        mock_claim.side_effect = lambda limit: docs if mock_claim.call_count == 1 else []
+        mock_process.side_effect = lambda subdocs, logger_name, binary, staging_dir: \
+            [(i, mbid, {}) for i, mbid, _ in subdocs]
+
+        pipeline = hl_calc.Pipeline("sha1", mock.MagicMock(), extract_threads=2, batch_size=2)
+        pipeline.start()
+        for _ in range(500):
+            if pipeline.get_stats()["save"]["items"] == 5:
+                break
+            time.sleep(0.01)
+
+        pipeline.stop()
+
+        stats = pipeline.get_stats()
+        self.assertEqual(stats["fetch"]["items"], 5)
+        self.assertEqual(stats["extract"]["items"], 5)
+        self.assertEqual(stats["save"]["items"], 5)
+        self.assertEqual(stats["extract"]["threads"], 2)
+        self.assertEqual(stats["save"]["queue_depth"], 0)
+
+        # Documents were given to the extractor in batches of 2, and all were saved
+        self.assertEqual(sorted(len(call[0][0]) for call in mock_process.call_args_list), [1, 2, 2])
+        saved = sorted(item[0] for call in mock_write.call_args_list for item in call[0][0])
+        self.assertEqual(saved, list(range(5)))
+
+    def test_pipeline_batch_size(self):
+        with self.assertRaises(ValueError):
+            hl_calc.Pipeline("sha1", mock.MagicMock(), batch_size=hl_calc.MAX_ITEMS_PER_PROCESS + 1)
+
+    @mock.patch("hl_extractor.hl_calc.SLEEP_DURATION", 0.01)
+    @mock.patch("db.data.write_many_high_level")
+    @mock.patch("hl_extractor.hl_calc.process_lowlevel_data")
+    @mock.patch("db.data.claim_unprocessed_highlevel_documents")
+    def test_pipeline_reconfigure(self, mock_claim, mock_process, mock_write):
+        mock_claim.return_value = []
+        pipeline = hl_calc.Pipeline("sha1", mock.MagicMock(), extract_threads=1, batch_size=2)
+        pipeline.start()
+        self.addCleanup(pipeline.stop)
+
+        pipeline.reconfigure(extract_threads=3, batch_size=5)
+        self.assertEqual({"threads": 3, "batch_size": 5, "fetch_threads": 1, "save_threads": 1},
+                         pipeline.get_settings())
+        self.assertEqual(3, pipeline.get_stats()["extract"]["threads"])
+        self.assertEqual(3 * hl_calc.PREFETCH_CHUNKS_PER_THREAD, pipeline.extract_queue.maxsize)
+        self.assertEqual(3, len([t for t in pipeline.threads["extract"].values() if t.is_alive()]))
+
+        # Removed threads exit once they are waiting for work
+        pipeline.reconfigure(extract_threads=1)
+        for _ in range(500):
+            if len([t for t in pipeline.threads["extract"].values() if t.is_alive()]) == 1:
+                break
+            time.sleep(0.01)
+        self.assertTrue(pipeline.threads["extract"][0].is_alive())
+        self.assertFalse(pipeline.threads["extract"][2].is_alive())
+
+        # Documents fetched afterwards are given to the extractor in the new batch size
+        mock_process.side_effect = lambda subdocs, logger_name, binary, staging_dir: \
+            [(i, mbid, {}) for i, mbid, _ in subdocs]
+        unclaimed = [[(i, 'mbid%d' % i) for i in range(5)]]
+        mock_claim.side_effect = lambda limit: unclaimed.pop() if unclaimed else []
+        for _ in range(500):
+            if pipeline.get_stats()["save"]["items"] == 5:
+                break
+            time.sleep(0.01)
+        self.assertEqual([5], [len(call[0][0]) for call in mock_process.call_args_list])
+
+        for kwargs in [{"extract_threads": 0}, {"save_threads": -1},
+                       {"batch_size": hl_calc.MAX_ITEMS_PER_PROCESS + 1}]:
+            with self.assertRaises(ValueError):
+                pipeline.reconfigure(**kwargs)
+
+    def test_read_control_file(self):
+        fd, path = tempfile.mkstemp(suffix=".yaml")
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        with open(path, "w") as f:
+            f.write("threads: 4\nbatch_size: 10\n")
+        self.assertEqual({"threads": 4, "batch_size": 10}, hl_calc.read_control_file(path))
+
+        for contents in ["threads: four\n", "processes: 4\n", "- 4\n", "threads: [4\n"]:
+            with open(path, "w") as f:
+                f.write(contents)
+            with self.assertRaises(hl_calc.HighLevelConfigurationError):
+                hl_calc.read_control_file(path)
+
+        pipeline = mock.MagicMock()
+        logger = mock.MagicMock()
+        hl_calc.apply_control_file(pipeline, path, logger)
+        pipeline.reconfigure.assert_not_called()
+        logger.error.assert_called_once()
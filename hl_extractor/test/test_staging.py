@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from hl_extractor import staging
+
+
+class StagingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_get_staging_dir(self):
+        self.assertEqual(staging.get_staging_dir(self.dirname), self.dirname)
+
+        with mock.patch("hl_extractor.staging.DEFAULT_STAGING_DIRS", [self.dirname]):
+            # A directory which doesn't exist isn't used
+            self.assertEqual(staging.get_staging_dir(os.path.join(self.dirname, "missing")), self.dirname)
+            self.assertEqual(staging.get_staging_dir(), self.dirname)
+
+        with mock.patch("hl_extractor.staging.DEFAULT_STAGING_DIRS", []):
+            self.assertIsNone(staging.get_staging_dir())
+
+    def test_make_working_dir(self):
+        working_dir = staging.make_working_dir("hlcalc", self.dirname)
+        self.assertEqual(os.path.dirname(working_dir), self.dirname)
+
+        # Falls back to the system temporary directory
+        working_dir = staging.make_working_dir("hlcalc", os.path.join(self.dirname, "missing"))
+        self.assertEqual(os.path.dirname(working_dir), tempfile.gettempdir())
+        os.rmdir(working_dir)
+
+    def test_lowlevel_file_writer(self):
+        paths = {1: os.path.join(self.dirname, "1.json"),
+                 22: os.path.join(self.dirname, "22.json"),
+                 3: os.path.join(self.dirname, "3.json")}
+        writer = staging.LowlevelFileWriter(paths)
+        # Rows can be split anywhere, including in the middle of an id
+        writer.write(b'1\x02{"a":1}\n2')
+        writer.write(b'2\x02{"b":')
+        writer.write(b'2}\n')
+        writer.close()
+
+        self.assertEqual(writer.written, {1, 22})
+        with open(paths[1], "rb") as fp:
+            self.assertEqual(fp.read(), b'{"a":1}')
+        with open(paths[22], "rb") as fp:
+            self.assertEqual(fp.read(), b'{"b":2}')
+        self.assertFalse(os.path.exists(paths[3]))
@@ -47,7 +47,7 @@ def init_db(archive, force, skip_create_db=False):
     found at http://www.postgresql.org/docs/current/static/populate.html.
     """
 
-    db.init_db_engine(current_app.config['POSTGRES_ADMIN_URI'])
+    db.init_db_engine(current_app.config['POSTGRES_ADMIN_URI'], pool_size=0)
     if force:
         res = db.run_sql_script_without_transaction(os.path.join(ADMIN_SQL_DIR, 'drop_db.sql'))
         if not res:
@@ -60,10 +60,10 @@ def init_db(archive, force, skip_create_db=False):
             raise Exception('Failed to create new database and user! Exit code: %i' % res)
 
     current_app.logger.info('Creating database extensions...')
-    db.init_db_engine(current_app.config['POSTGRES_ADMIN_AB_URI'])
+    db.init_db_engine(current_app.config['POSTGRES_ADMIN_AB_URI'], pool_size=0)
     res = db.run_sql_script_without_transaction(os.path.join(ADMIN_SQL_DIR, 'create_extensions.sql'))
 
-    db.init_db_engine(current_app.config['SQLALCHEMY_DATABASE_URI'])
+    db.init_db_engine(current_app.config['SQLALCHEMY_DATABASE_URI'], **db.get_pool_options(current_app.config))
 
     current_app.logger.info('Creating schema...')
     db.run_sql_script(os.path.join(ADMIN_SQL_DIR, 'create_schema.sql'))
@@ -93,6 +93,14 @@ def init_db(archive, force, skip_create_db=False):
     current_app.logger.info('Populating similarity_metrics table...')
     db.run_sql_script(os.path.join(ADMIN_SQL_DIR, 'populate_metrics_table.sql'))
 
+    if archive:
+        current_app.logger.info('Updating submission counters...')
+        db.data.update_submission_counters()
+        current_app.logger.info('Queueing submissions for the highlevel extractor...')
+        db.data.populate_highlevel_pending()
+        current_app.logger.info('Copying individual low-level features...')
+        db.data.populate_lowlevel_features()
+
     current_app.logger.info("Done!")
 
 
@@ -115,6 +123,13 @@ def import_data(archive, drop_constraints=False):
         db.run_sql_script(os.path.join(ADMIN_SQL_DIR, 'create_primary_keys.sql'))
         db.run_sql_script(os.path.join(ADMIN_SQL_DIR, 'create_foreign_keys.sql'))
 
+    current_app.logger.info('Updating submission counters...')
+    db.data.update_submission_counters()
+    current_app.logger.info('Queueing submissions for the highlevel extractor...')
+    db.data.populate_highlevel_pending()
+    current_app.logger.info('Copying individual low-level features...')
+    db.data.populate_lowlevel_features()
+
 
 @cli.command(name='import_dataset_data')
 @click.option("--drop-constraints", "-d", is_flag=True, help="Drop primary and foreign keys before importing.")
@@ -189,6 +204,22 @@ def update_sequences():
     current_app.logger.info('Done!')
 
 
+@cli.command(name='populate_lowlevel_features')
+def populate_lowlevel_features():
+    """Copy individual features of low-level submissions to the lowlevel_features table."""
+    current_app.logger.info('Copying individual low-level features...')
+    num_added = db.data.populate_lowlevel_features()
+    current_app.logger.info('Copied features of %s submissions' % num_added)
+
+
+@cli.command(name='update_submission_counters')
+def update_submission_counters():
+    """Backfill the next submission offset of each MBID from the lowlevel table."""
+    current_app.logger.info('Updating submission counters...')
+    db.data.update_submission_counters()
+    current_app.logger.info('Done!')
+
+
 @cli.group()
 @click.pass_context
 def highlevel(ctx):
@@ -230,6 +261,17 @@ def remove_failed_rows():
         sys.exit(1)
 
 
+@highlevel.command(name="populate_pending")
+def populate_pending():
+    """ Queues all lowlevel submissions with no highlevel data for the highlevel extractor"""
+    try:
+        num_added = db.data.populate_highlevel_pending()
+        click.echo("Queued %s submissions for highlevel processing" % num_added)
+    except db.exceptions.DatabaseException as e:
+        click.echo("Error: %s" % e, err=True)
+        sys.exit(1)
+
+
 @cli.command(name='set_rate_limits')
 @click.argument('per_ip', type=click.IntRange(1, None), required=False)
 @click.argument('window_size', type=click.IntRange(1, None), required=False)
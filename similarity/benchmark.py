@@ -0,0 +1,301 @@
+"""Measure the speed and accuracy of similarity indices with different parameters.
+
+An index is built for each combination of distance type and number of trees, from
+random vectors or from vectors of a metric in the similarity table. For each index, the time
+taken to add items and build it, the size of the saved files and the memory used are reported.
+The index is then queried with each combination of search_k and oversample (see
+:meth:`similarity.index_model.AnnoyModel.get_nns_by_id`), and the latency of the queries and their
+recall@k compared to an exact search of all of the vectors are reported.
+
+Each index is built and queried in a child process, so that the memory it uses can be measured.
+The vectors are inherited by the child processes when they are forked, like the indices built
+by :func:`db.similarity.add_indices`.
+
+Run with ``./manage.py similarity benchmark``, which writes a JSON report.
+"""
+import datetime
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import similarity.delta_index
+import similarity.exceptions
+import similarity.index_model
+import similarity.index_utils
+import db.exceptions
+import db.similarity
+
+# Number of vectors generated or added to an index at a time
+BENCHMARK_CHUNK_SIZE = 100000
+# Maximum number of distances computed at a time by exact_neighbours, to limit its memory use
+EXACT_CHUNK_DISTANCES = 1 << 26
+# Name of the indices saved by the benchmark
+BENCHMARK_INDEX_NAME = "benchmark"
+
+# Vectors and exact neighbours of the benchmark being run, which are inherited by the processes
+# forked by run_benchmark
+_benchmark_vectors = None
+_benchmark_queries = None
+
+
+def get_index_configs():
+    """Get the (distance_type, n_trees) of the indices in BASE_INDICES and get_all_indices"""
+    configs = set()
+    for distances in similarity.index_model.BASE_INDICES.values():
+        for distance_type, all_n_trees in distances.items():
+            configs.update((distance_type, n_trees) for n_trees in all_n_trees)
+    for distance_type, indices in similarity.index_utils.get_all_indices().items():
+        configs.update((distance_type, n_trees) for _, n_trees in indices)
+    return sorted(config for config in configs if config[0] in similarity.delta_index.DISTANCE_TYPES)
+
+
+def generate_vectors(count, dimensionality, clusters=1000, seed=None):
+    """Make ``count`` random vectors, grouped around ``clusters`` centres so that
+    they have near neighbours like the vectors of real metrics"""
+    random = np.random.RandomState(seed)
+    centres = random.normal(size=(clusters, dimensionality)).astype(np.float32)
+    vectors = np.empty((count, dimensionality), dtype=np.float32)
+    for start in range(0, count, BENCHMARK_CHUNK_SIZE):
+        end = min(start + BENCHMARK_CHUNK_SIZE, count)
+        vectors[start:end] = centres[random.randint(clusters, size=end - start)]
+        vectors[start:end] += random.normal(scale=0.3, size=(end - start, dimensionality))
+    return vectors
+
+
+def resample_vectors(sample, count, seed=None):
+    """Make ``count`` vectors from a sample of the vectors of a metric. If there are fewer
+    vectors in the sample, copies of them with some noise added are used for the rest."""
+    sample = np.asarray(sample, dtype=np.float32)
+    if count <= len(sample):
+        return sample[:count].copy()
+    random = np.random.RandomState(seed)
+    scale = sample.std(axis=0) * 0.05
+    vectors = np.empty((count, sample.shape[1]), dtype=np.float32)
+    vectors[:len(sample)] = sample
+    for start in range(len(sample), count, BENCHMARK_CHUNK_SIZE):
+        end = min(start + BENCHMARK_CHUNK_SIZE, count)
+        vectors[start:end] = sample[random.randint(len(sample), size=end - start)]
+        vectors[start:end] += random.normal(size=(end - start, sample.shape[1])) * scale
+    return vectors
+
+
+def load_sampled_vectors(metric_name, count, sample_size, seed=None):
+    """Make ``count`` vectors from the vectors of a metric for up to ``sample_size``
+    rows of the similarity table (see :func:`resample_vectors`)
+
+    Raises:
+        NoDataFoundException: if the similarity table is empty
+    """
+    batches = list(db.similarity.get_metric_vectors(metric_name, min(count, sample_size), BENCHMARK_CHUNK_SIZE))
+    if not batches:
+        raise db.exceptions.NoDataFoundException("No existing similarity data.")
+    sample = np.concatenate([np.asarray(batch, dtype=np.float32) for batch in batches])
+    return resample_vectors(sample, count, seed=seed)
+
+
+def exact_neighbours(vectors, queries, k, distance_type):
+    """Find the ``k`` nearest rows of ``vectors`` to each of the rows ``queries`` by
+    computing their distance to every row.
+
+    Returns:
+        a tuple (neighbours, latencies), with a set of row numbers for each query and the
+        number of seconds taken to search for it
+    """
+    k = min(k, len(vectors))
+    chunk_size = max(k, EXACT_CHUNK_DISTANCES // max(vectors.shape[1], 1))
+    neighbours = []
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        best_rows = np.empty(0, dtype=np.int64)
+        best_distances = np.empty(0, dtype=np.float32)
+        for chunk_start in range(0, len(vectors), chunk_size):
+            distances = similarity.delta_index.get_distances(vectors[chunk_start:chunk_start + chunk_size],
+                                                             vectors[query], distance_type)
+            rows = np.concatenate([best_rows, np.arange(chunk_start, chunk_start + len(distances))])
+            distances = np.concatenate([best_distances, distances])
+            nearest = np.argpartition(distances, k - 1)[:k]
+            best_rows, best_distances = rows[nearest], distances[nearest]
+        latencies.append(time.perf_counter() - start)
+        neighbours.append(set(best_rows.tolist()))
+    return neighbours, latencies
+
+
+def _get_rss():
+    # Get the resident set size of this process in bytes
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def _get_max_rss():
+    # Get the peak resident set size of this process in bytes. ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_latency_stats(latencies):
+    """Get the p50, p99 and mean of some latencies in seconds, in milliseconds"""
+    latencies = np.asarray(latencies) * 1000
+    return {"p50": float(np.percentile(latencies, 50)),
+            "p99": float(np.percentile(latencies, 99)),
+            "mean": float(latencies.mean())}
+
+
+class BenchmarkModel(similarity.index_model.AnnoyModel):
+    """An index of the vectors of a benchmark, with any distance type and number of trees.
+    Its items are the row numbers of the vectors."""
+
+    def __init__(self, distance_type, n_trees, dimensionality):
+        super(BenchmarkModel, self).__init__(BENCHMARK_INDEX_NAME, n_trees=n_trees, distance_type=distance_type,
+                                             dimensionality=dimensionality)
+
+    def parse_initial_params(self, metric_name, n_trees, distance_type):
+        if distance_type not in similarity.delta_index.DISTANCE_TYPES:
+            raise similarity.exceptions.IndexNotFoundException('Index for specified distance_type is not possible.')
+        if not isinstance(n_trees, int) or n_trees < 1:
+            raise similarity.exceptions.IndexNotFoundException('Index for specified number of trees is not possible.')
+        self.metric_name = metric_name
+        self.distance_type = distance_type
+        self.n_trees = n_trees
+
+
+def benchmark_index(distance_type, n_trees, k, query_params, n_jobs, location):
+    """Build, save and query an index of the vectors of the benchmark being run.
+
+    Arguments:
+        query_params: a list of tuples (search_k, oversample), which the index is queried with
+
+    Returns:
+        a dictionary of measurements of the index
+    """
+    vectors = _benchmark_vectors
+    queries, exact = _benchmark_queries
+    start_rss = _get_rss()
+
+    model = BenchmarkModel(distance_type, n_trees, vectors.shape[1])
+    start = time.perf_counter()
+    for chunk_start in range(0, len(vectors), BENCHMARK_CHUNK_SIZE):
+        for item, vector in enumerate(vectors[chunk_start:chunk_start + BENCHMARK_CHUNK_SIZE].tolist(),
+                                      start=chunk_start):
+            model.add_recording_with_vector(item, vector)
+    add_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    model.build(n_jobs=n_jobs)
+    build_seconds = time.perf_counter() - start
+    build_max_rss = _get_max_rss()
+
+    # Saving the index loads it from the saved files, which are queried as the webserver does
+    model.save(location=location)
+    index_path = similarity.index_model.get_index_path(model.metric_name, distance_type, n_trees, location=location)
+    path = similarity.index_model.resolve_index_path(index_path)
+    file_size = os.path.getsize(path)
+    vectors_file_size = os.path.getsize(similarity.index_model.get_vectors_path(path))
+
+    results = []
+    for search_k, oversample in query_params:
+        latencies = []
+        found = 0
+        for query, exact_rows in zip(queries, exact):
+            start = time.perf_counter()
+            items, _, _ = model.get_nns_by_id(query, k, search_k=search_k, oversample=oversample)
+            latencies.append(time.perf_counter() - start)
+            found += len(exact_rows.intersection(items))
+        results.append({"search_k": search_k,
+                        "oversample": oversample,
+                        "latency_ms": get_latency_stats(latencies),
+                        "recall_at_k": float(found) / sum(len(exact_rows) for exact_rows in exact) if exact else None})
+
+    model.index.unload()
+    model.vectors = None
+    similarity.index_model.remove_index_files(index_path)
+
+    return {"distance_type": distance_type,
+            "n_trees": n_trees,
+            "add_seconds": add_seconds,
+            "build_seconds": build_seconds,
+            "file_size_bytes": file_size,
+            "vectors_file_size_bytes": vectors_file_size,
+            "max_rss_bytes": build_max_rss,
+            "rss_increase_bytes": build_max_rss - start_rss,
+            "queries": results}
+
+
+def _benchmark_index(arguments):
+    return benchmark_index(*arguments)
+
+
+def run_benchmark(vectors, configs, k=10, queries=1000, search_ks=(-1,), oversamples=(1,), n_jobs=-1, location=None,
+                  seed=None, log=None):
+    """Measure indices of ``vectors`` with each of some parameters.
+
+    Arguments:
+        vectors: a float32 matrix with a row for each item
+        configs: a list of tuples (distance_type, n_trees)
+        k: the number of neighbours found by each query
+        queries: the number of queries of each index, of random items of the index
+        search_ks: the search_k values which each index is queried with
+        oversamples: the oversample values which each index is queried with, for each search_k
+        n_jobs: the number of threads used to build each index
+        location: a directory to save indices in while they are measured. If None, a temporary directory is used
+        seed: seed for choosing the items which are queried
+        log: a function called with a message as the benchmark progresses
+
+    Returns:
+        a report of the measurements, which can be serialized as JSON
+    """
+    global _benchmark_vectors, _benchmark_queries
+    log = log or (lambda message: None)
+    random = np.random.RandomState(seed)
+    query_rows = random.choice(len(vectors), size=min(queries, len(vectors)), replace=False).tolist()
+    tmp_location = None
+    if not location:
+        location = tmp_location = tempfile.mkdtemp()
+
+    report = {"created": datetime.datetime.utcnow().isoformat() + "Z",
+              "platform": platform.platform(),
+              "python": platform.python_version(),
+              "numpy": np.__version__,
+              "cpu_count": os.cpu_count(),
+              "items": len(vectors),
+              "dimensionality": int(vectors.shape[1]),
+              "k": k,
+              "queries": len(query_rows),
+              "search_ks": list(search_ks),
+              "oversamples": list(oversamples),
+              "n_jobs": n_jobs,
+              "exact": {},
+              "indices": []}
+    try:
+        exact_by_distance = {}
+        for distance_type in sorted(set(distance_type for distance_type, _ in configs)):
+            log("Finding exact neighbours for {} distance...".format(distance_type))
+            exact, latencies = exact_neighbours(vectors, query_rows, k, distance_type)
+            exact_by_distance[distance_type] = exact
+            report["exact"][distance_type] = {"latency_ms": get_latency_stats(latencies)}
+
+        _benchmark_vectors = vectors
+        query_params = [(search_k, oversample) for search_k in search_ks for oversample in oversamples]
+        for distance_type, n_trees in configs:
+            log("Measuring {} index with {} trees...".format(distance_type, n_trees))
+            _benchmark_queries = (query_rows, exact_by_distance[distance_type])
+            # A new process for each index, so that its peak memory use is measured separately
+            with multiprocessing.get_context("fork").Pool(1) as pool:
+                result = pool.apply(_benchmark_index, ((distance_type, n_trees, k, query_params, n_jobs, location),))
+            report["indices"].append(result)
+            log("{distance_type} {n_trees}: build {build_seconds:.1f}s".format(**result))
+            for query_result in result["queries"]:
+                latency = query_result["latency_ms"]
+                log("  search_k={search_k} oversample={oversample}: p50 {p50:.3f}ms, p99 {p99:.3f}ms, "
+                    "recall@{k} {recall_at_k:.4f}".format(k=k, p50=latency["p50"], p99=latency["p99"],
+                                                          **query_result))
+    finally:
+        _benchmark_vectors = None
+        _benchmark_queries = None
+        if tmp_location:
+            shutil.rmtree(tmp_location)
+    return report
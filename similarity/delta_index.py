@@ -0,0 +1,172 @@
+"""Recordings added to the similarity table since an index was built.
+
+Annoy indices can't be changed once they are built. So that new recordings can be found
+without rebuilding every index, rows of the similarity table with an id higher than any
+item in a saved index are kept in a DeltaIndex, which is searched exhaustively alongside
+the Annoy index. Deltas are kept small by regularly saving new indices which include these
+recordings (see the `compact-indices` command).
+
+A delta is saved next to its index by the `update-deltas` command, as a numpy structured
+array with the columns of an index mapping (see :mod:`similarity.index_mapping`) and the
+vector of each item. It is memory-mapped when it is loaded, so like the index its pages are
+shared by all processes which load it.
+
+Distances are computed in the same way as Annoy computes them, so that results from
+the two can be merged.
+"""
+import numpy as np
+
+import similarity.index_mapping
+
+# Distance types which can be searched by a DeltaIndex
+DISTANCE_TYPES = ("angular", "euclidean", "manhattan")
+
+
+def get_distances(vectors, vector, distance_type):
+    """Get the distance from ``vector`` to each row of the matrix ``vectors``"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vector = np.asarray(vector, dtype=np.float32)
+    if distance_type == "angular":
+        # Distance between the normalized vectors, sqrt(2 - 2 * cos(u, v)),
+        # or sqrt(2) if either vector is 0
+        norms = np.einsum("ij,ij->i", vectors, vectors) * np.dot(vector, vector)
+        cosines = np.divide(vectors.dot(vector), np.sqrt(norms), out=np.zeros(len(vectors), dtype=np.float32),
+                            where=norms > 0)
+        return np.sqrt(np.maximum(2 - 2 * cosines, 0))
+    if distance_type == "euclidean":
+        return np.sqrt(np.square(vectors - vector).sum(axis=1))
+    if distance_type == "manhattan":
+        return np.abs(vectors - vector).sum(axis=1)
+    raise ValueError("Distance type {} is not supported".format(distance_type))
+
+
+def get_delta_dtype(dimensionality):
+    """Get the dtype of the items of a delta whose vectors have ``dimensionality`` values"""
+    return np.dtype(similarity.index_mapping.MAPPING_DTYPE.descr + [("vector", "<f4", (dimensionality,))])
+
+
+class DeltaIndex(object):
+    """An exhaustively searched set of vectors, which can be added to after it is queried"""
+
+    def __init__(self, dimensionality, distance_type, items=None):
+        """
+        Args:
+            items: the items of a delta, as loaded by :func:`load_delta`. If None, the delta is empty.
+        """
+        if distance_type not in DISTANCE_TYPES:
+            raise ValueError("Distance type {} is not supported".format(distance_type))
+        self.dimensionality = dimensionality
+        self.distance_type = distance_type
+        if items is None:
+            items = np.empty(0, dtype=get_delta_dtype(dimensionality))
+        # Replaced as a whole by add, so that queries in other threads always see a consistent delta
+        self._mapping = similarity.index_mapping.IndexMapping(items)
+
+    @property
+    def items(self):
+        """The items of the delta, in ascending order of id"""
+        return self._mapping.mapping
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def max_id(self):
+        """The highest id in the delta, or None if it is empty"""
+        items = self.items
+        return int(items["id"][-1]) if len(items) else None
+
+    def add(self, ids, vectors, recordings):
+        """Add items to the delta.
+
+        Arguments:
+            ids: lowlevel.ids of the items, in ascending order and higher than any id already added
+            vectors: a vector for each item
+            recordings: the (MBID, offset) of each item
+        """
+        if not len(ids):
+            return
+        builder = similarity.index_mapping.MappingBuilder()
+        for id, (mbid, offset) in zip(ids, recordings):
+            builder.add(id, mbid, offset)
+        mapping = builder.build()
+        new_items = np.empty(len(ids), dtype=self.items.dtype)
+        for name in similarity.index_mapping.MAPPING_DTYPE.names:
+            new_items[name] = mapping[name]
+        new_items["vector"] = np.asarray(vectors, dtype=np.float32).reshape(len(ids), self.dimensionality)
+
+        items = np.concatenate([self.items, new_items])
+        items["by_id"] = np.arange(len(items))
+        # lexsort sorts by the last key first
+        items["by_recording"] = np.lexsort((items["offset"], items["gid_lo"], items["gid_hi"]))
+        self._mapping = similarity.index_mapping.IndexMapping(items)
+
+    def get_vectors(self, ids):
+        """Get the vectors of many ids.
+
+        Returns:
+            a tuple (vectors, found). vectors is a float32 matrix with a row for each id, and found is
+            a boolean array which is False for ids which aren't in the delta, whose rows are 0.
+        """
+        mapping = self._mapping
+        vectors = np.zeros((len(ids), self.dimensionality), dtype=np.float32)
+        items = mapping.get_items(ids)
+        found = np.asarray([item is not None for item in items], dtype=bool)
+        if found.any():
+            vectors[found] = mapping.mapping["vector"][np.asarray([item for item in items if item is not None])]
+        return vectors, found
+
+    def get_vector(self, id):
+        """Get the vector of an item, or None if it isn't in the delta"""
+        vectors, found = self.get_vectors([id])
+        return vectors[0] if found[0] else None
+
+    def get_recording(self, id):
+        """Get the (MBID, offset) of an item, or None if it isn't in the delta"""
+        mapping = self._mapping
+        item = mapping.get_items([id])[0]
+        return None if item is None else mapping.get_recordings([item])[0]
+
+    def get_id(self, mbid, offset):
+        """Get the id of a recording, or None if it isn't in the delta"""
+        return self._mapping.get_ids([(mbid, offset)])[0]
+
+    def get_nns_by_vector(self, vector, n):
+        """Get the ``n`` items nearest to ``vector``
+
+        Returns:
+            a tuple (ids, distances), nearest first
+        """
+        items = self.items
+        if not len(items) or n <= 0:
+            return [], []
+        distances = get_distances(items["vector"], vector, self.distance_type)
+        n = min(n, len(items))
+        nearest = np.argpartition(distances, n - 1)[:n]
+        nearest = nearest[np.argsort(distances[nearest], kind="stable")]
+        return items["id"][nearest].tolist(), distances[nearest].tolist()
+
+
+def save_delta(path, delta):
+    """Save the items of a delta to ``path``"""
+    # numpy.save adds .npy to file names which don't end with it, so give it a file instead
+    with open(path, "wb") as f:
+        np.save(f, delta.items)
+
+
+def load_delta(path, dimensionality, distance_type):
+    """Memory-map a delta saved with save_delta.
+
+    Returns:
+        a DeltaIndex, or None if there is no delta at ``path`` or its vectors don't have ``dimensionality`` values
+    """
+    try:
+        items = np.load(path, mmap_mode="r")
+    except IOError:
+        return None
+    except ValueError:
+        # Empty arrays can't be memory-mapped
+        items = np.load(path)
+    if items.dtype != get_delta_dtype(dimensionality):
+        return None
+    return DeltaIndex(dimensionality, distance_type, items=items)
@@ -0,0 +1,259 @@
+"""Similarity queries which combine several metrics.
+
+A hybrid query is given a weight for each of some base metrics. Candidates are found by
+querying the index of each metric for more neighbours than were asked for, and the union
+of the candidates is ranked by the weighted sum of their distances from the query recording,
+which are computed from the vectors of the indices. Weights are normalized to sum to 1, so
+that the combined distances are on the same scale as the distances of a single metric.
+
+Querying an index for every metric is slow, so a HybridModel can be saved for weightings
+which are queried often (see the `add-hybrid-index` command). Its vectors combine the vectors
+of each metric, so that it can be queried instead of the index of each metric to find
+candidates. The candidates are then ranked in the same way.
+"""
+import glob
+import math
+import os
+
+import numpy as np
+from flask import current_app
+
+import similarity.delta_index
+import similarity.exceptions
+import similarity.index_model
+import db.similarity
+
+from collections import defaultdict
+
+# Number of candidates found by a hybrid query for each neighbour that is asked for
+HYBRID_OVERSAMPLE = 3
+# Parameters of the base indices which are queried, and of saved hybrid indices
+HYBRID_DISTANCE_TYPE = "angular"
+HYBRID_INDEX_DISTANCE_TYPE = "euclidean"
+HYBRID_N_TREES = 10
+# Saved hybrid indices are named "hybrid-<metric><weight>-...", e.g. "hybrid-bpm0.5-mfccs0.5"
+HYBRID_INDEX_PREFIX = "hybrid-"
+
+
+def parse_weights(items):
+    """Parse the weights of a hybrid query.
+
+    Arguments:
+        items: a list of strings "metric:weight" or "metric". The weight of a metric
+        without one is 1.
+
+    Returns:
+        a dictionary {metric: weight} of weights normalized by :func:`normalize_weights`
+
+    Raises:
+        ValueError: if an item can't be parsed, a metric is given more than once,
+        or the weights are invalid
+    """
+    weights = {}
+    for item in items:
+        metric, _, weight = item.strip().partition(":")
+        if metric in weights:
+            raise ValueError("Metric {} is given more than once".format(metric))
+        try:
+            weights[metric] = float(weight) if weight else 1.0
+        except ValueError:
+            raise ValueError("Weight of metric {} is not a number".format(metric))
+    return normalize_weights(weights)
+
+
+def normalize_weights(weights):
+    """Check the weights of a hybrid query and scale them to sum to 1. Metrics with a weight of 0 are removed.
+
+    Raises:
+        ValueError: if a metric doesn't have a base index, a weight is negative or not finite,
+        or no metric has a weight above 0
+    """
+    for metric, weight in weights.items():
+        if HYBRID_DISTANCE_TYPE not in similarity.index_model.BASE_INDICES.get(metric, {}):
+            raise ValueError("An index with the metric {} does not exist".format(metric))
+        if not math.isfinite(weight) or weight < 0:
+            raise ValueError("Weight of metric {} must be a number >= 0".format(metric))
+    total = sum(weights.values())
+    if total <= 0:
+        raise ValueError("At least one metric must have a weight above 0")
+    return {metric: weight / total for metric, weight in weights.items() if weight > 0}
+
+
+def get_hybrid_name(weights):
+    """Get the name of the saved hybrid index for some weights. Weightings which are
+    the same after normalizing and rounding to 3 significant figures have the same name."""
+    weights = normalize_weights(weights)
+    return HYBRID_INDEX_PREFIX + "-".join("{}{:.3g}".format(metric, weight) for metric, weight in sorted(weights.items()))
+
+
+def combine_vectors(vectors, weights):
+    """Combine the vectors of a recording for each metric into the vector of a hybrid index.
+
+    Each vector is normalized and scaled by the square root of the weight of its metric.
+    The euclidean distance between two combined vectors is then sqrt(sum(weight * distance ** 2)),
+    where distance is the angular distance of each metric, which approximates the combined distance
+    used to rank the results of a hybrid query.
+
+    Arguments:
+        vectors: a dictionary {metric: vector}
+        weights: normalized weights {metric: weight}
+    """
+    parts = []
+    for metric, weight in sorted(weights.items()):
+        vector = np.asarray(vectors[metric], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        parts.append(vector * (math.sqrt(weight) / norm) if norm > 0 else vector)
+    return np.concatenate(parts).tolist()
+
+
+class HybridModel(similarity.index_model.AnnoyModel):
+    """An index of the combined vectors of several metrics (see :func:`combine_vectors`), which is used
+    to find the candidates of hybrid queries with the same weights"""
+
+    def __init__(self, weights, n_trees=HYBRID_N_TREES, load_existing=False):
+        self.weights = normalize_weights(weights)
+        super(HybridModel, self).__init__(get_hybrid_name(self.weights), n_trees=n_trees,
+                                          distance_type=HYBRID_INDEX_DISTANCE_TYPE, load_existing=load_existing)
+
+    def parse_initial_params(self, metric_name, n_trees, distance_type):
+        if not isinstance(n_trees, int) or n_trees < 1:
+            raise similarity.exceptions.IndexNotFoundException('Index for specified number of trees is not possible.')
+        self.metric_name = metric_name
+        self.distance_type = distance_type
+        self.n_trees = n_trees
+
+    def _get_dimensionality(self):
+        return sum(db.similarity.get_metric_dimensionality(metric) for metric in self.columns)
+
+    @property
+    def columns(self):
+        return sorted(self.weights)
+
+    def get_row_vector(self, row):
+        return combine_vectors({metric: row[metric] for metric in self.columns}, self.weights)
+
+    def _get_metadata(self):
+        metadata = super(HybridModel, self)._get_metadata()
+        metadata["weights"] = self.weights
+        return metadata
+
+
+def get_saved_hybrid_indices(location=None):
+    """Get the parameters of the hybrid indices which have been saved.
+
+    Returns:
+        a list of tuples (weights, n_trees, max_id), where max_id is the highest id in the index
+    """
+    if not location:
+        location = current_app.config['SIMILARITY_INDEX_DIR']
+    saved = []
+    pattern = "{}*_{}_*.ann".format(HYBRID_INDEX_PREFIX, HYBRID_INDEX_DISTANCE_TYPE)
+    for path in sorted(glob.glob(os.path.join(location, pattern))):
+        metadata = similarity.index_model._read_metadata(path)
+        if metadata and "weights" in metadata:
+            saved.append((metadata["weights"], metadata["n_trees"], metadata.get("max_id")))
+    return saved
+
+
+def get_hybrid_index(weights, n_trees=HYBRID_N_TREES):
+    """Get the saved hybrid index for some weights, loaded in the same way as
+    :func:`similarity.index_model.get_index`, or None if there isn't one"""
+    weights = normalize_weights(weights)
+    try:
+        return similarity.index_model.get_shared_index(
+            get_hybrid_name(weights), HYBRID_INDEX_DISTANCE_TYPE, n_trees,
+            lambda: HybridModel(weights, n_trees=n_trees, load_existing=True))
+    except similarity.exceptions.IndexNotFoundException:
+        return None
+
+
+def get_combined_distances(indices, id, candidates):
+    """Get the combined distance of a hybrid query from a recording to each of some candidates.
+
+    Arguments:
+        indices: a list of tuples (index, weight), with the index of each metric of the query
+        id: the lowlevel.id of the query recording
+        candidates: a list of lowlevel.ids
+
+    Returns:
+        an array of the weighted sum of the distances of each candidate. The distance of
+        candidates which aren't in all of the indices is infinite.
+
+    Raises:
+        ItemNotFoundException: if the query recording isn't in all of the indices
+    """
+    combined = np.zeros(len(candidates), dtype=np.float64)
+    for index, weight in indices:
+        vector, found = index.get_vectors([id])
+        if not found[0]:
+            raise similarity.exceptions.ItemNotFoundException('The item you are requesting is not indexed.')
+        vectors, found = index.get_vectors(candidates)
+        distances = similarity.delta_index.get_distances(vectors, vector[0], index.distance_type)
+        combined += weight * np.where(found, distances, np.inf)
+    return combined
+
+
+def _get_candidates(indices, hybrid_index, id, num_candidates):
+    # Get the lowlevel.ids of the candidates of a hybrid query, from the hybrid index for its weights
+    # if there is one which has the query recording, or else from the index of each metric
+    if hybrid_index is not None:
+        try:
+            ids, _, _ = hybrid_index.get_nns_by_id(id, num_candidates)
+            return sorted(set(ids))
+        except similarity.exceptions.ItemNotFoundException:
+            pass
+    candidates = set()
+    for index, _ in indices:
+        try:
+            ids, _, _ = index.get_nns_by_id(id, num_candidates)
+            candidates.update(ids)
+        except similarity.exceptions.ItemNotFoundException:
+            continue
+    return sorted(candidates)
+
+
+def get_hybrid_nns(recordings, weights, num_neighbours, oversample=HYBRID_OVERSAMPLE):
+    """Get the most similar recordings to each (MBID, offset) tuple provided, using
+    the weighted combination of the distances of several metrics.
+
+    Arguments:
+        recordings: a list of tuples (MBID, offset)
+        weights: a dictionary {metric: weight}
+        num_neighbours (int): the number of similar recordings to get for each recording
+        oversample (int): the number of candidates to find for each neighbour
+
+    Returns:
+        a dictionary of similar recordings in the same format as
+        :meth:`similarity.index_model.AnnoyModel.get_bulk_nns_by_mbid`.
+
+    Raises:
+        IndexNotFoundException: if there is no index for one of the metrics
+    """
+    weights = normalize_weights(weights)
+    indices = [(similarity.index_model.get_index(metric, n_trees=HYBRID_N_TREES, distance_type=HYBRID_DISTANCE_TYPE),
+                weight) for metric, weight in sorted(weights.items())]
+    hybrid_index = get_hybrid_index(weights)
+    first_index = indices[0][0]
+    num_candidates = num_neighbours * oversample
+
+    recordings_info = defaultdict(dict)
+    for recording_id, (mbid, offset) in zip(first_index.get_ids(recordings), recordings):
+        if recording_id is None:
+            continue
+        candidates = _get_candidates(indices, hybrid_index, recording_id, num_candidates)
+        try:
+            distances = get_combined_distances(indices, recording_id, candidates)
+        except similarity.exceptions.ItemNotFoundException:
+            continue
+        nearest = [row for row in np.argsort(distances, kind="stable").tolist() if np.isfinite(distances[row])]
+        nearest = nearest[:num_neighbours]
+        similar_recordings = first_index.get_recordings([candidates[row] for row in nearest])
+        data = []
+        for row, recording in zip(nearest, similar_recordings):
+            if recording[0] is None:
+                continue
+            data.append({'recording_mbid': recording[0],
+                         'offset': recording[1],
+                         'distance': float(distances[row])})
+        recordings_info[mbid][str(offset)] = data
+    return recordings_info
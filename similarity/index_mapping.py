@@ -0,0 +1,237 @@
+"""Mapping between the items of a similarity index, lowlevel.ids and (MBID, offset) pairs.
+
+Items are numbered from 0 in the order they are added to an index, so that the index only
+has space for the recordings which are in it, however sparse their lowlevel.ids are. The
+mapping is saved next to an index when it is built, so that the results of a query can be
+resolved without querying the database. It is a numpy structured array with a row for each
+item of the index, which is saved with ``numpy.save`` and memory-mapped when it is loaded.
+Like Annoy index files, its pages are shared by all processes which load it.
+
+MBIDs are stored as two unsigned 64 bit integers. Items added without a recording have the
+nil MBID. The ``by_id`` and ``by_recording`` columns hold the row numbers of the mapping in
+lowlevel.id and (MBID, offset) order, so that items can be found for ids and recordings.
+"""
+import array
+import uuid
+
+import numpy as np
+
+MAPPING_DTYPE = np.dtype([
+    ("id", "<i4"),
+    ("gid_hi", "<u8"),
+    ("gid_lo", "<u8"),
+    ("offset", "<u2"),
+    ("by_id", "<i4"),
+    ("by_recording", "<i4"),
+])
+
+_UINT64_MASK = (1 << 64) - 1
+
+
+def _split_mbid(mbid):
+    value = uuid.UUID(str(mbid)).int
+    return value >> 64, value & _UINT64_MASK
+
+
+def _join_mbid(gid_hi, gid_lo):
+    return str(uuid.UUID(int=(gid_hi << 64) | gid_lo))
+
+
+def _binary_search(count, key, get_key):
+    """Find the position in [0, count) whose key is ``key``, where ``get_key(position)``
+    is in ascending order, or return None if there isn't one"""
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        if get_key(middle) < key:
+            low = middle + 1
+        else:
+            high = middle
+    if low < count and get_key(low) == key:
+        return low
+    return None
+
+
+class MappingBuilder(object):
+    """Numbers the items added to an index while it is being built"""
+
+    def __init__(self):
+        self.ids = array.array("q")
+        self.gid_hi = array.array("Q")
+        self.gid_lo = array.array("Q")
+        self.offsets = array.array("q")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, id, mbid, offset):
+        """Add an item. Each id should only be added once.
+
+        Arguments:
+            id: the lowlevel.id of the item
+            mbid, offset: the recording of the item. mbid may be None for items without a recording
+
+        Returns:
+            the number of the new item in the index
+        """
+        gid_hi, gid_lo = _split_mbid(mbid) if mbid is not None else (0, 0)
+        self.ids.append(id)
+        self.gid_hi.append(gid_hi)
+        self.gid_lo.append(gid_lo)
+        self.offsets.append(offset or 0)
+        return len(self.ids) - 1
+
+    def get_item(self, id):
+        """Get the number of the item with a lowlevel.id, or None if it hasn't been added"""
+        items = np.flatnonzero(np.frombuffer(self.ids, dtype=np.int64) == id)
+        return int(items[0]) if len(items) else None
+
+    def build(self):
+        """Get the mapping of the added items, as a numpy array with dtype MAPPING_DTYPE
+
+        Raises:
+            ValueError: if an id or offset is too large to be stored in the mapping
+        """
+        ids = np.frombuffer(self.ids, dtype=np.int64)
+        offsets = np.frombuffer(self.offsets, dtype=np.int64)
+        if len(ids) and ids.max() > np.iinfo(np.int32).max:
+            raise ValueError("Index item id {} is too large for the mapping".format(ids.max()))
+        if len(offsets) and offsets.max() > np.iinfo(np.uint16).max:
+            raise ValueError("Submission offset {} is too large for the mapping".format(offsets.max()))
+
+        mapping = np.empty(len(ids), dtype=MAPPING_DTYPE)
+        mapping["id"] = ids
+        mapping["gid_hi"] = np.frombuffer(self.gid_hi, dtype=np.uint64)
+        mapping["gid_lo"] = np.frombuffer(self.gid_lo, dtype=np.uint64)
+        mapping["offset"] = offsets
+        mapping["by_id"] = np.argsort(ids, kind="stable")
+        # lexsort sorts by the last key first
+        mapping["by_recording"] = np.lexsort((mapping["offset"], mapping["gid_lo"], mapping["gid_hi"]))
+        return mapping
+
+
+class IndexMapping(object):
+    """Looks up the items of an index in a mapping built by MappingBuilder"""
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+
+    def __len__(self):
+        return len(self.mapping)
+
+    def _get_rows(self, items):
+        items = np.asarray(items, dtype=np.int64)
+        found = (items >= 0) & (items < len(self.mapping))
+        return self.mapping[np.where(found, items, 0)], found
+
+    def get_recordings(self, items):
+        """Get the (MBID, offset) of many items.
+
+        Returns:
+            a list of (MBID, offset) tuples in the same order as ``items``.
+            (None, None) is used for items which aren't in the mapping, or
+            which were added without a recording.
+        """
+        if not len(items) or not len(self.mapping):
+            return [(None, None)] * len(items)
+
+        rows, found = self._get_rows(items)
+        found &= (rows["gid_hi"] != 0) | (rows["gid_lo"] != 0)
+        recordings = []
+        for is_found, gid_hi, gid_lo, offset in zip(found.tolist(), rows["gid_hi"].tolist(),
+                                                    rows["gid_lo"].tolist(), rows["offset"].tolist()):
+            if is_found:
+                recordings.append((_join_mbid(gid_hi, gid_lo), offset))
+            else:
+                recordings.append((None, None))
+        return recordings
+
+    def get_item_ids(self, items):
+        """Get the lowlevel.ids of many items, with None for items which aren't in the mapping"""
+        if not len(items) or not len(self.mapping):
+            return [None] * len(items)
+
+        rows, found = self._get_rows(items)
+        return [id if is_found else None for id, is_found in zip(rows["id"].tolist(), found.tolist())]
+
+    def get_items(self, ids):
+        """Get the items of many lowlevel.ids, with None for ids which aren't in the mapping"""
+        if not len(ids) or not len(self.mapping):
+            return [None] * len(ids)
+
+        # A binary search for all of the ids at once
+        ids = np.asarray(ids, dtype=np.int64)
+        by_id = self.mapping["by_id"]
+        item_ids = self.mapping["id"]
+        low = np.zeros(len(ids), dtype=np.int64)
+        high = np.full(len(ids), len(self.mapping), dtype=np.int64)
+        while True:
+            searching = low < high
+            if not searching.any():
+                break
+            middle = (low + high) // 2
+            below = searching & (item_ids[by_id[np.minimum(middle, len(self.mapping) - 1)]] < ids)
+            low = np.where(below, middle + 1, low)
+            high = np.where(searching & ~below, middle, high)
+        items = by_id[np.minimum(low, len(self.mapping) - 1)]
+        found = (low < len(self.mapping)) & (item_ids[items] == ids)
+        return [int(item) if is_found else None for item, is_found in zip(items.tolist(), found.tolist())]
+
+    def _get_item_by_recording(self, mbid, offset):
+        try:
+            key = _split_mbid(mbid) + (int(offset),)
+        except (ValueError, TypeError):
+            return None
+        if key[:2] == (0, 0):
+            return None
+
+        by_recording = self.mapping["by_recording"]
+
+        def get_key(i):
+            row = self.mapping[by_recording[i]]
+            return int(row["gid_hi"]), int(row["gid_lo"]), int(row["offset"])
+
+        position = _binary_search(len(self.mapping), key, get_key)
+        return None if position is None else int(by_recording[position])
+
+    def get_ids(self, recordings):
+        """Get the lowlevel.ids of many recordings.
+
+        Arguments:
+            recordings: a list of (MBID, offset) tuples
+
+        Returns:
+            a list of ids in the same order as ``recordings``. None is used for
+            recordings which aren't in the mapping.
+        """
+        ids = []
+        for mbid, offset in recordings:
+            item = self._get_item_by_recording(mbid, offset)
+            ids.append(None if item is None else int(self.mapping[item]["id"]))
+        return ids
+
+
+def save_mapping(path, mapping):
+    """Save a mapping built by MappingBuilder.build to ``path``"""
+    # numpy.save adds .npy to file names which don't end with it, so give it a file instead
+    with open(path, "wb") as f:
+        np.save(f, mapping)
+
+
+def load_mapping(path):
+    """Memory-map a mapping saved with save_mapping.
+
+    Returns:
+        an IndexMapping, or None if there is no mapping at ``path``, or if it was saved in an
+        older format where the items of an index were lowlevel.ids
+    """
+    try:
+        mapping = np.load(path, mmap_mode="r")
+    except IOError:
+        return None
+    except ValueError:
+        # Empty arrays can't be memory-mapped
+        mapping = np.load(path)
+    if mapping.dtype != MAPPING_DTYPE:
+        return None
+    return IndexMapping(mapping)
@@ -1,8 +1,18 @@
+import array
+import glob
+import json
 import os
+import shutil
+import tempfile
+import threading
+import time
 
+import numpy as np
 from flask import current_app
 
+import similarity.delta_index
 import similarity.exceptions
+import similarity.index_mapping
 import db.similarity
 import db.data
 import db.exceptions
@@ -10,8 +20,219 @@ import db.exceptions
 from annoy import AnnoyIndex
 from collections import defaultdict
 
+# Number of seconds that a process uses an index loaded by get_index before checking
+# if a newer index file has been saved
+INDEX_CHECK_INTERVAL = 10
+
+# Number of rows which are read at a time when adding rows of the similarity table to the
+# delta saved with an index, and the maximum number of rows kept in a delta, see AnnoyModel.save_delta.
+# Indices are rebuilt by compact-indices long before their deltas are full.
+DELTA_UPDATE_BATCH_SIZE = 10000
+DELTA_MAX_ITEMS = 50000
+
+# Indices loaded by get_index,
+# {(metric_name, distance_type, n_trees): {"index", "file_id", "delta_file_id", "checked_at"}}
+_loaded_indices = {}
+_loaded_indices_lock = threading.Lock()
+
+
+def get_index_path(metric_name, distance_type, n_trees, location=None):
+    """Get the path of a saved index. This is a link to the index file in the directory of
+    the version of the index which was saved last (see :meth:`AnnoyModel.save`). Use
+    :func:`resolve_index_path` to find the files saved alongside the index."""
+    if not location:
+        location = current_app.config['SIMILARITY_INDEX_DIR']
+    name = '_'.join([metric_name, distance_type, str(n_trees)]) + '.ann'
+    return os.path.join(location, name)
+
+
+def resolve_index_path(index_path):
+    """Get the path of the index file of the version which ``index_path`` links to. Files
+    saved alongside the index have the same path with a different extension. Find them from
+    a resolved path, so that they are from the same version as the index even if a newer
+    version is saved meanwhile."""
+    return os.path.realpath(index_path)
+
+
+def _link_version(index_path, version_path):
+    # Point the link at index_path to the index file of a new version. Renaming a link replaces
+    # the old one atomically, so processes see either all of the old files or all of the new ones.
+    tmp_path = index_path + '.tmp'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    os.symlink(os.path.relpath(version_path, os.path.dirname(index_path)), tmp_path)
+    os.replace(tmp_path, index_path)
+
+
+def remove_saved_versions(index_path, keep=()):
+    """Remove the directories of the saved versions of an index, except for those in ``keep``,
+    and the files of the index if it was saved before versions were used."""
+    keep = [os.path.realpath(path) for path in keep]
+    for path in glob.glob(glob.escape(os.path.splitext(index_path)[0]) + '.*'):
+        if os.path.isdir(path) and os.path.realpath(path) not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+    for path in [get_metadata_path(index_path), get_mapping_path(index_path), get_vectors_path(index_path)]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def remove_index_files(index_path):
+    """Remove a saved index and all of its versions"""
+    if os.path.lexists(index_path):
+        os.remove(index_path)
+    remove_saved_versions(index_path)
+
+
+def get_metadata_path(index_path):
+    """Get the path of the metadata file of an index, e.g. mfccs_angular_10.json"""
+    return os.path.splitext(index_path)[0] + '.json'
+
+
+def get_mapping_path(index_path):
+    """Get the path of the id mapping of an index, e.g. mfccs_angular_10.mapping.npy"""
+    return os.path.splitext(index_path)[0] + '.mapping.npy'
+
+
+def get_vectors_path(index_path):
+    """Get the path of the vectors of an index, e.g. mfccs_angular_10.vectors.npy"""
+    return os.path.splitext(index_path)[0] + '.vectors.npy'
+
+
+def get_delta_path(index_path):
+    """Get the path of the delta of an index, e.g. mfccs_angular_10.delta.npy"""
+    return os.path.splitext(index_path)[0] + '.delta.npy'
+
+
+def load_vectors(path, n_items, dimensionality):
+    """Memory-map the vectors saved with an index by :meth:`AnnoyModel.save`.
+
+    Returns:
+        a float32 matrix with a row for each item of the index, or None if there are no vectors
+        at ``path`` or they don't match the index
+    """
+    try:
+        vectors = np.load(path, mmap_mode="r")
+    except IOError:
+        return None
+    except ValueError:
+        # Empty arrays can't be memory-mapped
+        vectors = np.load(path)
+    if vectors.dtype != np.float32 or vectors.shape != (n_items, dimensionality):
+        return None
+    return vectors
+
+
+def _replace_file(path, write):
+    """Write a file by calling ``write`` with a temporary path, and then renaming the temporary file.
+    Processes which have the old file open or memory-mapped keep reading the old file, and
+    a partially written file is never seen at ``path``."""
+    tmp_path = path + '.tmp'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _write_metadata(index_path, metadata):
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(metadata, f)
+    _replace_file(get_metadata_path(index_path), write)
+
+
+def _read_metadata(index_path):
+    """Read the metadata file of an index, or return None if the index was saved without one"""
+    try:
+        with open(get_metadata_path(resolve_index_path(index_path))) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def get_saved_max_id(metric_name, distance_type, n_trees):
+    """Get the highest id in a saved index, or None if there is no saved index with
+    these parameters or it was saved without this information"""
+    metadata = _read_metadata(get_index_path(metric_name, distance_type, n_trees))
+    if not metadata:
+        return None
+    return metadata.get("max_id")
+
+
+def _get_file_id(path):
+    """Something which changes when the file at ``path`` is replaced"""
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _get_delta_file_id(index):
+    # The file id of the delta saved with a loaded index, or None if it has no delta
+    try:
+        return _get_file_id(get_delta_path(index.path))
+    except (OSError, TypeError):
+        return None
+
+
+def get_index(metric_name, n_trees=10, distance_type='angular'):
+    """Get a loaded index, which is shared by all requests handled by this process.
+
+    Each index is loaded once per process. Annoy memory-maps the index file, so the pages of an
+    index are also shared between all processes which load it. A process starts using a newer index
+    within INDEX_CHECK_INTERVAL seconds of it being saved. Indices which are already in use are
+    left untouched, because saving an index writes a new version (see :meth:`AnnoyModel.save`).
+
+    Recordings added to the similarity table after the index was built are searched in the delta
+    saved with the index (see :meth:`AnnoyModel.save_delta`), which is memory-mapped in the same way.
+    A process starts using a newer delta within INDEX_CHECK_INTERVAL seconds of it being saved.
+
+    Raises:
+        IndexNotFoundException: if the parameters are invalid or there is no saved index
+        with these parameters
+    """
+    return get_shared_index(metric_name, distance_type, n_trees,
+                            lambda: AnnoyModel(metric_name, n_trees=n_trees, distance_type=distance_type,
+                                               load_existing=True))
+
+
+def get_shared_index(metric_name, distance_type, n_trees, load):
+    """Get an index which is loaded by calling ``load`` and shared by all requests handled
+    by this process, in the same way as :func:`get_index`. ``metric_name``, ``distance_type``
+    and ``n_trees`` are the parameters of the saved index which is loaded.
+    """
+    key = (metric_name, distance_type, n_trees)
+    loaded = _loaded_indices.get(key)
+    if loaded and time.time() - loaded["checked_at"] < INDEX_CHECK_INTERVAL:
+        return loaded["index"]
+
+    with _loaded_indices_lock:
+        now = time.time()
+        loaded = _loaded_indices.get(key)
+        if loaded and now - loaded["checked_at"] < INDEX_CHECK_INTERVAL:
+            return loaded["index"]
+
+        try:
+            file_id = _get_file_id(get_index_path(metric_name, distance_type, n_trees))
+        except OSError:
+            _loaded_indices.pop(key, None)
+            raise similarity.exceptions.IndexNotFoundException('Index with specified parameters does not exist.')
+        if not loaded or loaded["file_id"] != file_id:
+            index = load()
+            loaded = {"index": index, "file_id": file_id, "delta_file_id": _get_delta_file_id(index), "checked_at": now}
+            _loaded_indices[key] = loaded
+        loaded["checked_at"] = now
+
+        delta_file_id = _get_delta_file_id(loaded["index"])
+        if delta_file_id != loaded["delta_file_id"]:
+            loaded["delta_file_id"] = delta_file_id
+            loaded["index"].load_delta()
+        return loaded["index"]
+
+
+def unload_indices():
+    """Forget all indices loaded by :func:`get_index` in this process"""
+    with _loaded_indices_lock:
+        _loaded_indices.clear()
+
+
 class AnnoyModel(object):
-    def __init__(self, metric_name, n_trees=10, distance_type='angular', load_existing=False):
+    def __init__(self, metric_name, n_trees=10, distance_type='angular', load_existing=False, dimensionality=None):
         """
         Args:
             - metric_name: the name of the metric that vectors in the index will
@@ -22,17 +243,55 @@ class AnnoyModel(object):
               "angular", "euclidean", "manhattan", "hamming", or "dot".
             - load_existing: if load_existing is True, then load function will be
               called upon initialization.
+            - dimensionality: the dimensionality of the vectors of a new index. If None,
+              it is read from the similarity table.
+
+        Use :func:`get_index` to query a saved index, rather than loading it for every query.
         """
         # Check params
         self.parse_initial_params(metric_name, n_trees, distance_type)
-        self.dimensionality = db.similarity.get_metric_dimensionality(self.metric_name)
-        self.index = AnnoyIndex(self.dimensionality, metric=self.distance_type)
+        self.dimensionality = None
+        self.index = None
+        # lowlevel.id and (MBID, offset) of the items in the index. While the index is being built,
+        # this is a MappingBuilder which numbers the items added so far, and once it is built or loaded
+        # an IndexMapping. A loaded index has no mapping if it was saved without one. The items
+        # of these indices are lowlevel.ids, and the database is used to find their recordings.
+        self.mapping = similarity.index_mapping.MappingBuilder()
+        # The highest id added to the index
+        self.max_id = None
+        # The vectors of the items of the index, in item order. While the index is being built, this is
+        # an array of the vectors added so far, and once it is built a float32 matrix. The matrix of a
+        # loaded index is memory-mapped from the file written by save, and is None if it was saved without one.
+        self.vectors = array.array("f")
+        # Recordings added to the similarity table after the index was built, see save_delta
+        self.delta = None
+        # The path of the index file of the version of the index which was saved or loaded, see resolve_index_path
+        self.path = None
 
         # in_loaded_state set to True if the index is built, loaded, or saved.
         # At any of these points, items can no longer be added to the index.
         self.in_loaded_state = False
         if load_existing:
             self.load()
+        else:
+            self._init_index(dimensionality or self._get_dimensionality())
+
+    def _init_index(self, dimensionality):
+        self.dimensionality = dimensionality
+        self.index = AnnoyIndex(self.dimensionality, metric=self.distance_type)
+
+    def _get_dimensionality(self):
+        # Get the dimensionality of new indices from the similarity table
+        return db.similarity.get_metric_dimensionality(self.metric_name)
+
+    @property
+    def columns(self):
+        """The columns of the similarity table which the vectors of the index are made from"""
+        return [self.metric_name]
+
+    def get_row_vector(self, row):
+        """Get the vector of the index for a row of the similarity table with the index's columns"""
+        return row[self.metric_name]
 
     def parse_initial_params(self, metric_name, n_trees, distance_type):
         # Validate the index parameters passed to AnnoyModel.
@@ -51,15 +310,32 @@ class AnnoyModel(object):
         else:
             raise similarity.exceptions.IndexNotFoundException('Index for specified number of trees is not possible.')
 
-    def build(self):
+    def build(self, n_jobs=None):
         """Build and load the index using the specified number of trees. An index
-        must be built before it can be queried."""
-        n_jobs = current_app.config['SIMILARITY_BUILD_NUM_JOBS']
+        must be built before it can be queried.
+
+        Args:
+            n_jobs: the number of threads used to build the trees. If None,
+            SIMILARITY_BUILD_NUM_JOBS is read from the app config.
+        """
+        if n_jobs is None:
+            n_jobs = current_app.config['SIMILARITY_BUILD_NUM_JOBS']
         self.index.build(n_trees=self.n_trees, n_jobs=n_jobs)
+        if isinstance(self.mapping, similarity.index_mapping.MappingBuilder):
+            self.mapping = similarity.index_mapping.IndexMapping(self.mapping.build())
+        if isinstance(self.vectors, array.array):
+            self.vectors = np.frombuffer(self.vectors, dtype=np.float32).reshape(-1, self.dimensionality)
         self.in_loaded_state = True
 
     def save(self, location=None, name=None):
-        # Save and load the index using the metric name.
+        """Save the index using the metric name, with a metadata file holding its dimensionality,
+        a mapping from its items to the lowlevel.id and (MBID, offset) of the recordings that were added,
+        and a matrix of the vectors of its items, which is used by queries of the saved index.
+
+        The files are written to a new directory, and the index path is then linked to the index
+        file in it. An existing index with the same name is replaced, without affecting processes
+        that are using it. The directory of the version which was replaced is kept for processes
+        which are loading it, and older versions are removed."""
         if not self.in_loaded_state:
             raise similarity.exceptions.LoadStateException('Index must be built before saving.')
         if not location:
@@ -69,9 +345,36 @@ class AnnoyModel(object):
         except OSError:
             if not os.path.isdir(location):
                 raise
-        name = '_'.join([name or self.metric_name, self.distance_type, str(self.n_trees)]) + '.ann'
-        file_path = os.path.join(location, name)
+        index_path = get_index_path(name or self.metric_name, self.distance_type, self.n_trees, location=location)
+        previous_path = resolve_index_path(index_path)
+        version_dir = tempfile.mkdtemp(prefix=os.path.splitext(os.path.basename(index_path))[0] + '.', dir=location)
+        os.chmod(version_dir, 0o755)
+        file_path = os.path.join(version_dir, os.path.basename(index_path))
+        _write_metadata(file_path, self._get_metadata())
+        if self.mapping is not None:
+            similarity.index_mapping.save_mapping(get_mapping_path(file_path), self.mapping.mapping)
+        if self.vectors is not None:
+            self._save_vectors(get_vectors_path(file_path))
         self.index.save(file_path)
+        self.path = file_path
+        _link_version(index_path, file_path)
+        remove_saved_versions(index_path, keep=[version_dir, os.path.dirname(previous_path)])
+        self.vectors = load_vectors(get_vectors_path(file_path), self.index.get_n_items(), self.dimensionality)
+
+    def _save_vectors(self, path):
+        # Write the vectors of the items of the index to a .npy file, in item order, so that
+        # they can be read without the overhead of a call to Annoy for each item
+        with open(path, "wb") as f:
+            np.save(f, np.asarray(self.vectors, dtype=np.float32))
+
+    def _get_metadata(self):
+        # Get the metadata saved alongside the index
+        return {"metric": self.metric_name,
+                "distance_type": self.distance_type,
+                "n_trees": self.n_trees,
+                "dimensionality": self.dimensionality,
+                "n_items": self.index.get_n_items(),
+                "max_id": self.max_id}
 
     def load(self, name=None):
         """
@@ -81,51 +384,106 @@ class AnnoyModel(object):
         Raises:
             IndexNotFoundException: if there is no saved index with the given parameters.
         """
-        # Load and build an existing annoy index.
-        file_path = current_app.config['SIMILARITY_INDEX_DIR']
-        name = '_'.join([name or self.metric_name, self.distance_type, str(self.n_trees)]) + '.ann'
-        full_path = os.path.join(file_path, name)
+        # Load and build an existing annoy index. The dimensionality of the index is read
+        # from its metadata file, falling back to the database for indices saved without one.
+        full_path = resolve_index_path(get_index_path(name or self.metric_name, self.distance_type, self.n_trees))
+        metadata = _read_metadata(full_path)
+        if metadata:
+            dimensionality = metadata["dimensionality"]
+        else:
+            dimensionality = self.dimensionality or self._get_dimensionality()
+        if self.index is None or dimensionality != self.dimensionality:
+            self._init_index(dimensionality)
         try:
             self.index.load(full_path)
             self.in_loaded_state = True
         except IOError:
             raise similarity.exceptions.IndexNotFoundException
+        self.mapping = similarity.index_mapping.load_mapping(get_mapping_path(full_path))
+        self.vectors = load_vectors(get_vectors_path(full_path), self.index.get_n_items(), self.dimensionality)
+        self.max_id = metadata.get("max_id") if metadata else None
+        self.path = full_path
+        self.load_delta()
+
+    def load_delta(self):
+        """Memory-map the delta saved with this index by :meth:`save_delta`, if it has one"""
+        if self.distance_type not in similarity.delta_index.DISTANCE_TYPES:
+            return
+        self.delta = similarity.delta_index.load_delta(get_delta_path(self.path), self.dimensionality,
+                                                       self.distance_type)
+
+    def save_delta(self):
+        """Add rows of the similarity table with an id higher than any item in the index to
+        the delta saved with this index, which is searched along with the index by the processes
+        which use it. Rows are read DELTA_UPDATE_BATCH_SIZE at a time, and the delta stops growing
+        once it has DELTA_MAX_ITEMS items, until a new index is saved.
+
+        The delta is saved in the same directory as the version of the index which was loaded,
+        replacing the previous delta without affecting processes that are using it.
 
-    def add_recording_by_mbid(self, mbid, offset):
-        """Add a single recording specified by (mbid, offset) to the index.
-        Note that when adding a single recording, space is allocated for
-        the lowlevel.id + 1 items.
+        Returns:
+            the number of items added to the delta
         """
+        if not self.in_loaded_state or self.path is None:
+            raise similarity.exceptions.LoadStateException('Index must be saved or loaded before adding to its delta.')
+        if self.distance_type not in similarity.delta_index.DISTANCE_TYPES:
+            return 0
+        delta = self.delta
+        if delta is None:
+            delta = similarity.delta_index.DeltaIndex(self.dimensionality, self.distance_type)
+
+        added = 0
+        while True:
+            limit = min(DELTA_UPDATE_BATCH_SIZE, DELTA_MAX_ITEMS - len(delta))
+            if limit <= 0:
+                current_app.logger.warning("The delta of index %s is full, the index should be rebuilt",
+                                           self.metric_name)
+                break
+            if len(delta):
+                after_id = delta.max_id
+            elif self.max_id is not None:
+                after_id = self.max_id
+            else:
+                # Items of indices saved without max_id are lowlevel.ids
+                after_id = self.index.get_n_items() - 1
+            rows = db.similarity.get_similarity_after(self.columns, after_id, limit)
+            delta.add([row["id"] for row in rows],
+                      [self.get_row_vector(row) for row in rows],
+                      [(row["gid"], row["submission_offset"]) for row in rows])
+            added += len(rows)
+            if len(rows) < limit:
+                break
+
+        delta_path = get_delta_path(self.path)
+        if added or not os.path.exists(delta_path):
+            _replace_file(delta_path, lambda tmp_path: similarity.delta_index.save_delta(tmp_path, delta))
+        self.delta = delta
+        return added
+
+    def add_recording_by_mbid(self, mbid, offset):
+        """Add a single recording specified by (mbid, offset) to the index."""
         if self.in_loaded_state:
             raise similarity.exceptions.CannotAddItemException("Item cannot be added once index is in load state.")
         item = db.similarity.get_similarity_by_mbid(mbid, offset)
         if item:
-            recording_vector = item[self.metric_name]
-            id = item['id']
             # If an item already exists, this should not error
             # and we should not add the item.
-            try:
-                self.index.get_item_vector(id)
-            except IndexError:
-                self.index.add_item(id, recording_vector)
+            if self.mapping.get_item(item["id"]) is None:
+                self._add_item(item["id"], item[self.metric_name], mbid, offset)
 
     def add_recording_by_id(self, id):
-        """Add a single recording specified by its lowlevel.id to the index.
-        Note that when adding a single recording, space is allocated for
-        lowlevel.id + 1 items.
-        """
+        """Add a single recording specified by its lowlevel.id to the index."""
         if self.in_loaded_state:
             raise similarity.exceptions.CannotAddItemException("Item cannot be added once index is in load state.")
         item = db.similarity.get_similarity_row_id(id)
         if item:
             # If an item already exists, this should not error
             # and we should not add the item.
-            try:
-                self.index.get_item_vector(id)
-            except IndexError:
-                self.index.add_item(item["id"], item[self.metric_name])
+            if self.mapping.get_item(item["id"]) is None:
+                mbid, offset = db.data.get_mbids_by_ids([item["id"]])[0]
+                self._add_item(item["id"], item[self.metric_name], mbid, offset)
 
-    def add_recording_with_vector(self, id, vector):
+    def add_recording_with_vector(self, id, vector, recording=None):
         """Add a single recording to the index using its lowlevel.id and
         a precomputed metric vector.
 
@@ -136,7 +494,12 @@ class AnnoyModel(object):
             Dimensionality of the vector must match the dimensionality with which the
             index is initialized
 
-        *NOTE*: Annoy will allocate memory for max(n) + 1 items.
+            recording: the (MBID, offset) of the recording, which is added to the
+            mapping saved with the index. Items added without a recording are never
+            returned from queries of the index.
+
+        *NOTE*: Items are numbered in the order they are added, and the number of each
+        lowlevel.id is kept in the mapping saved with the index. Each id should only be added once.
         """
         if self.in_loaded_state:
             raise similarity.exceptions.CannotAddItemException("Item cannot be added once index is in load state.")
@@ -144,9 +507,113 @@ class AnnoyModel(object):
             raise similarity.exceptions.CannotAddItemException(
                 "Dimensionality of vector provided does not match index dimensionality.")
 
-        self.index.add_item(id, vector)
+        mbid, offset = recording or (None, None)
+        self._add_item(id, vector, mbid, offset)
+
+    def _add_item(self, id, vector, mbid, offset):
+        # Add an item to the index and its mapping, and keep its vector to be saved with the index
+        self.index.add_item(self.mapping.add(id, mbid, offset), vector)
+        self.vectors.extend(vector)
+        self.max_id = id if self.max_id is None else max(self.max_id, id)
+
+    def _has_mapping(self):
+        # Whether the items of the index are numbered by its mapping, rather than being lowlevel.ids
+        return isinstance(self.mapping, similarity.index_mapping.IndexMapping)
+
+    def _get_item(self, id):
+        # Get the index item of a lowlevel.id, or None if it isn't in the index
+        if self._has_mapping():
+            return self.mapping.get_items([id])[0]
+        return id
+
+    def _get_items_info(self, items):
+        # Get lowlevel.ids and (MBID, offset) of index items
+        if self._has_mapping():
+            return self.mapping.get_item_ids(items), self.mapping.get_recordings(items)
+        return list(items), db.data.get_mbids_by_ids(items)
+
+    def get_ids(self, recordings):
+        """Get the lowlevel.ids of many (MBID, offset) combinations in the index or its delta,
+        with None for recordings which aren't in either"""
+        if self._has_mapping():
+            ids = self.mapping.get_ids(recordings)
+        else:
+            ids = db.data.get_ids_by_mbids(recordings)
+        if self.delta:
+            ids = [self.delta.get_id(mbid, offset) if id is None else id for id, (mbid, offset) in zip(ids, recordings)]
+        return ids
+
+    def get_recordings(self, ids):
+        """Get the (MBID, offset) of many lowlevel.ids in the index or its delta,
+        with (None, None) for ids which aren't in either"""
+        recordings = [(None, None)] * len(ids)
+        rows = []
+        for row, id in enumerate(ids):
+            recording = self.delta.get_recording(id) if self.delta else None
+            if recording is not None:
+                recordings[row] = recording
+            else:
+                rows.append(row)
+        items = [self._get_item(ids[row]) for row in rows]
+        rows = [row for row, item in zip(rows, items) if item is not None]
+        _, item_recordings = self._get_items_info([item for item in items if item is not None])
+        for row, recording in zip(rows, item_recordings):
+            recordings[row] = tuple(recording)
+        return recordings
+
+    def get_vectors(self, ids):
+        """Get the vectors of many lowlevel.ids in the index or its delta.
 
-    def get_nns_by_id(self, id, num_neighbours):
+        Returns:
+            a tuple (vectors, found). vectors is a float32 matrix with a row for each id, and found is
+            a boolean array which is False for ids which aren't in the index, whose rows are 0.
+        """
+        vectors = np.zeros((len(ids), self.dimensionality), dtype=np.float32)
+        found = np.zeros(len(ids), dtype=bool)
+        if self.vectors is None or not self._has_mapping():
+            for row, id in enumerate(ids):
+                try:
+                    vectors[row] = self._get_vector(id)
+                    found[row] = True
+                except IndexError:
+                    pass
+            return vectors, found
+
+        items = self.mapping.get_items(ids)
+        rows = np.asarray([row for row, item in enumerate(items) if item is not None], dtype=np.int64)
+        vectors[rows] = self.vectors[np.asarray([items[row] for row in rows], dtype=np.int64)]
+        found[rows] = True
+        if self.delta:
+            delta_vectors, delta_found = self.delta.get_vectors(ids)
+            vectors[delta_found] = delta_vectors[delta_found]
+            found |= delta_found
+        return vectors, found
+
+    def _get_vector(self, id):
+        # Get the vector of a lowlevel.id in the index or its delta
+        vector = self.delta.get_vector(id) if self.delta else None
+        if vector is not None:
+            return vector.tolist()
+        item = self._get_item(id)
+        if item is None:
+            raise IndexError("Item is not in the index")
+        return self._get_item_vector(item)
+
+    def _get_item_vector(self, item):
+        # Get the vector of an index item
+        if self.vectors is not None:
+            return self.vectors[item].tolist()
+        return self.index.get_item_vector(item)
+
+    def _rerank(self, items, distances, num_neighbours):
+        # Get the num_neighbours nearest of a larger set of candidates found in the index, as a tuple
+        # (items, distances). The distances returned by Annoy are already exact, so this only re-sorts
+        # the candidates by the same distances: oversampling finds better neighbours by searching
+        # more of the index, not by changing the distance of any candidate.
+        nearest = np.argsort(distances, kind="stable")[:num_neighbours]
+        return [items[i] for i in nearest], [distances[i] for i in nearest]
+
+    def get_nns_by_id(self, id, num_neighbours, search_k=-1, oversample=1):
         """Get the most similar recordings for a recording with the
            specified id.
 
@@ -156,30 +623,58 @@ class AnnoyModel(object):
             num_neighbours: positive integer, number of similar recordings
             to be returned in the query.
 
+            search_k: the number of nodes inspected by Annoy when searching the
+            index. Larger values give more accurate results, but take longer.
+            -1 inspects n_trees * the number of candidates nodes.
+
+            oversample: if more than 1, num_neighbours * oversample candidates
+            are found in the index, and the num_neighbours of them which are nearest
+            are returned. This searches more of the index, like a larger search_k.
+
         Returns:
             A list of the form [<lowlevel.ids>, <recordings>, <distances>]
             where <lowlevel.ids> is a list of lowlevel.ids [id_1, ..., id_n],
             <recordings> is a list of tuples (MBID, offset),
             and <distances> is a list of distances, corresponding to each similar recording.
         """
+        rerank = oversample > 1
+        num_candidates = num_neighbours * oversample if rerank else num_neighbours
         try:
-            items = self.index.get_nns_by_item(id, num_neighbours, include_distances=True)
+            if self.delta:
+                vector = self._get_vector(id)
+                items, distances = self.index.get_nns_by_vector(vector, num_candidates, search_k=search_k,
+                                                                include_distances=True)
+            else:
+                item = self._get_item(id)
+                if item is None:
+                    raise IndexError("Item is not in the index")
+                items, distances = self.index.get_nns_by_item(item, num_candidates, search_k=search_k,
+                                                              include_distances=True)
         except IndexError:
             raise similarity.exceptions.ItemNotFoundException('The item you are requesting is not indexed.')
-
-        # Unpack to get ids and distances
-        ids = items[0]
-        distances = items[1]
-        recordings = db.data.get_mbids_by_ids(ids)
+        if rerank:
+            items, distances = self._rerank(items, distances, num_neighbours)
+
+        ids, recordings = self._get_items_info(items)
+        if self.delta:
+            # Merge the results from the index and the delta
+            delta_ids, delta_distances = self.delta.get_nns_by_vector(vector, num_neighbours)
+            results = list(zip(distances, ids, recordings))
+            results += [(distance, delta_id, self.delta.get_recording(delta_id))
+                        for distance, delta_id in zip(delta_distances, delta_ids)]
+            results = sorted(results, key=lambda result: result[0])[:num_neighbours]
+            distances = [distance for distance, _, _ in results]
+            ids = [result_id for _, result_id, _ in results]
+            recordings = [recording for _, _, recording in results]
         return ids, recordings, distances
 
-    def get_nns_by_mbid(self, mbid, offset, num_neighbours):
+    def get_nns_by_mbid(self, mbid, offset, num_neighbours, search_k=-1, oversample=1):
         # Find corresponding lowlevel.id to (mbid, offset) combination,
         # then call get_nns_by_id
-        lookup = self.get_bulk_nns_by_mbid([(mbid, offset)], num_neighbours)
+        lookup = self.get_bulk_nns_by_mbid([(mbid, offset)], num_neighbours, search_k=search_k, oversample=oversample)
         return lookup.get(mbid, {}).get(str(offset), [])
 
-    def get_bulk_nns_by_mbid(self, recordings, num_neighbours):
+    def get_bulk_nns_by_mbid(self, recordings, num_neighbours, search_k=-1, oversample=1):
         """Get most similar recordings for each (MBID, offset) tuple provided.
         Similar recordings list returned is ordered with the most similar at
         index 0.
@@ -191,6 +686,8 @@ class AnnoyModel(object):
             num_neighbours (int): the number of similar recordings desired
             for each recording specified.
 
+            search_k, oversample: the accuracy of the search, see :meth:`get_nns_by_id`
+
         Returns:
             a dictionary of the mbids and offsets given in the recordings parameter.
             Each item is a list of dictionaries, containing the keys recording_mbid, offset, and distance:
@@ -208,12 +705,18 @@ class AnnoyModel(object):
         """
         recordings_info = defaultdict(dict)
 
-        ids = db.data.get_ids_by_mbids(recordings)
+        ids = self.get_ids(recordings)
         for recording_id, (mbid, offset) in zip(ids, recordings):
+            if recording_id is None:
+                continue
             try:
-                ids, similar_recordings, distances = self.get_nns_by_id(recording_id, num_neighbours)
+                ids, similar_recordings, distances = self.get_nns_by_id(recording_id, num_neighbours,
+                                                                        search_k=search_k, oversample=oversample)
                 data = []
                 for recording, distance in zip(similar_recordings, distances):
+                    if recording[0] is None:
+                        # An item which was added without its recording
+                        continue
                     data.append({'recording_mbid': recording[0], 
                                  'offset': recording[1], 
                                  'distance': distance})
@@ -235,11 +738,18 @@ class AnnoyModel(object):
             If an IndexError occurs (one or more of ids is not indexed)
             then None is returned.
         """
-        id_1, id_2 = db.data.get_ids_by_mbids([rec_one, rec_two])
+        id_1, id_2 = self.get_ids([rec_one, rec_two])
         if id_1 is None or id_2 is None:
             return None
         try:
-            return self.index.get_distance(id_1, id_2)
+            if self.delta and (self.delta.get_vector(id_1) is not None or self.delta.get_vector(id_2) is not None):
+                distances = similarity.delta_index.get_distances([self._get_vector(id_1)], self._get_vector(id_2),
+                                                                 self.distance_type)
+                return float(distances[0])
+            item_1, item_2 = self._get_item(id_1), self._get_item(id_2)
+            if item_1 is None or item_2 is None:
+                return None
+            return self.index.get_distance(item_1, item_2)
         except IndexError:
             return None
 
@@ -247,7 +757,7 @@ class AnnoyModel(object):
 """
 A dictionary to track the base indices that should be built.
 Naming convention for a saved index is "<metric_name>_<distance_type>_<n_trees>.ann"
-e.g. "mfccs_angular_10.ann"
+e.g. "mfccs_angular_10.ann", which links to the index file of its latest version
 Format of BASE_INDICES dictionary:
 {"metric_name": {"distance_type": [n_trees, ..., n_trees]}
 """
@@ -1,9 +1,6 @@
-import os
-
-from flask import current_app
 
 import similarity.metrics
-from similarity.index_model import AnnoyModel
+from similarity.index_model import AnnoyModel, get_index_path, remove_index_files
 
 from collections import defaultdict
 
@@ -44,28 +41,6 @@ def initialize_indices(n_trees="10", distance_type="angular", load_existing=Fals
 
 
 def remove_index(metric, n_trees=10, distance_type="angular"):
-    """Deletes the static index originally saved when an index is computed."""
-    file_path = current_app.config['SIMILARITY_INDEX_DIR']
-    name = '_'.join([metric, distance_type, str(n_trees)]) + '.ann'
-    full_path = os.path.join(file_path, name)
-    if os.path.exists(full_path):
-        os.remove(full_path)
-
-
-def add_empty_rows(index, ids):
-    """Annoy index will allocate space for max(id) + 1 items.
-    Since there are some gaps with empty rows in the db, we
-    need to insert placeholder vectors so that Annoy does
-    not initialize unpredictable vectors in their place.
-
-    Args:
-        index: An initialized Annoy index.
-
-        ids (list): A list of ids which should be added to the index.
-        Will be used to find empty rows.
-    """
-    missing_ids = set(range(ids[len(ids)-1])) - set(ids)
-    for id in missing_ids:
-        placeholder = [0] * index.dimensionality
-        index.add_recording_with_vector(id, placeholder)
-    return index
+    """Deletes the static index originally saved when an index is computed,
+    and its metadata, mapping and vectors files."""
+    remove_index_files(get_index_path(metric, distance_type, n_trees))
@@ -1,16 +1,31 @@
+import itertools
+import json
+import sys
+
+from flask import current_app
 from flask.cli import FlaskGroup
 import click
 
 import webserver
+import similarity.benchmark
+import similarity.delta_index
+import similarity.exceptions
+import similarity.hybrid
 import similarity.index_utils
-from similarity.index_model import AnnoyModel
+import similarity.metrics
+from similarity.index_model import AnnoyModel, get_saved_max_id
 import db
+import db.exceptions
 import db.similarity
 import db.similarity_stats
 
 NORMALIZATION_SAMPLE_SIZE = 10000
 ADD_METRICS_BATCH_SIZE = 10000
 ADD_INDEX_BATCH_SIZE = 100000
+# Indices are rebuilt by compact-indices when this many recordings have been added since they were built
+COMPACT_MIN_NEW_ITEMS = 10000
+BENCHMARK_ITEMS = 1000000
+BENCHMARK_SAMPLE_SIZE = 1000000
 
 cli = FlaskGroup(add_default_commands=False, create_app=webserver.create_app)
 
@@ -70,7 +85,9 @@ def compute_stats(sample_size, force):
 
 @cli.command(name="add-metrics")
 @click.option("--batch-size", "-b", type=int, default=ADD_METRICS_BATCH_SIZE, help="Override processing batch size.")
-def add_metrics(batch_size):
+@click.option("--workers", "-w", type=click.IntRange(min=1), default=1,
+              help="Number of processes computing metrics at the same time.")
+def add_metrics(batch_size, workers):
     """Computes all 12 base metrics for each recording
     in the lowlevel table, inserting these values in
     the similarity.similarity table.
@@ -82,12 +99,38 @@ def add_metrics(batch_size):
         batch_size: integer, number of recordings that
         should be added on each iteration.
         Suggested value between 10 000 and 20 000.
+
+        workers: integer, number of processes to use.
+        With more than one worker the recordings are split
+        into ranges of ids, and progress in each range is
+        saved so that an interrupted run can be continued
+        by running the command again with any number of
+        workers.
     """
     click.echo("Adding all metrics...")
-    db.similarity.add_metrics(batch_size)
+    if workers > 1 or db.similarity.similarity_shards_exist():
+        db.similarity.add_metrics_parallel(batch_size, workers)
+    else:
+        db.similarity.add_metrics(batch_size)
     click.echo("Finished adding all metrics, exiting...")
 
 
+@cli.command(name="rebuild-metrics")
+@click.option("--batch-size", "-b", type=int, default=ADD_METRICS_BATCH_SIZE, help="Override processing batch size.")
+def rebuild_metrics(batch_size):
+    """Recomputes all 12 base metrics for every recording
+    in the lowlevel table, replacing the contents of the
+    similarity.similarity table.
+
+    The metrics are loaded into a new unlogged table, which
+    replaces the similarity table once it is complete. Use
+    this after the normalization stats are recomputed.
+    """
+    click.echo("Rebuilding all metrics...")
+    db.similarity.rebuild_similarity(batch_size)
+    click.echo("Finished rebuilding all metrics, exiting...")
+
+
 @cli.command(name='add-index')
 @click.argument("metric")
 @click.option("--distance_type", "-d", default='angular', help="Method of measuring distance between metric vectors")
@@ -109,7 +152,11 @@ def add_index(metric, batch_size, n_trees, distance_type):
     click.echo("Initializing index...")
     index = AnnoyModel(metric, n_trees=n_trees, distance_type=distance_type)
     click.echo("Adding index: {}".format(metric))
-    db.similarity.add_index(index, num_ids, ids, batch_size=batch_size)
+    try:
+        db.similarity.add_index(index, num_ids, ids, batch_size=batch_size)
+    except db.exceptions.DatabaseException as e:
+        click.echo("Error: %s" % e, err=True)
+        sys.exit(1)
     click.echo("Done!")
 
 
@@ -119,24 +166,208 @@ def add_index(metric, batch_size, n_trees, distance_type):
                                                             Tradeoff: more trees gives more precision, \
                                                             but takes longer to build.")
 @click.option("--batch_size", "-b", type=int, default=ADD_INDEX_BATCH_SIZE, help="Size of batches")
-def add_indices(batch_size, n_trees, distance_type):
+@click.option("--workers", "-w", type=click.IntRange(min=1), default=1,
+              help="Number of indices built at the same time, each in its own process.")
+def add_indices(batch_size, n_trees, distance_type, workers):
     """Creates an annoy index then adds all recordings to the index,
     for each of the base metrics.
 
+    The similarity table is read once and each recording is added
+    to all of the indices, which are then built by `--workers`
+    processes. Each build uses SIMILARITY_BUILD_NUM_JOBS threads.
+
     *NOTE*: Using this command overwrites any existing index with the
     same parameters.
     """
-    click.echo("Gathering ids to insert...")
-    num_ids = db.similarity.get_similarity_count()
-    ids = db.similarity.get_similarity_ids()
     click.echo("Initializing indices...")
     indices = similarity.index_utils.initialize_indices(n_trees=n_trees, distance_type=distance_type)
-    for index in indices:
-        click.echo("Adding index: {}".format(index.metric_name))
-        db.similarity.add_index(index, num_ids, ids, batch_size=batch_size)
+    click.echo("Adding indices: {}".format(", ".join(index.metric_name for index in indices)))
+    try:
+        db.similarity.add_indices(indices, batch_size, workers=workers)
+    except db.exceptions.DatabaseException as e:
+        click.echo("Error: %s" % e, err=True)
+        sys.exit(1)
     click.echo("Finished adding all indices. Exiting...")
 
 
+@cli.command(name='compact-indices')
+@click.option("--distance-type", "-d", default='angular')
+@click.option("--n-trees", "-n", type=int, default=10, help="Number of trees for building index. \
+                                                            Tradeoff: more trees gives more precision, \
+                                                            but takes longer to build.")
+@click.option("--batch_size", "-b", type=int, default=ADD_INDEX_BATCH_SIZE, help="Size of batches")
+@click.option("--workers", "-w", type=click.IntRange(min=1), default=1,
+              help="Number of indices built at the same time, each in its own process.")
+@click.option("--min-new-items", "-m", type=int, default=COMPACT_MIN_NEW_ITEMS,
+              help="Rebuild an index if at least this many recordings have been added since it was built.")
+def compact_indices(batch_size, n_trees, distance_type, workers, min_new_items):
+    """Rebuilds the indices of the base metrics which are missing, or which
+    are missing many recordings that were added to the similarity table
+    after they were built. Saved hybrid indices which are missing many
+    recordings are also rebuilt.
+
+    Until an index is rebuilt, these recordings are kept in the delta
+    saved with the index by `update-deltas`, and are searched exhaustively.
+    This should be run regularly to keep those deltas small.
+    """
+    names = []
+    for name in similarity.metrics.BASE_METRIC_NAMES:
+        max_id = get_saved_max_id(name, distance_type, n_trees)
+        new_items = None if max_id is None else db.similarity.count_similarity_after(max_id)
+        if new_items is None or new_items >= min_new_items:
+            names.append(name)
+        click.echo("{}: {} new items".format(name, "unknown" if new_items is None else new_items))
+
+    indices = [AnnoyModel(name, n_trees=n_trees, distance_type=distance_type) for name in names]
+    for weights, hybrid_n_trees, max_id in similarity.hybrid.get_saved_hybrid_indices():
+        new_items = None if max_id is None else db.similarity.count_similarity_after(max_id)
+        index = similarity.hybrid.HybridModel(weights, n_trees=hybrid_n_trees)
+        if new_items is None or new_items >= min_new_items:
+            names.append(index.metric_name)
+            indices.append(index)
+        click.echo("{}: {} new items".format(index.metric_name, "unknown" if new_items is None else new_items))
+
+    if not names:
+        click.echo("No indices need to be rebuilt. Exiting...")
+        return
+    click.echo("Rebuilding indices: {}".format(", ".join(names)))
+    try:
+        db.similarity.add_indices(indices, batch_size, workers=workers)
+    except db.exceptions.DatabaseException as e:
+        click.echo("Error: %s" % e, err=True)
+        sys.exit(1)
+    click.echo("Finished rebuilding indices. Exiting...")
+
+
+@cli.command(name='update-deltas')
+@click.option("--distance-type", "-d", default='angular')
+@click.option("--n-trees", "-n", type=int, default=10, help="Number of trees of the indices of the base metrics.")
+def update_deltas(n_trees, distance_type):
+    """Adds the recordings which were added to the similarity table after
+    each saved index was built to the delta saved with the index.
+
+    Processes which query an index load its delta when it changes, and search
+    it along with the index, so new recordings are found without rebuilding
+    the index. This should be run after each run of `add-metrics`.
+    """
+    if db.similarity.similarity_shards_exist():
+        click.echo("Error: Metrics are still being added by a run of add-metrics with several workers. "
+                   "Finish it by running add-metrics before updating deltas.", err=True)
+        sys.exit(1)
+
+    for name in similarity.metrics.BASE_METRIC_NAMES:
+        try:
+            index = AnnoyModel(name, n_trees=n_trees, distance_type=distance_type, load_existing=True)
+        except similarity.exceptions.IndexNotFoundException:
+            click.echo("{}: no saved index".format(name))
+            continue
+        click.echo("{}: {} new items".format(name, index.save_delta()))
+    for weights, hybrid_n_trees, _ in similarity.hybrid.get_saved_hybrid_indices():
+        index = similarity.hybrid.HybridModel(weights, n_trees=hybrid_n_trees, load_existing=True)
+        click.echo("{}: {} new items".format(index.metric_name, index.save_delta()))
+    click.echo("Finished updating deltas. Exiting...")
+
+
+@cli.command(name='add-hybrid-index')
+@click.option("--metric", "-m", "metrics", multiple=True, required=True,
+              help="A metric and its weight, as metric:weight. Repeat for each metric of the index.")
+@click.option("--n-trees", "-n", type=int, default=similarity.hybrid.HYBRID_N_TREES,
+              help="Number of trees for building index. \
+                    Tradeoff: more trees gives more precision, \
+                    but takes longer to build.")
+@click.option("--batch_size", "-b", type=int, default=ADD_INDEX_BATCH_SIZE, help="Size of batches")
+def add_hybrid_index(metrics, n_trees, batch_size):
+    """Creates an index of the combined vectors of several metrics, for hybrid
+    queries with these weights, e.g.
+
+        add-hybrid-index -m mfccs:0.5 -m bpm:0.3 -m moods:0.2
+
+    Hybrid queries with the same weights use this index to find candidates,
+    instead of querying the index of each metric. Add one for each weighting
+    which is queried often. Saved hybrid indices are rebuilt by `compact-indices`,
+    and can be removed with `remove-index <name> -d euclidean`.
+
+    *NOTE*: Using this command overwrites any existing index with the
+    same weights.
+    """
+    try:
+        weights = similarity.hybrid.parse_weights(metrics)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--metric")
+    click.echo("Initializing index...")
+    index = similarity.hybrid.HybridModel(weights, n_trees=n_trees)
+    click.echo("Adding hybrid index: {}".format(index.metric_name))
+    try:
+        db.similarity.add_indices([index], batch_size)
+    except db.exceptions.DatabaseException as e:
+        click.echo("Error: %s" % e, err=True)
+        sys.exit(1)
+    click.echo("Done!")
+
+
+@cli.command(name='benchmark')
+@click.option("--items", "-n", type=click.IntRange(min=1), default=BENCHMARK_ITEMS,
+              help="Number of vectors in each index, e.g. 1000000 to 50000000.")
+@click.option("--source", type=click.Choice(["synthetic", "sampled"]), default="synthetic",
+              help="Use random vectors, or vectors of a metric from the similarity table.")
+@click.option("--metric", "-m", type=click.Choice(similarity.metrics.BASE_METRIC_NAMES), default="mfccs",
+              help="Metric whose vectors are sampled.")
+@click.option("--sample-size", type=click.IntRange(min=1), default=BENCHMARK_SAMPLE_SIZE,
+              help="Number of rows of the similarity table which are sampled.")
+@click.option("--dimensionality", type=click.IntRange(min=1), default=13, help="Dimensionality of random vectors.")
+@click.option("--clusters", type=click.IntRange(min=1), default=1000,
+              help="Number of clusters which random vectors are grouped in.")
+@click.option("--distance-type", "-d", "distance_types", multiple=True,
+              type=click.Choice(similarity.delta_index.DISTANCE_TYPES),
+              help="Distance types to measure. Repeat for each type.")
+@click.option("--n-trees", "-t", "all_n_trees", type=click.IntRange(min=1), multiple=True,
+              help="Numbers of trees to measure. Repeat for each number.")
+@click.option("-k", type=click.IntRange(min=1), default=10, help="Number of neighbours found by each query.")
+@click.option("--queries", "-q", type=click.IntRange(min=1), default=1000, help="Number of queries of each index.")
+@click.option("--search-k", "-s", "search_ks", type=int, multiple=True, default=[-1],
+              help="search_k values of the queries. Repeat for each value.")
+@click.option("--oversample", "oversamples", type=click.IntRange(min=1), multiple=True, default=[1],
+              help="Oversample values of the queries, for each search_k. Repeat for each value.")
+@click.option("--seed", type=int, default=None, help="Seed for random vectors and queries.")
+@click.option("--output", "-o", type=click.Path(dir_okay=False, writable=True), default="similarity_benchmark.json",
+              help="Path of the JSON report.")
+def benchmark(items, source, metric, sample_size, dimensionality, clusters, distance_types, all_n_trees, k, queries,
+              search_ks, oversamples, seed, output):
+    """Measures the build time, file size, memory use, query latency and
+    recall@k of indices with different parameters, and writes a JSON report.
+
+    By default, the distance types and numbers of trees of the indices in
+    BASE_INDICES and `index_utils.get_all_indices` are measured. Each index
+    is built with SIMILARITY_BUILD_NUM_JOBS threads, and queried with each
+    combination of `--search-k` and `--oversample`. Queries with an oversample
+    above 1 find more candidates in the index, and return the nearest of them.
+
+    Random vectors are used unless `--source sampled` is given. Sampled vectors
+    are read from the similarity table, and if there are fewer than `--items`,
+    copies of them with some noise added are used for the rest.
+    """
+    configs = similarity.benchmark.get_index_configs()
+    if distance_types or all_n_trees:
+        configs = list(itertools.product(distance_types or sorted(set(d for d, _ in configs)),
+                                         all_n_trees or sorted(set(n for _, n in configs))))
+
+    click.echo("Loading {} vectors...".format(items))
+    if source == "sampled":
+        vectors = similarity.benchmark.load_sampled_vectors(metric, items, sample_size, seed=seed)
+    else:
+        vectors = similarity.benchmark.generate_vectors(items, dimensionality, clusters=clusters, seed=seed)
+
+    report = similarity.benchmark.run_benchmark(vectors, configs, k=k, queries=queries, search_ks=search_ks,
+                                                oversamples=oversamples,
+                                                n_jobs=current_app.config['SIMILARITY_BUILD_NUM_JOBS'],
+                                                seed=seed, log=click.echo)
+    report["source"] = {"type": source, "metric": metric if source == "sampled" else None,
+                        "sample_size": sample_size if source == "sampled" else None}
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    click.echo("Wrote report to {}".format(output))
+
+
 @cli.command(name='remove-index')
 @click.argument("metric")
 @click.option("--distance_type", "-d", default='angular', help="Method of measuring distance between metric vectors.")
@@ -9,6 +9,24 @@ class BaseMetric(object):
     description = ''
     category = ''
 
+    def transform_batch(self, values):
+        """Transform the data of many recordings at once.
+
+        Args:
+            values: a list with the data of each recording, in the form taken by ``transform``
+
+        Returns:
+            a numpy array with a row for each item of ``values``. Rows for data which
+            can't be transformed are all 0.
+        """
+        matrix = np.zeros((len(values), self.length()))
+        for i, value in enumerate(values):
+            try:
+                matrix[i] = self.transform(value)
+            except ValueError:
+                pass
+        return matrix
+
 
 class LowLevelMetric(BaseMetric):
     path = ''
@@ -44,6 +62,20 @@ class NormalizedLowLevelMetric(LowLevelMetric):
         else:
             return list(data)
 
+    def _normalize_batch(self, values):
+        # Select and normalize the features of all valid rows with one operation each
+        valid = np.array([bool(value) for value in values], dtype=bool)
+        matrix = np.zeros((len(values), self.length()))
+        if valid.any():
+            data = np.array([value for value in values if value], dtype=float)[:, self.indices]
+            if np.count_nonzero(np.array(self.stddevs)):
+                data = (data - np.array(self.means)) / np.array(self.stddevs)
+            matrix[valid] = data
+        return matrix, valid
+
+    def transform_batch(self, values):
+        return self._normalize_batch(values)[0]
+
 
 class WeightedNormalizedLowLevelMetric(NormalizedLowLevelMetric):
     weight = 0.95
@@ -57,6 +89,11 @@ class WeightedNormalizedLowLevelMetric(NormalizedLowLevelMetric):
         data = super(WeightedNormalizedLowLevelMetric, self).transform(data)
         return list(data * self.weight_vector)
 
+    def transform_batch(self, values):
+        matrix, valid = self._normalize_batch(values)
+        matrix[valid] *= self.weight_vector
+        return matrix
+
 
 class MfccsMetric(NormalizedLowLevelMetric):
     name = 'mfccs'
@@ -95,6 +132,19 @@ class CircularMetric(LowLevelMetric):
         value = data * 2 * np.pi
         return list(np.array([np.cos(value), np.sin(value)]))
 
+    def _circular_batch(self, values, valid):
+        """Wrap many values around the circle, leaving rows which aren't valid as 0"""
+        matrix = np.zeros((len(values), self.length()))
+        value = values[valid] * 2 * np.pi
+        matrix[valid, 0] = np.cos(value)
+        matrix[valid, 1] = np.sin(value)
+        return matrix
+
+    def transform_batch(self, values):
+        valid = np.array([value is not None for value in values], dtype=bool)
+        values = np.array([value if value is not None else 0 for value in values], dtype=float)
+        return self._circular_batch(values, valid)
+
 
 KEYS_CIRCLE = ['C', 'G', 'D', 'A', 'E', 'B', 'F#', 'C#', 'G#', 'D#', 'A#', 'F']
 KEYS_MAP = {KEYS_CIRCLE[i]: float(i) / 12 for i in range(12)}
@@ -116,6 +166,17 @@ class KeyMetric(CircularMetric):
         except KeyError:
             raise ValueError('Invalid data value: {}'.format(data))
 
+    def transform_batch(self, values):
+        key_values = np.zeros(len(values))
+        valid = np.zeros(len(values), dtype=bool)
+        for i, data in enumerate(values):
+            try:
+                key_values[i] = KEYS_MAP[data['key_key']] + SCALES_MAP[data['key_scale']]
+                valid[i] = True
+            except (KeyError, TypeError):
+                pass
+        return self._circular_batch(key_values, valid)
+
 
 class LogCircularMetric(CircularMetric):
     def transform(self, data):
@@ -123,6 +184,11 @@ class LogCircularMetric(CircularMetric):
             raise ValueError('Invalid data value: {}'.format(data))
         return super(LogCircularMetric, self).transform(np.log2(data))
 
+    def transform_batch(self, values):
+        valid = np.array([bool(value) for value in values], dtype=bool)
+        values = np.array([value if value else 1 for value in values], dtype=float)
+        return self._circular_batch(np.log2(values), valid)
+
 
 class BpmMetric(LogCircularMetric):
     name = 'bpm'
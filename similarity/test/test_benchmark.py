@@ -0,0 +1,66 @@
+import json
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import similarity.benchmark
+from similarity.benchmark import exact_neighbours, generate_vectors, get_index_configs, resample_vectors, \
+    run_benchmark
+
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.vectors = generate_vectors(2000, 5, clusters=20, seed=1)
+
+    def test_get_index_configs(self):
+        self.assertEqual([("angular", 10), ("manhattan", 10)], get_index_configs())
+
+    def test_generate_vectors(self):
+        self.assertEqual((2000, 5), self.vectors.shape)
+        self.assertEqual(np.float32, self.vectors.dtype)
+        self.assertTrue((generate_vectors(2000, 5, clusters=20, seed=1) == self.vectors).all())
+
+    def test_resample_vectors(self):
+        sample = self.vectors[:100]
+        self.assertTrue((resample_vectors(sample, 50) == sample[:50]).all())
+        vectors = resample_vectors(sample, 250, seed=2)
+        self.assertEqual((250, 5), vectors.shape)
+        self.assertTrue((vectors[:100] == sample).all())
+
+    def test_exact_neighbours(self):
+        # The distances are computed in chunks, whose nearest rows are merged
+        with mock.patch("similarity.benchmark.EXACT_CHUNK_DISTANCES", 300 * 5):
+            neighbours, latencies = exact_neighbours(self.vectors, [0, 7], 10, "euclidean")
+        self.assertEqual(2, len(latencies))
+        for query, rows in zip([0, 7], neighbours):
+            distances = np.sqrt(np.square(self.vectors - self.vectors[query]).sum(axis=1))
+            self.assertEqual(set(np.argsort(distances)[:10].tolist()), rows)
+
+    def test_run_benchmark(self):
+        messages = []
+        report = run_benchmark(self.vectors, [("angular", 2), ("manhattan", 5)], k=5, queries=20,
+                               oversamples=[1, 3], seed=3, log=messages.append)
+        # The report can be written as JSON
+        report = json.loads(json.dumps(report))
+        self.assertEqual(2000, report["items"])
+        self.assertEqual(5, report["dimensionality"])
+        self.assertEqual(20, report["queries"])
+        self.assertEqual(["angular", "manhattan"], sorted(report["exact"]))
+        self.assertEqual([("angular", 2), ("manhattan", 5)],
+                         [(result["distance_type"], result["n_trees"]) for result in report["indices"]])
+        for result in report["indices"]:
+            self.assertGreater(result["file_size_bytes"], 0)
+            self.assertGreater(result["vectors_file_size_bytes"], 0)
+            self.assertGreater(result["max_rss_bytes"], 0)
+            self.assertEqual([(-1, 1), (-1, 3)],
+                             [(query["search_k"], query["oversample"]) for query in result["queries"]])
+            for query in result["queries"]:
+                self.assertGreater(query["recall_at_k"], 0.5)
+                self.assertLessEqual(query["recall_at_k"], 1)
+                self.assertLessEqual(query["latency_ms"]["p50"], query["latency_ms"]["p99"])
+            # Re-ranking more candidates doesn't lose neighbours which were found
+            self.assertGreaterEqual(result["queries"][1]["recall_at_k"], result["queries"][0]["recall_at_k"])
+        self.assertIsNone(similarity.benchmark._benchmark_vectors)
+        self.assertTrue(messages)
@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from annoy import AnnoyIndex
+
+from similarity.delta_index import DeltaIndex, get_distances, load_delta, save_delta
+
+
+class DeltaIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.mbid = "0dad432b-16cc-4bf0-8961-fd31d124b01b"
+        self.mbid_two = "e8afe383-1478-497e-90b1-7885c7f37f6e"
+        self.vectors = [[1, 0, 0], [0.5, 0.5, 0], [0, 0, 0], [-1, 2, 3]]
+
+    def test_get_distances(self):
+        # Distances are the same as distances computed by Annoy
+        for distance_type in ["angular", "euclidean", "manhattan"]:
+            index = AnnoyIndex(3, metric=distance_type)
+            for i, vector in enumerate(self.vectors):
+                index.add_item(i, vector)
+            distances = get_distances(self.vectors, self.vectors[3], distance_type)
+            for i, distance in enumerate(distances.tolist()):
+                self.assertAlmostEqual(index.get_distance(i, 3), distance, places=5)
+
+        with self.assertRaises(ValueError):
+            get_distances(self.vectors, self.vectors[0], "hamming")
+
+    def test_add(self):
+        delta = DeltaIndex(3, "angular")
+        self.assertEqual(0, len(delta))
+        self.assertIsNone(delta.max_id)
+        delta.add([], [], [])
+        self.assertEqual(0, len(delta))
+
+        delta.add([10, 12], self.vectors[:2], [(self.mbid.upper(), 0), (self.mbid_two, 1)])
+        delta.add([13], self.vectors[2:3], [(self.mbid, 1)])
+        self.assertEqual(3, len(delta))
+        self.assertEqual(13, delta.max_id)
+        self.assertEqual([0.5, 0.5, 0], delta.get_vector(12).tolist())
+        self.assertIsNone(delta.get_vector(11))
+        self.assertEqual((self.mbid, 0), delta.get_recording(10))
+        self.assertIsNone(delta.get_recording(11))
+        self.assertEqual(12, delta.get_id(self.mbid_two, 1))
+        self.assertEqual(13, delta.get_id(self.mbid, "1"))
+        self.assertIsNone(delta.get_id(self.mbid_two, 0))
+        self.assertIsNone(delta.get_id(self.mbid_two, None))
+
+    def test_get_nns_by_vector(self):
+        delta = DeltaIndex(3, "euclidean")
+        self.assertEqual(([], []), delta.get_nns_by_vector([1, 0, 0], 2))
+
+        delta.add([1, 2, 3, 4], self.vectors, [(self.mbid, i) for i in range(4)])
+        ids, distances = delta.get_nns_by_vector([1, 0, 0], 3)
+        self.assertEqual([1, 2, 3], ids)
+        self.assertEqual([0, round(0.5 ** 0.5, 5), 1], [round(distance, 5) for distance in distances])
+
+        ids, distances = delta.get_nns_by_vector([1, 0, 0], 10)
+        self.assertEqual([1, 2, 3, 4], ids)
+
+        with self.assertRaises(ValueError):
+            DeltaIndex(3, "dot")
+
+    def test_save_load(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        path = os.path.join(location, "mfccs_angular_10.delta.npy")
+        self.assertIsNone(load_delta(path, 3, "angular"))
+
+        # Empty deltas can be saved
+        save_delta(path, DeltaIndex(3, "angular"))
+        self.assertEqual(0, len(load_delta(path, 3, "angular")))
+
+        delta = DeltaIndex(3, "angular")
+        delta.add([10, 12], self.vectors[:2], [(self.mbid, 0), (self.mbid_two, 1)])
+        save_delta(path, delta)
+        loaded = load_delta(path, 3, "angular")
+        self.assertEqual(12, loaded.max_id)
+        self.assertEqual([0.5, 0.5, 0], loaded.get_vector(12).tolist())
+        self.assertEqual((self.mbid_two, 1), loaded.get_recording(12))
+        self.assertEqual(10, loaded.get_id(self.mbid, 0))
+        self.assertEqual([10, 12], loaded.get_nns_by_vector([1, 0, 0], 2)[0])
+
+        # A loaded delta can be added to, without changing the saved delta
+        loaded.add([13], self.vectors[2:3], [(self.mbid, 1)])
+        self.assertEqual(13, loaded.get_id(self.mbid, 1))
+        self.assertEqual(2, len(load_delta(path, 3, "angular")))
+
+        # A delta of vectors with another dimensionality isn't loaded
+        self.assertIsNone(load_delta(path, 4, "angular"))
@@ -0,0 +1,142 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from annoy import AnnoyIndex
+from flask import current_app
+
+from webserver.testing import AcousticbrainzTestCase
+import similarity.exceptions
+import similarity.hybrid
+import similarity.index_model
+from similarity.hybrid import HybridModel, combine_vectors, get_combined_distances, get_hybrid_name, \
+    get_hybrid_nns, normalize_weights, parse_weights
+from similarity.index_model import AnnoyModel
+
+
+class HybridTestCase(AcousticbrainzTestCase):
+
+    def setUp(self):
+        super(HybridTestCase, self).setUp()
+        self.mbid = "0dad432b-16cc-4bf0-8961-fd31d124b01b"
+        self.mbid_two = "e8afe383-1478-497e-90b1-7885c7f37f6e"
+        self.mbid_three = "ffffffff-ffff-ffff-ffff-ffffffffff00"
+        self.recordings = [(self.mbid, 0), (self.mbid_two, 0), (self.mbid_three, 0)]
+        self.mfccs = [[1, 0, 0], [0, 1, 0], [1, 0.2, 0]]
+        self.bpm = [[1, 0], [1, 0.1], [0, 1]]
+
+    def _build_index(self, metric, vectors):
+        with mock.patch("db.similarity.get_metric_dimensionality", return_value=len(vectors[0])):
+            index = AnnoyModel(metric, 10, "angular")
+        for id, (vector, recording) in enumerate(zip(vectors, self.recordings)):
+            index.add_recording_with_vector(id, vector, recording=recording)
+        index.build(n_jobs=1)
+        return index
+
+    def test_parse_weights(self):
+        self.assertEqual({"mfccs": 0.75, "bpm": 0.25}, parse_weights(["mfccs:3", " bpm:1"]))
+        self.assertEqual({"mfccs": 0.5, "moods": 0.5}, parse_weights(["mfccs", "moods"]))
+        # Metrics with a weight of 0 are removed
+        self.assertEqual({"mfccs": 1}, parse_weights(["mfccs:2", "bpm:0"]))
+
+        for items in [["mfccs:1", "mfccs:2"], ["mfccs:x"], ["nothing:1"], ["mfccs:-1"], ["mfccs:0"], [],
+                      ["mfccs:nan"]]:
+            with self.assertRaises(ValueError):
+                parse_weights(items)
+
+    def test_get_hybrid_name(self):
+        self.assertEqual("hybrid-bpm0.333-mfccs0.667", get_hybrid_name({"mfccs": 2, "bpm": 1}))
+        self.assertEqual(get_hybrid_name({"mfccs": 0.5, "moods": 0.5}), get_hybrid_name({"moods": 3, "mfccs": 3}))
+
+    def test_combine_vectors(self):
+        # The euclidean distance between combined vectors combines the angular distances of each metric
+        weights = normalize_weights({"mfccs": 3, "bpm": 1})
+        combined = [combine_vectors({"mfccs": mfccs, "bpm": bpm}, weights) for mfccs, bpm in zip(self.mfccs, self.bpm)]
+        self.assertEqual(5, len(combined[0]))
+
+        indices = {}
+        for metric, vectors in [("mfccs", self.mfccs), ("bpm", self.bpm)]:
+            indices[metric] = AnnoyIndex(len(vectors[0]), metric="angular")
+            for i, vector in enumerate(vectors):
+                indices[metric].add_item(i, vector)
+        euclidean = AnnoyIndex(5, metric="euclidean")
+        for i, vector in enumerate(combined):
+            euclidean.add_item(i, vector)
+        for i in range(3):
+            expected = sum(weight * indices[metric].get_distance(i, 2) ** 2 for metric, weight in weights.items())
+            self.assertAlmostEqual(expected ** 0.5, euclidean.get_distance(i, 2), places=5)
+
+        # Vectors are in order of metric, and zero vectors stay zero
+        combined = combine_vectors({"mfccs": [0, 0, 0], "bpm": [0, 2]}, {"mfccs": 0.75, "bpm": 0.25})
+        self.assertEqual([0, 0.5, 0, 0, 0], combined)
+
+    def test_get_combined_distances(self):
+        mfccs = self._build_index("mfccs", self.mfccs)
+        bpm = self._build_index("bpm", self.bpm)
+        distances = get_combined_distances([(mfccs, 0.75), (bpm, 0.25)], 0, [0, 1, 2, 5])
+        for i in range(3):
+            expected = 0.75 * mfccs.index.get_distance(0, i) + 0.25 * bpm.index.get_distance(0, i)
+            self.assertAlmostEqual(expected, distances[i], places=5)
+        # Candidates which aren't in the indices are never returned
+        self.assertEqual(float("inf"), distances[3])
+
+        with self.assertRaises(similarity.exceptions.ItemNotFoundException):
+            get_combined_distances([(mfccs, 0.75), (bpm, 0.25)], 5, [0, 1])
+
+    @mock.patch("similarity.hybrid.get_hybrid_index")
+    @mock.patch("similarity.index_model.get_index")
+    def test_get_hybrid_nns(self, get_index, get_hybrid_index):
+        indices = {"mfccs": self._build_index("mfccs", self.mfccs), "bpm": self._build_index("bpm", self.bpm)}
+        get_index.side_effect = lambda metric, **kwargs: indices[metric]
+        get_hybrid_index.return_value = None
+
+        # mbid_three is closest to the query in mfccs, but mbid_two is closest in the combination
+        result = get_hybrid_nns([(self.mbid, 0), ("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0)],
+                                {"mfccs": 1, "bpm": 3}, 2)
+        self.assertEqual([self.mbid], list(result.keys()))
+        similar = result[self.mbid]["0"]
+        self.assertEqual([(self.mbid, 0), (self.mbid_two, 0)], [(item["recording_mbid"], item["offset"]) for item in similar])
+        self.assertAlmostEqual(0, similar[0]["distance"], places=5)
+        expected = 0.25 * indices["mfccs"].index.get_distance(0, 1) + 0.75 * indices["bpm"].index.get_distance(0, 1)
+        self.assertAlmostEqual(expected, similar[1]["distance"], places=5)
+
+        # A recording is its own nearest neighbour
+        result = get_hybrid_nns([(self.mbid_three, 0)], {"mfccs": 1}, 1, oversample=1)
+        neighbours = [(item["recording_mbid"], item["offset"]) for item in result[self.mbid_three]["0"]]
+        self.assertEqual([(self.mbid_three, 0)], neighbours)
+
+    @mock.patch("db.similarity.get_metric_dimensionality")
+    def test_hybrid_model(self, get_metric_dimensionality):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        self.addCleanup(similarity.index_model.unload_indices)
+        get_metric_dimensionality.side_effect = lambda metric: {"mfccs": 3, "bpm": 2}[metric]
+
+        index = HybridModel({"mfccs": 3, "bpm": 1})
+        self.assertEqual("hybrid-bpm0.25-mfccs0.75", index.metric_name)
+        self.assertEqual(["bpm", "mfccs"], index.columns)
+        self.assertEqual(5, index.dimensionality)
+        for id, (mfccs, bpm, recording) in enumerate(zip(self.mfccs, self.bpm, self.recordings)):
+            index.add_recording_with_vector(id, index.get_row_vector({"id": id, "mfccs": mfccs, "bpm": bpm}),
+                                            recording=recording)
+        index.build(n_jobs=1)
+        index.save(location=location)
+        index_path = similarity.index_model.resolve_index_path(
+            os.path.join(location, "hybrid-bpm0.25-mfccs0.75_euclidean_10.ann"))
+        with open(similarity.index_model.get_metadata_path(index_path)) as f:
+            self.assertEqual({"mfccs": 0.75, "bpm": 0.25}, json.load(f)["weights"])
+
+        with mock.patch.dict(current_app.config, {"SIMILARITY_INDEX_DIR": location}):
+            self.assertEqual([({"mfccs": 0.75, "bpm": 0.25}, 10, 2)], similarity.hybrid.get_saved_hybrid_indices())
+            loaded = similarity.hybrid.get_hybrid_index({"mfccs": 0.75, "bpm": 0.25})
+            self.assertEqual(3, loaded.index.get_n_items())
+            with mock.patch("db.similarity.get_similarity_after", return_value=[]) as get_similarity_after:
+                loaded.save_delta()
+                # New recordings are read with the vectors of each metric
+                get_similarity_after.assert_called_once_with(["bpm", "mfccs"], 2, mock.ANY)
+            self.assertIsNone(similarity.hybrid.get_hybrid_index({"mfccs": 0.5, "bpm": 0.5}))
+
+        with self.assertRaises(similarity.exceptions.IndexNotFoundException):
+            HybridModel({"mfccs": 1}, n_trees=0)
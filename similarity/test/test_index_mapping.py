@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from similarity.index_mapping import MappingBuilder, IndexMapping, save_mapping, load_mapping
+
+
+class IndexMappingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.mbid = "0dad432b-16cc-4bf0-8961-fd31d124b01b"
+        self.mbid_two = "e8afe383-1478-497e-90b1-7885c7f37f6e"
+        self.mbid_three = "ffffffff-ffff-ffff-ffff-ffffffffff00"
+
+        builder = MappingBuilder()
+        # Items can be added in any order, and are numbered in the order they are added
+        self.assertEqual(0, builder.add(7, self.mbid_two, 0))
+        self.assertEqual(1, builder.add(2, self.mbid.upper(), 1))
+        self.assertEqual(2, builder.add(3, self.mbid_three, 65535))
+        self.assertEqual(3, builder.add(1, self.mbid, 0))
+        self.assertEqual(4, builder.add(9, None, None))
+        self.assertEqual(5, len(builder))
+        self.assertEqual(2, builder.get_item(3))
+        self.assertIsNone(builder.get_item(4))
+        self.mapping = builder.build()
+
+    def test_build(self):
+        self.assertEqual([7, 2, 3, 1, 9], self.mapping["id"].tolist())
+        self.assertEqual([0, 1, 65535, 0, 0], self.mapping["offset"].tolist())
+        self.assertEqual([3, 1, 2, 0, 4], self.mapping["by_id"].tolist())
+
+        builder = MappingBuilder()
+        builder.add(1, self.mbid, 65536)
+        with self.assertRaises(ValueError):
+            builder.build()
+
+    def test_get_recordings(self):
+        mapping = IndexMapping(self.mapping)
+        expected = [(self.mbid, 0), (self.mbid_two, 0), (None, None), (self.mbid_three, 65535), (None, None),
+                    (None, None)]
+        self.assertEqual(expected, mapping.get_recordings([3, 0, 4, 2, 5, -1]))
+        self.assertEqual([], mapping.get_recordings([]))
+
+    def test_get_item_ids(self):
+        mapping = IndexMapping(self.mapping)
+        self.assertEqual([1, 7, 9, None], mapping.get_item_ids([3, 0, 4, 5]))
+        self.assertEqual([None], IndexMapping(MappingBuilder().build()).get_item_ids([0]))
+
+    def test_get_items(self):
+        mapping = IndexMapping(self.mapping)
+        self.assertEqual([3, 0, None, 4, None], mapping.get_items([1, 7, 5, 9, 100]))
+        self.assertEqual([None], IndexMapping(MappingBuilder().build()).get_items([1]))
+
+    def test_get_ids(self):
+        mapping = IndexMapping(self.mapping)
+        recordings = [(self.mbid, 1), (self.mbid_two, 0), (self.mbid, 0), (self.mbid_two, 1),
+                      (self.mbid_three.upper(), 65535), ("not-an-mbid", 0),
+                      ("00000000-0000-0000-0000-000000000000", 0)]
+        self.assertEqual([2, 7, 1, None, 3, None, None], mapping.get_ids(recordings))
+
+        self.assertEqual([None], IndexMapping(MappingBuilder().build()).get_ids([(self.mbid, 0)]))
+
+    def test_save_load(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        path = os.path.join(location, "mfccs_angular_10.mapping.npy")
+        self.assertIsNone(load_mapping(path))
+
+        save_mapping(path, self.mapping)
+        self.assertEqual(["mfccs_angular_10.mapping.npy"], os.listdir(location))
+        mapping = load_mapping(path)
+        self.assertEqual([(self.mbid, 1)], mapping.get_recordings([1]))
+        self.assertEqual([7], mapping.get_ids([(self.mbid_two, 0)]))
+
+        save_mapping(path, MappingBuilder().build())
+        self.assertEqual(0, len(load_mapping(path)))
+
+        # Mappings saved in an older format aren't used
+        save_mapping(path, np.zeros(2, dtype=[("id", "<i4"), ("offset", "<u2")]))
+        self.assertIsNone(load_mapping(path))
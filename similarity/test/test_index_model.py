@@ -1,15 +1,22 @@
 import os
 import json
+import shutil
+import tempfile
+import time
 from unittest import mock
 import unittest
 
+from flask import current_app
+import numpy as np
+
 import db.exceptions
-from db.testing import DatabaseTestCase, TEST_DATA_PATH, gid_types
+from webserver.testing import AcousticbrainzTestCase, DB_TEST_DATA_PATH, gid_types
 import similarity.exceptions
+import similarity.index_model
 from similarity.index_model import AnnoyModel
 
 
-class IndexModelTestCase(DatabaseTestCase):
+class IndexModelTestCase(AcousticbrainzTestCase):
 
     @mock.patch("db.similarity.get_metric_dimensionality")
     def setUp(self, get_metric_dimensionality):
@@ -22,11 +29,11 @@ class IndexModelTestCase(DatabaseTestCase):
         self.model = AnnoyModel(metric, n_trees, distance_type)
 
         self.test_mbid = "0dad432b-16cc-4bf0-8961-fd31d124b01b"
-        self.test_lowlevel_data_json = open(os.path.join(TEST_DATA_PATH, self.test_mbid + '.json')).read()
+        self.test_lowlevel_data_json = open(os.path.join(DB_TEST_DATA_PATH, self.test_mbid + '.json')).read()
         self.test_lowlevel_data = json.loads(self.test_lowlevel_data_json)
 
         self.test_mbid_two = 'e8afe383-1478-497e-90b1-7885c7f37f6e'
-        self.test_lowlevel_data_json_two = open(os.path.join(TEST_DATA_PATH, self.test_mbid_two + '.json')).read()
+        self.test_lowlevel_data_json_two = open(os.path.join(DB_TEST_DATA_PATH, self.test_mbid_two + '.json')).read()
         self.test_lowlevel_data_two = json.loads(self.test_lowlevel_data_json_two)
 
     @mock.patch("similarity.index_model.os")
@@ -44,32 +51,205 @@ class IndexModelTestCase(DatabaseTestCase):
             self.model.save()
 
     def test_save(self):
-        # If location is correct, assert saved with proper file name
-        # and full path
+        # Each save writes the files of the index to a new directory, which the index path links to
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        # Files of an index saved before versions were used are removed
+        for name in ["mfccs_angular_10.ann", "mfccs_angular_10.json", "mfccs_angular_10.vectors.npy"]:
+            open(os.path.join(location, name), "w").close()
+        self.model.add_recording_with_vector(3, [1, 0, 0], recording=(self.test_mbid, 0))
+        self.model.add_recording_with_vector(5, [0, 1, 0.5], recording=(self.test_mbid_two, 0))
         self.model.build()
-        self.model.index = mock.Mock()
-        self.model.save()
-        expected_path = "/code/annoy_indices/mfccs_angular_10.ann"
-        self.model.index.save.assert_called_with(expected_path)
+        self.assertEqual([[1, 0, 0], [0, 1, 0.5]], self.model.vectors.tolist())
+        with mock.patch.dict(current_app.config, {"SIMILARITY_INDEX_DIR": location}):
+            self.model.save()
+        index_path = os.path.join(location, "mfccs_angular_10.ann")
+        self.assertTrue(os.path.islink(index_path))
+        first_path = similarity.index_model.resolve_index_path(index_path)
+        first_dir = os.path.dirname(first_path)
+        self.assertEqual(os.path.realpath(location), os.path.dirname(first_dir))
+        self.assertEqual(["mfccs_angular_10.ann", "mfccs_angular_10.json", "mfccs_angular_10.mapping.npy",
+                          "mfccs_angular_10.vectors.npy"], sorted(os.listdir(first_dir)))
+        self.assertEqual([first_dir], [os.path.realpath(os.path.join(location, name))
+                                       for name in os.listdir(location) if name != "mfccs_angular_10.ann"])
+        self.assertEqual([[1, 0, 0], [0, 1, 0.5]], np.load(os.path.join(first_dir, "mfccs_angular_10.vectors.npy")).tolist())
+
+        loaded = AnnoyModel("mfccs", 10, "angular", dimensionality=3)
+        with mock.patch.dict(current_app.config, {"SIMILARITY_INDEX_DIR": location}):
+            self.assertEqual(5, similarity.index_model.get_saved_max_id("mfccs", "angular", 10))
+            loaded.load()
+            # The version which was replaced is kept for processes which are loading it,
+            # and older versions are removed
+            self.model.save()
+            second_dir = os.path.dirname(similarity.index_model.resolve_index_path(index_path))
+            self.assertNotEqual(first_dir, second_dir)
+            self.assertTrue(os.path.isdir(first_dir))
+            self.model.save()
+        self.assertFalse(os.path.exists(first_dir))
+        self.assertTrue(os.path.isdir(second_dir))
+        # A loaded index can still be queried after its files are removed
+        self.assertEqual([3, 5], loaded.get_nns_by_id(3, 2)[0])
 
     def test_save_location(self):
         # Saves to specified location with specified name, with params appended
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
         self.model.build()
-        self.model.index = mock.Mock()
-        self.model.save(location="/code/annoy_indices/test_indices", name="test_mfccs")
-        expected_path = "/code/annoy_indices/test_indices/test_mfccs_angular_10.ann"
-        self.model.index.save.assert_called_with(expected_path)
+        self.model.save(location=os.path.join(location, "test_indices"), name="test_mfccs")
+        index_path = os.path.join(location, "test_indices", "test_mfccs_angular_10.ann")
+        self.assertTrue(os.path.islink(index_path))
+        self.assertEqual("test_mfccs_angular_10.ann", os.path.basename(similarity.index_model.resolve_index_path(index_path)))
 
-    def test_load(self):
-        # Raises error if no index with specified name exists
-        name = "test"
-        with self.assertRaises(similarity.exceptions.IndexNotFoundException):
-            self.model.load(name=name)
+    @mock.patch("db.similarity.get_metric_dimensionality")
+    def test_get_index(self, get_metric_dimensionality):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        self.addCleanup(similarity.index_model.unload_indices)
+        self.model.add_recording_with_vector(0, [1, 0, 0], recording=(self.test_mbid, 0))
+        self.model.add_recording_with_vector(1, [0, 1, 0], recording=(self.test_mbid_two, 0))
+        self.model.build()
+        self.model.save(location=location)
+        index_path = similarity.index_model.resolve_index_path(os.path.join(location, "mfccs_angular_10.ann"))
+        with open(similarity.index_model.get_metadata_path(index_path)) as f:
+            self.assertEqual(3, json.load(f)["dimensionality"])
+
+        with mock.patch.dict(current_app.config, {"SIMILARITY_INDEX_DIR": location}):
+            # Dimensionality is read from the metadata file
+            index = similarity.index_model.get_index("mfccs")
+            get_metric_dimensionality.assert_not_called()
+            self.assertEqual(2, index.index.get_n_items())
+
+            # Recordings are found using the mapping saved with the index
+            with mock.patch("db.data.get_mbids_by_ids") as get_mbids_by_ids, \
+                    mock.patch("db.data.get_ids_by_mbids") as get_ids_by_mbids:
+                similar = index.get_nns_by_mbid(self.test_mbid, 0, 2)
+                self.assertEqual([(self.test_mbid, 0), (self.test_mbid_two, 0)],
+                                 [(item["recording_mbid"], item["offset"]) for item in similar])
+                get_mbids_by_ids.assert_not_called()
+                get_ids_by_mbids.assert_not_called()
+            self.assertIs(index, similarity.index_model.get_index("mfccs"))
+
+            # A newer index is used once it has been saved and the check interval has passed
+            get_metric_dimensionality.return_value = 3
+            new_model = AnnoyModel("mfccs", 10, "angular")
+            for id in range(3):
+                new_model.add_recording_with_vector(id, [1, id, 0])
+            new_model.build()
+            new_model.save(location=location)
+            self.assertIs(index, similarity.index_model.get_index("mfccs"))
+
+            check_time = time.time() + similarity.index_model.INDEX_CHECK_INTERVAL + 1
+            with mock.patch("similarity.index_model.time.time", return_value=check_time):
+                new_index = similarity.index_model.get_index("mfccs")
+                self.assertIsNot(index, new_index)
+                self.assertEqual(3, new_index.index.get_n_items())
+                self.assertIs(new_index, similarity.index_model.get_index("mfccs"))
+            # The old index can still be used by requests which have it
+            self.assertEqual([0, 1], index.index.get_nns_by_item(0, 2))
+
+            with self.assertRaises(similarity.exceptions.IndexNotFoundException):
+                similarity.index_model.get_index("mfccs", distance_type="manhattan")
+
+    def test_rerank(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        model = AnnoyModel("mfccs", 10, "angular", dimensionality=3)
+        vectors = [[1, 0, 0], [0, 1, 0], [1, 0.1, 0], [1, 1, 1], [0.9, 0.2, 0]]
+        for id, vector in enumerate(vectors, start=10):
+            model.add_recording_with_vector(id, vector, recording=(self.test_mbid, id))
+        model.build()
+        ids, recordings, distances = model.get_nns_by_id(10, 3, oversample=2)
+        self.assertEqual([10, 12, 14], ids)
+
+        # The vectors of the items are saved with the index, and used by queries
+        model.save(location=location)
+        index_path = similarity.index_model.resolve_index_path(os.path.join(location, "mfccs_angular_10.ann"))
+        self.assertTrue(os.path.exists(similarity.index_model.get_vectors_path(index_path)))
+        self.assertEqual((5, 3), model.vectors.shape)
+        self.assertEqual([0.9, 0.2, 0], [round(value, 5) for value in model.vectors[4].tolist()])
+
+        for search_k, oversample in [(-1, 1), (-1, 3), (100, 2)]:
+            ids, recordings, distances = model.get_nns_by_id(10, 3, search_k=search_k, oversample=oversample)
+            self.assertEqual([10, 12, 14], ids)
+            self.assertEqual([(self.test_mbid, 10), (self.test_mbid, 12), (self.test_mbid, 14)], recordings)
+            for id, distance in zip(ids, distances):
+                self.assertAlmostEqual(model.index.get_distance(0, id - 10), distance, places=5)
+
+        vectors, found = model.get_vectors([14, 99, 10])
+        self.assertEqual([True, False, True], found.tolist())
+        self.assertEqual([0, 0, 0], vectors[1].tolist())
+        self.assertEqual([1, 0, 0], vectors[2].tolist())
+
+    @mock.patch("db.similarity.get_similarity_after")
+    def test_delta(self, get_similarity_after):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        self.addCleanup(similarity.index_model.unload_indices)
+        self.model.add_recording_with_vector(0, [1, 0, 0], recording=(self.test_mbid, 0))
+        self.model.add_recording_with_vector(1, [0, 1, 0], recording=(self.test_mbid_two, 0))
+        self.model.build()
+        self.model.save(location=location)
+
+        # Recordings added to the similarity table after the index was built are saved in a delta
+        mbid_three = "ffffffff-ffff-ffff-ffff-ffffffffff00"
+        get_similarity_after.return_value = [{"id": 2, "gid": mbid_three, "submission_offset": 0,
+                                              "mfccs": [1, 0.1, 0]}]
+        self.assertEqual(1, self.model.save_delta())
+        get_similarity_after.assert_called_once_with(["mfccs"], 1, similarity.index_model.DELTA_UPDATE_BATCH_SIZE)
+        get_similarity_after.reset_mock()
+
+        # Processes using the index load the delta without querying the database, and it is found by queries
+        with mock.patch.dict(current_app.config, {"SIMILARITY_INDEX_DIR": location}):
+            index = similarity.index_model.get_index("mfccs")
+        get_similarity_after.assert_not_called()
+        self.assertEqual(1, len(index.delta))
+
+        similar = index.get_nns_by_mbid(self.test_mbid, 0, 2)
+        self.assertEqual([(self.test_mbid, 0), (mbid_three, 0)],
+                         [(item["recording_mbid"], item["offset"]) for item in similar])
+        similar = index.get_nns_by_mbid(mbid_three, 0, 3)
+        self.assertEqual([(mbid_three, 0), (self.test_mbid, 0), (self.test_mbid_two, 0)],
+                         [(item["recording_mbid"], item["offset"]) for item in similar])
+        self.assertAlmostEqual(index.get_similarity_between((self.test_mbid, 0), (mbid_three, 0)),
+                               similar[1]["distance"], places=5)
+
+        # The delta continues from its last item, and is read in batches until there are no more rows
+        get_similarity_after.side_effect = [[{"id": 3, "gid": mbid_three, "submission_offset": 1, "mfccs": [0, 0, 1]},
+                                             {"id": 4, "gid": mbid_three, "submission_offset": 2, "mfccs": [0, 1, 1]}],
+                                            [{"id": 5, "gid": mbid_three, "submission_offset": 3, "mfccs": [1, 1, 1]}]]
+        with mock.patch("similarity.index_model.DELTA_UPDATE_BATCH_SIZE", 2):
+            self.assertEqual(3, self.model.save_delta())
+        self.assertEqual([mock.call(["mfccs"], 2, 2), mock.call(["mfccs"], 4, 2)], get_similarity_after.call_args_list)
+
+        # Processes start using a new delta after the check interval has passed
+        with mock.patch.dict(current_app.config, {"SIMILARITY_INDEX_DIR": location}):
+            self.assertIs(index, similarity.index_model.get_index("mfccs"))
+            self.assertEqual(1, len(index.delta))
+            check_time = time.time() + similarity.index_model.INDEX_CHECK_INTERVAL + 1
+            with mock.patch("similarity.index_model.time.time", return_value=check_time):
+                self.assertIs(index, similarity.index_model.get_index("mfccs"))
+        self.assertEqual(4, len(index.delta))
+        self.assertEqual(5, index.get_ids([(mbid_three, 3)])[0])
+
+        # The delta stops growing once it is full
+        get_similarity_after.side_effect = None
+        with mock.patch("similarity.index_model.DELTA_MAX_ITEMS", 4):
+            self.assertEqual(0, self.model.save_delta())
+        self.assertEqual(2, get_similarity_after.call_count)
 
-        # No name specified, uses metric name
-        self.model.index = mock.Mock()
-        self.model.load()
-        expected_path = "/code/annoy_indices/mfccs_angular_10.ann"
+    def test_load(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        with mock.patch.dict(current_app.config, {"SIMILARITY_INDEX_DIR": location}):
+            # Raises error if no index with specified name exists
+            name = "test"
+            with self.assertRaises(similarity.exceptions.IndexNotFoundException):
+                self.model.load(name=name)
+
+            # No name specified, uses metric name
+            self.model.index = mock.Mock()
+            self.model.load()
+        expected_path = os.path.join(location, "mfccs_angular_10.ann")
         self.model.index.load.assert_called_with(expected_path)
         self.assertEqual(True, self.model.in_loaded_state)
 
@@ -91,11 +271,12 @@ class IndexModelTestCase(DatabaseTestCase):
     def test_add_recordings_by_mbid_exists(self, get_similarity_by_mbid):
         # If item with given lowlevel.id already exists, no addition occurs.
         self.model.index = mock.Mock()
-        self.model.index.get_item_vector.return_value = [1, 2, 3]
-        get_similarity_by_mbid.return_value = {"id": 1, "mfccs": "data"}
+        get_similarity_by_mbid.return_value = {"id": 1, "mfccs": [1, 0, 0]}
 
         self.model.add_recording_by_mbid(self.test_mbid, 0)
-        self.model.index.add_item.assert_not_called()
+        self.model.index.add_item.assert_called_once_with(0, [1, 0, 0])
+        self.model.add_recording_by_mbid(self.test_mbid, 0)
+        self.model.index.add_item.assert_called_once_with(0, [1, 0, 0])
 
     @mock.patch("db.similarity.get_similarity_row_id")
     def test_add_recordings_by_id_none(self, get_similarity_row_id):
@@ -112,26 +293,30 @@ class IndexModelTestCase(DatabaseTestCase):
         self.model.add_recording_by_id(1)
         self.model.index.get_item_vector.assert_not_called()
 
+    @mock.patch("db.data.get_mbids_by_ids")
     @mock.patch("db.similarity.get_similarity_row_id")
-    def test_add_recordings_by_id_exists(self, get_similarity_row_id):
+    def test_add_recordings_by_id_exists(self, get_similarity_row_id, get_mbids_by_ids):
         # If item with given lowlevel.id already exists, no addition occurs.
         self.model.index = mock.Mock()
-        self.model.index.get_item_vector.return_value = [1, 2, 3]
-        get_similarity_row_id.return_value = {"id": 1, "mfccs": "data"}
+        get_similarity_row_id.return_value = {"id": 1, "mfccs": [1, 0, 0]}
+        get_mbids_by_ids.return_value = [(self.test_mbid, 0)]
 
         self.model.add_recording_by_id(1)
-        self.model.index.add_item.assert_not_called()
+        self.model.add_recording_by_id(1)
+        self.model.index.add_item.assert_called_once_with(0, [1, 0, 0])
 
+    @mock.patch("db.data.get_mbids_by_ids")
     @mock.patch("db.similarity.get_similarity_row_id")
-    def test_add_recordings_by_id(self, get_similarity_row_id):
-        # If item is not already submitted, addition occurs.
-        get_similarity_row_id.return_value = {"id": 1, "mfccs": "data"}
+    def test_add_recordings_by_id(self, get_similarity_row_id, get_mbids_by_ids):
+        # If item is not already submitted, addition occurs. Items are numbered from 0
+        get_similarity_row_id.return_value = {"id": 5, "mfccs": [1, 0, 0]}
+        get_mbids_by_ids.return_value = [(self.test_mbid, 0)]
         self.model.in_loaded_state = False
         self.model.index = mock.Mock()
-        self.model.index.get_item_vector.side_effect = IndexError
 
-        self.model.add_recording_by_id(1)
-        self.model.index.add_item.assert_called_with(1, "data")
+        self.model.add_recording_by_id(5)
+        self.model.index.add_item.assert_called_with(0, [1, 0, 0])
+        self.assertEqual(0, self.model.mapping.get_item(5))
 
     def test_add_recording_with_vector_none(self):
         # If model is built, (in_loaded_state is True), error is raised.
@@ -141,23 +326,24 @@ class IndexModelTestCase(DatabaseTestCase):
         with self.assertRaises(similarity.exceptions.CannotAddItemException):
             self.model.add_recording_with_vector(id, vector)
 
-        # If item is already submitted, no addition occurs.
+        # If the vector has the wrong dimensionality, error is raised.
         self.model.in_loaded_state = False
         self.model.index = mock.Mock()
-        self.model.index.get_item_vector.return_value = vector
-
-        self.model.add_recording_with_vector(1, vector)
+        with self.assertRaises(similarity.exceptions.CannotAddItemException):
+            self.model.add_recording_with_vector(1, [1, 2])
         self.model.index.add_item.assert_not_called()
 
     def test_add_recording_with_vector(self):
-        # If no item is already submitted, addition occurs.
+        # Items are numbered in the order they are added
         self.model.in_loaded_state = False
         vector = [1, 2, 3]
         self.model.index = mock.Mock()
-        self.model.index.get_item_vector.side_effect = IndexError
 
-        self.model.add_recording_with_vector(1, vector)
+        self.model.add_recording_with_vector(10, vector)
+        self.model.index.add_item.assert_called_with(0, vector)
+        self.model.add_recording_with_vector(4, vector, recording=(self.test_mbid, 0))
         self.model.index.add_item.assert_called_with(1, vector)
+        self.assertEqual(10, self.model.max_id)
 
     def test_get_nns_by_id_none(self):
         # If item is not submitted, error is raised
@@ -189,63 +375,55 @@ class IndexModelTestCase(DatabaseTestCase):
 
     def test_get_bulk_nns_by_mbid_none(self):
         """
-        If an item is not indexed, ItemNotFoundException caught and item
-        is skipped.
+        If a recording is not submitted or not indexed, it is skipped.
 
-        If a recording is not submitted, NoDataFoundException caught and item
+        If an item is not indexed, ItemNotFoundException caught and item
         is skipped.
         """
         num_neighbours = 2
         recordings = [(self.test_mbid, 0), (self.test_mbid, 1), (self.test_mbid, 2)]
-        returns = [similarity.exceptions.ItemNotFoundException,
-                   db.exceptions.NoDataFoundException,
-                   ([1, 2],
-                    [("0dad432b-16cc-4bf0-8961-fd31d124b01b", 0), ("e8afe383-1478-497e-90b1-7885c7f37f6e", 0)],
-                    [0.4, 0.5])]
-        self.model.get_nns_by_mbid = mock.Mock()
-        self.model.get_nns_by_mbid.side_effect = returns
-
-        expected = {self.test_mbid: {'2': [(self.test_mbid, 0), (self.test_mbid_two, 0)]}}
+        self.model.get_ids = mock.Mock(return_value=[None, 5, 6])
+        self.model.get_nns_by_id = mock.Mock()
+        self.model.get_nns_by_id.side_effect = [
+            similarity.exceptions.ItemNotFoundException,
+            ([1, 2], [(self.test_mbid, 0), (self.test_mbid_two, 0)], [0.4, 0.5])]
+
+        expected = {self.test_mbid: {'2': [{'recording_mbid': self.test_mbid, 'offset': 0, 'distance': 0.4},
+                                           {'recording_mbid': self.test_mbid_two, 'offset': 0, 'distance': 0.5}]}}
         ret = self.model.get_bulk_nns_by_mbid(recordings, num_neighbours)
         self.assertDictEqual(expected, ret)
+        self.model.get_ids.assert_called_once_with(recordings)
+        self.assertEqual([mock.call(5, num_neighbours, search_k=-1, oversample=1),
+                          mock.call(6, num_neighbours, search_k=-1, oversample=1)],
+                         self.model.get_nns_by_id.call_args_list)
 
     def test_get_bulk_nns_by_mbid(self):
         """
-        If extended_info is True, lowlevel.id and distance is included
-        in the tuple for each similar recording.
-
-        If extended_info is False, only tuples of (MBID, offset) are
-        included in the tuple for each similar recording.
+        Similar recordings are returned for each recording with their distance,
+        and items which were added without a recording are skipped.
         """
         num_neighbours = 2
         recordings = [(self.test_mbid, 1), (self.test_mbid_two, 2)]
-
-        returns = [([1, 2],
-                    [("0dad432b-16cc-4bf0-8961-fd31d124b01b", 0), ("e8afe383-1478-497e-90b1-7885c7f37f6e", 0)],
-                    [0.4, 0.5]),
-                   ([3, 4],
-                    [("0dad432b-16cc-4bf0-8961-fd31d124b01b", 1), ("0dad432b-16cc-4bf0-8961-fd31d124b01b", 3)],
-                    [0.1, 0.2])]
-
-        self.model.get_nns_by_mbid = mock.Mock()
-        self.model.get_nns_by_mbid.side_effect = returns
-
-        # extended_info is not specified, defaults as False
-        self.model.get_nns_by_mbid.side_effect = returns
-        expected = {self.test_mbid: {'1': [("0dad432b-16cc-4bf0-8961-fd31d124b01b", 0),
-                                           ("e8afe383-1478-497e-90b1-7885c7f37f6e", 0)]},
-                    self.test_mbid_two: {'2': [("0dad432b-16cc-4bf0-8961-fd31d124b01b", 1),
-                                               ("0dad432b-16cc-4bf0-8961-fd31d124b01b", 3)]}}
-        ret = self.model.get_bulk_nns_by_mbid(recordings, num_neighbours)
+        self.model.get_ids = mock.Mock(return_value=[3, 4])
+        self.model.get_nns_by_id = mock.Mock()
+        self.model.get_nns_by_id.side_effect = [
+            ([1, 2], [(self.test_mbid, 0), (self.test_mbid_two, 0)], [0.4, 0.5]),
+            ([3, 4, 7], [(self.test_mbid, 1), (self.test_mbid, 3), (None, None)], [0.1, 0.2, 0.3])]
+
+        expected = {self.test_mbid: {'1': [{'recording_mbid': self.test_mbid, 'offset': 0, 'distance': 0.4},
+                                           {'recording_mbid': self.test_mbid_two, 'offset': 0, 'distance': 0.5}]},
+                    self.test_mbid_two: {'2': [{'recording_mbid': self.test_mbid, 'offset': 1, 'distance': 0.1},
+                                               {'recording_mbid': self.test_mbid, 'offset': 3, 'distance': 0.2}]}}
+        ret = self.model.get_bulk_nns_by_mbid(recordings, num_neighbours, search_k=100, oversample=2)
         self.assertEqual(expected, ret)
+        self.model.get_nns_by_id.assert_called_with(4, num_neighbours, search_k=100, oversample=2)
 
     def test_get_similarity_between_none(self):
         # If one of the (MBID, offset) tuples is not submitted,
-        # error is raised.
+        # None is returned.
         rec1 = (self.test_mbid, 0)
         rec2 = (self.test_mbid_two, 0)
-        with self.assertRaises(db.exceptions.NoDataFoundException):
-            self.model.get_similarity_between(rec1, rec2)
+        self.assertIsNone(self.model.get_similarity_between(rec1, rec2))
 
         # If one of the (MBID, offset) tuples is not indexed,
         # None is returned.
@@ -0,0 +1,73 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A thread-safe mapping which holds at most ``max_size`` items.
+
+    When the cache is full, adding a new item discards the least recently used one.
+    The number of hits and misses of :meth:`get` are counted so that the effectiveness
+    of the cache can be measured.
+    """
+
+    def __init__(self, max_size):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Get an item from the cache, marking it as the most recently used item.
+        If it doesn't exist, return ``default``"""
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Add an item to the cache, removing the least recently used item if the cache is full"""
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        """Remove an item from the cache if it exists"""
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        """Remove all items from the cache and reset the hit and miss counters"""
+        with self._lock:
+            self._items.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Get the current hit and miss counts and the size of the cache
+
+        Returns:
+            a dictionary {"hits": int, "misses": int, "size": int, "max_size": int}
+        """
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "size": len(self._items),
+                    "max_size": self.max_size}
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
@@ -0,0 +1,41 @@
+import unittest
+
+from utils.lru_cache import LRUCache
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_get_put(self):
+        cache = LRUCache(2)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("a", 1), 1)
+        cache.put("a", 10)
+        self.assertEqual(cache.get("a"), 10)
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 2, "size": 1, "max_size": 2})
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        # Reading a makes b the least recently used item
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_delete_clear(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.delete("a")
+        cache.delete("missing")
+        self.assertNotIn("a", cache)
+        cache.get("b")
+        cache.clear()
+        self.assertEqual(cache.stats(), {"hits": 0, "misses": 0, "size": 0, "max_size": 2})
+
+    def test_invalid_size(self):
+        with self.assertRaises(ValueError):
+            LRUCache(0)
@@ -60,8 +60,8 @@ def create_app(debug=None):
         sentry.init_sentry(**sentry_config)
 
     # Database connection
-    from db import init_db_engine
-    init_db_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+    from db import init_db_engine, get_pool_options
+    init_db_engine(app.config['SQLALCHEMY_DATABASE_URI'], **get_pool_options(app.config))
 
     # Cache
     if 'REDIS_HOST' in app.config and\
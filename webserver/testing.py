@@ -1,7 +1,9 @@
+from brainzutils import cache
 from brainzutils.ratelimit import set_rate_limits
 
 import db
 import db.data
+import db.document_cache
 import json
 import os
 import random
@@ -37,6 +39,10 @@ class AcousticbrainzTestCase(TestCase):
             session['_fresh'] = True
 
     def reset_db(self):
+        # Cached ids and documents refer to rows that are about to be removed
+        db.data.clear_caches()
+        cache.flush_all()
+        db.document_cache.reset()
         self.drop_tables()
         self.drop_types()
         self.init_db()
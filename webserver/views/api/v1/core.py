@@ -1,14 +1,16 @@
 import json
 import uuid
 
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, jsonify, current_app, stream_with_context
 
 import db.data
+import db.document_cache
 import webserver.views.api.exceptions
 from db.data import submit_low_level_data, count_lowlevel
 from db.exceptions import NoDataFoundException, BadDataException
 from webserver.decorators import crossdomain
 from utils.container_utils import remove_duplicates
+from utils.list_utils import chunks
 from brainzutils.ratelimit import ratelimit
 
 bp_core = Blueprint('api_v1_core', __name__)
@@ -23,28 +25,40 @@ bp_core = Blueprint('api_v1_core', __name__)
 #: The maximum number of items that you can pass as a recording_ids parameter to bulk lookup endpoints
 MAX_ITEMS_PER_BULK_REQUEST = 25
 
-# Individual features selectable in get_many_individual_features.
+#: The maximum number of documents that you can submit in one request to the bulk submission endpoint
+MAX_ITEMS_PER_BULK_SUBMISSION = 100
+
+#: The maximum number of items that you can pass in the body of a POST request to bulk lookup endpoints
+MAX_ITEMS_PER_POST_BULK_REQUEST = 5000
+
+# POST bulk lookups query the database for this many recordings at a time
+BULK_LOOKUP_CHUNK_SIZE = 500
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# Individual features selectable in get_many_individual_features, and their columns in the
+# lowlevel_features table (see db.data.LOWLEVEL_FEATURES).
 # Note: metadata.version and metadata.audio_properties will be included in all responses.
 AVAILABLE_FEATURES = {
-    "lowlevel.average_loudness": ["llj.data->'lowlevel'->'average_loudness'", None],
-    "lowlevel.dynamic_complexity": ["llj.data->'lowlevel'->'dynamic_complexity'", None],
-    "metadata.audio_properties.replay_gain": ["llj.data->'metadata'->'audio_properties'->'replay_gain'", None],
-    "metadata.tags": ["llj.data->'metadata'->'tags'", {}],
-    "rhythm.beats_count": ["llj.data->'rhythm'->'beats_count'", None],
-    "rhythm.beats_loudness.mean": ["llj.data->'rhythm'->'beats_loudness'->'mean'", None],
-    "rhythm.bpm": ["llj.data->'rhythm'->'bpm'", None],
-    "rhythm.bpm_histogram_first_peak_bpm.mean": ["llj.data->'rhythm'->bpm_histogram_first_peak_bpm'->'mean'", None],
-    "rhythm.bpm_histogram_second_peak_bpm.mean": ["llj.data->'rhythm'->bpm_histogram_second_peak_bpm'->'mean'", None],
-    "rhythm.danceability": ["llj.data->'rhythm'->'danceability'", None],
-    "rhythm.onset_rate": ["llj.data->'rhythm'->'onset_rate'", None],
-    "tonal.chords_key": ["llj.data->'tonal'->'chords_key'", None],
-    "tonal.chords_scale": ["llj.data->'tonal'->'chords_scale'", None],
-    "tonal.chords_changes_rate": ["llj.data->'tonal'->'chords_changes_rate'", None],
-    "tonal.key_key": ["llj.data->'tonal'->'key_key'", None],
-    "tonal.key_scale": ["llj.data->'tonal'->'key_scale'", None],
-    "tonal.key_strength": ["llj.data->'tonal'->'key_strength'", None],
-    "tonal.tuning_frequency": ["llj.data->'tonal'->'tuning_frequency'", None],
-    "tonal.tuning_equal_tempered_deviation": ["llj.data->'tonal'->'tuning_equal_tempered_deviation'", None]
+    "lowlevel.average_loudness": ["llf.lowlevel_average_loudness", None],
+    "lowlevel.dynamic_complexity": ["llf.lowlevel_dynamic_complexity", None],
+    "metadata.audio_properties.replay_gain": ["llf.metadata_audio_properties_replay_gain", None],
+    "metadata.tags": ["llf.metadata_tags", {}],
+    "rhythm.beats_count": ["llf.rhythm_beats_count", None],
+    "rhythm.beats_loudness.mean": ["llf.rhythm_beats_loudness_mean", None],
+    "rhythm.bpm": ["llf.rhythm_bpm", None],
+    "rhythm.bpm_histogram_first_peak_bpm.mean": ["llf.rhythm_bpm_histogram_first_peak_bpm_mean", None],
+    "rhythm.bpm_histogram_second_peak_bpm.mean": ["llf.rhythm_bpm_histogram_second_peak_bpm_mean", None],
+    "rhythm.danceability": ["llf.rhythm_danceability", None],
+    "rhythm.onset_rate": ["llf.rhythm_onset_rate", None],
+    "tonal.chords_key": ["llf.tonal_chords_key", None],
+    "tonal.chords_scale": ["llf.tonal_chords_scale", None],
+    "tonal.chords_changes_rate": ["llf.tonal_chords_changes_rate", None],
+    "tonal.key_key": ["llf.tonal_key_key", None],
+    "tonal.key_scale": ["llf.tonal_key_scale", None],
+    "tonal.key_strength": ["llf.tonal_key_strength", None],
+    "tonal.tuning_frequency": ["llf.tonal_tuning_frequency", None],
+    "tonal.tuning_equal_tempered_deviation": ["llf.tonal_tuning_equal_tempered_deviation", None]
 }
 
 #: Features that can be selected individually from the bulk low-level endpoint
@@ -97,7 +111,7 @@ def get_low_level(mbid):
     offset = request.args.get("n")
     _, mbid, offset = _validate_arguments(str(mbid), offset)
     try:
-        return jsonify(db.data.load_low_level(mbid, offset))
+        return _json_document_response(db.data.load_low_level_json(mbid, offset))
     except NoDataFoundException:
         raise webserver.views.api.exceptions.APINotFound("Not found")
 
@@ -157,6 +171,81 @@ def submit_low_level(mbid):
     return jsonify({"message": "ok"})
 
 
+@bp_core.route("/low-level/bulk", methods=["POST"])
+@ratelimit()
+def submit_many_low_level():
+    """Submit many low-level documents to AcousticBrainz in a single request.
+
+    The request body is a JSON list of objects, each containing a recording MBID and
+    the low-level document for that recording:
+
+    .. sourcecode:: json
+
+       [{"mbid": "mbid1", "data": {document}},
+        {"mbid": "mbid2", "data": {document}}]
+
+    Every item in the request gets a result in the response, in the same order as the request.
+    The status of an item is ``saved`` if it was added, ``duplicate`` if the exact same document has
+    already been submitted, or ``rejected`` if it is invalid. Rejected items include a ``message``
+    explaining why they weren't accepted. Rejected items don't stop other items from being saved.
+
+    **Example response**:
+
+    .. sourcecode:: json
+
+       {"results": [{"mbid": "mbid1", "status": "saved"},
+                    {"mbid": "mbid2", "status": "rejected", "message": "Key 'lowlevel' was not found in submitted data."}]}
+
+    You can submit up to :py:const:`~webserver.views.api.v1.core.MAX_ITEMS_PER_BULK_SUBMISSION` documents in a request.
+
+    :reqheader Content-Type: *application/json*
+
+    :resheader Content-Type: *application/json*
+    """
+    raw_data = request.get_data()
+    try:
+        items = json.loads(raw_data.decode("utf-8"))
+    except ValueError as e:
+        raise webserver.views.api.exceptions.APIBadRequest("Cannot parse JSON document: %s" % e)
+
+    if not isinstance(items, list):
+        raise webserver.views.api.exceptions.APIBadRequest("Request body must be a list of submissions")
+    if len(items) > MAX_ITEMS_PER_BULK_SUBMISSION:
+        raise webserver.views.api.exceptions.APIBadRequest(
+            "More than %s submissions not allowed per request" % MAX_ITEMS_PER_BULK_SUBMISSION)
+
+    max_duplicate_submissions = current_app.config.get('MAX_NUMBER_DUPLICATE_SUBMISSIONS', None)
+
+    results = [None] * len(items)
+    submissions = []
+    positions = []
+    for position, item in enumerate(items):
+        mbid = item.get("mbid") if isinstance(item, dict) else None
+        try:
+            # Like the single submission endpoint, only accept lower-case MBIDs
+            if str(uuid.UUID(mbid)) != mbid:
+                raise ValueError
+        except (ValueError, TypeError, AttributeError):
+            results[position] = {"mbid": mbid, "status": db.data.SUBMISSION_REJECTED,
+                                 "message": "'%s' is not a valid UUID" % mbid}
+            continue
+        submissions.append((mbid, item.get("data")))
+        positions.append(position)
+
+    try:
+        statuses = db.data.submit_many_low_level_data(submissions, 'mbid', max_duplicate_submissions)
+    except BadDataException as e:
+        raise webserver.views.api.exceptions.APIBadRequest("%s" % e)
+
+    for position, (mbid, _), (status, message) in zip(positions, submissions, statuses):
+        result = {"mbid": mbid, "status": status}
+        if message:
+            result["message"] = message
+        results[position] = result
+
+    return jsonify({"results": results})
+
+
 def _validate_map_classes(map_classes):
     """Validate the map_classes parameter
 
@@ -236,24 +325,33 @@ def _parse_bulk_params(params):
     ret = []
 
     for recording in params.split(";"):
-        parts = str(recording).split(":")
-        mbid = parts[0]
-        if not mbid:
-            continue
-        if len(parts) == 1:
-            offset = None
-        elif len(parts) == 2:
-            offset = parts[1]
-        else:
-            raise webserver.views.api.exceptions.APIBadRequest("More than 1 colon (:) in '%s'" % recording)
-
-        args = _validate_arguments(mbid, offset)
-        ret.append(args)
+        args = _parse_recording_id(recording)
+        if args:
+            ret.append(args)
 
     # Remove duplicates, preserving order
     return remove_duplicates(ret)
 
 
+def _parse_recording_id(recording):
+    """Validate and parse one mbid[:offset] item of a bulk request, as described in :func:`_parse_bulk_params`.
+
+    Returns a tuple (mbid, parsed_mbid, offset), or None if the mbid is missing.
+    """
+    parts = str(recording).split(":")
+    mbid = parts[0]
+    if not mbid:
+        return None
+    if len(parts) == 1:
+        offset = None
+    elif len(parts) == 2:
+        offset = parts[1]
+    else:
+        raise webserver.views.api.exceptions.APIBadRequest("More than 1 colon (:) in '%s'" % recording)
+
+    return _validate_arguments(mbid, offset)
+
+
 def _get_recording_ids_from_request():
     """
     Read the ?recording_ids query parameter from the flask request and validate it.
@@ -281,6 +379,78 @@ def _get_recording_ids_from_request():
     return recordings
 
 
+def _get_recording_ids_from_body():
+    """
+    Read the recording ids from the JSON body of a POST bulk lookup request and validate them.
+    The body should be in the format
+        {"recording_ids": ["mbid:n", "mbid", ...]}
+    where each item has the same format as an item of the ?recording_ids query parameter
+    of GET bulk lookups.
+
+    Returns:
+        a list of (mbid, parsed_mbid, offset) tuples, as returned by :func:`_parse_bulk_params`
+
+    Raises:
+        APIBadRequest if the body isn't in this format, there are more than
+        MAX_ITEMS_PER_POST_BULK_REQUEST items, or the format of the mbids or offsets are invalid
+    """
+    try:
+        body = json.loads(request.get_data().decode("utf-8"))
+    except ValueError as e:
+        raise webserver.views.api.exceptions.APIBadRequest("Cannot parse JSON document: %s" % e)
+
+    recording_ids = body.get("recording_ids") if isinstance(body, dict) else None
+    if not isinstance(recording_ids, list) or not recording_ids:
+        raise webserver.views.api.exceptions.APIBadRequest("Request body must contain a list of `recording_ids`")
+    if len(recording_ids) > MAX_ITEMS_PER_POST_BULK_REQUEST:
+        raise webserver.views.api.exceptions.APIBadRequest(
+            "More than %s recordings not allowed per request" % MAX_ITEMS_PER_POST_BULK_REQUEST)
+
+    recordings = []
+    for recording in recording_ids:
+        if not isinstance(recording, str):
+            raise webserver.views.api.exceptions.APIBadRequest("'%s' is not a valid recording id" % (recording,))
+        args = _parse_recording_id(recording)
+        if args:
+            recordings.append(args)
+
+    return remove_duplicates(recordings)
+
+
+def _ndjson_lookup_response(recordings, lookup):
+    """Make a streamed response for a POST bulk lookup, with one JSON document per line.
+
+    Recordings are looked up in chunks of BULK_LOOKUP_CHUNK_SIZE, and the lines for
+    each chunk are sent before the next chunk is looked up.
+
+    Arguments:
+        recordings: the list of items to look up
+        lookup: a function that takes a chunk of ``recordings`` and returns an
+            iterable of lines (strings of JSON documents without a trailing newline)
+    """
+    def generate():
+        for chunk in chunks(recordings, BULK_LOOKUP_CHUNK_SIZE):
+            lines = list(lookup(chunk))
+            if lines:
+                yield "\n".join(lines) + "\n"
+
+    return current_app.response_class(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+
+def _recording_document_lines(recordings, recording_details):
+    """Make the lines of a POST bulk lookup response for documents of recordings.
+
+    Arguments:
+        recordings: a list of (mbid, offset) tuples, in the order of the lines
+        recording_details: a dictionary {mbid: {offset: JSON document}}. Recordings
+            that aren't in it are skipped
+    """
+    for mbid, offset in recordings:
+        document = recording_details.get(mbid, {}).get(str(offset))
+        if document is not None:
+            yield '{"data":%s,"mbid":%s,"offset":%d}' % (document, db.document_cache.dumps(mbid), offset)
+
+
 @bp_core.route("/low-level", methods=["GET"])
 @crossdomain()
 @ratelimit()
@@ -337,11 +507,10 @@ def get_many_lowlevel():
     recordings = [(mbid, offset) for _, mbid, offset in recordings]
 
     parsed_features = _parse_individual_features()
-    if parsed_features:
-        recording_details = db.data.load_many_individual_features(recordings, parsed_features)
-    else:
-        recording_details = db.data.load_many_low_level(recordings)
+    if not parsed_features:
+        return _bulk_json_documents_response(db.data.load_many_low_level_json(recordings), mbid_mapping)
 
+    recording_details = db.data.load_many_individual_features(recordings, parsed_features)
     recording_details['mbid_mapping'] = {}
     if mbid_mapping:
         recording_details['mbid_mapping'] = mbid_mapping
@@ -349,6 +518,58 @@ def get_many_lowlevel():
     return jsonify(recording_details)
 
 
+@bp_core.route("/low-level", methods=["POST"])
+@crossdomain()
+@ratelimit()
+def lookup_many_lowlevel():
+    """Get low-level data for many recordings at once, listing the recordings in the request body.
+
+    This is the same as ``GET /low-level``, but allows many more recordings in a request.
+    The response is streamed as newline-delimited JSON, with one line for each recording
+    that was found, in the order of the request.
+
+    **Example request**:
+
+    .. sourcecode:: json
+
+       {"recording_ids": ["mbid1", "mbid1:1", "MBID2:3"]}
+
+    **Example response**:
+
+    .. sourcecode:: json
+
+       {"data": {document}, "mbid": "mbid1", "offset": 0}
+       {"data": {document}, "mbid": "mbid1", "offset": 1}
+       {"data": {document}, "mbid": "mbid2", "offset": 3}
+
+    MBIDs are always returned in a normalised form. Recordings which are not present in
+    the database are skipped.
+
+    You can specify up to :py:const:`~webserver.views.api.v1.core.MAX_ITEMS_PER_POST_BULK_REQUEST`
+    recordings in a request, in the format of the ``recording_ids`` parameter of ``GET /low-level``.
+
+    :query features: *Optional.* A list of features to be returned for each recording, as for ``GET /low-level``.
+
+    :reqheader Content-Type: *application/json*
+
+    :resheader Content-Type: *application/x-ndjson*
+    """
+    recordings = [(mbid, offset) for _, mbid, offset in _get_recording_ids_from_body()]
+    parsed_features = _parse_individual_features()
+
+    def lookup(chunk):
+        if parsed_features:
+            features = db.data.load_many_individual_features(chunk, parsed_features)
+            recording_details = {mbid: {offset: db.document_cache.dumps(document)
+                                        for offset, document in documents.items()}
+                                 for mbid, documents in features.items()}
+        else:
+            recording_details = db.data.load_many_low_level_json(chunk)
+        return _recording_document_lines(chunk, recording_details)
+
+    return _ndjson_lookup_response(recordings, lookup)
+
+
 @bp_core.route("/high-level", methods=["GET"])
 @crossdomain()
 @ratelimit()
@@ -402,6 +623,88 @@ def get_many_highlevel():
     return jsonify(recording_details)
 
 
+@bp_core.route("/high-level", methods=["POST"])
+@crossdomain()
+@ratelimit()
+def lookup_many_highlevel():
+    """Get high-level data for many recordings at once, listing the recordings in the request body.
+
+    This is the same as ``GET /high-level``, but allows many more recordings in a request.
+    The request and response are in the format described for ``POST /low-level``.
+
+    You can specify up to :py:const:`~webserver.views.api.v1.core.MAX_ITEMS_PER_POST_BULK_REQUEST`
+    recordings in a request.
+
+    :query map_classes: *Optional.* If set to 'true', map class names to human-readable values
+
+    :reqheader Content-Type: *application/json*
+
+    :resheader Content-Type: *application/x-ndjson*
+    """
+    map_classes = _validate_map_classes(request.args.get("map_classes"))
+    recordings = [(mbid, offset) for _, mbid, offset in _get_recording_ids_from_body()]
+
+    def lookup(chunk):
+        highlevel = db.data.load_many_high_level(chunk, map_classes)
+        recording_details = {mbid: {offset: db.document_cache.dumps(document)
+                                    for offset, document in documents.items()}
+                             for mbid, documents in highlevel.items()}
+        return _recording_document_lines(chunk, recording_details)
+
+    return _ndjson_lookup_response(recordings, lookup)
+
+
+def _can_splice_json():
+    """Check if documents serialized with :func:`db.document_cache.dumps` are
+    identical to the output of jsonify with the current configuration."""
+    return (not current_app.debug
+            and not current_app.config["JSONIFY_PRETTYPRINT_REGULAR"]
+            and current_app.config["JSON_SORT_KEYS"]
+            and current_app.config["JSON_AS_ASCII"])
+
+
+def _json_document_response(document):
+    """Make a response containing a document serialized with :func:`db.document_cache.dumps`.
+    The response is the same as ``jsonify`` of the decoded document."""
+    if not _can_splice_json():
+        return jsonify(json.loads(document))
+    return current_app.response_class(document + "\n", mimetype=current_app.config["JSONIFY_MIMETYPE"])
+
+
+def _bulk_json_documents_response(recording_details, mbid_mapping):
+    """Make a response for a bulk request from documents serialized with :func:`db.document_cache.dumps`.
+    The response is the same as ``jsonify`` of the decoded documents with an ``mbid_mapping`` item,
+    and is streamed to the client so that the whole response is never held in memory as one string.
+
+    Arguments:
+        recording_details: a dictionary {mbid: {offset: JSON document}}
+        mbid_mapping: a dictionary {requested mbid: normalised mbid}
+    """
+    if not _can_splice_json():
+        recording_details = {mbid: {offset: json.loads(document) for offset, document in documents.items()}
+                             for mbid, documents in recording_details.items()}
+        recording_details['mbid_mapping'] = mbid_mapping
+        return jsonify(recording_details)
+
+    def generate():
+        # Items are in the order that jsonify sorts them in
+        keys = sorted(list(recording_details.keys()) + ['mbid_mapping'])
+        yield "{"
+        for i, key in enumerate(keys):
+            separator = "," if i else ""
+            if key == 'mbid_mapping':
+                yield separator + '"mbid_mapping":' + db.document_cache.dumps(mbid_mapping)
+                continue
+            documents = recording_details[key]
+            yield separator + db.document_cache.dumps(key) + ":{"
+            for j, offset in enumerate(sorted(documents.keys())):
+                yield ("," if j else "") + db.document_cache.dumps(offset) + ":" + documents[offset]
+            yield "}"
+        yield "}\n"
+
+    return current_app.response_class(generate(), mimetype=current_app.config["JSONIFY_MIMETYPE"])
+
+
 def _parse_individual_features():
     """Check whether the features are found or not.
     Parse the query string of features to create a list of
@@ -415,8 +718,8 @@ def _parse_individual_features():
         parsed_features, a list of tuples of the form:
             (<feature_path>, <alias>, <default_type>)
 
-            <feature_path> is a string holding the path to a feature:
-            "llj.data->feature_name"
+            <feature_path> is a string holding the column of a feature:
+            "llf.lowlevel_feature_name"
 
             <alias> is a string alias for a feature:
             "lowlevel.feature_name"
@@ -437,9 +740,9 @@ def _parse_individual_features():
             parsed_features.append((feature_path, alias, default_type))
 
     # Always include metadata.version and metadata.audio_properties
-    metadata_version = "llj.data->'metadata'->'version'"
+    metadata_version = "llf.metadata_version"
     metadata_version_alias = "metadata.version"
-    metadata_audio_properties = "llj.data->'metadata'->'audio_properties'"
+    metadata_audio_properties = "llf.metadata_audio_properties"
     metadata_audio_properties_alias = "metadata.audio_properties"
 
     parsed_features.append((metadata_version, metadata_version_alias, {}))
@@ -489,3 +792,39 @@ def get_many_count():
         recording_counts['mbid_mapping'] = mbid_mapping
 
     return jsonify(recording_counts)
+
+
+@bp_core.route("/count", methods=["POST"])
+@crossdomain()
+@ratelimit()
+def lookup_many_count():
+    """Get low-level count for many recordings at once, listing the recordings in the request body.
+
+    This is the same as ``GET /count``, but allows many more MBIDs in a request.
+    The request is in the format described for ``POST /low-level``. Offsets are ignored.
+    The response is streamed as newline-delimited JSON, with one line for each MBID
+    that has submissions, in the order of the request.
+
+    **Example response**:
+
+    .. sourcecode:: json
+
+       {"count": 3, "mbid": "mbid1"}
+       {"count": 1, "mbid": "mbid2"}
+
+    You can specify up to :py:const:`~webserver.views.api.v1.core.MAX_ITEMS_PER_POST_BULK_REQUEST`
+    MBIDs in a request.
+
+    :reqheader Content-Type: *application/json*
+
+    :resheader Content-Type: *application/x-ndjson*
+    """
+    mbids = remove_duplicates([mbid for _, mbid, _ in _get_recording_ids_from_body()])
+
+    def lookup(chunk):
+        counts = db.data.count_many_lowlevel(chunk)
+        for mbid in chunk:
+            if mbid in counts:
+                yield db.document_cache.dumps({"count": counts[mbid]["count"], "mbid": mbid})
+
+    return _ndjson_lookup_response(mbids, lookup)
@@ -4,15 +4,22 @@ from operator import itemgetter
 from brainzutils.ratelimit import ratelimit
 from flask import Blueprint, jsonify, request
 
+import db.document_cache
 import webserver.views.api.exceptions
 from webserver.decorators import crossdomain
-from webserver.views.api.v1.core import _parse_bulk_params, _get_recording_ids_from_request
-from similarity.index_model import BASE_INDICES, AnnoyModel
+from webserver.views.api.v1.core import _parse_bulk_params, _get_recording_ids_from_request, \
+    _get_recording_ids_from_body, _ndjson_lookup_response
+from similarity.index_model import BASE_INDICES, get_index
+from similarity.hybrid import get_hybrid_nns, parse_weights
 from similarity.exceptions import IndexNotFoundException, ItemNotFoundException
 from db.exceptions import NoDataFoundException
 
 bp_similarity = Blueprint('api_v1_similarity', __name__)
 
+# Limits of the parameters which make queries more accurate, but slower
+MAX_SEARCH_K = 200000
+MAX_OVERSAMPLE = 10
+
 class RemoveDupsType:
     """'Enum' to determine which kind of deduplication to do when returning similar recordings"""
     # only remove a dup if the mbid is the same and the distance is the same
@@ -81,6 +88,11 @@ def  _check_index_params(metric):
     if not n_trees or n_trees not in BASE_INDICES[metric][distance_type]:
         n_trees = 10
 
+    n_neighbours, threshold, remove_dups = _check_query_params()
+    return metric, distance_type, n_trees, n_neighbours, threshold, remove_dups
+
+
+def _check_query_params():
     n_neighbours = request.args.get("n_neighbours")
     try:
         n_neighbours = int(n_neighbours)
@@ -108,7 +120,44 @@ def  _check_index_params(metric):
     else:
         remove_dups = RemoveDupsType.none
 
-    return metric, distance_type, n_trees, n_neighbours, threshold, remove_dups
+    return n_neighbours, threshold, remove_dups
+
+
+def _check_search_params():
+    search_k = request.args.get("search_k")
+    try:
+        search_k = int(search_k)
+        if search_k < 1:
+            search_k = -1
+        elif search_k > MAX_SEARCH_K:
+            search_k = MAX_SEARCH_K
+    except (ValueError, TypeError):
+        search_k = -1
+
+    oversample = request.args.get("oversample")
+    try:
+        oversample = int(oversample)
+        if oversample < 1:
+            oversample = 1
+        elif oversample > MAX_OVERSAMPLE:
+            oversample = MAX_OVERSAMPLE
+    except (ValueError, TypeError):
+        oversample = 1
+
+    return search_k, oversample
+
+
+def _check_hybrid_params():
+    metrics = request.args.get("metrics")
+    if not metrics:
+        raise webserver.views.api.exceptions.APIBadRequest("Missing `metrics` parameter")
+    try:
+        weights = parse_weights(metrics.split(";"))
+    except ValueError as e:
+        raise webserver.views.api.exceptions.APIBadRequest(str(e))
+
+    n_neighbours, threshold, remove_dups = _check_query_params()
+    return weights, n_neighbours, threshold, remove_dups
 
 
 @bp_similarity.route("/<metric>/", methods=["GET"])
@@ -165,17 +214,75 @@ def get_many_similar_recordings(metric):
         only the submission with the lowest score. This may result in the number of returned items being
         less than n_neighbours if it is set.
 
+    :query search_k: *Optional.* The number of nodes of the index which are inspected by
+        the search (1-200000). Larger values give more accurate results, but take longer.
+        By default, 10 times the number of candidates are inspected.
+
+    :query oversample: *Optional.* Find this many times n_neighbours candidates in the index,
+        and return the n_neighbours of them which are nearest (1-10). The distances of the candidates
+        are the same as without oversampling, but more of the index is searched. Larger values
+        give more accurate results, but take longer. Default is 1, which doesn't oversample.
+
     :resheader Content-Type: *application/json*
     """
     recordings = _get_recording_ids_from_request()
     recordings = [(mbid, offset) for _, mbid, offset in recordings]
     metric, distance_type, n_trees, n_neighbours, threshold, remove_dups = _check_index_params(metric)
+    search_k, oversample = _check_search_params()
+    try:
+        index = get_index(metric, n_trees=n_trees, distance_type=distance_type)
+    except IndexNotFoundException:
+        raise webserver.views.api.exceptions.APIBadRequest("Index does not exist with specified parameters.")
+
+    similar_recordings = index.get_bulk_nns_by_mbid(recordings, n_neighbours, search_k=search_k, oversample=oversample)
+    result = collections.defaultdict(dict)
+    for mbid, submissions in similar_recordings.items():
+        for offset, items in submissions.items():
+            items = _limit_recordings_by_threshold(items, threshold)
+            items = _sort_and_remove_duplicate_submissions(items, remove_dups)
+            result[mbid][offset] = items
+    return jsonify(result)
+
+
+@bp_similarity.route("/hybrid/", methods=["GET"])
+@crossdomain()
+@ratelimit()
+def get_many_hybrid_similar_recordings():
+    """Get the most similar submissions to multiple (MBID, offset) combinations,
+    combining several metrics.
+
+    Similar recordings are ranked by the weighted sum of their distances from the
+    recording in each metric, with weights normalized to sum to 1. The response is in
+    the same format as ``GET /similarity/<metric>/``.
+
+    :query recording_ids: *Required.* A list of recording MBIDs to retrieve
+        Takes the form `mbid[:offset];mbid[:offset]`. Offsets are optional, and should
+        be >= 0
+
+    :query metrics: *Required.* The metrics to combine, and their weights.
+        Takes the form `metric[:weight];metric[:weight]`, e.g. `mfccs:0.5;bpm:0.3;moods:0.2`.
+        Weights are optional, and should be >= 0. The default weight is 1.
+        The metrics available are shown here :py:const:`~similarity.metrics.BASE_METRIC_NAMES`.
+
+    :query n_neighbours: *Optional.* The number of similar recordings that
+        should be returned for each item in ``recording_ids`` (1-1000).
+        Default is 200 recordings.
+
+    :query threshold: *Optional.* Only return items whose combined distance from the query
+        recording is less than this (0-1).
+
+    :query remove_dups: *Optional.* As for ``GET /similarity/<metric>/``.
+
+    :resheader Content-Type: *application/json*
+    """
+    recordings = _get_recording_ids_from_request()
+    recordings = [(mbid, offset) for _, mbid, offset in recordings]
+    weights, n_neighbours, threshold, remove_dups = _check_hybrid_params()
     try:
-        index = AnnoyModel(metric, n_trees=n_trees, distance_type=distance_type, load_existing=True)
+        similar_recordings = get_hybrid_nns(recordings, weights, n_neighbours)
     except IndexNotFoundException:
         raise webserver.views.api.exceptions.APIBadRequest("Index does not exist with specified parameters.")
 
-    similar_recordings = index.get_bulk_nns_by_mbid(recordings, n_neighbours)
     result = collections.defaultdict(dict)
     for mbid, submissions in similar_recordings.items():
         for offset, items in submissions.items():
@@ -185,6 +292,54 @@ def get_many_similar_recordings(metric):
     return jsonify(result)
 
 
+@bp_similarity.route("/<metric>/", methods=["POST"])
+@crossdomain()
+@ratelimit()
+def lookup_many_similar_recordings(metric):
+    """Get the most similar submissions to many (MBID, offset) combinations at once,
+    listing the recordings in the request body.
+
+    This is the same as ``GET /similarity/<metric>/``, but allows many more recordings in a request.
+    The request is in the format described for ``POST /low-level``, and the other parameters
+    are the same as for ``GET /similarity/<metric>/``.
+    The response is streamed as newline-delimited JSON, with one line for each recording
+    that is in the index, in the order of the request.
+
+    **Example response**:
+
+    .. sourcecode:: json
+
+        {"data": [{"distance": d, "offset": offset, "recording_mbid": most_similar_mbid}, ...], "mbid": "mbid1", "offset": 0}
+        {"data": [{"distance": d, "offset": offset, "recording_mbid": most_similar_mbid}, ...], "mbid": "mbid2", "offset": 1}
+
+    You can specify up to :py:const:`~webserver.views.api.v1.core.MAX_ITEMS_PER_POST_BULK_REQUEST`
+    recordings in a request.
+
+    :reqheader Content-Type: *application/json*
+
+    :resheader Content-Type: *application/x-ndjson*
+    """
+    metric, distance_type, n_trees, n_neighbours, threshold, remove_dups = _check_index_params(metric)
+    search_k, oversample = _check_search_params()
+    recordings = [(mbid, offset) for _, mbid, offset in _get_recording_ids_from_body()]
+    try:
+        index = get_index(metric, n_trees=n_trees, distance_type=distance_type)
+    except IndexNotFoundException:
+        raise webserver.views.api.exceptions.APIBadRequest("Index does not exist with specified parameters.")
+
+    def lookup(chunk):
+        similar_recordings = index.get_bulk_nns_by_mbid(chunk, n_neighbours, search_k=search_k, oversample=oversample)
+        for mbid, offset in chunk:
+            items = similar_recordings.get(mbid, {}).get(str(offset))
+            if items is None:
+                continue
+            items = _limit_recordings_by_threshold(items, threshold)
+            items = _sort_and_remove_duplicate_submissions(items, remove_dups)
+            yield db.document_cache.dumps({"data": items, "mbid": mbid, "offset": offset})
+
+    return _ndjson_lookup_response(recordings, lookup)
+
+
 def check_bad_request_between_recordings():
     """
     Check if a request for similarity between recordings is valid. The ?recording_ids parameter
@@ -244,7 +399,7 @@ def get_similarity_between(metric):
     recordings = check_bad_request_between_recordings()
     metric, distance_type, n_trees, n_neighbours, threshold, remove_dups = _check_index_params(metric)
     try:
-        index = AnnoyModel(metric, n_trees=n_trees, distance_type=distance_type, load_existing=True)
+        index = get_index(metric, n_trees=n_trees, distance_type=distance_type)
     except IndexNotFoundException:
         raise webserver.views.api.exceptions.APIBadRequest("Index does not exist with specified parameters.")
 
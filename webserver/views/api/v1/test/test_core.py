@@ -6,6 +6,10 @@ import uuid
 
 from unittest import mock
 
+import flask
+
+import db.data
+import db.document_cache
 import db.exceptions
 import webserver.views.api.exceptions
 from webserver.testing import AcousticbrainzTestCase
@@ -46,6 +50,22 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         resp = self.client.get("/api/v1/%s/low-level" % mbid.upper())
         self.assertEqual(resp.status_code, 200)
 
+    @mock.patch("db.data.load_low_level_json")
+    def test_get_low_level_same_as_jsonify(self, ll):
+        """Documents serialized by the document cache are returned as jsonify would return them"""
+        document = dict(self.test_recording1_data, extra={"unicode": "\u00fc/\u2603", "floats": [1e-05, 0.1]})
+        ll.return_value = db.document_cache.dumps(document)
+        resp = self.client.get("/api/v1/%s/low-level" % self.uuid)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(flask.jsonify(document).get_data(), resp.get_data())
+
+        with mock.patch("db.data.load_many_low_level_json") as many:
+            many.return_value = {self.uuid: {"0": ll.return_value, "10": "{}"}}
+            resp = self.client.get("/api/v1/low-level?recording_ids=%s;%s:10" % (self.uuid, self.uuid.upper()))
+        expected = {self.uuid: {"0": document, "10": {}},
+                    "mbid_mapping": {self.uuid.upper(): self.uuid}}
+        self.assertEqual(flask.jsonify(expected).get_data(), resp.get_data())
+
     def test_submit_low_level(self):
         mbid = "0dad432b-16cc-4bf0-8961-fd31d124b01b"
 
@@ -59,6 +79,39 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         resp = self.client.get("/api/v1/%s/low-level" % mbid)
         self.assertEqual(resp.status_code, 200)
 
+    def test_submit_many_low_level(self):
+        submissions = [{"mbid": self.test_recording1_mbid, "data": self.test_recording1_data},
+                       {"mbid": self.test_recording1_mbid, "data": self.test_recording1_data},
+                       {"mbid": self.test_recording2_mbid.upper(), "data": self.test_recording2_data},
+                       {"mbid": self.test_recording2_mbid, "data": {"metadata": {}}}]
+        resp = self.client.post("/api/v1/low-level/bulk", data=json.dumps(submissions),
+                                content_type="application/json")
+        self.assertEqual(resp.status_code, 200)
+        results = resp.json["results"]
+        self.assertEqual([r["status"] for r in results], ["saved", "duplicate", "rejected", "rejected"])
+        self.assertEqual(results[2]["message"], "'%s' is not a valid UUID" % self.test_recording2_mbid.upper())
+        self.assertNotIn("message", results[0])
+
+        resp = self.client.get("/api/v1/%s/low-level" % self.test_recording1_mbid)
+        self.assertEqual(resp.status_code, 200)
+        resp = self.client.get("/api/v1/%s/low-level" % self.test_recording2_mbid)
+        self.assertEqual(resp.status_code, 404)
+
+    def test_submit_many_low_level_bad_request(self):
+        resp = self.client.post("/api/v1/low-level/bulk", data="{not json", content_type="application/json")
+        self.assertEqual(resp.status_code, 400)
+
+        resp = self.client.post("/api/v1/low-level/bulk", data=json.dumps({"mbid": self.test_recording1_mbid}),
+                                content_type="application/json")
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json["message"], "Request body must be a list of submissions")
+
+        submissions = [{"mbid": self.test_recording1_mbid, "data": {}}] * (core.MAX_ITEMS_PER_BULK_SUBMISSION + 1)
+        resp = self.client.post("/api/v1/low-level/bulk", data=json.dumps(submissions),
+                                content_type="application/json")
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json["message"], "More than 100 submissions not allowed per request")
+
     def test_cors_headers(self):
         mbid = "0dad432b-16cc-4bf0-8961-fd31d124b01b"
         self.load_low_level_data(mbid)
@@ -69,7 +122,7 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
 
         # TODO: Test in get_high_level.
 
-    @mock.patch("db.data.load_low_level")
+    @mock.patch("db.data.load_low_level_json")
     def test_ll_bad_uuid_404(self, load_low_level):
         """ URL Endpoint returns 404 because url-part doesn't match UUID.
             This error is raised by Flask, but we special-case to json.
@@ -81,7 +134,7 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         expected_result = {"message": "The requested URL was not found on the server. If you entered the URL manually please check your spelling and try again."}
         self.assertEqual(resp.json, expected_result)
 
-    @mock.patch("db.data.load_low_level")
+    @mock.patch("db.data.load_low_level_json")
     def test_ll_internal_server_error(self, load_low_level):
 
         # Flask will propagate exceptions instead of calling an error handler
@@ -99,29 +152,29 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         self.assertDictEqual(resp.json, expected_result)
         self.app.config['PROPAGATE_EXCEPTIONS'] = old_propagate_exceptions
 
-    @mock.patch("db.data.load_low_level")
+    @mock.patch("db.data.load_low_level_json")
     def test_ll_no_offset(self, ll):
-        ll.return_value = {}
+        ll.return_value = "{}"
         resp = self.client.get("/api/v1/%s/low-level" % self.uuid)
         self.assertEqual(200, resp.status_code)
         ll.assert_called_with(self.uuid, 0)
 
-    @mock.patch("db.data.load_low_level")
+    @mock.patch("db.data.load_low_level_json")
     def test_ll_numerical_offset(self, ll):
-        ll.return_value = {}
+        ll.return_value = "{}"
         resp = self.client.get("/api/v1/%s/low-level?n=3" % self.uuid)
         self.assertEqual(200, resp.status_code)
         ll.assert_called_with(self.uuid, 3)
 
-    @mock.patch("db.data.load_low_level")
+    @mock.patch("db.data.load_low_level_json")
     def test_ll_bad_offset(self, ll):
         # non-numerical offset is replaced by 0
-        ll.return_value = {}
+        ll.return_value = "{}"
         resp = self.client.get("/api/v1/%s/low-level?n=x" % self.uuid)
         self.assertEqual(200, resp.status_code)
         ll.assert_called_with(self.uuid, 0)
 
-    @mock.patch("db.data.load_low_level")
+    @mock.patch("db.data.load_low_level_json")
     def test_ll_no_item(self, ll):
         ll.side_effect = db.exceptions.NoDataFoundException
         resp = self.client.get("/api/v1/%s/low-level" % self.uuid)
@@ -147,7 +200,7 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         self.assertEqual(200, resp.status_code)
         hl.assert_called_with(self.uuid, 3, False)
 
-    @mock.patch('db.data.load_many_low_level')
+    @mock.patch('db.data.load_many_low_level_json')
     def test_get_bulk_ll_no_param(self, load_many_low_level):
         # No parameter in bulk lookup results in an error
         resp = self.client.get('api/v1/low-level')
@@ -156,7 +209,7 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         expected_result = {"message": "Missing `recording_ids` parameter"}
         self.assertEqual(resp.json, expected_result)
 
-    @mock.patch('db.data.load_many_low_level')
+    @mock.patch('db.data.load_many_low_level_json')
     def test_get_bulk_ll(self, load_many_low_level):
         # Check that many items are returned, including two offsets of the
         # same MBID
@@ -169,9 +222,9 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         rec_40_3 = {"recording": "405a5ff4-7ee2-436b-95c1-90ce8a83b359:3"}
 
         load_many_low_level.return_value = {
-            "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9": {"0": rec_c5},
-            "7f27d7a9-27f0-4663-9d20-2c9c40200e6d": {"3": rec_7f},
-            "405a5ff4-7ee2-436b-95c1-90ce8a83b359": {"2": rec_40_2, "3": rec_40_3}
+            "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9": {"0": json.dumps(rec_c5)},
+            "7f27d7a9-27f0-4663-9d20-2c9c40200e6d": {"3": json.dumps(rec_7f)},
+            "405a5ff4-7ee2-436b-95c1-90ce8a83b359": {"2": json.dumps(rec_40_2), "3": json.dumps(rec_40_3)}
         }
 
         resp = self.client.get('api/v1/low-level?recording_ids=' + params)
@@ -194,9 +247,12 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         # upper-case
         params = "c5f4909e-1d7b-4f15-a6f6-1AF376BC01C9"
         expected_result = {
-            "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9": {"0": rec_c5}
+            "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9": {"0": rec_c5},
+            "mbid_mapping": {"C5F4909E-1D7B-4F15-A6F6-1AF376BC01C9": "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9"}
+        }
+        load_many_low_level.return_value = {
+            "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9": {"0": json.dumps(rec_c5)}
         }
-        load_many_low_level.return_value = expected_result
         resp = self.client.get('api/v1/low-level?recording_ids=' + params.upper())
         self.assertEqual(resp.status_code, 200)
 
@@ -206,7 +262,7 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         recordings = [("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0)]
         load_many_low_level.assert_called_with(recordings)
 
-    @mock.patch('db.data.load_many_low_level')
+    @mock.patch('db.data.load_many_low_level_json')
     def test_get_bulk_ll_absent_mbid(self, load_many_low_level):
         # Check that within a set of mbid parameters, the ones absent
         # from the database are ignored.
@@ -217,8 +273,8 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         rec_40_2 = {"recording": "405a5ff4-7ee2-436b-95c1-90ce8a83b359:2"}
 
         load_many_low_level.return_value = {
-            "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9": {"0": rec_c5},
-            "405a5ff4-7ee2-436b-95c1-90ce8a83b359": {"2": rec_40_2}
+            "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9": {"0": json.dumps(rec_c5)},
+            "405a5ff4-7ee2-436b-95c1-90ce8a83b359": {"2": json.dumps(rec_40_2)}
         }
 
         resp = self.client.get('api/v1/low-level?recording_ids=' + params)
@@ -424,10 +480,10 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         recordings = [("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0),
                       ("405a5ff4-7ee2-436b-95c1-90ce8a83b359", 2),
                       ("405a5ff4-7ee2-436b-95c1-90ce8a83b359", 3)]
-        features = [("llj.data->'lowlevel'->'average_loudness'", "lowlevel.average_loudness", None),
-                    ("llj.data->'rhythm'->'onset_rate'", "rhythm.onset_rate", None),
-                    ("llj.data->'metadata'->'version'", "metadata.version", {}),
-                    ("llj.data->'metadata'->'audio_properties'", "metadata.audio_properties", {})]
+        features = [("llf.lowlevel_average_loudness", "lowlevel.average_loudness", None),
+                    ("llf.rhythm_onset_rate", "rhythm.onset_rate", None),
+                    ("llf.metadata_version", "metadata.version", {}),
+                    ("llf.metadata_audio_properties", "metadata.audio_properties", {})]
         load_many_individual_features.assert_called_with(recordings, features)
 
         # upper-case MBID
@@ -444,9 +500,9 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         # to load_many_high_level is always lower-case regardless of what we pass in
         self.assertEqual(resp.json, expected_result)
         recordings = [("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0)]
-        features = [("llj.data->'lowlevel'->'average_loudness'", "lowlevel.average_loudness", None),
-                    ("llj.data->'metadata'->'version'", "metadata.version", {}),
-                    ("llj.data->'metadata'->'audio_properties'", "metadata.audio_properties", {})]
+        features = [("llf.lowlevel_average_loudness", "lowlevel.average_loudness", None),
+                    ("llf.metadata_version", "metadata.version", {}),
+                    ("llf.metadata_audio_properties", "metadata.audio_properties", {})]
         load_many_individual_features.assert_called_with(recordings, features)
 
     @mock.patch('db.data.load_many_individual_features')
@@ -473,11 +529,17 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         recordings = [("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0),
                       ("7f27d7a9-27f0-4663-9d20-2c9c40200e6d", 3),
                       ("405a5ff4-7ee2-436b-95c1-90ce8a83b359", 2)]
-        features = [("llj.data->'rhythm'->'onset_rate'", "rhythm.onset_rate", None),
-                    ("llj.data->'metadata'->'version'", "metadata.version", {}),
-                    ("llj.data->'metadata'->'audio_properties'", "metadata.audio_properties", {})]
+        features = [("llf.rhythm_onset_rate", "rhythm.onset_rate", None),
+                    ("llf.metadata_version", "metadata.version", {}),
+                    ("llf.metadata_audio_properties", "metadata.audio_properties", {})]
         load_many_individual_features.assert_called_with(recordings, features)
 
+    def test_available_features_columns(self):
+        """Every feature that can be selected is in the lowlevel_features table"""
+        for alias, (feature_path, _) in core.AVAILABLE_FEATURES.items():
+            self.assertIn(alias, db.data.LOWLEVEL_FEATURES)
+            self.assertEqual(feature_path, "llf." + db.data.lowlevel_feature_column(alias))
+
     def test_get_bulk_individual_features_more_than_25(self):
         # Create many random uuids, because of parameter deduplication
         manyids = [str(uuid.uuid4()) for i in range(26)]
@@ -554,6 +616,67 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         self.assertEqual('More than 25 recordings not allowed per request',
                          resp.json['message'])
 
+    def test_lookup_bulk_count(self):
+        mbids = self.submit_fake_data()
+        body = {"recording_ids": [mbid.upper() for mbid in mbids]}
+        resp = self.client.post('api/v1/count', data=json.dumps(body), content_type="application/json")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual([{"count": 1, "mbid": "7f27d7a9-27f0-4663-9d20-2c9c40200e6d"},
+                          {"count": 2, "mbid": "405a5ff4-7ee2-436b-95c1-90ce8a83b359"}], lines)
+
+    @mock.patch('webserver.views.api.v1.core.BULK_LOOKUP_CHUNK_SIZE', 2)
+    @mock.patch('db.data.load_many_low_level_json')
+    def test_lookup_bulk_ll(self, load_many_low_level):
+        recordings = [(str(uuid.uuid4()), offset) for offset in range(5)]
+        load_many_low_level.side_effect = lambda chunk: {
+            mbid: {str(offset): json.dumps({"offset": offset})} for mbid, offset in chunk if offset != 3}
+
+        body = {"recording_ids": ["%s:%s" % recording for recording in recordings]}
+        resp = self.client.post('api/v1/low-level', data=json.dumps(body), content_type="application/json")
+        self.assertEqual(resp.status_code, 200)
+        lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        # Recordings which aren't found are skipped, and lines are in the order of the request
+        self.assertEqual([{"data": {"offset": offset}, "mbid": mbid, "offset": offset}
+                          for mbid, offset in recordings if offset != 3], lines)
+        # Recordings are looked up in chunks
+        self.assertEqual([mock.call(recordings[0:2]), mock.call(recordings[2:4]), mock.call(recordings[4:])],
+                         load_many_low_level.call_args_list)
+
+    @mock.patch('db.data.load_many_high_level')
+    def test_lookup_bulk_hl(self, load_many_high_level):
+        mbid = "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9"
+        load_many_high_level.return_value = {mbid: {"2": {"highlevel": {}}}}
+        body = {"recording_ids": [mbid + ":2"]}
+        resp = self.client.post('api/v1/high-level?map_classes=true', data=json.dumps(body),
+                                content_type="application/json")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual('{"data":{"highlevel":{}},"mbid":"%s","offset":2}\n' % mbid, resp.get_data(as_text=True))
+        load_many_high_level.assert_called_with([(mbid, 2)], True)
+
+    def test_lookup_bulk_bad_body(self):
+        for body in ["{not json", "[]", '{"recording_ids": []}', '{"recording_ids": "x"}']:
+            resp = self.client.post('api/v1/low-level', data=body, content_type="application/json")
+            self.assertEqual(resp.status_code, 400)
+
+        resp = self.client.post('api/v1/low-level', data=json.dumps({"recording_ids": [1]}),
+                                content_type="application/json")
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual("'1' is not a valid recording id", resp.json["message"])
+
+        resp = self.client.post('api/v1/low-level', data=json.dumps({"recording_ids": ["not-a-uuid"]}),
+                                content_type="application/json")
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual("'not-a-uuid' is not a valid UUID", resp.json["message"])
+
+    @mock.patch('webserver.views.api.v1.core.MAX_ITEMS_PER_POST_BULK_REQUEST', 3)
+    def test_lookup_bulk_too_many(self):
+        body = {"recording_ids": [str(uuid.uuid4()) for _ in range(4)]}
+        resp = self.client.post('api/v1/count', data=json.dumps(body), content_type="application/json")
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual('More than 3 recordings not allowed per request', resp.json['message'])
+
 
 class GetBulkValidationTest(unittest.TestCase):
     # Validation/parse methods don't need to spin up test server
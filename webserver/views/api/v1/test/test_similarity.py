@@ -26,21 +26,21 @@ class APISimilarityViewsTestCase(AcousticbrainzTestCase):
         self.test_recording2_data_json = open(os.path.join(DB_TEST_DATA_PATH, self.test_recording2_mbid + '.json')).read()
         self.test_recording2_data = json.loads(self.test_recording2_data_json)
 
-    @mock.patch("webserver.views.api.v1.similarity.AnnoyModel")
-    def test_get_similar_recordings_bad_uuid(self, annoy_model):
+    @mock.patch("webserver.views.api.v1.similarity.get_index")
+    def test_get_similar_recordings_bad_uuid(self, get_index):
         """ URL Endpoint returns 404 because url-part doesn't match UUID.
             This error is raised by Flask, but we special-case to json.
         """
         resp = self.client.get("/api/v1/similarity/mfccs/nothing")
         self.assertEqual(404, resp.status_code)
 
-        annoy_model.assert_not_called()
+        get_index.assert_not_called()
         expected_result = {"message": "The requested URL was not found on the server. "
                                       "If you entered the URL manually please check your spelling and try again."}
         self.assertEqual(resp.json, expected_result)
 
-    @mock.patch("webserver.views.api.v1.similarity.AnnoyModel")
-    def test_get_similar_recordings_invalid_params(self, annoy_model):
+    @mock.patch("webserver.views.api.v1.similarity.get_index")
+    def test_get_similar_recordings_invalid_params(self, get_index):
         # If index params are not in index_model.BASE_INDICES, they default.
         # If n_neighbours is larger than 1000, it defaults.
         annoy_mock = mock.Mock()
@@ -48,7 +48,7 @@ class APISimilarityViewsTestCase(AcousticbrainzTestCase):
             {"distance": 0.0001, "offset": 2, "recording_mbid": "f2cf852b-644c-4f2b-8c17-d059ead1f675"},
             {"distance": 0.0002, "offset": 0, "recording_mbid": "a48a4c29-082a-447b-97ea-c33d1e36b160"}
         ]}}
-        annoy_model.return_value = annoy_mock
+        get_index.return_value = annoy_mock
         resp = self.client.get("/api/v1/similarity/mfccs/?n_trees=-1&distance_type=7&n_neighbours=2000&recording_ids=%s:x" % self.uuid)
         self.assertEqual(200, resp.status_code)
 
@@ -57,23 +57,25 @@ class APISimilarityViewsTestCase(AcousticbrainzTestCase):
         n_trees = 10
         n_neighbours = 1000
         metric = "mfccs"
-        annoy_model.assert_called_with(metric, n_trees=n_trees, distance_type=distance_type, load_existing=True)
-        annoy_mock.get_bulk_nns_by_mbid.assert_called_with([(self.uuid, offset)], n_neighbours)
+        get_index.assert_called_with(metric, n_trees=n_trees, distance_type=distance_type)
+        annoy_mock.get_bulk_nns_by_mbid.assert_called_with([(self.uuid, offset)], n_neighbours,
+                                                           search_k=-1, oversample=1)
 
         # If n_neighbours is not numerical, it defaults
         resp = self.client.get("/api/v1/similarity/mfccs/?n_trees=-1&distance_type=7&n_neighbours=x&recording_ids=%s" % self.uuid)
         self.assertEqual(200, resp.status_code)
 
-        annoy_model.assert_called_with(metric, n_trees=n_trees, distance_type=distance_type, load_existing=True)
+        get_index.assert_called_with(metric, n_trees=n_trees, distance_type=distance_type)
         n_neighbours = 200
-        annoy_mock.get_bulk_nns_by_mbid.assert_called_with([(self.uuid, offset)], n_neighbours)
+        annoy_mock.get_bulk_nns_by_mbid.assert_called_with([(self.uuid, offset)], n_neighbours,
+                                                           search_k=-1, oversample=1)
 
-    @mock.patch("webserver.views.api.v1.similarity.AnnoyModel")
-    def test_get_similar_recordings_invalid_metric(self, annoy_model):
+    @mock.patch("webserver.views.api.v1.similarity.get_index")
+    def test_get_similar_recordings_invalid_metric(self, get_index):
         # If metric does not exist, APIBadRequest is raised.
         resp = self.client.get("/api/v1/similarity/nothing/?recording_ids=c5f4909e-1d7b-4f15-a6f6-1af376bc01c9")
         self.assertEqual(400, resp.status_code)
-        annoy_model.assert_not_called()
+        get_index.assert_not_called()
         expected_result = {"message": "An index with the specified metric does not exist."}
         self.assertEqual(expected_result, resp.json)
 
@@ -84,8 +86,8 @@ class APISimilarityViewsTestCase(AcousticbrainzTestCase):
         expected_result = {"message": "Missing `recording_ids` parameter"}
         self.assertEqual(resp.json, expected_result)
 
-    @mock.patch("webserver.views.api.v1.similarity.AnnoyModel")
-    def test_get_many_similar_recordings(self, annoy_model):
+    @mock.patch("webserver.views.api.v1.similarity.get_index")
+    def test_get_many_similar_recordings(self, get_index):
         # Check that similar recordings are returned for many recordings,
         # including two offsets of the same MBID.
         params = "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9;7f27d7a9-27f0-4663-9d20-2c9c40200e6d:3;" \
@@ -99,21 +101,21 @@ class APISimilarityViewsTestCase(AcousticbrainzTestCase):
         }
         annoy_mock = mock.Mock()
         annoy_mock.get_bulk_nns_by_mbid.return_value = expected_result
-        annoy_model.return_value = annoy_mock
+        get_index.return_value = annoy_mock
 
         resp = self.client.get('api/v1/similarity/mfccs/?recording_ids=' + params)
         self.assertEqual(200, resp.status_code)
         self.assertEqual(expected_result, resp.json)
 
         # Index parameters should default if not specified by query string.
-        annoy_model.assert_called_with("mfccs", n_trees=10, distance_type="angular", load_existing=True)
+        get_index.assert_called_with("mfccs", n_trees=10, distance_type="angular")
 
         recordings = [("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0),
                       ("7f27d7a9-27f0-4663-9d20-2c9c40200e6d", 3),
                       ("405a5ff4-7ee2-436b-95c1-90ce8a83b359", 2),
                       ("405a5ff4-7ee2-436b-95c1-90ce8a83b359", 3)]
 
-        annoy_mock.get_bulk_nns_by_mbid.assert_called_with(recordings, 200)
+        annoy_mock.get_bulk_nns_by_mbid.assert_called_with(recordings, 200, search_k=-1, oversample=1)
 
         # upper-case
         params = "c5f4909e-1d7b-4f15-a6f6-1AF376BC01C9"
@@ -129,10 +131,79 @@ class APISimilarityViewsTestCase(AcousticbrainzTestCase):
 
         # Recordings passed in should be lowercased when parsing.
         recordings = [("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0)]
-        annoy_mock.get_bulk_nns_by_mbid.assert_called_with(recordings, 200)
+        annoy_mock.get_bulk_nns_by_mbid.assert_called_with(recordings, 200, search_k=-1, oversample=1)
 
-    @mock.patch("webserver.views.api.v1.similarity.AnnoyModel")
-    def test_get_many_similar_recordings_missing_mbid(self, annoy_model):
+    @mock.patch("webserver.views.api.v1.similarity.get_index")
+    def test_get_many_similar_recordings_search_params(self, get_index):
+        annoy_mock = mock.Mock()
+        annoy_mock.get_bulk_nns_by_mbid.return_value = {}
+        get_index.return_value = annoy_mock
+        resp = self.client.get("/api/v1/similarity/mfccs/?recording_ids=%s&n_neighbours=10&search_k=2000&oversample=4"
+                               % self.uuid)
+        self.assertEqual(200, resp.status_code)
+        annoy_mock.get_bulk_nns_by_mbid.assert_called_with([(self.uuid, 0)], 10, search_k=2000, oversample=4)
+
+    @mock.patch("webserver.views.api.v1.similarity.get_hybrid_nns")
+    def test_get_many_hybrid_similar_recordings(self, get_hybrid_nns):
+        similars = [{'recording_mbid': "similar_rec2", 'offset': 0, 'distance': 0.3},
+                    {'recording_mbid': "similar_rec1", 'offset': 0, 'distance': 0.1}]
+        get_hybrid_nns.return_value = {self.uuid: {"0": similars}}
+
+        resp = self.client.get("/api/v1/similarity/hybrid/?recording_ids=%s&metrics=mfccs:3;bpm:1&threshold=0.2"
+                               % self.uuid)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual({self.uuid: {"0": [similars[1]]}}, resp.json)
+        # Weights are normalized
+        get_hybrid_nns.assert_called_with([(self.uuid, 0)], {"mfccs": 0.75, "bpm": 0.25}, 200)
+
+        get_hybrid_nns.side_effect = IndexNotFoundException
+        resp = self.client.get("/api/v1/similarity/hybrid/?recording_ids=%s&metrics=moods" % self.uuid)
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual({"message": "Index does not exist with specified parameters."}, resp.json)
+
+    @mock.patch("webserver.views.api.v1.similarity.get_hybrid_nns")
+    def test_get_many_hybrid_similar_recordings_invalid_metrics(self, get_hybrid_nns):
+        resp = self.client.get("/api/v1/similarity/hybrid/?recording_ids=%s" % self.uuid)
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual({"message": "Missing `metrics` parameter"}, resp.json)
+
+        resp = self.client.get("/api/v1/similarity/hybrid/?recording_ids=%s&metrics=mfccs:1;nothing:1" % self.uuid)
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual({"message": "An index with the metric nothing does not exist"}, resp.json)
+
+        resp = self.client.get("/api/v1/similarity/hybrid/?recording_ids=%s&metrics=mfccs:x" % self.uuid)
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual({"message": "Weight of metric mfccs is not a number"}, resp.json)
+        get_hybrid_nns.assert_not_called()
+
+    @mock.patch("webserver.views.api.v1.similarity.get_index")
+    def test_lookup_many_similar_recordings(self, get_index):
+        similars = [{'recording_mbid': "similar_rec2", 'offset': 0, 'distance': 0.2},
+                    {'recording_mbid': "similar_rec1", 'offset': 0, 'distance': 0.1}]
+        annoy_mock = mock.Mock()
+        annoy_mock.get_bulk_nns_by_mbid.return_value = {
+            "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9": {"0": similars},
+            "405a5ff4-7ee2-436b-95c1-90ce8a83b359": {"2": similars}
+        }
+        get_index.return_value = annoy_mock
+
+        body = {"recording_ids": ["405a5ff4-7ee2-436b-95c1-90ce8a83b359:2",
+                                  "7f27d7a9-27f0-4663-9d20-2c9c40200e6d:3",
+                                  "C5F4909E-1D7B-4F15-A6F6-1AF376BC01C9"]}
+        resp = self.client.post('api/v1/similarity/mfccs/?n_neighbours=2&threshold=0.15',
+                                data=json.dumps(body), content_type="application/json")
+        self.assertEqual(200, resp.status_code)
+        lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual([{"data": [similars[1]], "mbid": "405a5ff4-7ee2-436b-95c1-90ce8a83b359", "offset": 2},
+                          {"data": [similars[1]], "mbid": "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", "offset": 0}],
+                         lines)
+        annoy_mock.get_bulk_nns_by_mbid.assert_called_with([("405a5ff4-7ee2-436b-95c1-90ce8a83b359", 2),
+                                                            ("7f27d7a9-27f0-4663-9d20-2c9c40200e6d", 3),
+                                                            ("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0)], 2,
+                                                           search_k=-1, oversample=1)
+
+    @mock.patch("webserver.views.api.v1.similarity.get_index")
+    def test_get_many_similar_recordings_missing_mbid(self, get_index):
         # Check that within a set of mbid parameters, the ones absent
         # from the database are ignored.
         recordings = "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9;7f27d7a9-27f0-4663-9d20-2c9c40200e6d:3;" \
@@ -149,7 +220,7 @@ class APISimilarityViewsTestCase(AcousticbrainzTestCase):
         }
         annoy_mock = mock.Mock()
         annoy_mock.get_bulk_nns_by_mbid.return_value = expected_result
-        annoy_model.return_value = annoy_mock
+        get_index.return_value = annoy_mock
 
         query_string = {"recording_ids": recordings,
                         "n_trees": "-1",
@@ -160,12 +231,12 @@ class APISimilarityViewsTestCase(AcousticbrainzTestCase):
         self.assertEqual(expected_result, resp.json)
 
         # If index parameters are invalid, they are defaulted.
-        annoy_model.assert_called_with("mfccs", n_trees=10, distance_type="angular", load_existing=True)
+        get_index.assert_called_with("mfccs", n_trees=10, distance_type="angular")
 
         recordings = [("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0),
                       ("7f27d7a9-27f0-4663-9d20-2c9c40200e6d", 3),
                       ("405a5ff4-7ee2-436b-95c1-90ce8a83b359", 2)]
-        annoy_mock.get_bulk_nns_by_mbid.assert_called_with(recordings, 1000)
+        annoy_mock.get_bulk_nns_by_mbid.assert_called_with(recordings, 1000, search_k=-1, oversample=1)
 
     def test_get_many_similar_recordings_more_than_200(self):
         # Check that a request for over 200 recordings raises an error.
@@ -176,8 +247,8 @@ class APISimilarityViewsTestCase(AcousticbrainzTestCase):
         expected_result = {"message": "More than 25 recordings not allowed per request"}
         self.assertEqual(expected_result, resp.json)
 
-    @mock.patch("webserver.views.api.v1.similarity.AnnoyModel")
-    def test_get_similarity_between_no_params(self, annoy_model):
+    @mock.patch("webserver.views.api.v1.similarity.get_index")
+    def test_get_similarity_between_no_params(self, get_index):
         # If no index params are provided, they default.
         # Submissions can be selected using offset.
         recordings = "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9;7f27d7a9-27f0-4663-9d20-2c9c40200e6d:2"
@@ -186,22 +257,22 @@ class APISimilarityViewsTestCase(AcousticbrainzTestCase):
 
         annoy_mock = mock.Mock()
         annoy_mock.get_similarity_between.return_value = 1
-        annoy_model.return_value = annoy_mock
+        get_index.return_value = annoy_mock
 
         resp = self.client.get("/api/v1/similarity/mfccs/between/?recording_ids=" + recordings)
         self.assertEqual(200, resp.status_code)
         self.assertEqual({"mfccs": 1}, resp.json)
 
-        annoy_model.assert_called_with("mfccs", n_trees=10, distance_type="angular", load_existing=True)
+        get_index.assert_called_with("mfccs", n_trees=10, distance_type="angular")
         annoy_mock.get_similarity_between.assert_called_with(rec_1, rec_2)
 
-    @mock.patch("webserver.views.api.v1.similarity.AnnoyModel")
-    def test_get_similarity_between_exceptions(self, annoy_model):
+    @mock.patch("webserver.views.api.v1.similarity.get_index")
+    def test_get_similarity_between_exceptions(self, get_index):
         # If there is no submission for an (MBID, offset) combination,
         # empty dictionary is returned.
         annoy_mock = mock.Mock()
         annoy_mock.get_similarity_between.side_effect = NoDataFoundException
-        annoy_model.return_value = annoy_mock
+        get_index.return_value = annoy_mock
 
         recordings = "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9;7f27d7a9-27f0-4663-9d20-2c9c40200e6d:2"
         resp = self.client.get("/api/v1/similarity/mfccs/between/?recording_ids=" + recordings)
@@ -217,7 +288,7 @@ class APISimilarityViewsTestCase(AcousticbrainzTestCase):
         self.assertEqual(expected_result, resp.json)
 
         # If index is unable to load, APIBadRequest is raised.
-        annoy_model.side_effect = IndexNotFoundException
+        get_index.side_effect = IndexNotFoundException
         resp = self.client.get("/api/v1/similarity/mfccs/between/?recording_ids=" + recordings)
         self.assertEqual(400, resp.status_code)
 
@@ -357,6 +428,18 @@ class SimilarityValidationTest(AcousticbrainzTestCase):
             metric, distance_type, n_trees, n_neighbours, threshold, remove_dups = similarity._check_index_params('mfccs')
             self.assertIsNone(threshold)
 
+    def test_check_search_params(self):
+        with self.app.test_request_context(query_string={}):
+            self.assertEqual((-1, 1), similarity._check_search_params())
+        with self.app.test_request_context(query_string={'search_k': '5000', 'oversample': '3'}):
+            self.assertEqual((5000, 3), similarity._check_search_params())
+        with self.app.test_request_context(query_string={'search_k': '0', 'oversample': '-2'}):
+            self.assertEqual((-1, 1), similarity._check_search_params())
+        with self.app.test_request_context(query_string={'search_k': '100000000', 'oversample': '50'}):
+            self.assertEqual((similarity.MAX_SEARCH_K, similarity.MAX_OVERSAMPLE), similarity._check_search_params())
+        with self.app.test_request_context(query_string={'search_k': 'x', 'oversample': 'x'}):
+            self.assertEqual((-1, 1), similarity._check_search_params())
+
     def test_check_index_params_remove_dups(self):
         with self.app.test_request_context(query_string={'remove_dups': 'all'}):
             metric, distance_type, n_trees, n_neighbours, threshold, remove_dups = similarity._check_index_params('mfccs')
@@ -54,8 +54,8 @@ class SimilarityViewsTestCase(AcousticbrainzTestCase):
 
     @mock.patch("db.similarity.submit_eval_results")
     @mock.patch("webserver.views.similarity._get_extended_info")
-    @mock.patch("webserver.views.similarity.AnnoyModel")
-    def test_get_similar_service_index(self, annoy_model, _get_extended_info, submit_eval_results):
+    @mock.patch("webserver.views.similarity.get_index")
+    def test_get_similar_service_index(self, get_index, _get_extended_info, submit_eval_results):
         mbid = '0dad432b-16cc-4bf0-8961-fd31d124b01b'
         metric = 'mfccs'
         annoy_mock = mock.Mock()
@@ -63,7 +63,7 @@ class SimilarityViewsTestCase(AcousticbrainzTestCase):
             {"distance": 0.5, "offset": 0, "recording_mbid": "0dad432b-16cc-4bf0-8961-fd31d124b01b"},
             {"distance": 1.2, "offset": 1, "recording_mbid": "0dad432b-16cc-4bf0-8961-fd31d124b01b"}
         ]
-        annoy_model.return_value = annoy_mock
+        get_index.return_value = annoy_mock
 
         _get_extended_info.side_effect = [{"mock_info": "info1"}, {"mock_info": "info2"}]
         submit_eval_results.return_value = 1
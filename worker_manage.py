@@ -11,10 +11,25 @@ cli = FlaskGroup(add_default_commands=False, create_app=webserver.create_app)
 
 
 @cli.command('hl_extractor')
-@click.option('--threads', '-t', default=1, type=int)
-def command_hl_extractor(threads=1):
+@click.option('--threads', '-t', default=1, type=int, help="Number of extractor processes to run at once.")
+@click.option('--batch-size', '-b', default=hl_extractor.hl_calc.MAX_ITEMS_PER_PROCESS,
+              type=click.IntRange(1, hl_extractor.hl_calc.MAX_ITEMS_PER_PROCESS),
+              help="Number of documents given to each extractor process.")
+@click.option('--fetch-threads', default=hl_extractor.hl_calc.DEFAULT_FETCH_THREADS, type=click.IntRange(1, None),
+              help="Number of threads fetching documents from the database.")
+@click.option('--save-threads', default=hl_extractor.hl_calc.DEFAULT_SAVE_THREADS, type=click.IntRange(1, None),
+              help="Number of threads saving results to the database.")
+@click.option('--binary', default=hl_extractor.hl_calc.HIGH_LEVEL_EXTRACTOR_BINARY,
+              type=click.Path(dir_okay=False), help="Path to the highlevel extractor binary.")
+@click.option('--control-file', default=None, type=click.Path(dir_okay=False),
+              help="YAML file of settings (threads, batch_size, fetch_threads, save_threads) "
+                   "which are applied whenever it changes, without restarting.")
+def command_hl_extractor(threads=1, batch_size=hl_extractor.hl_calc.MAX_ITEMS_PER_PROCESS,
+                         fetch_threads=hl_extractor.hl_calc.DEFAULT_FETCH_THREADS,
+                         save_threads=hl_extractor.hl_calc.DEFAULT_SAVE_THREADS,
+                         binary=hl_extractor.hl_calc.HIGH_LEVEL_EXTRACTOR_BINARY, control_file=None):
     """Compute high-level features from low-level data files."""
-    hl_extractor.hl_calc.main(threads)
+    hl_extractor.hl_calc.main(threads, batch_size, fetch_threads, save_threads, binary, control_file)
 
 
 @cli.command('dataset_evaluator')